@@ -4,15 +4,173 @@ from __future__ import annotations
 Auth backend per Supabase con supporto JWKS.
 
 - Se SUPABASE_JWKS_URL è configurata e SUPABASE_VERIFY_DISABLED != "1",
-  verifica il token via JWKS (RS256).
+  verifica il token via JWKS (RS256). Un token non verificabile → 401.
 - Altrimenti effettua una decodifica senza verifica (modalità sviluppo).
+
+Cache di processo:
+- JWKS: chiavi in memoria con TTL, refresh immediato se arriva un `kid`
+  sconosciuto (rotazione chiavi), con intervallo minimo tra refresh forzati.
+- Token verificati: LRU limitata indicizzata per hash del token, valida fino a
+  `exp`; lo stesso bearer ripetuto non paga né rete né verifica RSA.
+
+Env:
+- SUPABASE_JWKS_TTL (secondi, default 600)
+- SUPABASE_JWKS_MIN_REFRESH (secondi tra refresh forzati, default 30)
+- SUPABASE_TOKEN_CACHE_SIZE (default 10000, 0 = disabilitata)
 """
 
+import asyncio
+import hashlib
+import logging
 import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
 import jwt
-from jwt import PyJWKClient
-from typing import Any, Dict
+from fastapi import HTTPException, status
+
 from app.core.interfaces import AuthBackend
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+class _JwksCache:
+    """Chiavi JWKS per `kid`, condivise dal processo."""
+
+    def __init__(self) -> None:
+        self._keys: Dict[str, Any] = {}
+        self._url: Optional[str] = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    async def _refresh(self, jwks_url: str) -> None:
+        resp = await get_supabase().client.get(jwks_url, timeout=10.0)
+        resp.raise_for_status()
+        jwk_set = jwt.PyJWKSet.from_dict(resp.json())
+        self._keys = {k.key_id: k.key for k in jwk_set.keys if k.key_id}
+        self._url = jwks_url
+        self._fetched_at = time.monotonic()
+        self.refreshes += 1
+        logger.info(f"🔑 JWKS aggiornato: {len(self._keys)} chiavi")
+
+    async def get_key(self, jwks_url: str, kid: Optional[str]) -> Any:
+        ttl = _env_float("SUPABASE_JWKS_TTL", 600.0)
+        min_refresh = _env_float("SUPABASE_JWKS_MIN_REFRESH", 30.0)
+        expired = self._url != jwks_url or (time.monotonic() - self._fetched_at) > ttl
+        key = None if expired else self._lookup(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        async with self._lock:
+            # Ricontrolla: un'altra richiesta può aver già aggiornato le chiavi
+            age = time.monotonic() - self._fetched_at
+            stale = self._url != jwks_url or age > ttl
+            key = None if stale else self._lookup(kid)
+            if key is None and (stale or age >= min_refresh):
+                await self._refresh(jwks_url)
+                key = self._lookup(kid)
+        if key is None:
+            raise jwt.PyJWKClientError(f"Chiave JWKS non trovata per kid={kid}")
+        return key
+
+    def _lookup(self, kid: Optional[str]) -> Any:
+        if kid:
+            return self._keys.get(kid)
+        # Token senza kid: accettato solo con una singola chiave pubblicata
+        if len(self._keys) == 1:
+            return next(iter(self._keys.values()))
+        return None
+
+    def clear(self) -> None:
+        self._keys = {}
+        self._url = None
+        self._fetched_at = 0.0
+
+
+class _VerifiedTokenCache:
+    """LRU limitata: hash token → (utente, exp)."""
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _max_size() -> int:
+        try:
+            return max(0, int(os.environ.get("SUPABASE_TOKEN_CACHE_SIZE", "10000")))
+        except Exception:
+            return 10000
+
+    @staticmethod
+    def key_for(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        user, exp = item
+        if exp <= time.time():
+            self._items.pop(key, None)
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return user
+
+    def put(self, key: str, user: Dict[str, Any], exp: float) -> None:
+        max_size = self._max_size()
+        if max_size <= 0:
+            return
+        self._items[key] = (user, exp)
+        self._items.move_to_end(key)
+        while len(self._items) > max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+_jwks_cache = _JwksCache()
+_token_cache = _VerifiedTokenCache()
+
+
+def get_auth_cache_stats() -> Dict[str, Any]:
+    """Contatori hit/miss delle cache JWKS e token verificati."""
+    return {
+        "jwks_hits": _jwks_cache.hits,
+        "jwks_misses": _jwks_cache.misses,
+        "jwks_refreshes": _jwks_cache.refreshes,
+        "token_cache_hits": _token_cache.hits,
+        "token_cache_misses": _token_cache.misses,
+        "token_cache_size": len(_token_cache),
+    }
+
+
+def _user_from_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = payload.get("sub") or payload.get("user_id") or "unknown"
+    email = payload.get("email") or payload.get("user_metadata", {}).get("email") or "unknown@example.com"
+    return {"id": user_id, "email": email}
 
 
 class SupabaseAuthBackend(AuthBackend):
@@ -26,26 +184,35 @@ class SupabaseAuthBackend(AuthBackend):
 
         Returns:
             Dict con id/email minimi
+
+        Raises:
+            HTTPException 401 se la verifica JWKS è attiva e il token non è valido
         """
         jwks_url = os.environ.get("SUPABASE_JWKS_URL")
         verify_disabled = os.environ.get("SUPABASE_VERIFY_DISABLED", "0") == "1"
 
-        if jwks_url and not verify_disabled:
-            try:
-                jwk_client = PyJWKClient(jwks_url)
-                signing_key = jwk_client.get_signing_key_from_jwt(bearer_token)
-                payload = jwt.decode(
-                    bearer_token,
-                    signing_key.key,
-                    algorithms=["RS256"],
-                    options={"require": ["exp", "iat", "sub"]},
-                )
-            except Exception:
-                payload = jwt.decode(bearer_token, options={"verify_signature": False})
-        else:
+        if not jwks_url or verify_disabled:
             payload = jwt.decode(bearer_token, options={"verify_signature": False})
-        user_id = payload.get("sub") or payload.get("user_id") or "unknown"
-        email = payload.get("email") or payload.get("user_metadata", {}).get("email") or "unknown@example.com"
-        return {"id": user_id, "email": email}
+            return _user_from_payload(payload)
+
+        cache_key = _VerifiedTokenCache.key_for(bearer_token)
+        cached = _token_cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
 
+        try:
+            kid = jwt.get_unverified_header(bearer_token).get("kid")
+            signing_key = await _jwks_cache.get_key(jwks_url, kid)
+            payload = jwt.decode(
+                bearer_token,
+                signing_key,
+                algorithms=["RS256"],
+                options={"require": ["exp", "iat", "sub"]},
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Token non valido: {e}")
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token non valido")
 
+        user = _user_from_payload(payload)
+        _token_cache.put(cache_key, user, float(payload["exp"]))
+        return dict(user)
@@ -6,14 +6,20 @@ Adapter per Flowise/NL-Flow (minimo funzionante via HTTP).
 - Richiede: FLOWISE_BASE_URL e FLOWISE_API_KEY nel .env
 - Esegue POST su {BASE_URL}/{flow_id} con il payload fornito.
 - In assenza di chiave o base_url, ritorna stub per sviluppo.
+- `open_stream()` esegue con `streaming: true` e inoltra gli eventi Flowise
+  man mano che arrivano (pool HTTP condiviso del processo).
+
+Env:
+- FLOWISE_STREAM_READ_TIMEOUT (secondi max tra due eventi, default 300)
 """
 
-from typing import Any, Dict, Optional, Tuple, List
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, List
 import os
 import json
 import logging
 import httpx
 from app.services.openrouter_user_keys import OpenRouterUserKeysService
+from app.services.upstream_pools import UpstreamUnavailable, upstream_client, upstream_timeout
 
 
 class FlowiseAdapter:
@@ -21,58 +27,51 @@ class FlowiseAdapter:
 
     def __init__(self, credentials_manager=None):
         self.credentials_manager = credentials_manager
-        self._base_url_cache = None
-        self._api_key_cache = None
 
+    # Nessuna cache locale: le credenziali decriptate sono già in memoria nel
+    # CredentialsManager condiviso, che vede subito rotazioni e invalidazioni.
     async def _get_base_url(self) -> Optional[str]:
         """Ottiene base URL con priorità: ENV > credentials criptate."""
-        if self._base_url_cache:
-            return self._base_url_cache
-        
         # 1) ENV
         env_url = os.environ.get("FLOWISE_BASE_URL")
         if env_url:
-            self._base_url_cache = env_url
             return env_url
 
         # 2) CREDENTIALS MANAGER (criptate)
         if self.credentials_manager:
             url = await self.credentials_manager.get_credential("flowise", "base_url")
             if url:
-                self._base_url_cache = url
                 return url
 
         # 3) Ultimo fallback
-        self._base_url_cache = None
         return None
 
     async def _get_api_key(self) -> Optional[str]:
         """Ottiene API key con priorità: ENV > credentials criptate."""
-        if self._api_key_cache:
-            return self._api_key_cache
-        
         # 1) ENV
         env_key = os.environ.get("FLOWISE_API_KEY")
         if env_key:
-            self._api_key_cache = env_key
             return env_key
 
         # 2) CREDENTIALS MANAGER (criptate)
         if self.credentials_manager:
             key = await self.credentials_manager.get_credential("flowise", "api_key")
             if key:
-                self._api_key_cache = key
                 return key
 
         # 3) Ultimo fallback
-        self._api_key_cache = None
         return None
 
-    async def execute(self, user_id: str, flow_id: str, data: Dict[str, Any], session_id: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    async def _prepare_request(self, user_id: str, flow_id: str, data: Dict[str, Any], session_id: Optional[str] = None) -> Optional[Tuple[str, Dict[str, str], Dict[str, Any]]]:
+        """Costruisce url, header e payload arricchito (chiave OpenRouter utente, nodi, sessione).
+
+        Returns:
+            (url, headers, payload) oppure None se Flowise non è configurato (modalità stub)
+        """
         base_url = await self._get_base_url()
         api_key = await self._get_api_key()
         if not base_url or not api_key:
-            return ({"text": f"[stub] Flowise eseguito: {flow_id}", "data": data}, {"cost_credits": None})
+            return None
 
         headers = {
             # Alcune versioni/config di Flowise richiedono 'Authorization: Bearer', altre 'x-api-key'.
@@ -135,14 +134,23 @@ class FlowiseAdapter:
         
         url = f"{base_url.rstrip('/')}/{flow_id}"
 
+        return url, headers, enriched
+
+    async def execute(self, user_id: str, flow_id: str, data: Dict[str, Any], session_id: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        prepared = await self._prepare_request(user_id, flow_id, data, session_id)
+        if prepared is None:
+            return ({"text": f"[stub] Flowise eseguito: {flow_id}", "data": data}, {"cost_credits": None})
+        url, headers, enriched = prepared
+
         # Aumenta timeout e aggiungi logging dettagliato
         timeout_seconds = 600.0  # Aumentato a 10 minuti
         try:
-            async with httpx.AsyncClient(timeout=timeout_seconds) as client:
-                logging.info(f"🚀 Chiamando Flowise: POST {url} con timeout {timeout_seconds}s")
-                if session_id:
-                    logging.warning(f"🔍 PAYLOAD COMPLETO INVIATO A FLOWISE: {json.dumps(enriched, indent=2)}")
-                resp = await client.post(url, headers=headers, json=enriched)
+            # Pool dedicato Flowise (bulkhead): i run lunghi non occupano socket Supabase/OpenRouter
+            client = upstream_client("flowise")
+            logging.info(f"🚀 Chiamando Flowise: POST {url} con timeout {timeout_seconds}s")
+            if session_id:
+                logging.warning(f"🔍 PAYLOAD COMPLETO INVIATO A FLOWISE: {json.dumps(enriched, indent=2)}")
+            resp = await client.post(url, headers=headers, json=enriched, timeout=upstream_timeout("flowise", timeout_seconds))
             
             resp.raise_for_status() # Lancia eccezione per status >= 400
             
@@ -155,6 +163,12 @@ class FlowiseAdapter:
                 logging.warning(f"⚠️ CONVERSATIONAL: Session ID CAMBIATO! Inviato={session_id}, Ricevuto={returned_session}")
             return result, {"cost_credits": None}
 
+        except UpstreamUnavailable as e:
+            logging.error(f"❌ Flowise non disponibile per {url}: {e}")
+            raise RuntimeError(f"Flowise unavailable: {e}")
+        except httpx.PoolTimeout as e:
+            logging.error(f"❌ Pool Flowise saturo per {url}: {e}")
+            raise RuntimeError("Flowise busy: connection pool exhausted")
         except httpx.TimeoutException as e:
             logging.error(f"❌ Timeout Flowise dopo {timeout_seconds}s per {url}: {e}")
             raise RuntimeError(f"Flowise timeout after {timeout_seconds}s")
@@ -166,6 +180,131 @@ class FlowiseAdapter:
             raise RuntimeError(f"Errore imprevisto durante la chiamata a Flowise: {e}")
 
 
+    async def open_stream(self, user_id: str, flow_id: str, data: Dict[str, Any], session_id: Optional[str] = None) -> "FlowiseStream":
+        """Esegue il flow con `streaming: true` e ritorna lo stream di eventi.
+
+        Gli errori HTTP (status >= 400) emergono qui, prima di inviare byte al client.
+        """
+        prepared = await self._prepare_request(user_id, flow_id, data, session_id)
+        if prepared is None:
+            stub = f"[stub] Flowise eseguito: {flow_id}"
+            return FlowiseStream(stub_events=[
+                {"event": "start", "data": ""},
+                *[{"event": "token", "data": word + " "} for word in stub.split(" ")],
+                {"event": "end", "data": "[DONE]"},
+            ])
+        url, headers, enriched = prepared
+        enriched = {**enriched, "streaming": True}
+        headers = {**headers, "Accept": "text/event-stream"}
+
+        try:
+            read_timeout = float(os.environ.get("FLOWISE_STREAM_READ_TIMEOUT", "300"))
+        except Exception:
+            read_timeout = 300.0
+        client = upstream_client("flowise")
+        request = client.build_request("POST", url, headers=headers, json=enriched, timeout=upstream_timeout("flowise", read_timeout))
+        logging.info(f"🚀 Chiamando Flowise (stream): POST {url}")
+        try:
+            resp = await client.send(request, stream=True)
+        except UpstreamUnavailable as e:
+            raise RuntimeError(f"Flowise unavailable: {e}")
+        except httpx.TimeoutException as e:
+            raise RuntimeError(f"Flowise timeout: {e}")
+        if resp.status_code >= 400:
+            body = await resp.aread()
+            await resp.aclose()
+            raise RuntimeError(f"Flowise error {resp.status_code}: {body.decode('utf-8', 'replace')}")
+        return FlowiseStream(response=resp)
+
+
+class FlowiseStream:
+    """Eventi di un'esecuzione Flowise in streaming.
+
+    Flowise invia SSE `data: {"event": "token"|"metadata"|"end"|..., "data": ...}`;
+    i flow non streamabili rispondono con un JSON unico, inoltrato come evento
+    `result`. Durante l'iterazione vengono raccolti testo, sessionId/chatId ed
+    eventuale errore per la risposta finale e l'addebito.
+    """
+
+    def __init__(self, response: Optional[httpx.Response] = None, stub_events: Optional[List[Dict[str, Any]]] = None) -> None:
+        self._response = response
+        self._stub_events = stub_events or []
+        self.text_parts: List[str] = []
+        self.session_id: Optional[str] = None
+        self.error: Optional[str] = None
+        self.completed = False
+        self.events_count = 0
+
+    def _observe(self, event: Dict[str, Any]) -> None:
+        self.events_count += 1
+        kind = event.get("event")
+        payload = event.get("data")
+        if kind == "token" and isinstance(payload, str):
+            self.text_parts.append(payload)
+        elif kind == "metadata" and isinstance(payload, dict):
+            self.session_id = payload.get("sessionId") or payload.get("chatId") or self.session_id
+        elif kind == "error":
+            self.error = str(payload)
+        elif kind == "end":
+            self.completed = True
+        elif kind == "result" and isinstance(payload, dict):
+            self.session_id = payload.get("sessionId") or payload.get("chatId") or self.session_id
+            self.completed = True
+
+    @staticmethod
+    def _sse(event: Dict[str, Any]) -> bytes:
+        return f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    async def events(self) -> AsyncIterator[bytes]:
+        try:
+            if self._response is None:
+                for event in self._stub_events:
+                    self._observe(event)
+                    yield self._sse(event)
+                return
+
+            content_type = self._response.headers.get("content-type", "")
+            if not content_type.startswith("text/event-stream"):
+                # Flow non streamabile: un solo evento col risultato completo
+                body = await self._response.aread()
+                try:
+                    result = json.loads(body)
+                except Exception:
+                    result = {"text": body.decode("utf-8", "replace")}
+                event = {"event": "result", "data": result}
+                self._observe(event)
+                yield self._sse(event)
+                return
+
+            async for line in self._response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                raw = line[5:].strip()
+                if not raw:
+                    continue
+                try:
+                    event = json.loads(raw)
+                except Exception:
+                    event = {"event": "token", "data": raw}
+                if not isinstance(event, dict):
+                    event = {"event": "token", "data": event}
+                self._observe(event)
+                yield self._sse(event)
+                if event.get("event") == "end":
+                    break
+        finally:
+            await self.aclose()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.text_parts)
+
+    async def aclose(self) -> None:
+        response, self._response = self._response, None
+        if response is not None:
+            await response.aclose()
+
+
 def _inject_openrouter_identity(payload: Dict[str, Any], user_id: str, key_name: Optional[str]) -> Dict[str, Any]:
     """Aggiunge overrideConfig.vars con user_id e openrouter_key_name, e rimuove openAIApiKey se presente.
 
@@ -13,9 +13,10 @@ import hashlib
 import base64
 import json
 from app.core.interfaces import BillingProvider
-import httpx
 import logging
 
+from app.services.upstream_pools import upstream_client, upstream_timeout
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,68 +32,59 @@ class LemonSqueezyAdapter(BillingProvider):
         self.store_id = ls_config.get("store_id") or os.environ.get("LEMONSQUEEZY_STORE_ID", "")
         self.bypass_signature = os.environ.get("LEMONSQUEEZY_BYPASS_SIGNATURE", "false").lower() in ("1","true","yes")
         
-        # API key e signing secret saranno caricati on-demand dalle credentials criptate
-        self._api_key_cache = None
+        # API key e signing secret letti on-demand (le credentials criptate sono in
+        # memoria nel CredentialsManager condiviso); il secret risolto resta qui
+        # per validate_webhook, che è sync
         self._signing_secret_cache = None
 
     async def _get_api_key(self) -> str:
         """Ottiene API key con priorità: ENV > config > credentials criptate."""
-        if self._api_key_cache:
-            return self._api_key_cache
-        
         # 1) ENV
         env_key = os.environ.get("LEMONSQUEEZY_API_KEY")
         if env_key:
-            self._api_key_cache = env_key
             return env_key
 
         # 2) CONFIG
         ls_config = self.config.get("lemonsqueezy") or {}
         cfg_key = ls_config.get("api_key")
         if cfg_key:
-            self._api_key_cache = cfg_key
             return cfg_key
 
         # 3) CREDENTIALS MANAGER (criptate)
         if self.credentials_manager:
             key = await self.credentials_manager.get_credential("lemonsqueezy", "api_key")
             if key:
-                self._api_key_cache = key
                 return key
 
         # 4) Ultimo fallback: stringa vuota
-        self._api_key_cache = ""
         return ""
 
     async def _get_signing_secret(self) -> str:
         """Ottiene webhook secret con priorità: ENV > config > credentials criptate."""
-        if self._signing_secret_cache:
-            return self._signing_secret_cache
-        
         # 1) ENV
         env_secret = os.environ.get("LEMONSQUEEZY_SIGNING_SECRET")
         if env_secret:
-            self._signing_secret_cache = env_secret
             return env_secret
 
         # 2) CONFIG
         ls_config = self.config.get("lemonsqueezy") or {}
         cfg_secret = ls_config.get("webhook_secret")
         if cfg_secret:
-            self._signing_secret_cache = cfg_secret
             return cfg_secret
 
         # 3) CREDENTIALS MANAGER (criptate)
         if self.credentials_manager:
             secret = await self.credentials_manager.get_credential("lemonsqueezy", "webhook_secret")
             if secret:
-                self._signing_secret_cache = secret
                 return secret
 
         # 4) Ultimo fallback: stringa vuota
-        self._signing_secret_cache = ""
         return ""
 
+    async def refresh_signing_secret(self) -> None:
+        """Risolve il signing secret corrente prima di validate_webhook (sync)."""
+        self._signing_secret_cache = await self._get_signing_secret()
+
     async def create_checkout(self, user_id: str, credits: int, amount_usd: Optional[float] = None, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         # Crea un checkout reale con custom_price usando variant_id da config (se presente)
         variant_id = (metadata or {}).get("variant_id") or self._variant_from_plan((metadata or {}).get("plan_id"))
@@ -167,25 +159,25 @@ class LemonSqueezyAdapter(BillingProvider):
         logger.info(f"LemonSqueezy checkout request - store_id: {store_id}, variant_id: {variant_id}, price_usd: {price_usd}")
         logger.info(f"Request body: {json.dumps(body, indent=2)}")
         
-        async with httpx.AsyncClient(timeout=15, base_url=self.base_url) as client:
-            resp = await client.post("/checkouts", json=body, headers=headers)
-            logger.info(f"LemonSqueezy response status: {resp.status_code}")
-            
-            if resp.status_code not in (200, 201):
-                logger.error(f"LemonSqueezy error response: {resp.text}")
-                raise ValueError(f"Errore LemonSqueezy: HTTP {resp.status_code}")
-                
-            data = resp.json()
-            logger.info(f"LemonSqueezy response data: {json.dumps(data, indent=2)}")
+        client = upstream_client("lemonsqueezy")
+        resp = await client.post(f"{self.base_url}/checkouts", json=body, headers=headers, timeout=upstream_timeout("lemonsqueezy", 15.0))
+        logger.info(f"LemonSqueezy response status: {resp.status_code}")
+        
+        if resp.status_code not in (200, 201):
+            logger.error(f"LemonSqueezy error response: {resp.text}")
+            raise ValueError(f"Errore LemonSqueezy: HTTP {resp.status_code}")
             
-            # LemonSqueezy restituisce l'URL in data.attributes.url
-            url = ((data.get("data") or {}).get("attributes") or {}).get("url")
+        data = resp.json()
+        logger.info(f"LemonSqueezy response data: {json.dumps(data, indent=2)}")
+        
+        # LemonSqueezy restituisce l'URL in data.attributes.url
+        url = ((data.get("data") or {}).get("attributes") or {}).get("url")
+        
+        if not url:
+            logger.warning("LemonSqueezy non ha restituito checkout_url")
+            raise ValueError("LemonSqueezy non ha restituito un checkout_url")
             
-            if not url:
-                logger.warning("LemonSqueezy non ha restituito checkout_url")
-                raise ValueError("LemonSqueezy non ha restituito un checkout_url")
-                
-            return {"provider": "lemonsqueezy", "checkout_url": url, "price_usd": price_usd}
+        return {"provider": "lemonsqueezy", "checkout_url": url, "price_usd": price_usd}
 
     async def get_plans(self) -> Dict[str, Any]:
         # Placeholder: piani statici. In futuro leggere da Supabase o da API LS
@@ -200,8 +192,7 @@ class LemonSqueezyAdapter(BillingProvider):
         if self.bypass_signature:
             return True
         try:
-            # Nota: validate_webhook deve essere sync, quindi uso fallback per ora
-            # In futuro potremmo rendere l'interfaccia async
+            # Nota: validate_webhook deve essere sync: il secret arriva da refresh_signing_secret
             signing_secret = self._signing_secret_cache or os.environ.get("LEMONSQUEEZY_SIGNING_SECRET", "")
             if not signing_secret or not signature:
                 return False
@@ -251,6 +242,21 @@ class LemonSqueezyAdapter(BillingProvider):
             "provider_ids": provider_ids
         }
 
+    def webhook_event_id(self, payload: Dict[str, Any], body: bytes) -> str:
+        """Id stabile dell'evento per il dedup dei retry.
+
+        LemonSqueezy non invia un id evento: si usa (evento, tipo e id risorsa,
+        updated_at), che distingue anche gli aggiornamenti successivi della
+        stessa subscription. Senza risorsa si ricade sull'hash del body.
+        """
+        meta = payload.get("meta") or {}
+        data = payload.get("data") or {}
+        attributes = data.get("attributes") or {}
+        event = meta.get("event_name") or payload.get("event_name") or payload.get("event") or ""
+        if data.get("id"):
+            return f"{event}:{data.get('type') or ''}:{data.get('id')}:{attributes.get('updated_at') or ''}"
+        return hashlib.sha256(body).hexdigest()
+
     def _variant_from_plan(self, plan_id: Optional[str]) -> Optional[str]:
         # Mapping SOLO da config persistente (nessun fallback implicito)
         if not plan_id:
@@ -7,12 +7,93 @@ Adapter OpenRouter con chiamata HTTP reale se configurata.
   `OPENROUTER_BASE_URL` (default: https://openrouter.ai/api/v1) all'endpoint
   `/chat/completions`.
 - In assenza di chiave, ritorna una risposta stub (per sviluppo).
+- `open_stream()` apre la stessa chiamata con `stream: true` e inoltra i chunk
+  SSE man mano che arrivano (letti solo quando il client li consuma); l'usage
+  del chunk finale resta disponibile per pricing e addebito a fine stream.
+
+Le richieste usano il pool HTTP condiviso del processo (keep-alive).
+
+Env:
+- OPENROUTER_STREAM_READ_TIMEOUT (secondi max tra due chunk, default 60)
 """
 
-from typing import Any, Dict, Optional, Tuple, List
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, List
+import json
 import os
 import httpx
 from app.core.interfaces import ProviderAdapter
+from app.services.upstream_pools import upstream_client, upstream_timeout
+
+
+def _map_usage(usage_raw: Dict[str, Any]) -> Dict[str, Any]:
+    input_tokens = usage_raw.get("prompt_tokens") or usage_raw.get("input_tokens") or 0
+    output_tokens = usage_raw.get("completion_tokens") or usage_raw.get("output_tokens") or 0
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        # Costo reale riportato da OpenRouter (USD), se presente
+        "cost_usd": usage_raw.get("cost"),
+        # Il costo in crediti viene gestito dal PricingEngine a monte
+        "cost_credits": None,
+    }
+
+
+class OpenRouterChatStream:
+    """Stream SSE aperto verso OpenRouter.
+
+    `events()` produce i chunk già formattati SSE; a fine iterazione `usage`
+    contiene i token (e il costo) del chunk finale e `completed` indica se lo
+    stream è arrivato a `[DONE]`.
+    """
+
+    def __init__(self, response: Optional[httpx.Response] = None, stub_events: Optional[List[Dict[str, Any]]] = None) -> None:
+        self._response = response
+        self._stub_events = stub_events or []
+        self.usage: Dict[str, Any] = {}
+        self.completed = False
+        self.chunks = 0
+
+    async def events(self) -> AsyncIterator[bytes]:
+        try:
+            if self._response is None:
+                for event in self._stub_events:
+                    if event.get("usage"):
+                        self.usage = _map_usage(event["usage"])
+                    self.chunks += 1
+                    yield f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                self.completed = True
+                yield b"data: [DONE]\n\n"
+                return
+
+            async for line in self._response.aiter_lines():
+                if not line:
+                    continue
+                if line.startswith(":"):
+                    # Commenti keep-alive di OpenRouter (": OPENROUTER PROCESSING")
+                    yield f"{line}\n\n".encode("utf-8")
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    self.completed = True
+                    yield b"data: [DONE]\n\n"
+                    break
+                try:
+                    chunk = json.loads(data)
+                except Exception:
+                    chunk = None
+                if isinstance(chunk, dict) and chunk.get("usage"):
+                    self.usage = _map_usage(chunk["usage"])
+                self.chunks += 1
+                yield f"data: {data}\n\n".encode("utf-8")
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        response, self._response = self._response, None
+        if response is not None:
+            await response.aclose()
 
 
 class OpenRouterAdapter(ProviderAdapter):
@@ -28,40 +109,70 @@ class OpenRouterAdapter(ProviderAdapter):
             usage = {"input_tokens": 0, "output_tokens": 0, "cost_credits": 0.0}
             return response, usage
 
-        payload: Dict[str, Any] = {
-            "model": model,
-            "messages": messages,
-        }
-        if options and isinstance(options, dict):
-            # Propaga alcune opzioni comuni
-            for key in ("temperature", "top_p", "max_tokens"):
-                if key in options:
-                    payload[key] = options[key]
-
+        payload = self._build_payload(model, messages, options)
         headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
         }
 
         url = f"{base_url}/chat/completions"
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            # In caso di errore, solleva con messaggio chiaro
-            if resp.status_code >= 400:
-                raise RuntimeError(f"OpenRouter error {resp.status_code}: {resp.text}")
-            data = resp.json()
+        resp = await upstream_client("openrouter").post(url, headers=headers, json=payload, timeout=upstream_timeout("openrouter", 60.0))
+        # In caso di errore, solleva con messaggio chiaro
+        if resp.status_code >= 400:
+            raise RuntimeError(f"OpenRouter error {resp.status_code}: {resp.text}")
+        data = resp.json()
 
         # Prova a mappare usage se presente
-        usage_raw = data.get("usage") or {}
-        input_tokens = usage_raw.get("prompt_tokens") or usage_raw.get("input_tokens") or 0
-        output_tokens = usage_raw.get("completion_tokens") or usage_raw.get("output_tokens") or 0
-        usage: Dict[str, Any] = {
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            # Il costo in crediti viene gestito dal PricingEngine a monte
-            "cost_credits": None,
-        }
-
+        usage = _map_usage(data.get("usage") or {})
         return data, usage
 
+    async def open_stream(self, user_id: str, model: str, messages: List[Dict[str, str]], options: Optional[Dict[str, Any]] = None) -> OpenRouterChatStream:
+        """Apre la chat in streaming. Gli errori HTTP upstream emergono qui, prima del primo byte al client."""
+        base_url = os.environ.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+        api_key = os.environ.get("OPENROUTER_PROVISIONING_KEY")
+        if not api_key:
+            fake_text = f"[stub] OpenRouter({model}) risponde a {len(messages)} messaggi per {user_id}"
+            return OpenRouterChatStream(stub_events=[
+                {"choices": [{"delta": {"role": "assistant", "content": word + " "}}]} for word in fake_text.split(" ")
+            ] + [{"choices": [], "usage": {"prompt_tokens": 0, "completion_tokens": 0}}])
+
+        payload = self._build_payload(model, messages, options)
+        payload["stream"] = True
+        # Chiede a OpenRouter token e costo nel chunk finale
+        payload["usage"] = {"include": True}
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        try:
+            read_timeout = float(os.environ.get("OPENROUTER_STREAM_READ_TIMEOUT", "60"))
+        except Exception:
+            read_timeout = 60.0
+        client = upstream_client("openrouter")
+        request = client.build_request(
+            "POST",
+            f"{base_url}/chat/completions",
+            headers=headers,
+            json=payload,
+            timeout=upstream_timeout("openrouter", read_timeout),
+        )
+        resp = await client.send(request, stream=True)
+        if resp.status_code >= 400:
+            body = await resp.aread()
+            await resp.aclose()
+            raise RuntimeError(f"OpenRouter error {resp.status_code}: {body.decode('utf-8', 'replace')}")
+        return OpenRouterChatStream(response=resp)
 
+    @staticmethod
+    def _build_payload(model: str, messages: List[Dict[str, str]], options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
+            "model": model,
+            "messages": messages,
+        }
+        if options and isinstance(options, dict):
+            # Propaga alcune opzioni comuni
+            for key in ("temperature", "top_p", "max_tokens"):
+                if key in options:
+                    payload[key] = options[key]
+        return payload
@@ -4,14 +4,16 @@ from fastapi import APIRouter, Header, HTTPException, status
 from pydantic import BaseModel, Field
 from typing import Any, Dict, List, Optional
 import os
-import httpx
 import secrets
 import asyncio
 
 from app.adapters.auth_supabase import SupabaseAuthBackend
 from app.services.billing_config_service import BillingConfigService
-from app.services.credentials_manager import CredentialsManager
+from app.services.credentials_manager import get_credentials_manager, invalidate_credentials_cache
+from app.services.flowise_config_service import invalidate_flow_config_cache
+from app.services.flow_result_cache import invalidate_flow_result_cache
 from app.services.payments_service import PaymentsService
+from app.services.supabase_rest import get_supabase
 
 
 router = APIRouter()
@@ -54,36 +56,49 @@ async def get_flow_config(
     app_id = app_id.strip()
     flow_key = flow_key.strip()
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        # Primo tentativo: eq (match esatto)
-        url = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
-        resp = await client.get(url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        data = resp.json()
-        # Fallback: ilike (case-insensitive) se vuoto
-        if not data:
-            # Punta prima a ilike exact (senza wildcard), poi con wildcard
-            url_ilike = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=ilike.{flow_key}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
-            resp2 = await client.get(url_ilike, headers=headers)
-            if resp2.status_code != 200:
-                raise HTTPException(status_code=resp2.status_code, detail=resp2.text)
-            data = resp2.json()
-            if not data:
-                url_ilike2 = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=ilike.*{flow_key}*&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
-                resp3 = await client.get(url_ilike2, headers=headers)
-                if resp3.status_code != 200:
-                    raise HTTPException(status_code=resp3.status_code, detail=resp3.text)
-                data = resp3.json()
-        if not data:
-            return {"found": False}
+    data = await _resolve_flow_config_rows(app_id, flow_key)
+    if not data:
+        return {"found": False}
     row = data[0]
     return {"found": True, "config": row}
+
+
+async def _resolve_flow_config_rows(app_id: str, flow_key: str) -> List[Dict[str, Any]]:
+    """Match esatto, case-insensitive e "contiene" in un solo round-trip (RPC resolve_flow_config).
+
+    Le righe arrivano già ordinate per qualità del match (campo `match_rank`).
+    Senza la migration 005 ripiega sui tre tentativi sequenziali storici.
+    """
+    client = get_supabase()
+    resp = await client.rpc("resolve_flow_config", {"p_app_id": app_id, "p_flow_key": flow_key}, timeout=10)
+    if resp.status_code == 200:
+        return resp.json() or []
+    if resp.status_code != 404:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+
+    # Primo tentativo: eq (match esatto)
+    url = f"/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
+    resp = await client.get(url, timeout=10)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    data = resp.json()
+    # Fallback: ilike (case-insensitive) se vuoto
+    if not data:
+        # Punta prima a ilike exact (senza wildcard), poi con wildcard
+        url_ilike = f"/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=ilike.{flow_key}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
+        resp2 = await client.get(url_ilike, timeout=10)
+        if resp2.status_code != 200:
+            raise HTTPException(status_code=resp2.status_code, detail=resp2.text)
+        data = resp2.json()
+        if not data:
+            url_ilike2 = f"/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=ilike.*{flow_key}*&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata"
+            resp3 = await client.get(url_ilike2, timeout=10)
+            if resp3.status_code != 200:
+                raise HTTPException(status_code=resp3.status_code, detail=resp3.text)
+            data = resp3.json()
+    return data
+
+
 @router.get("/flow-configs/all")
 async def list_flow_configs(
     app_id: str = "*",
@@ -105,20 +120,15 @@ async def list_flow_configs(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        if app_id == "*":
-            url = f"{supabase_url}/rest/v1/flow_configs?select=app_id,flow_key,flow_id,node_names,is_conversational,metadata,created_at&order=app_id,flow_key"
-        else:
-            url = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata,created_at&order=flow_key"
-        resp = await client.get(url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        rows = resp.json() or []
+    client = get_supabase()
+    if app_id == "*":
+        url = "/rest/v1/flow_configs?select=app_id,flow_key,flow_id,node_names,is_conversational,metadata,created_at&order=app_id,flow_key"
+    else:
+        url = f"/rest/v1/flow_configs?app_id=eq.{app_id}&select=app_id,flow_key,flow_id,node_names,is_conversational,metadata,created_at&order=flow_key"
+    resp = await client.get(url, timeout=10)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    rows = resp.json() or []
     return {"items": rows}
 
 
@@ -143,16 +153,13 @@ async def delete_flow_config(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        url = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}"
-        resp = await client.delete(url, headers=headers)
-        if resp.status_code not in (200, 204):
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    client = get_supabase()
+    url = f"/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}"
+    resp = await client.delete(url, timeout=10)
+    if resp.status_code not in (200, 204):
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    invalidate_flow_config_cache(app_id, flow_key)
+    invalidate_flow_result_cache()
     return {"status": "deleted"}
 
 
@@ -177,17 +184,12 @@ async def list_flow_keys(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        url = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&select=flow_key"
-        resp = await client.get(url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        rows = resp.json()
+    client = get_supabase()
+    url = f"/rest/v1/flow_configs?app_id=eq.{app_id}&select=flow_key"
+    resp = await client.get(url, timeout=10)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    rows = resp.json()
     # Deduplica e ordina
     keys = sorted({r.get("flow_key") for r in rows if isinstance(r, dict) and r.get("flow_key")})
     return {"app_id": app_id, "flow_keys": keys}
@@ -211,17 +213,12 @@ async def list_app_ids(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        url = f"{supabase_url}/rest/v1/flow_configs?select=app_id"
-        resp = await client.get(url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        rows = resp.json()
+    client = get_supabase()
+    url = "/rest/v1/flow_configs?select=app_id"
+    resp = await client.get(url, timeout=10)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    rows = resp.json()
     
     app_ids = sorted({r.get("app_id") for r in rows if isinstance(r, dict) and r.get("app_id")})
     return {"app_ids": app_ids}
@@ -248,12 +245,6 @@ async def upsert_flow_config(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates,return=representation",
-    }
     body = {
         "app_id": payload.app_id,
         "flow_key": payload.flow_key,
@@ -261,11 +252,18 @@ async def upsert_flow_config(
         "node_names": payload.node_names or [],
         "is_conversational": payload.is_conversational or False,
     }
-    async with httpx.AsyncClient(timeout=10) as client:
-        # Forza upsert esplicito sul vincolo composto (app_id, flow_key)
-        resp = await client.post(f"{supabase_url}/rest/v1/flow_configs?on_conflict=app_id,flow_key", headers=headers, json=body)
+    client = get_supabase()
+    # Forza upsert esplicito sul vincolo composto (app_id, flow_key)
+    resp = await client.post(
+        "/rest/v1/flow_configs?on_conflict=app_id,flow_key",
+        json=body,
+        prefer="resolution=merge-duplicates,return=representation",
+        timeout=10,
+    )
     if resp.status_code not in (200, 201):
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    invalidate_flow_config_cache(payload.app_id, payload.flow_key)
+    invalidate_flow_result_cache()
     return {"status": "ok", "config": resp.json()}
 
 
@@ -286,8 +284,8 @@ async def generate_token(req: GenerateTokenRequest) -> Dict[str, Any]:
         "Content-Type": "application/json",
     }
     body = {"email": req.email, "password": req.password}
-    async with httpx.AsyncClient(timeout=20) as client:
-        resp = await client.post(f"{supabase_url}/auth/v1/token?grant_type=password", headers=headers, json=body)
+    client = get_supabase()
+    resp = await client.post("/auth/v1/token?grant_type=password", json=body, headers=headers, timeout=20)
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
     data = resp.json()
@@ -378,20 +376,15 @@ async def list_users(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
 
     # Costruisci query
     select = "id,email,credits,created_at"
-    base = f"{supabase_url}/rest/v1/profiles?select={select}&order=created_at.desc&limit={max(1, min(limit, 500))}"
+    base = f"/rest/v1/profiles?select={select}&order=created_at.desc&limit={max(1, min(limit, 500))}"
     if q:
         base += f"&email=ilike.*{q}*"
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(base, headers=headers)
+    client = get_supabase()
+    resp = await client.get(base, timeout=10)
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
     rows = resp.json() or []
@@ -407,6 +400,53 @@ async def list_users(
     return {"count": len(users), "users": users}
 
 
+@router.get("/stats")
+async def admin_stats(
+    Authorization: Optional[str] = Header(default=None),
+    X_Admin_Key: Optional[str] = Header(default=None, alias="X-Admin-Key"),
+) -> Dict[str, Any]:
+    """Numeri della dashboard (utenti, crediti in circolo, addebiti di oggi, ricavi) in una sola chiamata.
+
+    Letti dai contatori della migration 010 (RPC get_admin_stats): il costo non cresce con gli utenti.
+    Senza migration ripiega sul solo conteggio utenti (`count=exact` di PostgREST).
+    """
+    core_admin_key = os.environ.get("CORE_ADMIN_KEY")
+    if not (X_Admin_Key and core_admin_key and X_Admin_Key == core_admin_key):
+        if not Authorization:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
+        token = Authorization.replace("Bearer ", "")
+        await auth_backend.get_current_user(token)
+
+    if not os.environ.get("SUPABASE_URL") or not os.environ.get("SUPABASE_SERVICE_KEY"):
+        raise HTTPException(status_code=500, detail="Supabase non configurato")
+
+    client = get_supabase()
+    resp = await client.rpc("get_admin_stats", {}, timeout=10)
+    if resp.status_code == 200:
+        data = resp.json() or {}
+        return {
+            "users": int(data.get("users") or 0),
+            "credits_outstanding": float(data.get("credits_outstanding") or 0),
+            "credits_debited_today": float(data.get("credits_debited_today") or 0),
+            "revenue_cents": {k: int(v) for k, v in (data.get("revenue_cents") or {}).items()},
+            "source": "counters",
+        }
+    if resp.status_code != 404:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+
+    resp = await client.request("GET", "/rest/v1/profiles?select=id&limit=1", prefer="count=exact", timeout=10)
+    if resp.status_code not in (200, 206):
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    total = (resp.headers.get("content-range") or "").rpartition("/")[2]
+    return {
+        "users": int(total) if total.isdigit() else None,
+        "credits_outstanding": None,
+        "credits_debited_today": None,
+        "revenue_cents": None,
+        "source": "fallback",
+    }
+
+
 # =============================
 # Billing Config (Admin)
 # =============================
@@ -460,7 +500,7 @@ async def test_provider_connection(
         if not Authorization:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
     
-    credentials_mgr = CredentialsManager()
+    credentials_mgr = get_credentials_manager()
     return await credentials_mgr.test_connection(provider)
 
 
@@ -480,10 +520,9 @@ async def rotate_provider_key(
         if not Authorization:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
     
-    credentials_mgr = CredentialsManager()
+    credentials_mgr = get_credentials_manager()
     success = await credentials_mgr.set_credential(payload.provider, payload.credential_key, payload.new_value)
     if success:
-        credentials_mgr.clear_cache()  # Invalida cache
         return {"status": "success", "message": f"Chiave {payload.credential_key} aggiornata"}
     return {"status": "error", "message": "Errore aggiornamento chiave"}
 @router.post("/billing/checkout")
@@ -510,14 +549,12 @@ async def admin_generate_checkout(
         supabase_url = os.environ.get("SUPABASE_URL")
         service_key = os.environ.get("SUPABASE_SERVICE_KEY")
         if supabase_url and service_key:
-            headers = {"apikey": service_key, "Authorization": f"Bearer {service_key}", "Accept": "application/json"}
-            import httpx
-            async with httpx.AsyncClient(timeout=10) as client:
-                r = await client.get(f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=email", headers=headers)
-                if r.status_code == 200:
-                    rows = r.json() or []
-                    if rows:
-                        meta["customer_email"] = rows[0].get("email")
+            client = get_supabase()
+            r = await client.get(f"/rest/v1/profiles?id=eq.{user_id}&select=email", timeout=10)
+            if r.status_code == 200:
+                rows = r.json() or []
+                if rows:
+                    meta["customer_email"] = rows[0].get("email")
 
         # Ottieni dettagli piano se plan_id è specificato
         credits = 0
@@ -564,20 +601,14 @@ async def admin_get_user_credits(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    import httpx
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=id,email,credits", headers=headers)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-        rows = r.json() or []
-        if not rows:
-            return {"found": False}
-        return {"found": True, "profile": rows[0]}
+    client = get_supabase()
+    r = await client.get(f"/rest/v1/profiles?id=eq.{user_id}&select=id,email,credits", timeout=10)
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.text)
+    rows = r.json() or []
+    if not rows:
+        return {"found": False}
+    return {"found": True, "profile": rows[0]}
 
 
 # === SYSTEM CREDENTIALS MANAGEMENT ===
@@ -667,32 +698,26 @@ async def test_supabase_connection(
         if not supabase_url or not service_key:
             return {"success": False, "error": "SUPABASE_URL o SUPABASE_SERVICE_KEY mancanti"}
         
-        import httpx
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json"
-        }
         
-        async with httpx.AsyncClient(timeout=10) as client:
-            # Test con una query semplice per contare le tabelle
-            resp = await client.get(f"{supabase_url}/rest/v1/", headers=headers)
-            if resp.status_code == 200:
-                # Prova a contare le tabelle nella schema public
-                tables_resp = await client.get(
-                    f"{supabase_url}/rest/v1/information_schema.tables?table_schema=eq.public&select=table_name", 
-                    headers=headers
-                )
-                table_count = len(tables_resp.json()) if tables_resp.status_code == 200 else 0
+        client = get_supabase()
+        # Test con una query semplice per contare le tabelle
+        resp = await client.get("/rest/v1/", timeout=10)
+        if resp.status_code == 200:
+            # Prova a contare le tabelle nella schema public
+            tables_resp = await client.get(
+                "/rest/v1/information_schema.tables?table_schema=eq.public&select=table_name",
+                timeout=10
+            )
+            table_count = len(tables_resp.json()) if tables_resp.status_code == 200 else 0
                 
-                return {
-                    "success": True,
-                    "message": "Connessione Supabase OK",
-                    "tables": table_count,
-                    "url": supabase_url[:30] + "..."
-                }
-            else:
-                return {"success": False, "error": f"HTTP {resp.status_code}: {resp.text[:100]}"}
+            return {
+                "success": True,
+                "message": "Connessione Supabase OK",
+                "tables": table_count,
+                "url": supabase_url[:30] + "..."
+            }
+        else:
+            return {"success": False, "error": f"HTTP {resp.status_code}: {resp.text[:100]}"}
                 
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -756,7 +781,7 @@ async def clear_credentials_cache(
     if not (X_Admin_Key and X_Admin_Key == os.environ.get("CORE_ADMIN_KEY")):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Admin key richiesta")
     
-    credentials_mgr = CredentialsManager()
+    credentials_mgr = get_credentials_manager()
     credentials_mgr.clear_cache()
     
     return {
@@ -781,25 +806,19 @@ async def export_credentials(
         if not supabase_url or not service_key:
             raise HTTPException(status_code=500, detail="Supabase non configurato")
         
-        import httpx
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json"
-        }
         
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(f"{supabase_url}/rest/v1/provider_credentials", headers=headers)
-            if resp.status_code == 200:
-                credentials = resp.json()
-                return {
-                    "export_date": "2025-01-27T00:00:00Z",
-                    "credentials_count": len(credentials),
-                    "credentials": credentials,
-                    "note": "Questo backup contiene credenziali criptate. Conserva in luogo sicuro."
-                }
-            else:
-                raise HTTPException(status_code=500, detail="Errore lettura credenziali da Supabase")
+        client = get_supabase()
+        resp = await client.get("/rest/v1/provider_credentials", timeout=10)
+        if resp.status_code == 200:
+            credentials = resp.json()
+            return {
+                "export_date": "2025-01-27T00:00:00Z",
+                "credentials_count": len(credentials),
+                "credentials": credentials,
+                "note": "Questo backup contiene credenziali criptate. Conserva in luogo sicuro."
+            }
+        else:
+            raise HTTPException(status_code=500, detail="Errore lettura credenziali da Supabase")
                 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore esportazione: {str(e)}")
@@ -815,7 +834,7 @@ async def get_credentials_status(
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Admin key richiesta")
     
     try:
-        credentials_mgr = CredentialsManager()
+        credentials_mgr = get_credentials_manager()
         
         if provider == "lemonsqueezy":
             api_key = await credentials_mgr.get_credential("lemonsqueezy", "api_key")
@@ -858,31 +877,26 @@ async def fix_credentials_encryption(
         if not supabase_url or not service_key:
             raise HTTPException(status_code=500, detail="Supabase non configurato")
         
-        import httpx
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json"
-        }
         
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(f"{supabase_url}/rest/v1/provider_credentials", headers=headers)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=500, detail="Errore lettura credenziali da Supabase")
+        client = get_supabase()
+        resp = await client.get("/rest/v1/provider_credentials", timeout=10)
+        if resp.status_code != 200:
+            raise HTTPException(status_code=500, detail="Errore lettura credenziali da Supabase")
             
-            credentials = resp.json()
-            if not credentials:
-                return {"status": "success", "message": "Nessuna credenziale da riparare", "fixed": 0}
+        credentials = resp.json()
+        if not credentials:
+            return {"status": "success", "message": "Nessuna credenziale da riparare", "fixed": 0}
             
-            # Elimina tutte le credenziali esistenti (sono corrotte)
-            delete_resp = await client.delete(f"{supabase_url}/rest/v1/provider_credentials", headers=headers)
+        # Elimina tutte le credenziali esistenti (sono corrotte)
+        delete_resp = await client.delete("/rest/v1/provider_credentials", timeout=10)
+        invalidate_credentials_cache()
             
-            return {
-                "status": "success", 
-                "message": f"Credenziali corrotte eliminate. Ri-inserisci le credenziali nella tab Security.",
-                "deleted": len(credentials),
-                "action_required": "Vai su Configuration → Security e ri-inserisci le credenziali LemonSqueezy e Flowise"
-            }
+        return {
+            "status": "success", 
+            "message": f"Credenziali corrotte eliminate. Ri-inserisci le credenziali nella tab Security.",
+            "deleted": len(credentials),
+            "action_required": "Vai su Configuration → Security e ri-inserisci le credenziali LemonSqueezy e Flowise"
+        }
                 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore riparazione: {str(e)}")
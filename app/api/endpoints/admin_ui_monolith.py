@@ -282,7 +282,7 @@ async def dashboard() -> str:
                     </div>
                     <div class="metric-card card bg-base-100 shadow-xl">
                         <div class="card-body">
-                            <h2 class="card-title text-sm">Revenue Target</h2>
+                            <h2 class="card-title text-sm">Revenue</h2>
                             <p class="text-3xl font-bold" id="metric-revenue">-</p>
                         </div>
                     </div>
@@ -1463,55 +1463,22 @@ async def dashboard() -> str:
                     return;
                 }
                 
-                // Load user count
+                // Aggregated server-side: one call, independent of the number of users
                 try {
-                    const users = await apiCall('/core/v1/admin/users?limit=1');
-                    // API returns {count, users} not {total}
-                    const totalUsers = users.count || users.total || 0;
-                    document.getElementById('metric-users').textContent = totalUsers.toString();
-                    
-                    // If we need total count and current response has limit, get full count
-                    if (totalUsers === 1 && users.users && users.users.length === 1) {
-                        const fullCount = await apiCall('/core/v1/admin/users?limit=1000');
-                        document.getElementById('metric-users').textContent = (fullCount.count || 0).toString();
-                    }
+                    const stats = await apiCall('/core/v1/admin/stats');
+                    const fmt = (v) => (v === null || v === undefined) ? 'N/A' : Number(v).toLocaleString();
+                    document.getElementById('metric-users').textContent = fmt(stats.users);
+                    document.getElementById('metric-credits').textContent = fmt(stats.credits_outstanding);
+                    document.getElementById('metric-credits').title = `Debited today: ${fmt(stats.credits_debited_today)}`;
+                    const revenue = stats.revenue_cents || {};
+                    const currencies = Object.keys(revenue);
+                    document.getElementById('metric-revenue').textContent = stats.revenue_cents === null ? 'N/A'
+                        : (currencies.length ? currencies.map(c => `${(revenue[c] / 100).toLocaleString()} ${c}`).join(' · ') : '$0');
                 } catch (e) {
                     document.getElementById('metric-users').textContent = 'N/A';
-                    console.error('Failed to load users:', e);
-                }
-                
-                // Load pricing config for revenue target
-                try {
-                    const pricing = await apiCall('/core/v1/admin/pricing/config');
-                    const revenue = pricing.monthly_revenue_target_usd || 0;
-                    document.getElementById('metric-revenue').textContent = `$${revenue.toLocaleString()}`;
-                } catch (e) {
-                    // If no config exists, show default value
-                    if (e.message && e.message.includes('422')) {
-                        document.getElementById('metric-revenue').textContent = '$0';
-                        console.log('No pricing config found, using defaults');
-                    } else {
-                        document.getElementById('metric-revenue').textContent = 'N/A';
-                        console.error('Failed to load pricing:', e);
-                    }
-                }
-                
-                // Try to get total credits from all users
-                try {
-                    const users = await apiCall('/core/v1/admin/users?limit=1000');
-                    const totalCredits = users.users ? users.users.reduce((sum, u) => sum + (u.credits || 0), 0) : 0;
-                    document.getElementById('metric-credits').textContent = totalCredits.toLocaleString();
-                    
-                    // Show signup credits info if configured
-                    const pricing = await apiCall('/core/v1/admin/pricing/config');
-                    const signupCredits = pricing.signup_initial_credits || 0;
-                    if (signupCredits > 0) {
-                        const estimatedCost = (users.users?.length || 0) * signupCredits;
-                        document.getElementById('metric-credits').title = `Total: ${totalCredits} | Signup Credits: ${signupCredits} each | Est. Cost: ${estimatedCost} credits`;
-                    }
-                } catch (e) {
                     document.getElementById('metric-credits').textContent = 'N/A';
-                    console.error('Failed to load credits:', e);
+                    document.getElementById('metric-revenue').textContent = 'N/A';
+                    console.error('Failed to load stats:', e);
                 }
                 
                 // Hide setup alert if configured
@@ -2328,11 +2295,43 @@ async def dashboard() -> str:
                 const output = document.getElementById('test-output');
                 output.innerHTML = '<span class="loading loading-spinner loading-md"></span> Executing...';
                 
-                const url = streaming 
-                    ? `/core/v1/flows/execute/stream?app_id=${appId}`
-                    : `/core/v1/flows/execute?app_id=${appId}`;
+                if (streaming) {
+                    // SSE: mostra i token man mano che arrivano
+                    const headers = { 'Content-Type': 'application/json' };
+                    if (state.token) headers['Authorization'] = `Bearer ${state.token}`;
+                    if (state.adminKey) headers['X-Admin-Key'] = state.adminKey;
+                    const response = await fetch(`${state.baseUrl}/core/v1/flows/execute/stream?app_id=${appId}`, {
+                        method: 'POST',
+                        headers,
+                        body: JSON.stringify(body)
+                    });
+                    if (!response.ok) throw new Error(`HTTP ${response.status}: ${await response.text()}`);
+                    const pre = document.createElement('pre');
+                    pre.className = 'json';
+                    output.innerHTML = '';
+                    output.appendChild(pre);
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    const events = [];
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        const parts = buffer.split('\\n\\n');
+                        buffer = parts.pop();
+                        for (const part of parts) {
+                            if (!part.startsWith('data:')) continue;
+                            const evt = JSON.parse(part.slice(5).trim());
+                            if (evt.event === 'token') pre.textContent += evt.data;
+                            else events.push(evt);
+                        }
+                    }
+                    pre.textContent += '\\n\\n' + JSON.stringify(events, null, 2);
+                    return;
+                }
                 
-                const result = await apiCall(url, {
+                const result = await apiCall(`/core/v1/flows/execute?app_id=${appId}`, {
                     method: 'POST',
                     body: JSON.stringify(body)
                 });
@@ -8,6 +8,8 @@ import httpx
 import logging
 import asyncio
 
+from app.services.job_queue import get_job_queue
+
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
@@ -55,8 +57,8 @@ async def signup(payload: SignupPayload) -> Dict[str, Any]:
     email = payload.email.strip()
     
     if user_id:
-        # Avvia provisioning in background
-        asyncio.create_task(_provision_user_after_signup(user_id, email))
+        # Provisioning come job durevole (eseguito subito, ripreso se il worker si riavvia)
+        await get_job_queue().enqueue("signup_provisioning", {"user_id": user_id, "email": email})
         logger.info(f"🚀 Avviato provisioning in background per {email} (user_id={user_id})")
     else:
         logger.warning(f"⚠️ Signup completato ma user_id non trovato nella risposta per {email}")
@@ -133,6 +135,14 @@ async def _provision_user_after_signup(user_id: str, email: str) -> None:
         logger.error(f"❌ Errore generale provisioning post-signup per {email}: {e}")
 
 
+async def _provisioning_job(payload: Dict[str, Any], context: Optional[Dict[str, Any]]) -> None:
+    """Job `signup_provisioning` (vedi app/services/job_queue.py)."""
+    await _provision_user_after_signup(payload["user_id"], payload.get("email") or "")
+
+
+get_job_queue().register("signup_provisioning", _provisioning_job)
+
+
 class LoginPayload(BaseModel):
     email: str
     password: str
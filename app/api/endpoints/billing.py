@@ -1,17 +1,20 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Header, HTTPException, status, Request
+from fastapi import APIRouter, Header, HTTPException, status, Request, Response
 from pydantic import BaseModel, Field
 from typing import Dict, Any, Optional
 from app.adapters.auth_supabase import SupabaseAuthBackend
-from app.services.payments_service import PaymentsService
+from app.services.payments_service import get_payments_service
 from app.adapters.provider_lemonsqueezy import LemonSqueezyAdapter
+from app.services.idempotency_store import get_idempotency_store
+import hashlib
+import os
 
 
 router = APIRouter()
 
 auth_backend = SupabaseAuthBackend()
-payments = PaymentsService()  # Lazy-load provider con config
+payments = get_payments_service()  # Lazy-load provider con config (condiviso col consumer webhook)
 
 
 class CheckoutRequest(BaseModel):
@@ -21,8 +24,16 @@ class CheckoutRequest(BaseModel):
 
 
 @router.get("/plans")
-async def get_plans() -> Dict[str, Any]:
-    return await payments.get_plans()
+async def get_plans(If_None_Match: Optional[str] = Header(default=None, alias="If-None-Match")) -> Response:
+    # Endpoint pubblico ad alto traffico: risposta precalcolata, 304 se il client ha già i piani
+    body, etag = await payments.get_plans_response()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={int(os.environ.get('BILLING_PLANS_MAX_AGE', '60'))}",
+    }
+    if If_None_Match and etag in [t.strip() for t in If_None_Match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.post("/checkout")
@@ -51,7 +62,25 @@ async def webhook(
     logger.info(f"📝 Headers: {dict(request.headers)}")
     logger.info(f"📦 Body length: {len(body)}")
     
-    result = await payments.process_webhook(body=body, signature=signature)
+    # Firma + una sola scrittura dell'evento grezzo (dedup su event_id); accredito nel consumer asincrono
+    result = await payments.ingest_webhook(body=body, signature=signature)
+    if result is not None:
+        logger.info(f"✅ Webhook accodato: {result}")
+        return result
+
+    # Senza migration 008: elaborazione inline. I provider ritentano la consegna con
+    # lo stesso body: l'hash del body fa da chiave idempotente, così un retry non
+    # rielabora né riaccredita. Solo gli esiti "ok" vengono memorizzati (firma non
+    # valida o errori restano ritentabili).
+    event_key = request.headers.get("Idempotency-Key") or hashlib.sha256(body).hexdigest()
+    result = await get_idempotency_store().run(
+        user_id="webhook:billing",
+        key=event_key,
+        route="billing_webhook",
+        request={"body_sha256": hashlib.sha256(body).hexdigest()},
+        call=lambda: payments.process_webhook(body=body, signature=signature),
+        cacheable=lambda r: isinstance(r, dict) and r.get("status") == "ok",
+    )
     logger.info(f"✅ Webhook processato: {result}")
     return result
 
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Header, HTTPException, status, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from starlette.background import BackgroundTask
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
 from app.adapters.auth_supabase import SupabaseAuthBackend
 from app.services.credits_supabase import SupabaseCreditsLedger
 from app.adapters.provider_openrouter import OpenRouterAdapter
@@ -9,10 +10,20 @@ from app.services.pricing_service import AdvancedPricingSystem as PricingService
 from app.adapters.provider_flowise import FlowiseAdapter
 from app.services.openrouter_user_keys import OpenRouterUserKeysService
 from app.services.openrouter_usage_service import OpenRouterUsageService
-from app.services.credentials_manager import CredentialsManager
+from app.services.openrouter_cost_attribution import get_cost_attribution
+from app.services.idempotency_store import get_idempotency_store
+from app.services.admission_control import AdmissionTicket, get_admission_controller
+from app.services.job_queue import get_job_queue
+from app.services.user_context import get_user_context
+from app.services.credentials_manager import get_credentials_manager
+from app.services.chat_cache import CachedChat, chat_cache_key, chat_cache_ttl, get_chat_cache
+from app.services.flow_result_cache import flow_result_cache_key, flow_result_cache_ttl, get_flow_result_cache
+from app.services.flow_single_flight import Flight, billing_shares, coalesce_billing_policy, flow_is_deterministic, get_flow_single_flight
 import logging
 import os
 import asyncio
+import json
+import uuid
 
 router = APIRouter()
 
@@ -24,6 +35,7 @@ class ChatRequest(BaseModel):
     model: str = Field(..., description="Identificatore modello OpenRouter")
     messages: List[ChatMessage] = Field(..., description="Conversazione in formato chat")
     options: Optional[Dict[str, Any]] = Field(default=None, description="Opzioni aggiuntive")
+    stream: bool = Field(default=False, description="Se true, risposta SSE (text/event-stream) chunk per chunk")
 
 class ChatResponse(BaseModel):
     response: Dict[str, Any]
@@ -41,7 +53,7 @@ pricing = PricingService(config_file=os.environ.get("PRICING_CONFIG_FILE", "data
 
 # FlowiseAdapter con credentials manager
 def get_flowise_adapter():
-    credentials_mgr = CredentialsManager()
+    credentials_mgr = get_credentials_manager()
     return FlowiseAdapter(credentials_manager=credentials_mgr)
 
 flowise = get_flowise_adapter()
@@ -55,6 +67,60 @@ def get_usage_service() -> OpenRouterUsageService:
     return OpenRouterUsageService()
 
 
+# Task in background: il loop tiene solo riferimenti deboli, qui restano vivi fino al termine
+_background_tasks: Set["asyncio.Task[Any]"] = set()
+
+
+def _spawn(coro: Awaitable[Any]) -> "asyncio.Task[Any]":
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _sse_response(events: AsyncIterator[bytes], cleanup: Callable[[], Awaitable[None]]) -> StreamingResponse:
+    """StreamingResponse SSE con `cleanup` (addebito, prenotazione, slot di admission) eseguito una sola volta.
+
+    Parte dal `finally` del generatore e comunque dal BackgroundTask della risposta:
+    copre anche il client che si disconnette prima che il body venga iterato.
+    """
+    done = False
+
+    async def _once() -> None:
+        nonlocal done
+        if done:
+            return
+        done = True
+        await cleanup()
+
+    async def _body() -> AsyncIterator[bytes]:
+        try:
+            async for event in events:
+                yield event
+        finally:
+            # Fuori dallo scope eventualmente cancellato dalla disconnessione
+            _spawn(_once())
+
+    try:
+        return StreamingResponse(
+            _body(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            background=BackgroundTask(_once),
+        )
+    except BaseException:
+        _spawn(_once())
+        raise
+
+
+def _chat_cost_credits(model: str, usage: Dict[str, Any], est: float) -> float:
+    """Costo chat da addebitare: `cost_usd` riportato da OpenRouter, stima del modello se assente."""
+    cost_usd = (usage or {}).get("cost_usd")
+    if cost_usd is None:
+        return est
+    return pricing.calculate_operation_cost_credits("openrouter_chat", {"model": model, "cost_usd": cost_usd})
+
+
 @router.get("/providers/flowise/affordability-check")
 async def flowise_affordability_check(
     Authorization: Optional[str] = Header(default=None),
@@ -81,14 +147,11 @@ async def flowise_affordability_check(
         user_id = user["id"]
 
     app_id_for_threshold = X_App_Id or os.environ.get("CORE_APP_ID", "default")
-    # Carica config per leggere la soglia minima configurata in App Affordability
-    try:
-        await pricing._load_from_supabase_async(app_id_for_threshold)
-    except Exception:
-        pass
+    # Snapshot pricing (cache locale con TTL) per leggere la soglia configurata in App Affordability
+    pricing_cfg = await pricing.get_config_snapshot(app_id_for_threshold)
     # Fonte primaria per affordability per-app: flow_costs_usd; fallback legacy a minimum_affordability_per_app
-    flow_map = getattr(pricing.config, "flow_costs_usd", {}) or {}
-    legacy_map = getattr(pricing.config, "minimum_affordability_per_app", {}) or {}
+    flow_map = getattr(pricing_cfg, "flow_costs_usd", {}) or {}
+    legacy_map = getattr(pricing_cfg, "minimum_affordability_per_app", {}) or {}
     min_gate = 0.0
     if app_id_for_threshold in flow_map:
         try:
@@ -131,7 +194,8 @@ async def get_balance(Authorization: Optional[str] = Header(default=None)) -> Di
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
     token = Authorization.replace("Bearer ", "")
     user = await auth_backend.get_current_user(token)
-    credits = await credits_ledger.get_balance(user["id"])
+    # Lettura diretta: lo snapshot del percorso di esecuzione è per processo
+    credits = await credits_ledger.get_balance(user["id"], fresh=True)
     return {"credits": credits}
 
 @router.post("/credits/estimate")
@@ -147,6 +211,7 @@ async def estimate_credits(payload: EstimateRequest, Authorization: Optional[str
 async def openrouter_chat(
     payload: ChatRequest,
     Authorization: Optional[str] = Header(default=None),
+    X_App_Id: Optional[str] = Header(default=None, alias="X-App-Id"),
     Idempotency_Key: Optional[str] = Header(default=None, alias="Idempotency-Key")
 ) -> ChatResponse:
     if not Authorization:
@@ -155,13 +220,213 @@ async def openrouter_chat(
     token = Authorization.replace("Bearer ", "")
     user = await auth_backend.get_current_user(token)
 
+    if payload.stream:
+        # Uno stream non è riproponibile: niente store idempotente; lo slot resta occupato fino a fine stream
+        ticket = await get_admission_controller().acquire(user_id=user["id"], app_id=X_App_Id, route="openrouter_chat")
+        try:
+            return await _openrouter_chat_stream(payload, user, Idempotency_Key, ticket)
+        except BaseException:
+            await get_admission_controller().release(ticket)
+            raise
+
+    # Retry con la stessa Idempotency-Key: risposta salvata, nessuna nuova chiamata/addebito
+    return await get_idempotency_store().run(
+        user_id=user["id"],
+        key=Idempotency_Key,
+        route="openrouter_chat",
+        request=payload.model_dump(),
+        call=lambda: _openrouter_chat_cached_or_admitted(payload, user, X_App_Id, Idempotency_Key),
+    )
+
+
+async def _openrouter_chat_cached_or_admitted(payload: ChatRequest, user: Dict[str, Any], app_id: Optional[str], Idempotency_Key: Optional[str]) -> ChatResponse:
+    """Hit della cache chat senza slot di admission né prenotazione; altrimenti chiamata reale (e salvataggio)."""
+    pricing_cfg = await pricing.get_config_snapshot(app_id or os.environ.get("CORE_APP_ID", "default"))
+    ttl = chat_cache_ttl(payload.model, payload.options, pricing_cfg)
+    cache_key = None
+    if ttl > 0:
+        cache_key = chat_cache_key(app_id, payload.model, [m.model_dump() for m in payload.messages], payload.options)
+        hit = await get_chat_cache().get(cache_key)
+        if hit is not None:
+            return await _cached_chat_response(hit, payload, user["id"], pricing_cfg, Idempotency_Key)
+    result = await _admitted(user["id"], app_id, "openrouter_chat", lambda: _openrouter_chat_for_user(payload, user, Idempotency_Key))
+    if cache_key and _chat_succeeded(result.response):
+        await get_chat_cache().put(cache_key, result.response, result.usage, ttl)
+    return result
+
+
+def _chat_succeeded(response: Dict[str, Any]) -> bool:
+    choices = response.get("choices") if isinstance(response, dict) else None
+    return bool(choices) and not response.get("error")
+
+
+async def _cached_chat_response(hit: CachedChat, payload: ChatRequest, user_id: str, pricing_cfg: Any, Idempotency_Key: Optional[str]) -> ChatResponse:
+    """Risposta dalla cache; l'addebito ridotto è accodato sulla coda job prima di rispondere.
+
+    Gate sul saldo dello snapshot profilo (nessuna prenotazione): 402 come sul percorso senza cache.
+    """
+    amount = pricing.calculate_operation_cost_credits(
+        "openrouter_chat_cached",
+        {"model": payload.model, "cost_usd": hit.usage.get("cost_usd")},
+        config=pricing_cfg,
+    )
+    if amount > 0:
+        ctx = await get_user_context(user_id)
+        if ctx is not None and ctx.credits < amount:
+            raise HTTPException(status_code=402, detail={
+                "error_type": "insufficient_credits",
+                "available_credits": ctx.credits,
+                "minimum_required": amount,
+            })
+        job = {
+            "user_id": user_id,
+            "amount": amount,
+            # Chiave stabile per i retry del job anche senza Idempotency-Key del client
+            "idempotency_key": Idempotency_Key or f"chat-cache-{uuid.uuid4()}",
+        }
+        await _enqueue_cache_hit_debit("chat_cache_debit", job)
+    usage = {**hit.usage, "cost_credits": amount, "cached": True}
+    return ChatResponse(response=hit.response, usage=usage, transaction_id=None)
+
+
+async def _enqueue_cache_hit_debit(kind: str, job: Dict[str, Any]) -> None:
+    # Solo l'inserimento del job è sul percorso della richiesta; l'addebito gira in background
+    try:
+        await get_job_queue().enqueue(kind, job)
+    except Exception as e:
+        logging.warning("Addebito hit cache (%s) non accodato, addebito diretto: %s", kind, e)
+        await _cache_hit_debit_job(job, None)
+
+
+async def _cache_hit_debit_job(payload: Dict[str, Any], context: Optional[Dict[str, Any]]) -> None:
+    """Job `chat_cache_debit` / `flow_cache_debit`: addebito ridotto di una risposta servita dalla cache."""
+    reason = payload.get("reason") or "openrouter_chat_cached"
+    res = await credits_ledger.debit(
+        user_id=payload["user_id"],
+        amount=float(payload["amount"]),
+        reason=reason,
+        idempotency_key=payload.get("idempotency_key"),
+    )
+    if isinstance(res, dict) and res.get("error") == "insufficient_credits":
+        # Saldo sceso dopo il gate (addebiti concorrenti): si addebita il disponibile, mai sotto zero
+        available = float(res.get("available") or 0)
+        logging.warning("Addebito %s ridotto a %.2f per saldo insufficiente (utente %s)", reason, available, payload["user_id"])
+        if available <= 0:
+            return
+        res = await credits_ledger.debit(
+            user_id=payload["user_id"],
+            amount=available,
+            reason=reason,
+            idempotency_key=f"{payload.get('idempotency_key')}:available",
+        )
+    status_code = res.get("status") if isinstance(res, dict) else None
+    if isinstance(status_code, int) and (status_code >= 500 or status_code == 429):
+        raise RuntimeError(f"Addebito {reason} fallito: HTTP {status_code}")
+    if isinstance(res, dict) and res.get("success") is False:
+        # Errore definitivo (utente inesistente, importo non valido): un retry non cambierebbe l'esito
+        logging.error("Addebito %s scartato (utente %s): %s", reason, payload["user_id"], res.get("error"))
+
+
+get_job_queue().register("chat_cache_debit", _cache_hit_debit_job)
+get_job_queue().register("flow_cache_debit", _cache_hit_debit_job)
+
+
+async def _admitted(user_id: str, app_id: Optional[str], route: str, call: Callable[[], Awaitable[Any]]) -> Any:
+    """Esegue `call` dentro uno slot di admission control (429 immediato se i limiti sono esauriti).
+
+    Applicato dentro lo store idempotente: i replay non consumano slot né token.
+    """
+    async with get_admission_controller().slot(user_id=user_id, app_id=app_id, route=route):
+        return await call()
+
+
+async def _openrouter_chat_for_user(payload: ChatRequest, user: Dict[str, Any], Idempotency_Key: Optional[str]) -> ChatResponse:
     est = pricing.calculate_operation_cost_credits("openrouter_chat", {"model": payload.model})
-    debit_res = await credits_ledger.debit(user_id=user["id"], amount=est, reason="openrouter_chat", idempotency_key=Idempotency_Key)
-    response, usage = await openrouter.chat(user_id=user["id"], model=payload.model, messages=[m.model_dump() for m in payload.messages], options=payload.options)
+    # Prenotazione atomica (gate + hold); l'addebito avviene solo se la chat riesce
+    hold = await credits_ledger.reserve(user["id"], est, reason="openrouter_chat")
+    hold_id = hold.get("hold_id") if hold.get("success") else None
+    if not hold_id and hold.get("error") == "insufficient_credits":
+        raise HTTPException(status_code=402, detail={
+            "error_type": "insufficient_credits",
+            "available_credits": hold.get("available"),
+            "minimum_required": hold.get("required"),
+        })
+    try:
+        response, usage = await openrouter.chat(user_id=user["id"], model=payload.model, messages=[m.model_dump() for m in payload.messages], options=payload.options)
+    except Exception:
+        await _release_hold(hold_id)
+        raise
+    # Stessa fonte di costo dello streaming: cost_usd riportato, stima solo se assente
+    debit_res = await _charge(hold_id, user["id"], _chat_cost_credits(payload.model, usage, est), "openrouter_chat", Idempotency_Key)
     txn_id = debit_res.get("transaction_id") if isinstance(debit_res, dict) else None
     return ChatResponse(response=response, usage=usage, transaction_id=txn_id)
 
 
+async def _openrouter_chat_stream(payload: ChatRequest, user: Dict[str, Any], Idempotency_Key: Optional[str], ticket: AdmissionTicket) -> StreamingResponse:
+    """Proxy SSE: prenota la stima, inoltra i chunk e addebita a stream chiuso.
+
+    I chunk upstream vengono letti solo quando il client li consuma
+    (backpressure naturale di StreamingResponse). A fine stream l'usage del
+    chunk finale determina l'addebito; se lo stream si interrompe dopo aver
+    inoltrato contenuto si addebita la stima, altrimenti la prenotazione viene
+    rilasciata.
+    """
+    est = pricing.calculate_operation_cost_credits("openrouter_chat", {"model": payload.model})
+    hold = await credits_ledger.reserve(user["id"], est, reason="openrouter_chat")
+    hold_id = hold.get("hold_id") if hold.get("success") else None
+    if not hold_id and hold.get("error") == "insufficient_credits":
+        raise HTTPException(status_code=402, detail={
+            "error_type": "insufficient_credits",
+            "available_credits": hold.get("available"),
+            "minimum_required": hold.get("required"),
+        })
+    try:
+        upstream = await openrouter.open_stream(user_id=user["id"], model=payload.model, messages=[m.model_dump() for m in payload.messages], options=payload.options)
+    except Exception as e:
+        await _release_hold(hold_id)
+        logging.error(f"❌ Errore apertura stream OpenRouter: {e}")
+        raise HTTPException(status_code=502, detail=f"Errore OpenRouter: {e}")
+
+    async def _finalize() -> None:
+        # Anche su disconnessione del client o body mai iterato
+        try:
+            await upstream.aclose()
+            if upstream.completed:
+                await _charge(hold_id, user["id"], _chat_cost_credits(payload.model, upstream.usage, est), "openrouter_chat", Idempotency_Key)
+            elif upstream.chunks:
+                await _charge(hold_id, user["id"], est, "openrouter_chat", Idempotency_Key)
+            else:
+                await _release_hold(hold_id)
+        except Exception as e:
+            logging.warning("Addebito stream OpenRouter fallito: %s", e)
+        finally:
+            await get_admission_controller().release(ticket)
+
+    return _sse_response(upstream.events(), _finalize)
+
+
+async def _charge(hold_id: Optional[str], user_id: str, amount: float, reason: str, idempotency_key: Optional[str]) -> Dict[str, Any]:
+    """Addebita chiudendo la prenotazione; senza hold (RPC non disponibile) usa debit diretto."""
+    if hold_id:
+        res = await credits_ledger.settle(hold_id, amount, reason=reason)
+        if not (isinstance(res, dict) and res.get("error") == "hold_not_found" and res.get("legacy")):
+            return res
+        # Hold legacy perso (job ripreso da un altro processo): addebito diretto come per `expired`
+    if amount <= 0:
+        return {"success": True, "charged": 0.0}
+    return await credits_ledger.debit(user_id=user_id, amount=amount, reason=reason, idempotency_key=idempotency_key)
+
+
+async def _release_hold(hold_id: Optional[str]) -> None:
+    if not hold_id:
+        return
+    try:
+        await credits_ledger.release(hold_id)
+    except Exception as e:
+        # La prenotazione scade comunque (sweeper)
+        logging.warning("Rilascio hold %s fallito: %s", hold_id, e)
+
+
 class FlowiseRequest(BaseModel):
     flow_id: Optional[str] = None
     flow_key: Optional[str] = None
@@ -178,23 +443,68 @@ async def flowise_execute(
     X_App_Id: Optional[str] = Header(default=None, alias="X-App-Id"),
     Idempotency_Key: Optional[str] = Header(default=None, alias="Idempotency-Key")
 ) -> Dict[str, Any]:
+    as_user_id = payload.data.get("_as_user_id") if isinstance(payload.data, dict) else None
+    user_id = await _resolve_flow_user(Authorization, X_Admin_Key, as_user_id)
+
+    return await get_idempotency_store().run(
+        user_id=user_id,
+        key=Idempotency_Key,
+        route="flowise_execute",
+        request={"app_id": X_App_Id, **payload.model_dump()},
+        call=lambda: _admitted(user_id, X_App_Id, "flowise_execute", lambda: _flowise_execute_for_user(payload, user_id, X_App_Id, Idempotency_Key)),
+    )
+
+
+async def _resolve_flow_user(Authorization: Optional[str], X_Admin_Key: Optional[str], as_user_id: Optional[str]) -> str:
+    """Utente dell'esecuzione: bearer token, oppure impersonificazione admin via X-Admin-Key."""
     # Supporto admin: se X-Admin-Key è valido, consente impersonificazione via _as_user_id senza Authorization
     core_admin_key = os.environ.get("CORE_ADMIN_KEY")
-    user_id: Optional[str] = None
     if X_Admin_Key and core_admin_key and X_Admin_Key == core_admin_key:
-        # Impersonificazione: richiede _as_user_id nel payload.data
-        if not isinstance(payload.data, dict) or not payload.data.get("_as_user_id"):
+        if not as_user_id:
             raise HTTPException(status_code=400, detail="_as_user_id richiesto per esecuzione admin")
-        user_id = str(payload.data.get("_as_user_id"))
-    else:
-        if not Authorization:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
-        token = Authorization.replace("Bearer ", "")
-        user = await auth_backend.get_current_user(token)
-        user_id = user["id"]
+        return str(as_user_id)
+    if not Authorization:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token mancante")
+    token = Authorization.replace("Bearer ", "")
+    user = await auth_backend.get_current_user(token)
+    return user["id"]
+
+
+def _flow_insufficient_credits(
+    payload: FlowiseRequest, flow_id: str, app_id: str, min_gate: float, required: float, available: float,
+) -> HTTPException:
+    detail = {
+        "error_type": "insufficient_credits",
+        "can_afford": False,
+        "estimated_cost": None,
+        "minimum_required": float(required),
+        "available_credits": float(available),
+        "shortage": float(max(0.0, required - available)),
+        "flow_key": payload.flow_key,
+        "flow_id": flow_id,
+        "app_id": app_id,
+    }
+    headers = {
+        "X-Min-Affordability": str(min_gate),
+        "X-App-Id": app_id or "",
+        "X-Available-Credits": str(available),
+    }
+    logging.warning(f"❌ BLOCCATO per crediti insufficienti: {available} < {required}")
+    return HTTPException(status_code=402, detail=detail, headers=headers)
 
+
+async def _prepare_flow_execution(payload: FlowiseRequest, user_id: str, X_App_Id: Optional[str], use_result_cache: bool = False) -> Dict[str, Any]:
+    """Risoluzione flow_key → flow_id, sessione, snapshot pricing e gate+prenotazione crediti.
+
+    Condiviso da esecuzione bufferizzata e streaming. Solleva 404/400/402.
+    Con `use_result_cache` (solo bufferizzata) e un risultato in cache (`cached_result`)
+    applica il gate sul saldo dello snapshot profilo senza prenotare, e ritorna
+    l'addebito ridotto della hit (`cache_hit_credits`); per flow deterministici
+    ritorna anche la chiave di single-flight.
+    """
     flow_id = payload.flow_id
     is_conversational = False  # Default: flow stateless
+    flow_metadata: Any = None
     
     if not flow_id and payload.flow_key:
         from app.services.flowise_config_service import FlowiseConfigService
@@ -203,6 +513,7 @@ async def flowise_execute(
             raise HTTPException(status_code=404, detail=f"flow_config non trovata per app_id={X_App_Id or ''} flow_key={payload.flow_key}")
         flow_id = cfg.get("flow_id")
         is_conversational = bool(cfg.get("is_conversational", False))
+        flow_metadata = cfg.get("metadata")
         if not payload.node_names and isinstance(cfg.get("node_names"), list):
             payload.node_names = [str(n) for n in cfg["node_names"]]
     if not flow_id:
@@ -218,102 +529,329 @@ async def flowise_execute(
     if payload.node_names:
         data_for_adapter["_node_names"] = payload.node_names
 
-    pricing_breakdown = pricing.calculate_flow_pricing(payload.flow_key, flow_id)
-
     # Affordability pre-check per-app: soglia minima per app
     app_id_for_threshold = X_App_Id or os.environ.get("CORE_APP_ID", "default")
     logging.info(f"🔍 INIZIO Pre-check affordability: X_App_Id={X_App_Id}, app_id_for_threshold={app_id_for_threshold}")
-    
-    # CRITICO: ricarica config da Supabase prima del check (default-first)
-    try:
-        fresh_config = await pricing._load_from_supabase_async(app_id_for_threshold)
-        # Sorgente primaria: flow_costs_usd come affordability per app (chiave = app_id).
-        # La mappa legacy minimum_affordability_per_app è tollerata in lettura ma non più scritta.
-        if fresh_config and isinstance(getattr(fresh_config, "flow_costs_usd", None), dict):
-            primary_map = getattr(fresh_config, "flow_costs_usd", {}) or {}
-        else:
-            primary_map = getattr(pricing.config, "flow_costs_usd", {}) or {}
-        min_gate = float(primary_map.get(app_id_for_threshold, 0.0) or 0.0)
-        logging.warning(f"🔍 PCHECK: keys={list(primary_map.keys())} app={app_id_for_threshold} threshold={min_gate}")
-        required = float(min_gate)
-        available = await credits_ledger.get_balance(user_id)
-        logging.warning(f"🔍 PCHECK: app={app_id_for_threshold} threshold={min_gate} available={available} required={required}")
-        
-        if available < required:
-            detail = {
-                "error_type": "insufficient_credits",
-                "can_afford": False,
-                "estimated_cost": None,
-                "minimum_required": float(required),
-                "available_credits": float(available),
-                "shortage": float(max(0.0, required - available)),
-                "flow_key": payload.flow_key,
+
+    # Snapshot pricing (default-first) letto dalla cache locale: nessun I/O se valido.
+    # Lo stesso snapshot è usato per breakdown, gate e addebito di questa richiesta.
+    pricing_cfg = await pricing.get_config_snapshot(app_id_for_threshold)
+    pricing_breakdown = pricing.calculate_flow_pricing(payload.flow_key, flow_id, config=pricing_cfg)
+
+    # Cache risultati (opt-in via flow_configs.metadata): una hit salta Flowise e la prenotazione
+    input_key: Optional[str] = None
+    result_cache_ttl = flow_result_cache_ttl(flow_metadata, is_conversational) if use_result_cache else 0.0
+    deterministic = use_result_cache and flow_is_deterministic(flow_metadata, is_conversational)
+    if result_cache_ttl > 0 or deterministic:
+        input_key = flow_result_cache_key(flow_id, payload.data)
+    # Sorgente primaria: flow_costs_usd come affordability per app (chiave = app_id).
+    # La mappa legacy minimum_affordability_per_app è tollerata in lettura ma non più scritta.
+    primary_map = getattr(pricing_cfg, "flow_costs_usd", {}) or {}
+    min_gate = float(primary_map.get(app_id_for_threshold, 0.0) or 0.0)
+
+    if result_cache_ttl > 0:
+        cached_result = get_flow_result_cache().get(input_key)
+        if cached_result is not None:
+            # Hit: niente Flowise né prenotazione, ma stesso gate (saldo dello snapshot profilo)
+            # e addebito ridotto come per la cache chat
+            hit_credits = pricing.calculate_operation_cost_credits(
+                "flowise_execute_cached",
+                {"flow_key": payload.flow_key, "flow_id": flow_id},
+                config=pricing_cfg,
+            )
+            required = max(min_gate, hit_credits)
+            ctx = await get_user_context(user_id)
+            if ctx is not None and required > 0 and ctx.credits < required:
+                raise _flow_insufficient_credits(payload, flow_id, app_id_for_threshold, min_gate, required, ctx.credits)
+            return {
                 "flow_id": flow_id,
+                "is_conversational": is_conversational,
+                "session_id": None,
+                "data": data_for_adapter,
                 "app_id": app_id_for_threshold,
+                "pricing_cfg": pricing_cfg,
+                "pricing_breakdown": pricing_breakdown,
+                "hold_id": None,
+                "cached_result": cached_result,
+                "cache_hit_credits": hit_credits,
             }
-            headers = {
-                "X-Min-Affordability": str(min_gate),
-                "X-App-Id": app_id_for_threshold or "",
-                "X-Available-Credits": str(available),
-            }
-            logging.warning(f"❌ BLOCCATO per crediti insufficienti: {available} < {required}")
-            raise HTTPException(status_code=402, detail=detail, headers=headers)
+
+    hold_id: Optional[str] = None
+    try:
+        required = float(min_gate)
+        # Gate + prenotazione in un'unica chiamata atomica: nessuna lettura saldo separata,
+        # richieste concorrenti non possono superare il disponibile
+        hold = await credits_ledger.reserve(user_id, required, reason="flowise_execute", min_available=required)
+        logging.info(f"🔍 PCHECK: app={app_id_for_threshold} threshold={min_gate} hold={hold}")
+
+        if hold.get("success"):
+            hold_id = hold.get("hold_id")
+        elif hold.get("error") == "insufficient_credits":
+            available = float(hold.get("available") or 0.0)
+            required = float(hold.get("required") or required)
+            raise _flow_insufficient_credits(payload, flow_id, app_id_for_threshold, min_gate, required, available)
+        else:
+            logging.error(f"❌ Prenotazione crediti non riuscita: {hold}")
     except HTTPException:
         raise
     except Exception as e:
         logging.error(f"❌ ERRORE CRITICO nel pre-check affordability: {e}", exc_info=True)
         # Non bloccare se il pre-check fallisce, ma logga l'errore
 
-    # Usage prima/dopo obbligatorio (no fallback)
-    user_api_key = await get_user_keys_service().get_user_api_key(user_id)
-    usage_before = await get_usage_service().get_usage_usd(user_api_key)
+    return {
+        "flow_id": flow_id,
+        "is_conversational": is_conversational,
+        "session_id": session_id_to_use,
+        "data": data_for_adapter,
+        "app_id": app_id_for_threshold,
+        "pricing_cfg": pricing_cfg,
+        "pricing_breakdown": pricing_breakdown,
+        "hold_id": hold_id,
+        "result_cache": (input_key, result_cache_ttl) if result_cache_ttl > 0 else None,
+        "flight_key": input_key if deterministic else None,
+        "coalesce_policy": coalesce_billing_policy(flow_metadata),
+    }
 
+
+async def _settle_flow_cost(
+    cost_ticket: Any,
+    hold_id: Optional[str],
+    user_id: str,
+    pricing_cfg: Any,
+    Idempotency_Key: Optional[str],
+    participants: Optional[List[Dict[str, Any]]] = None,
+) -> None:
+    """Accoda il settlement del flow sulla coda job durevole (eseguito subito in-process).
+
+    `participants`: chiamanti di un'esecuzione coalizzata, con la quota di costo e il
+    moltiplicatore crediti (pricing della propria app) di ciascuno.
+    """
+    payload = {
+        "user_id": user_id,
+        "hold_id": hold_id,
+        "usage_before": cost_ticket.usage_before,
+        "credit_multiplier": float(pricing_cfg.final_credit_multiplier),
+        "idempotency_key": Idempotency_Key,
+    }
+    if participants:
+        payload["participants"] = participants
     try:
-        result, usage = await flowise.execute(
-            user_id=user_id, 
-            flow_id=flow_id, 
-            data=data_for_adapter,
-            session_id=session_id_to_use  # Passa sessionId se flow conversazionale
-        )
+        await get_job_queue().enqueue("flow_settle", payload, context={"ticket": cost_ticket})
     except Exception as e:
-        logging.error(f"❌ Errore esecuzione Flowise Adapter: {e}", exc_info=True)
+        get_cost_attribution().abandon(cost_ticket)
+        for p in _flow_participants(payload):
+            await _release_hold(p.get("hold_id"))
+        logging.warning("Scheduling async pricing fallito: %s", e)
+
+
+def _flow_participants(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Chiamanti da addebitare per un job `flow_settle` (il solo esecutore se non coalizzato)."""
+    return payload.get("participants") or [{
+        "user_id": payload["user_id"],
+        "hold_id": payload.get("hold_id"),
+        "idempotency_key": payload.get("idempotency_key"),
+        "share": 1.0,
+        "credit_multiplier": payload.get("credit_multiplier"),
+    }]
+
+
+def _flight_participants(leader: Dict[str, Any], followers: List[Dict[str, Any]], policy: str) -> List[Dict[str, Any]]:
+    callers = [leader, *followers]
+    return [{**caller, "share": share} for caller, share in zip(callers, billing_shares(policy, len(callers)))]
+
+
+async def _settle_flow_job(payload: Dict[str, Any], context: Optional[Dict[str, Any]]) -> None:
+    """Job `flow_settle`: attende il delta usage OpenRouter e chiude la prenotazione col costo reale.
+
+    Nel processo che ha eseguito il flow usa il ticket aperto (`context`); ripreso
+    da un altro worker ricostruisce il ticket dall'usage iniziale salvato nel job.
+    Il costo misurato (USD) resta nel payload: un retry ripete solo l'addebito.
+    Ogni partecipante è convertito in crediti col moltiplicatore della propria app.
+    """
+    user_id = payload["user_id"]
+    cost_engine = get_cost_attribution()
+    if payload.get("actual_usd") is None and payload.get("actual_credits") is None:
+        ticket = (context or {}).get("ticket")
+        if ticket is None:
+            api_key = await get_user_keys_service().get_user_api_key(user_id)
+            ticket = cost_engine.resume(api_key, payload.get("usage_before"))
+        attribution = await cost_engine.settle(ticket)
+        delta = attribution.delta_usd
+        if delta is None:
+            logging.warning("OpenRouter delta non disponibile: ub=%s ua=%s", attribution.usage_before, attribution.usage_after)
+            for p in _flow_participants(payload):
+                await _release_hold(p.get("hold_id"))
+            return
+        payload["actual_usd"] = delta
+
+    default_multiplier = float(payload.get("credit_multiplier") or 1.0)
+    # Partecipanti già chiusi registrati nel payload (salvato dalla coda prima del retry):
+    # l'addebito diretto (hold legacy perso o scaduto) non è deduplicato dal ledger,
+    # un retry dopo un errore parziale salta chi è già stato addebitato
+    settled = payload.setdefault("settled", [])
+    for i, p in enumerate(_flow_participants(payload)):
+        if i in settled:
+            continue
+        share = float(p.get("share", 1.0))
+        if share <= 0:
+            await _release_hold(p.get("hold_id"))
+            settled.append(i)
+            continue
+        if payload.get("actual_usd") is not None:
+            multiplier = float(p.get("credit_multiplier") or default_multiplier)
+            amount = round(float(payload["actual_usd"]) * multiplier * share, 2)
+        else:
+            # Job accodato in crediti già convertiti (versione precedente del payload)
+            amount = round(float(payload["actual_credits"]) * share, 2)
+        await _charge_flow_participant(p["user_id"], p.get("hold_id"), amount, p.get("idempotency_key"))
+        settled.append(i)
+
+
+async def _charge_flow_participant(user_id: str, hold_id: Optional[str], amount: float, idempotency_key: Optional[str]) -> None:
+    res = await _charge(hold_id, user_id, amount, "flowise_execute", idempotency_key)
+    if isinstance(res, dict) and res.get("status") == "expired":
+        # Prenotazione scaduta prima del settlement (worker fermo a lungo): addebito diretto
+        res = await credits_ledger.debit(user_id=user_id, amount=amount, reason="flowise_execute", idempotency_key=idempotency_key)
+    status_code = res.get("status") if isinstance(res, dict) else None
+    if isinstance(status_code, int) and (status_code >= 500 or status_code == 429):
+        # Errore transitorio del ledger: il job viene ritentato con backoff
+        raise RuntimeError(f"Addebito flow fallito: HTTP {status_code}")
+
+
+get_job_queue().register("flow_settle", _settle_flow_job)
+
+
+async def _follow_flow_flight(flight: Flight, prep: Dict[str, Any], payload: FlowiseRequest) -> Dict[str, Any]:
+    """Follower di un'esecuzione identica in corso: attende il risultato del leader.
+
+    L'addebito avviene nel settlement del leader secondo la policy del flow.
+    """
+    try:
+        result = await get_flow_single_flight().wait(flight)
+    except Exception as e:
+        await _release_hold(prep["hold_id"])
+        logging.error(f"❌ Errore esecuzione Flowise (coalizzata): {e}")
         raise HTTPException(status_code=502, detail=f"Errore durante l'esecuzione del flow: {e}")
+    return {
+        "payload_sent": prep["data"],
+        "result": result,
+        "pricing": {
+            **prep["pricing_breakdown"],
+            "status": "pending",
+            "mode": "coalesced",
+            "billing_policy": prep["coalesce_policy"],
+        },
+        "flow": {
+            "flow_id": prep["flow_id"],
+            "flow_key": payload.flow_key,
+            "is_conversational": prep["is_conversational"],
+            "session_id": None,
+        },
+        "coalesced": True,
+    }
 
-    # Misura il delta usage via OpenRouter (fonte verità), come InsightDesk
-    # FAST RETURN: ritorna subito il risultato e calcola/debita in background
-    fast_return = os.environ.get("FAST_RETURN_CREDITS", "true").lower() in ("1", "true", "yes")
 
-    async def _process_pricing_async() -> None:
+async def _flowise_execute_for_user(
+    payload: FlowiseRequest,
+    user_id: str,
+    X_App_Id: Optional[str],
+    Idempotency_Key: Optional[str],
+) -> Dict[str, Any]:
+    prep = await _prepare_flow_execution(payload, user_id, X_App_Id, use_result_cache=True)
+    flow_id = prep["flow_id"]
+    is_conversational = prep["is_conversational"]
+    session_id_to_use = prep["session_id"]
+    data_for_adapter = prep["data"]
+    pricing_cfg = prep["pricing_cfg"]
+    pricing_breakdown = prep["pricing_breakdown"]
+    hold_id = prep["hold_id"]
+
+    if prep.get("cached_result") is not None:
+        # Hit: nessuna chiamata a Flowise né misura usage OpenRouter; addebito ridotto sulla coda job
+        hit_credits = float(prep.get("cache_hit_credits") or 0.0)
+        if hit_credits > 0:
+            await _enqueue_cache_hit_debit("flow_cache_debit", {
+                "user_id": user_id,
+                "amount": hit_credits,
+                "reason": "flowise_execute_cached",
+                "idempotency_key": Idempotency_Key or f"flow-cache-{uuid.uuid4()}",
+            })
+        return {
+            "payload_sent": data_for_adapter,
+            "result": prep["cached_result"],
+            "pricing": {
+                **pricing_breakdown,
+                "status": "cached",
+                "mode": "cache",
+                "actual_cost_credits": hit_credits,
+            },
+            "flow": {
+                "flow_id": flow_id,
+                "flow_key": payload.flow_key,
+                "is_conversational": is_conversational,
+                "session_id": None,
+            },
+            "cached": True,
+        }
+
+    # Single-flight: un duplicato di un'esecuzione deterministica in corso attende quella
+    single_flight = get_flow_single_flight()
+    flight_key = prep.get("flight_key")
+    # Il moltiplicatore viaggia col chiamante: i follower possono arrivare da app con pricing diverso
+    caller = {
+        "user_id": user_id,
+        "hold_id": hold_id,
+        "idempotency_key": Idempotency_Key,
+        "credit_multiplier": float(pricing_cfg.final_credit_multiplier),
+    }
+    flight: Optional[Flight] = None
+    if flight_key:
+        joined = single_flight.join(flight_key, caller)
+        if joined is not None:
+            return await _follow_flow_flight(joined, prep, payload)
+        flight = single_flight.lead(flight_key)
+
+    try:
+        # Usage prima/dopo obbligatorio (no fallback)
+        # Cursore usage per chiave: 0-1 chiamate qui, il delta arriva dal settlement
+        user_api_key = await get_user_keys_service().get_user_api_key(user_id)
+        cost_engine = get_cost_attribution()
+        cost_ticket = await cost_engine.begin(user_api_key)
+        usage_before = cost_ticket.usage_before
+
         try:
-            # Parametri più ampi per catturare sottomodelli
-            delta, ub, ua = await get_usage_service().measure_delta_usd(
-                user_api_key,
-                pre_usage_usd=usage_before,
-                warmup_seconds=int(os.environ.get("OR_WARMUP_SECONDS", "4")),
-                attempts=int(os.environ.get("OR_ATTEMPTS", "30")),
-                interval_seconds=int(os.environ.get("OR_INTERVAL", "2")),
-            )
-            if delta is None or (ua is not None and ub is not None and ua < ub):
-                logging.warning("OpenRouter delta non disponibile: ub=%s ua=%s", ub, ua)
-                return
-            actual_usd = round(delta, 6)
-            actual_credits = round(delta * pricing.config.final_credit_multiplier, 2)
-            if actual_credits <= 0:
-                return
-            await credits_ledger.debit(
-                user_id=user_id,
-                amount=actual_credits,
-                reason="flowise_execute",
-                idempotency_key=Idempotency_Key,
+            result, usage = await flowise.execute(
+                user_id=user_id, 
+                flow_id=flow_id, 
+                data=data_for_adapter,
+                session_id=session_id_to_use  # Passa sessionId se flow conversazionale
             )
-        except Exception as bg_e:
-            logging.warning("Async pricing/debit fallito: %s", bg_e)
+        except Exception as e:
+            cost_engine.abandon(cost_ticket)
+            await _release_hold(hold_id)
+            logging.error(f"❌ Errore esecuzione Flowise Adapter: {e}", exc_info=True)
+            raise HTTPException(status_code=502, detail=f"Errore durante l'esecuzione del flow: {e}")
+    except BaseException as e:
+        if flight is not None:
+            # L'errore del leader (anche un annullamento) raggiunge tutti i follower
+            error = e if isinstance(e, Exception) else RuntimeError("esecuzione del leader annullata")
+            single_flight.finish(flight_key, flight, error=error)
+        raise
+
+    followers = single_flight.finish(flight_key, flight, result=result) if flight is not None else []
+    participants = _flight_participants(caller, followers, prep["coalesce_policy"]) if followers else None
+
+    if prep.get("result_cache"):
+        cache_key, cache_ttl = prep["result_cache"]
+        get_flow_result_cache().put(cache_key, result, cache_ttl)
+
+    # Misura il delta usage via OpenRouter (fonte verità), come InsightDesk
+    # FAST RETURN: ritorna subito il risultato e calcola/debita in background
+    fast_return = os.environ.get("FAST_RETURN_CREDITS", "true").lower() in ("1", "true", "yes")
 
     if fast_return:
-        try:
-            asyncio.create_task(_process_pricing_async())
-        except Exception as e:
-            logging.warning("Scheduling async pricing fallito: %s", e)
+        # Job durevole: l'addebito sopravvive a restart/redeploy del worker
+        await _settle_flow_cost(cost_ticket, hold_id, user_id, pricing_cfg, Idempotency_Key, participants=participants)
         # Estrai sessionId dalla risposta Flowise (se presente)
         response_session_id = result.get("sessionId") or result.get("chatId")
         
@@ -334,33 +872,39 @@ async def flowise_execute(
             }
         }
     else:
-        # Modalità sincrona (come prima)
-        delta_usd, usage_b, usage_a = await get_usage_service().measure_delta_usd(
-            user_api_key,
-            pre_usage_usd=usage_before,
-            warmup_seconds=2,
-            attempts=15,
-            interval_seconds=1,
-        )
+        # Modalità sincrona: attende il settlement del cursore
+        attribution = await cost_engine.settle(cost_ticket)
+        delta_usd, usage_b, usage_a = attribution.delta_usd, attribution.usage_before, attribution.usage_after
 
-        if delta_usd is None or (usage_a is not None and usage_b is not None and usage_a < usage_b):
+        if delta_usd is None:
+            for p in participants or [caller]:
+                await _release_hold(p.get("hold_id"))
             raise HTTPException(status_code=502, detail="Impossibile determinare il costo reale da OpenRouter per questa richiesta")
 
         actual_cost_usd = round(delta_usd, 6)
-        actual_cost_credits = round(delta_usd * pricing.config.final_credit_multiplier, 2)
-        usd_multiplier = pricing.config.total_overhead_multiplier * pricing.config.target_margin_multiplier
+        actual_cost_credits = round(delta_usd * pricing_cfg.final_credit_multiplier, 2)
+        if participants:
+            # Quote dei follower addebitate dalla coda job, la quota del leader qui sotto
+            try:
+                await get_job_queue().enqueue("flow_settle", {
+                    "user_id": user_id,
+                    "actual_usd": delta_usd,
+                    "credit_multiplier": float(pricing_cfg.final_credit_multiplier),
+                    "participants": participants[1:],
+                })
+            except Exception as e:
+                for p in participants[1:]:
+                    await _release_hold(p.get("hold_id"))
+                logging.warning("Scheduling addebito follower fallito: %s", e)
+            actual_cost_credits = round(delta_usd * pricing_cfg.final_credit_multiplier * participants[0]["share"], 2)
+        usd_multiplier = pricing_cfg.total_overhead_multiplier * pricing_cfg.target_margin_multiplier
         public_price_usd = round(actual_cost_usd * usd_multiplier, 6)
         total_multiplier_percent = round(usd_multiplier * 100.0, 3)
         markup_percent = round((usd_multiplier - 1.0) * 100.0, 3)
         try:
-            debit_details = await credits_ledger.debit(
-                user_id=user_id, 
-                amount=actual_cost_credits, 
-                reason="flowise_execute", 
-                idempotency_key=Idempotency_Key
-            )
+            debit_details = await _charge(hold_id, user_id, actual_cost_credits, "flowise_execute", Idempotency_Key)
         except Exception as e:
-            logging.error(f"⚠️ Errore gestione crediti per user {user['id']}: {e}", exc_info=True)
+            logging.error(f"⚠️ Errore gestione crediti per user {user_id}: {e}", exc_info=True)
             raise HTTPException(status_code=502, detail="Addebito crediti fallito")
 
         # Estrai sessionId dalla risposta Flowise (se presente)
@@ -391,6 +935,134 @@ async def flowise_execute(
         }
 
 
+class FlowExecuteRequest(BaseModel):
+    flow_key: Optional[str] = None
+    flow_id: Optional[str] = None
+    input: Optional[Any] = Field(default=None, description="Input del flow (stringa o oggetto)")
+    data: Optional[Dict[str, Any]] = None
+    node_names: Optional[List[str]] = None
+    session_id: Optional[str] = None
+    as_user_id: Optional[str] = Field(default=None, description="Impersonificazione (solo con X-Admin-Key)")
+
+    def to_flowise_request(self) -> FlowiseRequest:
+        data: Dict[str, Any] = {**(self.data or {})}
+        if self.input is not None:
+            data.setdefault("input", self.input)
+        return FlowiseRequest(
+            flow_id=self.flow_id,
+            flow_key=self.flow_key,
+            node_names=self.node_names,
+            session_id=self.session_id,
+            data=data,
+        )
+
+
+@router.post("/flows/execute")
+async def flows_execute(
+    payload: FlowExecuteRequest,
+    app_id: Optional[str] = Query(default=None),
+    Authorization: Optional[str] = Header(default=None),
+    X_Admin_Key: Optional[str] = Header(default=None, alias="X-Admin-Key"),
+    X_App_Id: Optional[str] = Header(default=None, alias="X-App-Id"),
+    Idempotency_Key: Optional[str] = Header(default=None, alias="Idempotency-Key")
+) -> Dict[str, Any]:
+    """Esecuzione flow (stessa pipeline di /providers/flowise/execute), usata dalla dashboard."""
+    request = payload.to_flowise_request()
+    user_id = await _resolve_flow_user(Authorization, X_Admin_Key, payload.as_user_id or request.data.get("_as_user_id"))
+    effective_app_id = app_id or X_App_Id
+    return await get_idempotency_store().run(
+        user_id=user_id,
+        key=Idempotency_Key,
+        route="flowise_execute",
+        request={"app_id": effective_app_id, **request.model_dump()},
+        call=lambda: _admitted(user_id, effective_app_id, "flowise_execute", lambda: _flowise_execute_for_user(request, user_id, effective_app_id, Idempotency_Key)),
+    )
+
+
+@router.post("/flows/execute/stream")
+async def flows_execute_stream(
+    payload: FlowExecuteRequest,
+    app_id: Optional[str] = Query(default=None),
+    Authorization: Optional[str] = Header(default=None),
+    X_Admin_Key: Optional[str] = Header(default=None, alias="X-Admin-Key"),
+    X_App_Id: Optional[str] = Header(default=None, alias="X-App-Id"),
+) -> StreamingResponse:
+    """Esecuzione flow in streaming (SSE).
+
+    Stessa risoluzione flow, iniezione chiave OpenRouter e gate di affordability
+    dell'esecuzione bufferizzata; gli eventi Flowise (`token`, `metadata`,
+    `agentReasoning`, ...) vengono inoltrati appena arrivano. In coda il Core
+    emette un evento `core` con flow e pricing (addebito in background).
+    """
+    request = payload.to_flowise_request()
+    user_id = await _resolve_flow_user(Authorization, X_Admin_Key, payload.as_user_id or request.data.get("_as_user_id"))
+    admission = get_admission_controller()
+    ticket = await admission.acquire(user_id=user_id, app_id=app_id or X_App_Id, route="flowise_execute")
+    try:
+        return await _flows_execute_stream_for_user(request, user_id, app_id or X_App_Id, ticket)
+    except BaseException:
+        await admission.release(ticket)
+        raise
+
+
+async def _flows_execute_stream_for_user(request: FlowiseRequest, user_id: str, app_id: Optional[str], ticket: AdmissionTicket) -> StreamingResponse:
+    prep = await _prepare_flow_execution(request, user_id, app_id)
+    hold_id = prep["hold_id"]
+
+    cost_engine = get_cost_attribution()
+    cost_ticket = await cost_engine.begin(await get_user_keys_service().get_user_api_key(user_id))
+    try:
+        upstream = await flowise.open_stream(
+            user_id=user_id,
+            flow_id=prep["flow_id"],
+            data=prep["data"],
+            session_id=prep["session_id"],
+        )
+    except Exception as e:
+        cost_engine.abandon(cost_ticket)
+        await _release_hold(hold_id)
+        logging.error(f"❌ Errore apertura stream Flowise: {e}", exc_info=True)
+        raise HTTPException(status_code=502, detail=f"Errore durante l'esecuzione del flow: {e}")
+
+    async def _events():
+        async for event in upstream.events():
+            yield event
+        summary = {
+            "event": "core",
+            "data": {
+                "flow": {
+                    "flow_id": prep["flow_id"],
+                    "flow_key": request.flow_key,
+                    "is_conversational": prep["is_conversational"],
+                    "session_id": upstream.session_id,
+                },
+                "pricing": {
+                    **prep["pricing_breakdown"],
+                    "status": "pending",
+                    "mode": "async",
+                    "usage_before_usd": cost_ticket.usage_before,
+                },
+            },
+        }
+        yield f"data: {json.dumps(summary, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    async def _finalize() -> None:
+        # Anche su disconnessione del client o body mai iterato: il flow upstream ha comunque consumato
+        try:
+            await upstream.aclose()
+            if upstream.events_count:
+                await _settle_flow_cost(cost_ticket, hold_id, user_id, prep["pricing_cfg"], None)
+            else:
+                cost_engine.abandon(cost_ticket)
+                await _release_hold(hold_id)
+        except Exception as e:
+            logging.warning("Chiusura stream Flowise fallita: %s", e)
+        finally:
+            await get_admission_controller().release(ticket)
+
+    return _sse_response(_events(), _finalize)
+
+
 @router.get("/providers/flowise/pricing")
 async def flowise_pricing(
     Authorization: Optional[str] = Header(default=None),
@@ -435,9 +1107,10 @@ async def flowise_pricing(
             "usage_after_usd": usage_a,
         }
 
+    pricing_cfg = await pricing.get_config_snapshot(os.environ.get("CORE_APP_ID", "default"))
     actual_cost_usd = round(delta_usd, 6)
-    actual_cost_credits = round(delta_usd * pricing.config.final_credit_multiplier, 2)
-    usd_multiplier = pricing.config.total_overhead_multiplier * pricing.config.target_margin_multiplier
+    actual_cost_credits = round(delta_usd * pricing_cfg.final_credit_multiplier, 2)
+    usd_multiplier = pricing_cfg.total_overhead_multiplier * pricing_cfg.target_margin_multiplier
     public_price_usd = round(actual_cost_usd * usd_multiplier, 6)
     total_multiplier_percent = round(usd_multiplier * 100.0, 3)
     markup_percent = round((usd_multiplier - 1.0) * 100.0, 3)
@@ -447,7 +1120,7 @@ async def flowise_pricing(
         "actual_cost_credits": actual_cost_credits,
         "usage_before_usd": usage_b,
         "usage_after_usd": usage_a,
-        "final_credit_multiplier": pricing.config.final_credit_multiplier,
+        "final_credit_multiplier": pricing_cfg.final_credit_multiplier,
         "usd_multiplier": round(usd_multiplier, 6),
         "total_multiplier_percent": total_multiplier_percent,
         "markup_percent": markup_percent,
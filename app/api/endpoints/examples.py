@@ -506,10 +506,10 @@ async def e2e_run() -> Dict[str, Any]:
     pricing = PricingService(config_file=config_path)
     try:
         # Carica pricing 'default' da Supabase per leggere i crediti di signup
-        await pricing._load_from_supabase_async("default")
+        pricing_cfg = await pricing.get_config_snapshot("default")
     except Exception:
-        pass
-    initial_credits = float(getattr(pricing.config, "signup_initial_credits", 0.0) or 0.0)
+        pricing_cfg = pricing.config
+    initial_credits = float(getattr(pricing_cfg, "signup_initial_credits", 0.0) or 0.0)
     
     headers_rw = {"apikey": service_key, "Authorization": f"Bearer {service_key}", "Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=representation"}
     async with httpx.AsyncClient(timeout=10) as client:
@@ -4,10 +4,11 @@ from pydantic import BaseModel
 from typing import List, Dict, Optional
 
 from app.adapters.auth_supabase import SupabaseAuthBackend
-from app.services.pricing_service import PricingConfig, FixedCost, AdvancedPricingSystem as PricingService
+from app.services.pricing_service import PricingConfig, FixedCost, AdvancedPricingSystem as PricingService, invalidate_pricing_cache
 import os
 import json
-import httpx
+
+from app.services.supabase_rest import get_supabase
 
 router = APIRouter()
 auth_backend = SupabaseAuthBackend()
@@ -31,14 +32,7 @@ async def _supabase_get_pricing_config(app_id: str) -> Optional[Dict]:
     service_key = os.environ.get("SUPABASE_SERVICE_KEY")
     if not supabase_url or not service_key:
         return None
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    url = f"{supabase_url}/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config"
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        r = await client.get(url, headers=headers)
+    r = await get_supabase().get(f"/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config", timeout=10.0)
     if r.status_code != 200:
         return None
     data = r.json()
@@ -59,21 +53,23 @@ async def _supabase_upsert_pricing_config(app_id: str, config: Dict) -> bool:
     service_key = os.environ.get("SUPABASE_SERVICE_KEY")
     if not supabase_url or not service_key:
         return False
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates,return=representation",
-    }
     # Hard filter: impedisce che chiavi di billing finiscano in pricing_configs
     filtered = dict(config)
     for k in ["plans", "provider", "lemonsqueezy", "billing", "variant_map"]:
         if k in filtered:
             filtered.pop(k, None)
     payload = {"app_id": app_id, "config": filtered}
-    async with httpx.AsyncClient(timeout=12.0) as client:
-        r = await client.post(f"{supabase_url}/rest/v1/pricing_configs", headers=headers, json=payload)
-    return r.status_code in (200, 201)
+    r = await get_supabase().post(
+        "/rest/v1/pricing_configs",
+        json=payload,
+        prefer="resolution=merge-duplicates,return=representation",
+        timeout=12.0,
+    )
+    ok = r.status_code in (200, 201)
+    if ok:
+        # Il gate di affordability legge snapshot locali: invalida subito
+        invalidate_pricing_cache()
+    return ok
 
 
 async def _supabase_list_all_pricing_configs() -> Optional[List[Dict]]:
@@ -86,13 +82,7 @@ async def _supabase_list_all_pricing_configs() -> Optional[List[Dict]]:
     service_key = os.environ.get("SUPABASE_SERVICE_KEY")
     if not supabase_url or not service_key:
         return None
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    async with httpx.AsyncClient(timeout=12.0) as client:
-        r = await client.get(f"{supabase_url}/rest/v1/pricing_configs?select=app_id,config", headers=headers)
+    r = await get_supabase().get("/rest/v1/pricing_configs?select=app_id,config", timeout=12.0)
     if r.status_code != 200:
         return None
     rows = r.json() or []
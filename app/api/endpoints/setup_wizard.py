@@ -5,7 +5,7 @@ from fastapi import APIRouter, HTTPException, status, Header, Depends
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel, Field
 from typing import Dict, Any, Optional
-from app.services.credentials_manager import CredentialsManager
+from app.services.credentials_manager import CredentialsManager, get_credentials_manager
 from app.services.credits_supabase import SupabaseCreditsLedger
 from app.services.billing_config_service import BillingConfigService
 import secrets
@@ -83,7 +83,7 @@ async def complete_setup(payload: SetupRequest) -> Dict[str, Any]:
             os.environ[key] = value
         
         # 4) Salva credentials criptate (ora Supabase è configurato)
-        credentials_mgr = CredentialsManager(app_id=payload.app_name)
+        credentials_mgr = get_credentials_manager(payload.app_name)
         
         # Salva chiavi LemonSqueezy
         await credentials_mgr.set_credential("lemonsqueezy", "api_key", payload.lemonsqueezy_api_key)
@@ -590,7 +590,7 @@ async def setup_status() -> Dict[str, Any]:
     credentials_mgr_error: Optional[str] = None
     if sections["supabase"]["configured"] and encryption_key:
         try:
-            credentials_mgr = CredentialsManager(app_id=app_id)
+            credentials_mgr = get_credentials_manager(app_id)
         except Exception as exc:  # pylint: disable=broad-except
             credentials_mgr_error = str(exc)
             diagnostics["credentials_error"] = credentials_mgr_error
@@ -725,7 +725,7 @@ async def reset_setup(
         if not X_Admin_Key or not core_admin_key or X_Admin_Key != core_admin_key:
             raise HTTPException(status_code=401, detail="Admin key richiesta per reset setup")
         
-        credentials_mgr = CredentialsManager()
+        credentials_mgr = get_credentials_manager()
         
         # Elimina tutte le credenziali esistenti
         providers_to_reset = ["lemonsqueezy", "flowise"]
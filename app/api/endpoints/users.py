@@ -4,12 +4,13 @@ from fastapi import APIRouter, Header, HTTPException, status
 from pydantic import BaseModel
 from typing import Any, Dict, Optional
 import os
-import httpx
 import secrets
 import logging
 import traceback
 
 from app.services.openrouter_provisioning import OpenRouterProvisioningService
+from app.services.supabase_rest import get_supabase
+from app.services.user_context import invalidate_user_context
 
 logger = logging.getLogger(__name__)
 
@@ -46,20 +47,14 @@ async def admin_create_user(
         raise HTTPException(status_code=400, detail="Email mancante")
     password = payload.password or ("Tmp" + secrets.token_urlsafe(12) + "1!")
 
-    headers_json = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    sb = get_supabase()
 
     # Crea utente Auth
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{supabase_url}/auth/v1/admin/users",
-            headers=headers_json,
-            json={"email": email, "password": password, "email_confirm": True},
-        )
+    r = await sb.post(
+        "/auth/v1/admin/users",
+        json={"email": email, "password": password, "email_confirm": True},
+        timeout=20,
+    )
     if r.status_code not in (200, 201):
         raise HTTPException(status_code=r.status_code, detail=r.text)
     body = r.json() or {}
@@ -74,12 +69,12 @@ async def admin_create_user(
     if payload.last_name: profile_payload["last_name"] = payload.last_name
     if payload.ui_language: profile_payload["ui_language"] = payload.ui_language
     if payload.timezone: profile_payload["timezone"] = payload.timezone
-    async with httpx.AsyncClient(timeout=10) as client:
-        _ = await client.post(
-            f"{supabase_url}/rest/v1/profiles",
-            headers={**headers_json, "Prefer": "resolution=merge-duplicates,return=representation"},
-            json=profile_payload,
-        )
+    _ = await sb.post(
+        "/rest/v1/profiles",
+        json=profile_payload,
+        prefer="resolution=merge-duplicates,return=representation",
+        timeout=10,
+    )
 
     # Accredita crediti iniziali
     from app.api.endpoints.pricing import _supabase_get_pricing_config
@@ -94,7 +89,7 @@ async def admin_create_user(
         ledger = SupabaseCreditsLedger()
         _ = await ledger.credit(user_id=user_id, amount=initial, reason="signup_initial_credits")
         try:
-            credits_after = float(await ledger.get_balance(user_id))
+            credits_after = float(await ledger.get_balance(user_id, fresh=True))
         except Exception:
             credits_after = None
 
@@ -146,87 +141,82 @@ async def admin_get_user(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
+    client = get_supabase()
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        # 1) Dati autenticazione (per email_confirmed_at)
-        auth_user = None
-        try:
-            auth_resp = await client.get(
-                f"{supabase_url}/auth/v1/admin/users/{user_id}",
-                headers=headers
-            )
-            if auth_resp.status_code == 200:
-                auth_user = auth_resp.json()
-        except Exception as e:
-            logger.warning(f"Errore caricamento dati auth per {user_id}: {e}")
-        
-        # 2) Profilo utente
-        profile_resp = await client.get(
-            f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=*",
-            headers=headers
+    # 1) Dati autenticazione (per email_confirmed_at)
+    auth_user = None
+    try:
+        auth_resp = await client.get(
+            f"/auth/v1/admin/users/{user_id}",
+            timeout=10,
         )
-        if profile_resp.status_code != 200:
-            raise HTTPException(status_code=profile_resp.status_code, detail="Errore caricamento profilo")
+        if auth_resp.status_code == 200:
+            auth_user = auth_resp.json()
+    except Exception as e:
+        logger.warning(f"Errore caricamento dati auth per {user_id}: {e}")
         
-        profiles = profile_resp.json()
-        if not profiles:
-            raise HTTPException(status_code=404, detail="Utente non trovato")
+    # 2) Profilo utente
+    profile_resp = await client.get(
+        f"/rest/v1/profiles?id=eq.{user_id}&select=*",
+        timeout=10,
+    )
+    if profile_resp.status_code != 200:
+        raise HTTPException(status_code=profile_resp.status_code, detail="Errore caricamento profilo")
         
-        profile = profiles[0]
+    profiles = profile_resp.json()
+    if not profiles:
+        raise HTTPException(status_code=404, detail="Utente non trovato")
         
-        # Aggiungi dati autenticazione al profilo se disponibili
-        if auth_user:
-            # Supabase Admin API restituisce email_confirmed_at direttamente nell'oggetto user
-            profile['email_confirmed_at'] = auth_user.get('email_confirmed_at') or auth_user.get('confirmed_at')
-            profile['confirmed_at'] = auth_user.get('confirmed_at') or auth_user.get('email_confirmed_at')  # Alias
-            # Log per debug
-            logger.debug(f"User {user_id} - email_confirmed_at: {profile.get('email_confirmed_at')}")
-        else:
-            # Se non riusciamo a ottenere dati auth, imposta a None esplicitamente
-            profile['email_confirmed_at'] = None
-            profile['confirmed_at'] = None
-            logger.warning(f"Impossibile ottenere dati auth per user {user_id}, email_confirmed_at non disponibile")
-
-        # Estrai dati OpenRouter dal profilo
-        openrouter_keys = []
-        if profile.get('openrouter_key_name'):
-            openrouter_keys.append({
-                'key_name': profile.get('openrouter_key_name'),
-                'limit_usd': profile.get('openrouter_key_limit', 0),
-                'is_active': profile.get('openrouter_provisioning_status') == 'active',
-                'created_at': profile.get('openrouter_key_created_at')
-            })
-
-        # 2) Subscription attiva
-        subscription = None
-        try:
-            sub_resp = await client.get(
-                f"{supabase_url}/rest/v1/subscriptions?user_id=eq.{user_id}&status=eq.active&select=*&limit=1",
-                headers=headers
-            )
-            if sub_resp.status_code == 200:
-                subs = sub_resp.json()
-                if subs:
-                    subscription = subs[0]
-        except Exception as e:
-            logger.warning(f"Errore caricamento subscription per {user_id}: {e}")
-
-        # 3) Ultime transazioni crediti (ultime 10)
-        credits_history = []
-        try:
-            history_resp = await client.get(
-                f"{supabase_url}/rest/v1/credit_transactions?user_id=eq.{user_id}&select=*&order=created_at.desc&limit=10",
-                headers=headers
-            )
-            if history_resp.status_code == 200:
-                credits_history = history_resp.json() or []
-        except Exception as e:
-            logger.warning(f"Errore caricamento storico crediti per {user_id}: {e}")
+    profile = profiles[0]
+        
+    # Aggiungi dati autenticazione al profilo se disponibili
+    if auth_user:
+        # Supabase Admin API restituisce email_confirmed_at direttamente nell'oggetto user
+        profile['email_confirmed_at'] = auth_user.get('email_confirmed_at') or auth_user.get('confirmed_at')
+        profile['confirmed_at'] = auth_user.get('confirmed_at') or auth_user.get('email_confirmed_at')  # Alias
+        # Log per debug
+        logger.debug(f"User {user_id} - email_confirmed_at: {profile.get('email_confirmed_at')}")
+    else:
+        # Se non riusciamo a ottenere dati auth, imposta a None esplicitamente
+        profile['email_confirmed_at'] = None
+        profile['confirmed_at'] = None
+        logger.warning(f"Impossibile ottenere dati auth per user {user_id}, email_confirmed_at non disponibile")
+
+    # Estrai dati OpenRouter dal profilo
+    openrouter_keys = []
+    if profile.get('openrouter_key_name'):
+        openrouter_keys.append({
+            'key_name': profile.get('openrouter_key_name'),
+            'limit_usd': profile.get('openrouter_key_limit', 0),
+            'is_active': profile.get('openrouter_provisioning_status') == 'active',
+            'created_at': profile.get('openrouter_key_created_at')
+        })
+
+    # 2) Subscription attiva
+    subscription = None
+    try:
+        sub_resp = await client.get(
+            f"/rest/v1/subscriptions?user_id=eq.{user_id}&status=eq.active&select=*&limit=1",
+            timeout=10,
+        )
+        if sub_resp.status_code == 200:
+            subs = sub_resp.json()
+            if subs:
+                subscription = subs[0]
+    except Exception as e:
+        logger.warning(f"Errore caricamento subscription per {user_id}: {e}")
+
+    # 3) Ultime transazioni crediti (ultime 10)
+    credits_history = []
+    try:
+        history_resp = await client.get(
+            f"/rest/v1/credit_transactions?user_id=eq.{user_id}&select=*&order=created_at.desc&limit=10",
+            timeout=10,
+        )
+        if history_resp.status_code == 200:
+            credits_history = history_resp.json() or []
+    except Exception as e:
+        logger.warning(f"Errore caricamento storico crediti per {user_id}: {e}")
 
     return {
         "status": "success",
@@ -252,42 +242,38 @@ async def admin_delete_user(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
+    client = get_supabase()
 
-    async with httpx.AsyncClient(timeout=20) as client:
-        # 1) Verifica esistenza utente
-        prof_resp = await client.get(
-            f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=email",
-            headers=headers
-        )
-        if prof_resp.status_code != 200 or not prof_resp.json():
-            raise HTTPException(status_code=404, detail="Utente non trovato")
+    # 1) Verifica esistenza utente
+    prof_resp = await client.get(
+        f"/rest/v1/profiles?id=eq.{user_id}&select=email",
+        timeout=20,
+    )
+    if prof_resp.status_code != 200 or not prof_resp.json():
+        raise HTTPException(status_code=404, detail="Utente non trovato")
 
-        # 2) Cancella da Auth Supabase
-        try:
-            auth_resp = await client.delete(
-                f"{supabase_url}/auth/v1/admin/users/{user_id}",
-                headers=headers
-            )
-            if auth_resp.status_code not in (200, 204):
-                logger.warning(f"Errore cancellazione auth per {user_id}: {auth_resp.text}")
-        except Exception as e:
-            logger.warning(f"Errore cancellazione auth per {user_id}: {e}")
-
-        # 3) Cancella profilo (CASCADE dovrebbe gestire le relazioni)
-        profile_resp = await client.delete(
-            f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}",
-            headers=headers
+    # 2) Cancella da Auth Supabase
+    try:
+        auth_resp = await client.delete(
+            f"/auth/v1/admin/users/{user_id}",
+            timeout=20,
+        )
+        if auth_resp.status_code not in (200, 204):
+            logger.warning(f"Errore cancellazione auth per {user_id}: {auth_resp.text}")
+    except Exception as e:
+        logger.warning(f"Errore cancellazione auth per {user_id}: {e}")
+
+    # 3) Cancella profilo (CASCADE dovrebbe gestire le relazioni)
+    profile_resp = await client.delete(
+        f"/rest/v1/profiles?id=eq.{user_id}",
+        timeout=20,
+    )
+    if profile_resp.status_code not in (200, 204):
+        raise HTTPException(
+            status_code=profile_resp.status_code,
+            detail=f"Errore cancellazione profilo: {profile_resp.text}"
         )
-        if profile_resp.status_code not in (200, 204):
-            raise HTTPException(
-                status_code=profile_resp.status_code,
-                detail=f"Errore cancellazione profilo: {profile_resp.text}"
-            )
+    invalidate_user_context(user_id)
 
     return {
         "status": "success",
@@ -322,7 +308,7 @@ async def admin_modify_credits(
     ledger = SupabaseCreditsLedger()
 
     # Verifica esistenza utente
-    balance_before = await ledger.get_balance(user_id)
+    balance_before = await ledger.get_balance(user_id, fresh=True)
     
     # Esegui operazione
     if payload.operation == "credit":
@@ -333,7 +319,7 @@ async def admin_modify_credits(
     if not result.get("success"):
         raise HTTPException(status_code=500, detail=f"Errore operazione crediti: {result.get('error', 'Unknown')}")
     
-    balance_after = await ledger.get_balance(user_id)
+    balance_after = await ledger.get_balance(user_id, fresh=True)
 
     return {
         "status": "success",
@@ -362,32 +348,25 @@ async def admin_get_credits_history(
     if not supabase_url or not service_key:
         raise HTTPException(status_code=500, detail="Supabase non configurato")
 
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-
     # Limita i parametri per sicurezza
     limit = max(1, min(limit, 500))
     offset = max(0, offset)
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        # Ottieni storico con paginazione
-        history_resp = await client.get(
-            f"{supabase_url}/rest/v1/credit_transactions?user_id=eq.{user_id}&select=*&order=created_at.desc&limit={limit}&offset={offset}",
-            headers=headers
-        )
+    # Ottieni storico con paginazione
+    history_resp = await get_supabase().get(
+        f"/rest/v1/credit_transactions?user_id=eq.{user_id}&select=*&order=created_at.desc&limit={limit}&offset={offset}",
+        timeout=10,
+    )
         
-        if history_resp.status_code != 200:
-            raise HTTPException(status_code=history_resp.status_code, detail="Errore caricamento storico")
+    if history_resp.status_code != 200:
+        raise HTTPException(status_code=history_resp.status_code, detail="Errore caricamento storico")
         
-        transactions = history_resp.json() or []
+    transactions = history_resp.json() or []
         
-        # Ottieni balance corrente
-        from app.services.credits_supabase import SupabaseCreditsLedger
-        ledger = SupabaseCreditsLedger()
-        current_balance = await ledger.get_balance(user_id)
+    # Ottieni balance corrente
+    from app.services.credits_supabase import SupabaseCreditsLedger
+    ledger = SupabaseCreditsLedger()
+    current_balance = await ledger.get_balance(user_id, fresh=True)
 
     return {
         "status": "success",
@@ -8,6 +8,7 @@ Contiene le definizioni di base per:
 - CreditsLedger: lettura saldo e addebito crediti
 - PricingEngine: stima costo in crediti
 - ProviderAdapter: esecuzione chiamate al provider (es. OpenRouter)
+- AdmissionCounterStore: contatori di concorrenza e token bucket per l'admission control
 
 Tutti i commenti devono essere in italiano, come da linee guida.
 """
@@ -35,13 +36,25 @@ class CreditsLedger(ABC):
     """Interfaccia per gestione saldo e transazioni crediti."""
 
     @abstractmethod
-    async def get_balance(self, user_id: str) -> float:
-        """Ritorna il saldo crediti attuale dell'utente."""
+    async def get_balance(self, user_id: str, *, fresh: bool = False) -> float:
+        """Ritorna il saldo crediti attuale dell'utente (`fresh`: senza snapshot in cache)."""
 
     @abstractmethod
     async def debit(self, user_id: str, amount: float, reason: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         """Addebita crediti in modo atomico e ritorna i dettagli della transazione."""
 
+    @abstractmethod
+    async def reserve(self, user_id: str, amount: float, *, reason: str = "hold", min_available: float = 0.0) -> Dict[str, Any]:
+        """Prenota crediti (gate di affordability + hold atomici); ritorna `hold_id` se riuscito."""
+
+    @abstractmethod
+    async def settle(self, hold_id: str, actual: float, reason: Optional[str] = None) -> Dict[str, Any]:
+        """Chiude la prenotazione addebitando il costo reale."""
+
+    @abstractmethod
+    async def release(self, hold_id: str) -> Dict[str, Any]:
+        """Rilascia la prenotazione senza addebito."""
+
 
 class PricingEngine(ABC):
     """Interfaccia per la stima dei costi in crediti."""
@@ -59,6 +72,21 @@ class ProviderAdapter(ABC):
         """Esegue una chat e ritorna (response, usage)."""
 
 
+class AdmissionCounterStore(ABC):
+    """Interfaccia per i contatori dell'admission control (memoria o condivisi tra worker)."""
+
+    @abstractmethod
+    async def acquire(self, scope: str, limit: int, ttl_seconds: float) -> Optional[str]:
+        """Occupa uno slot di `scope` se ce ne sono meno di `limit`; ritorna l'id del lease o None."""
+
+    @abstractmethod
+    async def release(self, scope: str, lease_id: str) -> None:
+        """Libera lo slot ottenuto con `acquire`."""
+
+    @abstractmethod
+    async def take_token(self, scope: str, rate: float, burst: float) -> float:
+        """Consuma un token dal bucket di `scope`; ritorna 0 se concesso, altrimenti i secondi di attesa."""
+
 
 class BillingProvider(ABC):
     """Interfaccia per provider di pagamento.
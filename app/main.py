@@ -1,12 +1,11 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import Dict
+from typing import Dict, Optional
 import os
 from dotenv import load_dotenv
 import asyncio
 from datetime import datetime, timedelta, timezone
-import httpx
 from pathlib import Path
 from fastapi.responses import Response
 
@@ -14,6 +13,8 @@ from fastapi.responses import Response
 load_dotenv()
 
 from app.api.router import api_router
+from app.services.metrics import MetricsMiddleware, get_metrics_registry, render_metrics
+from app.services.supabase_rest import get_supabase
 
 app = FastAPI(
     title="Flow Starter Core API",
@@ -45,6 +46,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latenza per route su /metrics (ASGI puro, esterno a CORS)
+app.add_middleware(MetricsMiddleware)
+
 # Monta router principale
 app.include_router(api_router, prefix="/core/v1")
 
@@ -68,30 +72,91 @@ async def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
+def _register_stats_collectors() -> None:
+    """Stats dei componenti di processo esposte come gauge su /metrics."""
+    from app.adapters.auth_supabase import get_auth_cache_stats
+    from app.services.admission_control import get_admission_stats
+    from app.services.billing_config_service import get_billing_config_cache_stats
+    from app.services.chat_cache import get_chat_cache_stats
+    from app.services.credentials_manager import get_credentials_cache_stats
+    from app.services.flow_result_cache import get_flow_result_cache_stats
+    from app.services.flow_single_flight import get_flow_single_flight_stats
+    from app.services.flowise_config_service import get_flow_config_cache_stats
+    from app.services.idempotency_store import get_idempotency_store
+    from app.services.job_queue import get_job_queue
+    from app.services.openrouter_cost_attribution import get_cost_attribution
+    from app.services.user_context import get_user_context_stats
+
+    registry = get_metrics_registry()
+    registry.register_stats("auth", get_auth_cache_stats)
+    registry.register_stats("admission", get_admission_stats)
+    registry.register_stats("billing_config_cache", get_billing_config_cache_stats)
+    registry.register_stats("chat_cache", get_chat_cache_stats)
+    registry.register_stats("credentials_cache", get_credentials_cache_stats)
+    registry.register_stats("flow_config_cache", get_flow_config_cache_stats)
+    registry.register_stats("flow_result_cache", get_flow_result_cache_stats)
+    registry.register_stats("flow_single_flight", get_flow_single_flight_stats)
+    registry.register_stats("idempotency", lambda: get_idempotency_store().stats())
+    registry.register_stats("job_queue", lambda: get_job_queue().stats())
+    registry.register_stats("cost_attribution", lambda: get_cost_attribution().stats())
+    registry.register_stats("user_context", get_user_context_stats)
+
+
+_register_stats_collectors()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(Authorization: Optional[str] = Header(default=None)) -> Response:
+    """Metriche Prometheus (text exposition). Con CORE_METRICS_TOKEN richiede il Bearer."""
+    token = os.environ.get("CORE_METRICS_TOKEN")
+    if token and Authorization != f"Bearer {token}":
+        return Response(status_code=401)
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # =============================
 # Rollout Scheduler (opzionale)
 # =============================
 
 async def _has_run_this_month(supabase_url: str, service_key: str) -> bool:
-    """Controlla se esiste già un run di rollout nel mese corrente (UTC)."""
+    """Controlla se esiste già un run di rollout completato nel mese corrente (UTC).
+
+    Un run rimasto 'running' (crash) non conta: lo riprende il controllo
+    giornaliero dello scheduler (`_has_interrupted_run`), dal checkpoint e senza
+    doppi accrediti.
+    """
     now = datetime.now(timezone.utc)
     start_month = datetime(year=now.year, month=now.month, day=1, tzinfo=timezone.utc)
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Accept": "application/json",
-    }
-    url = (
-        f"{supabase_url}/rest/v1/credits_rollout_runs"
+    path = (
+        "/rest/v1/credits_rollout_runs"
+        f"?run_timestamp=gte.{start_month.isoformat()}&status=eq.completed&select=id&limit=1"
+    )
+    legacy_path = (
+        "/rest/v1/credits_rollout_runs"
         f"?run_timestamp=gte.{start_month.isoformat()}&select=id&limit=1"
     )
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            r = await client.get(url, headers=headers)
-            if r.status_code != 200:
-                return False
-            rows = r.json() or []
-            return len(rows) > 0
+        r = await get_supabase().get(path, timeout=8.0)
+        if r.status_code == 400:
+            # Schema senza colonna status (migration 002 non applicata)
+            r = await get_supabase().get(legacy_path, timeout=8.0)
+        if r.status_code != 200:
+            return False
+        rows = r.json() or []
+        return len(rows) > 0
+    except Exception:
+        return False
+
+
+async def _has_interrupted_run(app_id: str) -> bool:
+    """True se il run del mese corrente per `app_id` è rimasto 'running' (crash o redeploy)."""
+    period = datetime.now(timezone.utc).strftime("%Y-%m")
+    path = f"/rest/v1/credits_rollout_runs?app_id=eq.{app_id}&period=eq.{period}&status=eq.running&select=id&limit=1"
+    try:
+        r = await get_supabase().get(path, timeout=8.0)
+        if r.status_code != 200:
+            return False
+        return len(r.json() or []) > 0
     except Exception:
         return False
 
@@ -99,6 +164,9 @@ async def _has_run_this_month(supabase_url: str, service_key: str) -> bool:
 async def _rollout_scheduler_loop() -> None:
     """Loop semplice: ogni giorno all'ora configurata controlla ed esegue rollout mensile se necessario.
 
+    Il primo del mese avvia il run; negli altri giorni riprende dal checkpoint
+    un run del mese rimasto 'running'.
+
     Env:
       CORE_ENABLE_ROLLOUT_SCHEDULER = '1' per attivare
       CORE_ROLLOUT_TIME_UTC = '03:00' (HH:MM) default
@@ -131,10 +199,10 @@ async def _rollout_scheduler_loop() -> None:
 
         # È arrivata l'ora del controllo
         try:
-            # Condizione di esecuzione: primo giorno del mese o force_daily per test
+            # Condizione di esecuzione: primo giorno del mese, run interrotto da riprendere o force_daily per test
             now2 = datetime.now(timezone.utc)
             is_first_day = now2.day == 1
-            if not (is_first_day or force_daily):
+            if not (is_first_day or force_daily or await _has_interrupted_run(app_id)):
                 continue
 
             # Evita doppi run controllando se c'è già un run nel mese
@@ -150,7 +218,77 @@ async def _rollout_scheduler_loop() -> None:
             print(f"[rollout] error: {e}")
 
 
+async def _maintenance_loop() -> None:
+    """Manutenzione periodica: prenotazioni crediti, chiavi idempotenti, lease di admission, job conclusi e cache chat su disco."""
+    interval = max(5, int(os.environ.get("CREDIT_HOLD_SWEEP_INTERVAL", "60")))
+    from app.services.credits_supabase import SupabaseCreditsLedger
+    from app.services.idempotency_store import get_idempotency_store
+    from app.services.admission_control import PostgresCounterStore, get_admission_controller
+    from app.services.job_queue import get_job_queue
+    from app.services.chat_cache import get_chat_cache
+    ledger = SupabaseCreditsLedger()
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            expired = await ledger.expire_holds()
+            if expired:
+                print(f"[holds] expired={expired}")
+            await get_idempotency_store().purge_expired()
+            store = get_admission_controller().store
+            if isinstance(store, PostgresCounterStore):
+                await store.purge()
+            await get_job_queue().purge_finished()
+            await get_chat_cache().purge_disk()
+        except Exception as e:
+            print(f"[maintenance] error: {e}")
+
+
+async def _webhook_consumer_loop() -> None:
+    """Consumer dei webhook billing persistiti (risvegliato a ogni ingestione)."""
+    from app.services.payments_service import get_payments_service
+    payments = get_payments_service()
+    interval = max(1.0, float(os.environ.get("WEBHOOK_CONSUMER_INTERVAL", "5")))
+    while True:
+        try:
+            processed = await payments.consume_webhooks()
+            if processed:
+                print(f"[webhooks] processed={processed}")
+                continue
+        except Exception as e:
+            print(f"[webhooks] error: {e}")
+        await payments.wait_for_webhooks(interval)
+
+
+async def _preload_credentials() -> None:
+    """Carica le credenziali provider dell'app prima delle prime richieste."""
+    try:
+        from app.services.credentials_manager import get_credentials_manager
+        await get_credentials_manager().preload()
+    except Exception as e:
+        print(f"[credentials] preload error: {e}")
+
+
 @app.on_event("startup")
 async def _startup_tasks() -> None:
+    # Pool HTTP condiviso verso Supabase (keep-alive, HTTP/2 se disponibile);
+    # OpenRouter/Flowise/LemonSqueezy hanno pool separati creati on-demand (upstream_pools)
+    await get_supabase().start()
     if os.environ.get("CORE_ENABLE_ROLLOUT_SCHEDULER", "0").lower() in ("1", "true", "yes"):
         asyncio.create_task(_rollout_scheduler_loop())
+    if os.environ.get("SUPABASE_URL") and os.environ.get("CREDIT_HOLD_SWEEP_INTERVAL", "60") != "0":
+        asyncio.create_task(_maintenance_loop())
+    if os.environ.get("SUPABASE_URL"):
+        # Pool di recupero job (orfani/retry); i nuovi job partono subito nel processo che li crea
+        from app.services.job_queue import get_job_queue
+        await get_job_queue().start()
+        asyncio.create_task(_webhook_consumer_loop())
+        asyncio.create_task(_preload_credentials())
+
+
+@app.on_event("shutdown")
+async def _shutdown_tasks() -> None:
+    from app.services.job_queue import get_job_queue
+    await get_job_queue().stop()
+    await get_supabase().aclose()
+    from app.services.upstream_pools import get_upstream_pools
+    await get_upstream_pools().aclose()
@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+"""
+Admission control per i proxy provider (Flowise, OpenRouter)
+============================================================
+Nessun limite impediva a un singolo client di tenere in volo decine di flow
+Flowise da 600s, esaurendo connessioni e file descriptor del worker per tutti.
+Prima di eseguire, ogni richiesta deve ottenere:
+
+1. uno slot di concorrenza per utente, per app e globale;
+2. un token dal bucket dell'utente e da quello dell'app (rate limit con burst).
+
+Il token si spende solo dopo aver ottenuto lo slot: una richiesta respinta per
+concorrenza non consuma budget di rate.
+
+Se uno dei limiti è esaurito la richiesta riceve subito 429 con `Retry-After`
+(nessuna coda: un tenant che fa burst non occupa il worker in attesa). Il cap
+per-utente sotto quello per-app e quello globale garantisce che i restanti
+slot restino disponibili agli altri tenant.
+
+Il limite globale è per processo (protegge le risorse del worker); i contatori
+per utente/app sono pluggable (`AdmissionCounterStore`): in memoria, oppure su
+Postgres (migration 006) per limiti condivisi tra più worker. Se le RPC non
+sono disponibili lo store Postgres ripiega sulla memoria.
+
+Disattivato di default: attivarlo cambia il comportamento per i client
+esistenti, i limiti vanno tarati sul traffico reale prima del rollout.
+
+Env (0 = limite disattivato):
+- ADMISSION_ENABLED (default 0)
+- ADMISSION_BACKEND (memory | postgres, default memory)
+- ADMISSION_MAX_INFLIGHT (globale per worker, default 200)
+- ADMISSION_MAX_INFLIGHT_PER_USER (default 4)
+- ADMISSION_MAX_INFLIGHT_PER_APP (default 50)
+- ADMISSION_USER_RATE / ADMISSION_USER_BURST (richieste/s, default 1 / 10)
+- ADMISSION_APP_RATE / ADMISSION_APP_BURST (default 20 / 100)
+- ADMISSION_LEASE_TTL (scadenza slot condivisi, default 900s)
+- ADMISSION_RETRY_AFTER (Retry-After su concorrenza esaurita, default 1s)
+"""
+
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import logging
+import math
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from app.core.interfaces import AdmissionCounterStore
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+class InMemoryCounterStore(AdmissionCounterStore):
+    """Contatori del singolo processo (nessun I/O)."""
+
+    _PRUNE_THRESHOLD = 10000
+
+    def __init__(self) -> None:
+        self._leases: Dict[str, Dict[str, float]] = {}
+        # scope -> (token, ultimo aggiornamento, rate, burst)
+        self._buckets: Dict[str, Tuple[float, float, float, float]] = {}
+
+    async def acquire(self, scope: str, limit: int, ttl_seconds: float) -> Optional[str]:
+        now = time.monotonic()
+        leases = self._leases.setdefault(scope, {})
+        for lease_id, expires_at in list(leases.items()):
+            if expires_at <= now:
+                leases.pop(lease_id, None)
+        if len(leases) >= limit:
+            return None
+        lease_id = uuid.uuid4().hex
+        leases[lease_id] = now + ttl_seconds
+        return lease_id
+
+    async def release(self, scope: str, lease_id: str) -> None:
+        leases = self._leases.get(scope)
+        if leases is None:
+            return
+        leases.pop(lease_id, None)
+        if not leases:
+            self._leases.pop(scope, None)
+
+    async def take_token(self, scope: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(scope, (burst, now, rate, burst))[:2]
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1.0:
+            self._buckets[scope] = (tokens - 1.0, now, rate, burst)
+            return 0.0
+        self._buckets[scope] = (tokens, now, rate, burst)
+        if len(self._buckets) > self._PRUNE_THRESHOLD:
+            self._prune(now)
+        return (1.0 - tokens) / rate
+
+    def _prune(self, now: float) -> None:
+        # Un bucket già ricaricato al massimo (con rate e burst propri) equivale a uno assente
+        for scope, (tokens, updated, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                self._buckets.pop(scope, None)
+
+    def inflight(self) -> int:
+        return sum(len(v) for v in self._leases.values())
+
+
+class PostgresCounterStore(AdmissionCounterStore):
+    """Contatori condivisi tra worker via RPC (migration 006), con fallback in memoria."""
+
+    def __init__(self) -> None:
+        self._fallback = InMemoryCounterStore()
+        self._available: Optional[bool] = None
+
+    def _enabled(self) -> bool:
+        return self._available is not False and get_supabase().configured
+
+    def _mark_missing(self, status_code: int) -> bool:
+        # 404 = RPC assente (migration 006 non applicata): contatori solo in memoria
+        if status_code == 404:
+            if self._available is not False:
+                logger.warning("⚠️ RPC admission_* assenti: admission control solo in memoria")
+            self._available = False
+            return True
+        return False
+
+    async def acquire(self, scope: str, limit: int, ttl_seconds: float) -> Optional[str]:
+        if not self._enabled():
+            return await self._fallback.acquire(scope, limit, ttl_seconds)
+        try:
+            resp = await get_supabase().rpc(
+                "admission_acquire",
+                {"p_scope": scope, "p_limit": limit, "p_ttl_seconds": int(math.ceil(ttl_seconds))},
+                timeout=5,
+            )
+            if self._mark_missing(resp.status_code):
+                return await self._fallback.acquire(scope, limit, ttl_seconds)
+            if resp.status_code == 200:
+                self._available = True
+                data = resp.json() or {}
+                return str(data["lease_id"]) if data.get("admitted") else None
+            logger.warning("admission_acquire %s: HTTP %s", scope, resp.status_code)
+        except Exception as e:
+            logger.warning("admission_acquire %s fallita: %s", scope, e)
+        # Errore transitorio: limite locale al posto di bloccare il traffico
+        return await self._fallback.acquire(scope, limit, ttl_seconds)
+
+    async def release(self, scope: str, lease_id: str) -> None:
+        # I lease locali sono esadecimali senza trattini, quelli del DB sono uuid
+        if "-" not in lease_id:
+            await self._fallback.release(scope, lease_id)
+            return
+        try:
+            await get_supabase().rpc("admission_release", {"p_lease_id": lease_id}, timeout=5)
+        except Exception as e:
+            # Il lease scade comunque (ADMISSION_LEASE_TTL)
+            logger.warning("admission_release %s fallita: %s", lease_id, e)
+
+    async def take_token(self, scope: str, rate: float, burst: float) -> float:
+        if not self._enabled():
+            return await self._fallback.take_token(scope, rate, burst)
+        try:
+            resp = await get_supabase().rpc(
+                "admission_take_token",
+                {"p_scope": scope, "p_rate": rate, "p_burst": burst},
+                timeout=5,
+            )
+            if self._mark_missing(resp.status_code):
+                return await self._fallback.take_token(scope, rate, burst)
+            if resp.status_code == 200:
+                self._available = True
+                data = resp.json() or {}
+                return 0.0 if data.get("allowed") else float(data.get("retry_after") or 1.0)
+            logger.warning("admission_take_token %s: HTTP %s", scope, resp.status_code)
+        except Exception as e:
+            logger.warning("admission_take_token %s fallita: %s", scope, e)
+        return await self._fallback.take_token(scope, rate, burst)
+
+    async def purge(self) -> None:
+        """Elimina lease scaduti e bucket inattivi (chiamato dal loop di manutenzione)."""
+        if not self._enabled():
+            return
+        resp = await get_supabase().rpc("admission_purge", {}, timeout=30)
+        self._mark_missing(resp.status_code)
+
+
+@dataclass
+class AdmissionTicket:
+    """Slot ottenuti da una richiesta ammessa; da rilasciare a fine esecuzione."""
+
+    route: str
+    leases: List[Tuple[str, str]] = field(default_factory=list)
+    holds_global: bool = False
+    released: bool = False
+
+
+class AdmissionController:
+    """Rate limit e concorrenza per utente, app e processo."""
+
+    def __init__(self, store: Optional[AdmissionCounterStore] = None) -> None:
+        self.store = store or self._store_from_env()
+        self._global_inflight = 0
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_concurrency = 0
+
+    @staticmethod
+    def _store_from_env() -> AdmissionCounterStore:
+        backend = os.environ.get("ADMISSION_BACKEND", "memory").strip().lower()
+        if backend in ("postgres", "supabase"):
+            return PostgresCounterStore()
+        return InMemoryCounterStore()
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.environ.get("ADMISSION_ENABLED", "0").lower() in ("1", "true", "yes")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "admitted": self.admitted,
+            "rejected_rate": self.rejected_rate,
+            "rejected_concurrency": self.rejected_concurrency,
+            "inflight": self._global_inflight,
+            "backend": type(self.store).__name__,
+        }
+
+    async def acquire(self, *, user_id: str, app_id: Optional[str], route: str) -> AdmissionTicket:
+        """Ammette la richiesta o solleva 429 con Retry-After."""
+        ticket = AdmissionTicket(route=route)
+        if not self.enabled():
+            return ticket
+        app_scope = app_id or os.environ.get("CORE_APP_ID", "default")
+
+        # 1) Concorrenza: globale del processo, poi utente e app
+        max_global = int(_env_float("ADMISSION_MAX_INFLIGHT", 200))
+        if max_global > 0:
+            if self._global_inflight >= max_global:
+                self.rejected_concurrency += 1
+                raise self._too_many("Server occupato: troppe esecuzioni in corso", _env_float("ADMISSION_RETRY_AFTER", 1.0))
+            self._global_inflight += 1
+            ticket.holds_global = True
+
+        try:
+            ttl = _env_float("ADMISSION_LEASE_TTL", 900.0)
+            for scope, limit_env, limit_default, label in (
+                (f"user:{user_id}", "ADMISSION_MAX_INFLIGHT_PER_USER", 4, "utente"),
+                (f"app:{app_scope}", "ADMISSION_MAX_INFLIGHT_PER_APP", 50, "app"),
+            ):
+                limit = int(_env_float(limit_env, limit_default))
+                if limit <= 0:
+                    continue
+                lease_id = await self.store.acquire(scope, limit, ttl)
+                if lease_id is None:
+                    self.rejected_concurrency += 1
+                    raise self._too_many(
+                        f"Troppe esecuzioni in corso per {label} (max {limit})",
+                        _env_float("ADMISSION_RETRY_AFTER", 1.0),
+                    )
+                ticket.leases.append((scope, lease_id))
+
+            # 2) Rate limit (token bucket), solo con lo slot ottenuto: prima l'utente, poi l'app
+            for scope, rate_env, burst_env, rate_default, burst_default in (
+                (f"user:{user_id}", "ADMISSION_USER_RATE", "ADMISSION_USER_BURST", 1.0, 10.0),
+                (f"app:{app_scope}", "ADMISSION_APP_RATE", "ADMISSION_APP_BURST", 20.0, 100.0),
+            ):
+                rate = _env_float(rate_env, rate_default)
+                if rate <= 0:
+                    continue
+                burst = max(1.0, _env_float(burst_env, burst_default))
+                wait = await self.store.take_token(scope, rate, burst)
+                if wait > 0:
+                    self.rejected_rate += 1
+                    raise self._too_many(f"Troppe richieste ({scope.split(':', 1)[0]}): riprova tra poco", wait)
+        except BaseException:
+            await self.release(ticket)
+            raise
+
+        self.admitted += 1
+        return ticket
+
+    async def release(self, ticket: Optional[AdmissionTicket]) -> None:
+        """Libera gli slot del ticket (idempotente)."""
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        if ticket.holds_global:
+            self._global_inflight = max(0, self._global_inflight - 1)
+        for scope, lease_id in ticket.leases:
+            try:
+                await self.store.release(scope, lease_id)
+            except Exception as e:
+                logger.warning("Rilascio slot %s fallito: %s", scope, e)
+
+    @asynccontextmanager
+    async def slot(self, *, user_id: str, app_id: Optional[str], route: str) -> AsyncIterator[AdmissionTicket]:
+        """`async with`: slot occupato per tutta la durata del blocco."""
+        ticket = await self.acquire(user_id=user_id, app_id=app_id, route=route)
+        try:
+            yield ticket
+        finally:
+            await self.release(ticket)
+
+    @staticmethod
+    def _too_many(detail: str, retry_after: float) -> HTTPException:
+        return HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(math.ceil(retry_after))))},
+        )
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """Admission controller condiviso del processo."""
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController()
+    return _controller
+
+
+def get_admission_stats() -> Dict[str, Any]:
+    return get_admission_controller().stats()
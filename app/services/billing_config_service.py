@@ -9,9 +9,80 @@ Campi attesi in config (JSON):
 - plans: [ { id, name, credits_per_month, price_usd, provider_variant_id? } ]
 """
 
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
+import logging
 import os
-import httpx
+import time
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+class BillingConfigCache:
+    """Snapshot in-process di `billing_configs` per app_id, con TTL e invalidazione versionata.
+
+    Come per il pricing, gli snapshot sono immutabili: chi li riceve non li
+    modifica e un reload crea un nuovo oggetto. L'identità dello snapshot è
+    usata da PaymentsService per ricostruire adapter e risposta piani solo
+    quando la config cambia.
+
+    Env:
+    - BILLING_CONFIG_CACHE_TTL (secondi, default 60; 0 = disabilitata)
+    """
+
+    def __init__(self) -> None:
+        self._snapshots: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def ttl() -> float:
+        try:
+            return float(os.environ.get("BILLING_CONFIG_CACHE_TTL", "60"))
+        except Exception:
+            return 60.0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, app_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._snapshots.get(app_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, app_id: str, snapshot: Dict[str, Any], version: int) -> None:
+        ttl = self.ttl()
+        if ttl <= 0 or version != self._version:
+            return
+        self._snapshots[app_id] = (time.monotonic() + ttl, snapshot)
+
+    def invalidate(self, app_id: Optional[str] = None) -> None:
+        self._version += 1
+        if app_id is None:
+            self._snapshots = {}
+        else:
+            self._snapshots.pop(app_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._snapshots), "version": self._version}
+
+
+_billing_config_cache = BillingConfigCache()
+
+
+def invalidate_billing_config_cache(app_id: Optional[str] = None) -> None:
+    """Da chiamare dopo scritture su `billing_configs` fuori da `put_config`."""
+    _billing_config_cache.invalidate(app_id)
+
+
+def get_billing_config_cache_stats() -> Dict[str, int]:
+    return _billing_config_cache.stats()
 
 
 class BillingConfigService:
@@ -19,27 +90,39 @@ class BillingConfigService:
         """Ottiene configurazione billing, con fallback a ENV vars per Railway.
         
         Ordine:
-        1. Database (se disponibile)
-        2. ENV vars (fallback per Railway/deployment semplificati)
+        1. Snapshot in cache (TTL)
+        2. Database (se disponibile)
+        3. ENV vars (fallback per Railway/deployment semplificati)
         """
+        app = app_id or os.environ.get("CORE_APP_ID", "default")
+        cached = _billing_config_cache.get(app)
+        if cached is not None:
+            return cached
+
+        version = _billing_config_cache.version
+        ok, snapshot = await self._load_config(app)
+        # Errori di lettura non vengono memorizzati: il fallback ENV vale solo per questa richiesta
+        if ok:
+            _billing_config_cache.put(app, snapshot, version)
+        return snapshot
+
+    async def _load_config(self, app: str) -> Tuple[bool, Dict[str, Any]]:
         supabase_url = os.environ.get("SUPABASE_URL")
         service_key = os.environ.get("SUPABASE_SERVICE_KEY")
-        app = app_id or os.environ.get("CORE_APP_ID", "default")
-        
+        ok = not (supabase_url and service_key)
+
         # Prova dal database
         if supabase_url and service_key:
             try:
-                url = f"{supabase_url}/rest/v1/billing_configs?app_id=eq.{app}&select=config"
-                headers = {"apikey": service_key, "Authorization": f"Bearer {service_key}", "Accept": "application/json"}
-                async with httpx.AsyncClient(timeout=10) as client:
-                    r = await client.get(url, headers=headers)
-                    if r.status_code == 200:
-                        rows = r.json() or []
-                        if rows:
-                            cfg = rows[0].get("config") or {}
-                            return {"app_id": app, "config": cfg}
-            except Exception:
-                pass
+                r = await get_supabase().get(f"/rest/v1/billing_configs?app_id=eq.{app}&select=config", timeout=10)
+                if r.status_code == 200:
+                    ok = True
+                    rows = r.json() or []
+                    if rows:
+                        cfg = rows[0].get("config") or {}
+                        return True, {"app_id": app, "config": cfg}
+            except Exception as e:
+                logger.warning("Lettura billing_configs fallita: %s", e)
         
         # Fallback ENV vars per Railway
         provider = os.environ.get("BILLING_PROVIDER", "lemonsqueezy")
@@ -55,7 +138,7 @@ class BillingConfigService:
             "plans": []
         }
         
-        return {"app_id": app, "config": fallback_config}
+        return ok, {"app_id": app, "config": fallback_config}
 
     async def put_config(self, config: Dict[str, Any], app_id: Optional[str] = None) -> Dict[str, Any]:
         supabase_url = os.environ.get("SUPABASE_URL")
@@ -67,10 +150,7 @@ class BillingConfigService:
         # Leggi config esistente per un merge non distruttivo
         existing: Dict[str, Any] = {}
         try:
-            get_url = f"{supabase_url}/rest/v1/billing_configs?app_id=eq.{app}&select=config"
-            headers_ro = {"apikey": service_key, "Authorization": f"Bearer {service_key}", "Accept": "application/json"}
-            async with httpx.AsyncClient(timeout=8) as client:
-                r0 = await client.get(get_url, headers=headers_ro)
+            r0 = await get_supabase().get(f"/rest/v1/billing_configs?app_id=eq.{app}&select=config", timeout=8)
             if r0.status_code == 200:
                 rows0 = r0.json() or []
                 if rows0:
@@ -89,20 +169,21 @@ class BillingConfigService:
             return inc if inc is not None else base
 
         merged_cfg = deep_merge(existing, config or {})
-        url = f"{supabase_url}/rest/v1/billing_configs?on_conflict=app_id"
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "resolution=merge-duplicates,return=representation"
-        }
         payload = {"app_id": app, "config": merged_cfg}
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            try:
-                body = resp.json()
-            except Exception:
-                body = {"raw": (resp.text[:200] if resp.text else "")}
+        resp = await get_supabase().post(
+            "/rest/v1/billing_configs?on_conflict=app_id",
+            json=payload,
+            prefer="resolution=merge-duplicates,return=representation",
+            timeout=10,
+        )
+        # Write-through: il nuovo snapshot sostituisce subito quello in cache
+        _billing_config_cache.invalidate(app)
+        if resp.status_code in (200, 201):
+            _billing_config_cache.put(app, {"app_id": app, "config": merged_cfg}, _billing_config_cache.version)
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"raw": (resp.text[:200] if resp.text else "")}
         return {"app_id": app, "config": merged_cfg, "status": resp.status_code, "response": body}
 
 
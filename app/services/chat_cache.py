@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+"""
+Cache delle risposte chat OpenRouter per prompt deterministici
+==============================================================
+Molte `/providers/openrouter/chat` ripetono lo stesso prompt con
+`temperature: 0`: la stessa risposta veniva ripagata in latenza e costo.
+
+- Opt-in per modello: TTL in `PricingConfig.chat_cache_ttl_seconds`
+  (`{"openai/gpt-4o-mini": 3600, "*": 600}`; mappa vuota = cache spenta).
+  Sono cacheabili solo le richieste con `temperature` 0, oppure con
+  `options.cache: true` esplicito; `options.cache: false` la esclude sempre.
+- Chiave: SHA-256 del JSON canonico (app, modello, messaggi, opzioni che
+  arrivano davvero a OpenRouter), quindi indipendente da ordine delle chiavi
+  e da `0` vs `0.0`.
+- Tier in memoria: LRU con budget in byte (dimensione della risposta serializzata).
+- Tier su disco opzionale (CHAT_CACHE_DIR): un file JSON per chiave con
+  scadenza assoluta, condiviso tra worker e riavvii; i file scaduti sono
+  rimossi in lettura e dal loop di manutenzione.
+- Le hit addebitano `chat_cache_hit_cost_ratio` del costo pieno (pricing).
+
+Env:
+- CHAT_CACHE_MAX_BYTES (budget tier memoria, default 64 MiB; 0 = solo disco)
+- CHAT_CACHE_MAX_ENTRY_BYTES (risposte più grandi non vengono salvate, default 1 MiB)
+- CHAT_CACHE_DIR (directory tier su disco; vuoto = disabilitato)
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Opzioni propagate a OpenRouter da `OpenRouterAdapter._build_payload`
+_KEY_OPTIONS = ("temperature", "top_p", "max_tokens")
+
+
+@dataclass(frozen=True)
+class CachedChat:
+    """Risposta salvata: trattata come immutabile da chi la riceve."""
+
+    response: Dict[str, Any]
+    usage: Dict[str, Any]
+    expires_at: float  # epoch (time.time), valido anche per il tier su disco
+    size: int
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def _canonical_options(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for key in _KEY_OPTIONS:
+        value = (options or {}).get(key)
+        if value is None:
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = float(value)
+        out[key] = value
+    return out
+
+
+def chat_cache_key(app_id: Optional[str], model: str, messages: List[Dict[str, Any]], options: Optional[Dict[str, Any]]) -> str:
+    """Hash canonico di (app, modello, messaggi, opzioni rilevanti)."""
+    canonical = json.dumps(
+        {
+            "app": app_id or "",
+            "model": model,
+            "messages": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+            "options": _canonical_options(options),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def chat_cache_ttl(model: str, options: Optional[Dict[str, Any]], config: Any) -> float:
+    """TTL per la richiesta (0 = non cacheabile)."""
+    opts = options or {}
+    if opts.get("cache") is False:
+        return 0.0
+    ttl_map = getattr(config, "chat_cache_ttl_seconds", None) or {}
+    try:
+        ttl = float(ttl_map.get(model, ttl_map.get("*", 0)) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    if ttl <= 0:
+        return 0.0
+    if opts.get("cache") is not True:
+        # Senza opt-in esplicito solo richieste deterministiche
+        try:
+            if float(opts.get("temperature", 1.0)) != 0.0:
+                return 0.0
+        except (TypeError, ValueError):
+            return 0.0
+    return ttl
+
+
+class ChatResponseCache:
+    """LRU in memoria a budget di byte con tier su disco opzionale."""
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[str, CachedChat]" = OrderedDict()
+        self._bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def max_bytes() -> int:
+        return _env_int("CHAT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+    @staticmethod
+    def max_entry_bytes() -> int:
+        return _env_int("CHAT_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+
+    @staticmethod
+    def disk_dir() -> Optional[str]:
+        return os.environ.get("CHAT_CACHE_DIR") or None
+
+    # -----------------------------
+    # Tier memoria
+    # -----------------------------
+    def _get_memory(self, key: str) -> Optional[CachedChat]:
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._drop(key)
+            return None
+        self._items.move_to_end(key)
+        return entry
+
+    def _insert(self, key: str, entry: CachedChat) -> None:
+        budget = self.max_bytes()
+        if entry.size > budget:
+            return
+        self._drop(key)
+        self._items[key] = entry
+        self._bytes += entry.size
+        while self._bytes > budget and self._items:
+            oldest = next(iter(self._items))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    # -----------------------------
+    # Tier disco
+    # -----------------------------
+    @staticmethod
+    def _path(directory: str, key: str) -> str:
+        return os.path.join(directory, key[:2], f"{key}.json")
+
+    def _read_disk(self, directory: str, key: str) -> Optional[CachedChat]:
+        path = self._path(directory, key)
+        try:
+            with open(path, "rb") as fh:
+                body = fh.read()
+            data = json.loads(body)
+            expires_at = float(data["expires_at"])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Voce cache chat illeggibile %s: %s", path, e)
+            return None
+        if expires_at <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return CachedChat(response=data.get("response") or {}, usage=data.get("usage") or {}, expires_at=expires_at, size=len(body))
+
+    def _write_disk(self, directory: str, key: str, body: bytes) -> None:
+        path = self._path(directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(body)
+        # Rename atomico: un lettore concorrente vede il file vecchio o quello completo
+        os.replace(tmp, path)
+
+    def _purge_disk(self, directory: str) -> int:
+        removed = 0
+        now = time.time()
+        for root, _dirs, files in os.walk(directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path, "rb") as fh:
+                        expires_at = float(json.loads(fh.read()).get("expires_at", 0))
+                    if expires_at <= now:
+                        os.remove(path)
+                        removed += 1
+                except Exception:
+                    continue
+        return removed
+
+    # -----------------------------
+    # API
+    # -----------------------------
+    async def get(self, key: str) -> Optional[CachedChat]:
+        entry = self._get_memory(key)
+        if entry is not None:
+            self.memory_hits += 1
+            return entry
+        directory = self.disk_dir()
+        if directory:
+            entry = await asyncio.to_thread(self._read_disk, directory, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._insert(key, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: Dict[str, Any], usage: Dict[str, Any], ttl: float) -> None:
+        """Salva la risposta; errori di serializzazione o disco non bloccano la richiesta."""
+        expires_at = time.time() + ttl
+        try:
+            body = json.dumps({"expires_at": expires_at, "response": response, "usage": usage}, separators=(",", ":")).encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logger.warning("Risposta chat non serializzabile, non cacheata: %s", e)
+            return
+        if len(body) > self.max_entry_bytes():
+            return
+        self._insert(key, CachedChat(response=response, usage=usage, expires_at=expires_at, size=len(body)))
+        self.stores += 1
+        directory = self.disk_dir()
+        if directory:
+            try:
+                await asyncio.to_thread(self._write_disk, directory, key, body)
+            except Exception as e:
+                logger.warning("Scrittura cache chat su disco fallita: %s", e)
+
+    async def purge_disk(self) -> int:
+        """Rimuove i file scaduti del tier su disco (loop di manutenzione)."""
+        directory = self.disk_dir()
+        if not directory or not os.path.isdir(directory):
+            return 0
+        return await asyncio.to_thread(self._purge_disk, directory)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": len(self._items),
+            "bytes": self._bytes,
+        }
+
+
+_chat_cache = ChatResponseCache()
+
+
+def get_chat_cache() -> ChatResponseCache:
+    return _chat_cache
+
+
+def invalidate_chat_cache() -> None:
+    """Svuota il tier in memoria (il disco scade per TTL)."""
+    _chat_cache.clear()
+
+
+def get_chat_cache_stats() -> Dict[str, Any]:
+    return _chat_cache.stats()
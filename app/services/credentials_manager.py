@@ -8,19 +8,138 @@ Responsabilità:
 - Generazione chiavi di crittografia sicure
 - Cache temporanea per performance
 - Rotazione chiavi
+
+Cache condivisa dal processo: tutte le credenziali di un'app vengono caricate
+con una sola RPC (`get_provider_credentials`, migration 009), decriptate una
+volta e tenute in memoria per CREDENTIALS_CACHE_TTL secondi (default 300).
+`set_credential` (rotazione) e `clear_cache` invalidano lo snapshot dell'app;
+un caricamento partito prima dell'invalidazione non lo ripopola. Un solo
+oggetto Fernet per chiave di cifratura. Senza migration 009 si usa la lettura
+per singola chiave, anch'essa in cache.
 """
 
-from typing import Any, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
 import os
 import httpx
 import secrets
 import base64
+import time
 from cryptography.fernet import Fernet
 import logging
 
+from app.services.supabase_rest import get_supabase
+
 
 logger = logging.getLogger(__name__)
 
+Snapshot = Dict[Tuple[str, str], str]
+
+
+_ciphers: Dict[str, Fernet] = {}
+
+
+def _get_cipher(encryption_key: str) -> Fernet:
+    """Istanza Fernet riusata per la stessa chiave (costruzione e validazione una sola volta)."""
+    cipher = _ciphers.get(encryption_key)
+    if cipher is None:
+        cipher = Fernet(encryption_key.encode())
+        _ciphers[encryption_key] = cipher
+    return cipher
+
+
+def _ttl() -> float:
+    try:
+        return float(os.environ.get("CREDENTIALS_CACHE_TTL", "300"))
+    except Exception:
+        return 300.0
+
+
+class CredentialsCache:
+    """Credenziali decriptate per app_id: snapshot completo (bulk) o singole chiavi (legacy)."""
+
+    def __init__(self) -> None:
+        self._snapshots: Dict[str, Tuple[float, Snapshot]] = {}
+        self._single: Dict[Tuple[str, str, str], Tuple[float, Optional[str]]] = {}
+        self._versions: Dict[str, int] = {}
+        self._inflight: Dict[str, "asyncio.Future[Optional[Snapshot]]"] = {}
+        self.bulk_available: Optional[bool] = None
+        self.hits = 0
+        self.loads = 0
+
+    def version(self, app_id: str) -> int:
+        return self._versions.get(app_id, 0)
+
+    async def snapshot(self, app_id: str, loader: Callable[[], Awaitable[Tuple[bool, Optional[Snapshot]]]]) -> Optional[Snapshot]:
+        """Snapshot dell'app (None se il caricamento in blocco non è disponibile)."""
+        entry = self._snapshots.get(app_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        if self.bulk_available is False:
+            return None
+
+        inflight = self._inflight.get(app_id)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future: "asyncio.Future[Optional[Snapshot]]" = asyncio.get_running_loop().create_future()
+        self._inflight[app_id] = future
+        version = self.version(app_id)
+        try:
+            self.loads += 1
+            ok, snap = await loader()
+            ttl = _ttl()
+            if ok and snap is not None and ttl > 0 and version == self.version(app_id):
+                self._snapshots[app_id] = (time.monotonic() + ttl, snap)
+            future.set_result(snap)
+            return snap
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(app_id, None)
+
+    def get_single(self, app_id: str, provider: str, key: str) -> Tuple[bool, Optional[str]]:
+        entry = self._single.get((app_id, provider, key))
+        if entry is None or entry[0] <= time.monotonic():
+            return False, None
+        self.hits += 1
+        return True, entry[1]
+
+    def put_single(self, app_id: str, provider: str, key: str, value: Optional[str], version: int) -> None:
+        ttl = _ttl()
+        if ttl > 0 and version == self.version(app_id):
+            self._single[(app_id, provider, key)] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, app_id: Optional[str] = None) -> None:
+        app_ids = [app_id] if app_id is not None else list({*self._versions, *self._snapshots, *(k[0] for k in self._single)})
+        for app in app_ids:
+            self._versions[app] = self._versions.get(app, 0) + 1
+            self._snapshots.pop(app, None)
+        self._single = {k: v for k, v in self._single.items() if app_id is not None and k[0] != app_id}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "loads": self.loads,
+            "apps": len(self._snapshots),
+            "bulk_available": self.bulk_available,
+        }
+
+
+_credentials_cache = CredentialsCache()
+
+
+def invalidate_credentials_cache(app_id: Optional[str] = None) -> None:
+    """Da chiamare dopo scritture su `provider_credentials` fuori da `set_credential`."""
+    _credentials_cache.invalidate(app_id)
+
+
+def get_credentials_cache_stats() -> Dict[str, Any]:
+    return _credentials_cache.stats()
+
 
 class CredentialsManager:
     """Gestisce credentials provider criptate."""
@@ -28,7 +147,6 @@ class CredentialsManager:
     def __init__(self, app_id: Optional[str] = None):
         self.app_id = app_id or os.environ.get("CORE_APP_ID", "default")
         self.encryption_key = self._get_or_generate_encryption_key()
-        self._cache: Dict[str, str] = {}
 
     def _get_or_generate_encryption_key(self) -> str:
         """Ottiene la chiave di crittografia da ENV.
@@ -44,7 +162,7 @@ class CredentialsManager:
             )
         try:
             # Valida che sia una chiave Fernet valida
-            _ = Fernet(env_key.encode())
+            _ = _get_cipher(env_key)
             return env_key
         except Exception as exc:
             # Non generiamo nuove chiavi automaticamente: hard‑fail
@@ -52,12 +170,15 @@ class CredentialsManager:
                 "CORE_ENCRYPTION_KEY non valida. Sostituisci la chiave nel .env e riavvia."
             ) from exc
 
+    def _decrypt(self, encrypted_b64: str) -> str:
+        encrypted = base64.b64decode(encrypted_b64.encode())
+        return _get_cipher(self.encryption_key).decrypt(encrypted).decode()
+
     async def set_credential(self, provider: str, key: str, value: str) -> bool:
         """Salva credential criptata su Supabase."""
         try:
             # Cripta il valore
-            fernet = Fernet(self.encryption_key.encode())
-            encrypted = fernet.encrypt(value.encode())
+            encrypted = _get_cipher(self.encryption_key).encrypt(value.encode())
             encrypted_b64 = base64.b64encode(encrypted).decode()
 
             supabase_url = os.environ.get("SUPABASE_URL")
@@ -66,12 +187,6 @@ class CredentialsManager:
                 logger.error("Supabase non configurato (SUPABASE_URL/SERVICE_KEY mancanti) in set_credential")
                 return False
 
-            url = f"{supabase_url}/rest/v1/rpc/set_provider_credential"
-            headers = {
-                "apikey": service_key,
-                "Authorization": f"Bearer {service_key}",
-                "Content-Type": "application/json"
-            }
             payload = {
                 "p_app_id": self.app_id,
                 "p_provider": provider,
@@ -80,70 +195,98 @@ class CredentialsManager:
                 "p_encryption_key": "placeholder"  # Non usato nella funzione SQL
             }
 
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.post(url, headers=headers, json=payload)
-                logger.info(f"set_provider_credential status={resp.status_code} body_len={len(resp.text) if resp.text else 0}")
-                if resp.status_code == 200:
-                    # Cache locale
-                    cache_key = f"{provider}:{key}"
-                    self._cache[cache_key] = value
-                    return True
-                else:
-                    logger.error(f"Errore RPC set_provider_credential: {resp.status_code} {resp.text[:200]}")
-                    return False
+            resp = await get_supabase().post("/rest/v1/rpc/set_provider_credential", json=payload, timeout=10)
+            logger.info(f"set_provider_credential status={resp.status_code} body_len={len(resp.text) if resp.text else 0}")
+            if resp.status_code == 200:
+                # Rotazione: lo snapshot dell'app viene ricaricato alla prossima lettura
+                _credentials_cache.invalidate(self.app_id)
+                return True
+            else:
+                logger.error(f"Errore RPC set_provider_credential: {resp.status_code} {resp.text[:200]}")
+                return False
         except Exception:
             logger.exception("Eccezione in set_credential")
             return False
 
+    async def _load_all(self) -> Tuple[bool, Optional[Snapshot]]:
+        """Carica e decripta tutte le credenziali dell'app con una sola RPC."""
+        if not get_supabase().configured:
+            return False, None
+        try:
+            resp = await get_supabase().rpc("get_provider_credentials", {"p_app_id": self.app_id}, timeout=10)
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to bulk-load credentials for {self.app_id}: {e}")
+            return False, None
+        if resp.status_code == 404:
+            if _credentials_cache.bulk_available is not False:
+                logger.warning("⚠️ RPC get_provider_credentials assente: lettura per singola chiave")
+            _credentials_cache.bulk_available = False
+            return False, None
+        if resp.status_code != 200:
+            logger.warning(f"⚠️ get_provider_credentials status={resp.status_code}")
+            return False, None
+        rows = resp.json()
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            logger.warning("⚠️ get_provider_credentials: risposta inattesa")
+            return False, None
+        _credentials_cache.bulk_available = True
+        snapshot: Snapshot = {}
+        for row in rows:
+            provider, key, encrypted_b64 = row.get("provider"), row.get("credential_key"), row.get("value")
+            if not provider or not key or not encrypted_b64:
+                continue
+            try:
+                snapshot[(provider, key)] = self._decrypt(encrypted_b64)
+            except Exception as e:
+                logger.warning(f"⚠️ Credential non decriptabile: {provider}:{key} - {e}")
+        logger.info(f"✅ Credentials loaded from database: {self.app_id} ({len(snapshot)} keys)")
+        return True, snapshot
+
+    async def preload(self) -> None:
+        """Carica lo snapshot dell'app (startup): i percorsi caldi non toccano il DB."""
+        await _credentials_cache.snapshot(self.app_id, self._load_all)
+
+    async def _get_single(self, provider: str, key: str) -> Optional[str]:
+        """Lettura legacy per singola chiave (senza migration 009)."""
+        found, value = _credentials_cache.get_single(self.app_id, provider, key)
+        if found:
+            return value
+        version = _credentials_cache.version(self.app_id)
+        try:
+            payload = {
+                "p_app_id": self.app_id,
+                "p_provider": provider,
+                "p_key": key,
+                "p_encryption_key": "placeholder"  # Non usato nella funzione SQL
+            }
+            resp = await get_supabase().post("/rest/v1/rpc/get_provider_credential", json=payload, timeout=10)
+            logger.info(f"get_provider_credential status={resp.status_code} body_len={len(resp.text) if resp.text else 0}")
+            if resp.status_code != 200:
+                return None
+            encrypted_b64 = resp.text.strip('"')  # Rimuovi quote JSON
+            value = self._decrypt(encrypted_b64) if encrypted_b64 and encrypted_b64 != "null" else None
+            _credentials_cache.put_single(self.app_id, provider, key, value, version)
+            return value
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to load credential from DB: {provider}:{key} - {e}")
+            return None
+
     async def get_credential(self, provider: str, key: str) -> Optional[str]:
         """Legge credential decriptata da Supabase, con fallback a ENV vars per Railway.
         
         Ordine di ricerca:
-        1. Cache in memoria
+        1. Cache condivisa del processo (snapshot dell'app)
         2. Database criptato (se disponibile)
         3. ENV vars (fallback per Railway/deployment semplificati)
         """
-        cache_key = f"{provider}:{key}"
-        
-        # Check cache prima
-        if cache_key in self._cache:
-            return self._cache[cache_key]
-
-        # Prova prima dal database criptato
-        try:
-            supabase_url = os.environ.get("SUPABASE_URL")
-            service_key = os.environ.get("SUPABASE_SERVICE_KEY")
-            if supabase_url and service_key:
-                url = f"{supabase_url}/rest/v1/rpc/get_provider_credential"
-                headers = {
-                    "apikey": service_key,
-                    "Authorization": f"Bearer {service_key}",
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "p_app_id": self.app_id,
-                    "p_provider": provider,
-                    "p_key": key,
-                    "p_encryption_key": "placeholder"  # Non usato nella funzione SQL
-                }
-
-                async with httpx.AsyncClient(timeout=10) as client:
-                    resp = await client.post(url, headers=headers, json=payload)
-                    logger.info(f"get_provider_credential status={resp.status_code} body_len={len(resp.text) if resp.text else 0}")
-                    if resp.status_code == 200:
-                        encrypted_b64 = resp.text.strip('"')  # Rimuovi quote JSON
-                        if encrypted_b64 and encrypted_b64 != "null":
-                            # Decripta
-                            fernet = Fernet(self.encryption_key.encode())
-                            encrypted = base64.b64decode(encrypted_b64.encode())
-                            decrypted = fernet.decrypt(encrypted).decode()
-                            
-                            # Cache locale
-                            self._cache[cache_key] = decrypted
-                            logger.info(f"✅ Credential loaded from database: {provider}:{key}")
-                            return decrypted
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to load credential from DB: {provider}:{key} - {e}")
+        if get_supabase().configured:
+            snapshot = await _credentials_cache.snapshot(self.app_id, self._load_all)
+            if snapshot is not None:
+                value = snapshot.get((provider, key))
+            else:
+                value = await self._get_single(provider, key)
+            if value is not None:
+                return value
         
         # Fallback a ENV vars per Railway/deployment semplificati
         env_var_map = {
@@ -157,11 +300,9 @@ class CredentialsManager:
         if env_var_name:
             env_value = os.environ.get(env_var_name)
             if env_value:
-                self._cache[cache_key] = env_value
-                logger.info(f"✅ Credential loaded from ENV var: {provider}:{key} → {env_var_name}")
                 return env_value
         
-        logger.warning(f"❌ Credential not found (DB or ENV): {provider}:{key}")
+        logger.debug(f"Credential not found (DB or ENV): {provider}:{key}")
         return None
 
     async def test_connection(self, provider: str) -> Dict[str, Any]:
@@ -189,5 +330,18 @@ class CredentialsManager:
         return {"success": False, "error": "Provider non supportato"}
 
     def clear_cache(self):
-        """Pulisce cache locale."""
-        self._cache.clear()
+        """Pulisce la cache delle credenziali dell'app (condivisa dal processo)."""
+        _credentials_cache.invalidate(self.app_id)
+
+
+_managers: Dict[str, CredentialsManager] = {}
+
+
+def get_credentials_manager(app_id: Optional[str] = None) -> CredentialsManager:
+    """CredentialsManager condiviso per app_id (solleva RuntimeError se CORE_ENCRYPTION_KEY manca)."""
+    app = app_id or os.environ.get("CORE_APP_ID", "default")
+    manager = _managers.get(app)
+    if manager is None:
+        manager = CredentialsManager(app_id=app)
+        _managers[app] = manager
+    return manager
@@ -5,40 +5,50 @@ Credits ledger basato su Supabase (minimo funzionante via REST).
 
 - Lettura saldo: GET su view/tabella `profiles` (campo `credits`).
 - Addebito: RPC `debit_user_credits` (se esiste), altrimenti fallback stub.
+- Prenotazioni: RPC `reserve_user_credits` / `settle_credit_hold` / `release_credit_hold`
+  (sql/003); senza migration ripiega su lettura saldo + debit a fine esecuzione.
 """
 
-from typing import Any, Dict, Optional, List, Tuple
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, List, Tuple
+import asyncio
+import logging
 import os
-import httpx
+import time
+import uuid
 from app.core.interfaces import CreditsLedger
+from app.services.metrics import record_credits_debited
+from app.services.supabase_rest import get_supabase, service_headers
+from app.services.user_context import get_user_context, invalidate_user_context
+
+
+logger = logging.getLogger(__name__)
+
+
+_LEGACY_HOLD_PREFIX = "legacy:"
 
 
 class SupabaseCreditsLedger(CreditsLedger):
     """Integrazione minimale via REST API di Supabase."""
 
-    async def get_balance(self, user_id: str) -> float:
+    def __init__(self) -> None:
+        # Prenotazioni in memoria quando le RPC della migration 003 non esistono
+        self._legacy_holds: Dict[str, Tuple[str, str]] = {}
+
+    async def get_balance(self, user_id: str, *, fresh: bool = False) -> float:
+        """Saldo dallo snapshot profilo del percorso di esecuzione.
+
+        `fresh=True` per le letture esposte all'utente/admin: l'invalidazione dello
+        snapshot è per processo, un altro worker potrebbe avere un saldo vecchio di TTL secondi.
+        """
         supabase_url = os.environ.get("SUPABASE_URL")
         service_key = os.environ.get("SUPABASE_SERVICE_KEY")
         if not supabase_url or not service_key:
             return 0.0
 
-        url = f"{supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=credits"
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code != 200:
-                return 0.0
-            data = resp.json()
-            if not data:
-                return 0.0
-            try:
-                return float(data[0].get("credits", 0) or 0)
-            except Exception:
-                return 0.0
+        # Snapshot profilo condiviso con le altre fasi della richiesta
+        ctx = await get_user_context(user_id, fresh=fresh)
+        return ctx.credits if ctx is not None else 0.0
 
     async def debit(self, user_id: str, amount: float, reason: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         supabase_url = os.environ.get("SUPABASE_URL")
@@ -47,26 +57,26 @@ class SupabaseCreditsLedger(CreditsLedger):
             return {"success": False, "error": "Missing Supabase env"}
 
         # Prova RPC ufficiale
-        url = f"{supabase_url}/rest/v1/rpc/debit_user_credits"
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "return=representation",
-            **({"Idempotency-Key": idempotency_key} if idempotency_key else {}),
-        }
+        headers = service_headers(
+            json_body=True,
+            prefer="return=representation",
+            extra={"Idempotency-Key": idempotency_key} if idempotency_key else None,
+        )
         payload = {"p_user_id": user_id, "p_amount": amount, "p_reason": reason}
-        async with httpx.AsyncClient(timeout=15) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            if resp.status_code == 200:
-                try:
-                    data = resp.json()
-                    return data if isinstance(data, dict) else {"success": True, "data": data}
-                except Exception:
-                    return {"success": True}
-            else:
-                # Fallback soft: non blocca, ma segnala errore
-                return {"success": False, "status": resp.status_code, "error": resp.text}
+        resp = await get_supabase().post("/rest/v1/rpc/debit_user_credits", json=payload, headers=headers, timeout=15)
+        invalidate_user_context(user_id)
+        if resp.status_code == 200:
+            try:
+                data = resp.json()
+            except Exception:
+                record_credits_debited(amount, reason)
+                return {"success": True}
+            if not isinstance(data, dict) or data.get("success", True):
+                record_credits_debited(amount, reason)
+            return data if isinstance(data, dict) else {"success": True, "data": data}
+        else:
+            # Fallback soft: non blocca, ma segnala errore
+            return {"success": False, "status": resp.status_code, "error": resp.text}
 
 
     async def credit(self, user_id: str, amount: float, reason: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
@@ -86,37 +96,157 @@ class SupabaseCreditsLedger(CreditsLedger):
         if not supabase_url or not service_key:
             return {"success": False, "error": "Missing Supabase env"}
 
-        url = f"{supabase_url}/rest/v1/rpc/credit_user_credits"
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "return=representation",
-            **({"Idempotency-Key": idempotency_key} if idempotency_key else {}),
-        }
+        headers = service_headers(
+            json_body=True,
+            prefer="return=representation",
+            extra={"Idempotency-Key": idempotency_key} if idempotency_key else None,
+        )
         payload = {"p_user_id": user_id, "p_amount": amount, "p_reason": reason}
-        async with httpx.AsyncClient(timeout=15) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            if resp.status_code == 200:
-                try:
-                    data = resp.json()
-                    return data if isinstance(data, dict) else {"success": True, "data": data}
-                except Exception:
-                    return {"success": True}
-            else:
-                return {"success": False, "status": resp.status_code, "error": resp.text}
+        resp = await get_supabase().post("/rest/v1/rpc/credit_user_credits", json=payload, headers=headers, timeout=15)
+        invalidate_user_context(user_id)
+        if resp.status_code == 200:
+            try:
+                data = resp.json()
+                return data if isinstance(data, dict) else {"success": True, "data": data}
+            except Exception:
+                return {"success": True}
+        else:
+            return {"success": False, "status": resp.status_code, "error": resp.text}
 
+    async def credit_webhook_event(self, log_id: str, user_id: str, amount: float, reason: str) -> Dict[str, Any]:
+        """Accredito di un evento webhook persistito, al più una volta per `log_id` (migration 012).
 
-    async def rollout_monthly_credits(self, *, app_id: str = "default", dry_run: bool = True) -> Dict[str, Any]:
+        Senza migration ritorna `{"success": False, "status": 404}`: il chiamante ricade su `credit`.
+        """
+        payload = {"p_log_id": log_id, "p_user_id": user_id, "p_amount": amount, "p_reason": reason}
+        resp = await get_supabase().rpc("credit_billing_webhook", payload, timeout=15)
+        invalidate_user_context(user_id)
+        if resp.status_code == 200:
+            data = resp.json()
+            return data if isinstance(data, dict) else {"success": True, "data": data}
+        return {"success": False, "status": resp.status_code, "error": resp.text}
+
+
+    async def reserve(self, user_id: str, amount: float, *, reason: str = "hold", min_available: float = 0.0, ttl_seconds: Optional[int] = None) -> Dict[str, Any]:
+        """Gate di affordability e prenotazione in un'unica RPC atomica.
+
+        Args:
+            user_id: ID utente Supabase (UUID)
+            amount: crediti da prenotare (può essere 0: solo gate)
+            reason: motivo usato anche per l'addebito finale
+            min_available: disponibile minimo richiesto (soglia App Affordability)
+            ttl_seconds: scadenza della prenotazione (default CREDIT_HOLD_TTL_SECONDS)
+
+        Returns:
+            {"success": True, "hold_id": ...} oppure
+            {"success": False, "error": "insufficient_credits", "available": ..., "required": ...}
+        """
+        supabase_url = os.environ.get("SUPABASE_URL")
+        service_key = os.environ.get("SUPABASE_SERVICE_KEY")
+        if not supabase_url or not service_key:
+            return {"success": False, "error": "Missing Supabase env"}
+
+        ttl = ttl_seconds if ttl_seconds is not None else _env_int("CREDIT_HOLD_TTL_SECONDS", 900)
+        payload = {
+            "p_user_id": user_id,
+            "p_amount": max(0.0, float(amount)),
+            "p_min_available": max(0.0, float(min_available)),
+            "p_ttl_seconds": ttl,
+            "p_reason": reason,
+        }
+        resp = await get_supabase().rpc("reserve_user_credits", payload, timeout=15)
+        if resp.status_code == 200:
+            data = resp.json()
+            return data if isinstance(data, dict) else {"success": False, "error": "invalid_response", "data": data}
+        if resp.status_code != 404:
+            return {"success": False, "status": resp.status_code, "error": resp.text}
+
+        # Migration 003 non applicata: gate su saldo letto, addebito al settle
+        available = await self.get_balance(user_id)
+        required = max(float(amount), float(min_available))
+        if available < required:
+            return {"success": False, "error": "insufficient_credits", "available": available, "required": required}
+        hold_id = f"{_LEGACY_HOLD_PREFIX}{uuid.uuid4()}"
+        self._legacy_holds[hold_id] = (user_id, reason)
+        return {"success": True, "hold_id": hold_id, "held": float(amount), "available": available, "legacy": True}
+
+    async def settle(self, hold_id: str, actual: float, reason: Optional[str] = None) -> Dict[str, Any]:
+        """Chiude la prenotazione addebitando `actual` (idempotente lato DB)."""
+        if hold_id.startswith(_LEGACY_HOLD_PREFIX):
+            entry = self._legacy_holds.pop(hold_id, None)
+            if entry is None:
+                # Hold legacy solo in memoria: settle dopo un restart o da un altro worker
+                return {"success": False, "error": "hold_not_found", "legacy": True}
+            user_id, hold_reason = entry
+            if actual <= 0:
+                return {"success": True, "charged": 0.0}
+            return await self.debit(user_id=user_id, amount=actual, reason=reason or hold_reason)
+
+        payload = {"p_hold_id": hold_id, "p_actual": max(0.0, float(actual)), "p_reason": reason}
+        resp = await get_supabase().rpc("settle_credit_hold", payload, timeout=15)
+        if resp.status_code == 200:
+            data = resp.json()
+            if isinstance(data, dict) and data.get("user_id"):
+                invalidate_user_context(str(data["user_id"]))
+            if isinstance(data, dict) and data.get("success") and not data.get("idempotent"):
+                record_credits_debited(data.get("charged"), reason)
+            return data if isinstance(data, dict) else {"success": True, "data": data}
+        return {"success": False, "status": resp.status_code, "error": resp.text}
+
+    async def release(self, hold_id: str) -> Dict[str, Any]:
+        """Rilascia la prenotazione (errore provider o costo non misurabile)."""
+        if hold_id.startswith(_LEGACY_HOLD_PREFIX):
+            self._legacy_holds.pop(hold_id, None)
+            return {"success": True, "status": "released"}
+        resp = await get_supabase().rpc("release_credit_hold", {"p_hold_id": hold_id}, timeout=15)
+        if resp.status_code == 200:
+            data = resp.json()
+            return data if isinstance(data, dict) else {"success": True, "data": data}
+        return {"success": False, "status": resp.status_code, "error": resp.text}
+
+    async def expire_holds(self, limit: int = 500) -> int:
+        """Sweeper: rilascia le prenotazioni scadute. Ritorna quante ne ha chiuse."""
+        supabase_url = os.environ.get("SUPABASE_URL")
+        service_key = os.environ.get("SUPABASE_SERVICE_KEY")
+        if not supabase_url or not service_key:
+            return 0
+        resp = await get_supabase().rpc("expire_credit_holds", {"p_limit": limit}, timeout=30)
+        if resp.status_code != 200:
+            return 0
+        data = resp.json()
+        try:
+            return int((data or {}).get("expired") or 0)
+        except Exception:
+            return 0
+
+    async def rollout_monthly_credits(
+        self,
+        *,
+        app_id: str = "default",
+        dry_run: bool = True,
+        period: Optional[str] = None,
+        progress: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> Dict[str, Any]:
         """Eroga i crediti mensili agli utenti con abbonamento attivo secondo `pricing_configs`.
 
-        Strategia semplice e sicura:
+        Strategia a lotti, ripristinabile:
         - Legge `pricing_configs` (campo rollout: credits_per_period, rollout_percentage, max_credits_rollover)
-        - Legge `subscriptions` attive (status='active') e preleva `credits_per_month` e `user_id`
-        - Calcola crediti da accreditare = floor(credits_per_month * rollout_percentage/100)
+        - Scorre `subscriptions` attive a pagine ordinate per user_id (keyset, ROLLOUT_PAGE_SIZE)
+        - Per ogni blocco (ROLLOUT_CHUNK_SIZE) legge i saldi con una sola query `id=in.(...)`
+          e accredita con la RPC set-based `rollout_credit_batch`; i blocchi girano
+          in parallelo con concorrenza limitata (ROLLOUT_CONCURRENCY)
+        - Calcola crediti da accreditare = round(credits_per_month * rollout_percentage/100)
         - Applica cap di rollover rispetto a `profiles.credits` se configurato
         - Se dry_run=True: non accredita, ritorna solo anteprima
-        - Se dry_run=False: accredita con reason='monthly_rollout' e registra un audit in `credits_rollout_runs`
+        - Se dry_run=False: registra il run in `credits_rollout_runs` e aggiorna il checkpoint
+          dopo ogni pagina; un run interrotto riprende dal checkpoint e `credits_rollout_items`
+          impedisce doppi accrediti nello stesso periodo
+
+        Args:
+            app_id: app per pricing_configs e chiave di idempotenza
+            dry_run: anteprima senza accrediti
+            period: periodo di idempotenza (default mese corrente UTC, 'YYYY-MM')
+            progress: callback (sync o async) invocata dopo ogni pagina con i contatori
 
         Returns:
             Riepilogo operazione con dettagli per-utente, conteggi e success flag.
@@ -126,151 +256,315 @@ class SupabaseCreditsLedger(CreditsLedger):
         if not supabase_url or not service_key:
             return {"success": False, "error": "Missing Supabase env"}
 
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json",
-        }
+        started = time.monotonic()
+        period = period or datetime.now(timezone.utc).strftime("%Y-%m")
+        page_size = max(1, _env_int("ROLLOUT_PAGE_SIZE", 1000))
+        chunk_size = max(1, _env_int("ROLLOUT_CHUNK_SIZE", 150))
+        semaphore = asyncio.Semaphore(max(1, _env_int("ROLLOUT_CONCURRENCY", 8)))
 
-        async with httpx.AsyncClient(timeout=20) as client:
-            # 1) Leggi pricing_configs
-            cfg_r = await client.get(f"{supabase_url}/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config", headers=headers)
-            cfg_obj: Dict[str, Any] = {}
-            if cfg_r.status_code == 200 and cfg_r.headers.get("content-type", "").startswith("application/json"):
-                data = cfg_r.json()
-                if data:
-                    cfg_obj = data[0].get("config") or {}
-            rollout_cfg = cfg_obj.get("rollout") or {}
-            credits_per_period = int(float(rollout_cfg.get("credits_per_period", 0) or 0))
-            rollout_percentage = float(rollout_cfg.get("rollout_percentage", 100) or 100)
-            max_rollover = rollout_cfg.get("max_credits_rollover")
-            try:
-                max_rollover = int(float(max_rollover)) if max_rollover is not None else None
-            except Exception:
-                max_rollover = None
+        sb = get_supabase()
+        # 1) Leggi pricing_configs
+        cfg_r = await sb.get(f"/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config", timeout=20)
+        cfg_obj: Dict[str, Any] = {}
+        if cfg_r.status_code == 200 and cfg_r.headers.get("content-type", "").startswith("application/json"):
+            data = cfg_r.json()
+            if data:
+                cfg_obj = data[0].get("config") or {}
+        rollout_cfg = cfg_obj.get("rollout") or {}
+        credits_per_period = int(float(rollout_cfg.get("credits_per_period", 0) or 0))
+        rollout_percentage = float(rollout_cfg.get("rollout_percentage", 100) or 100)
+        max_rollover = rollout_cfg.get("max_credits_rollover")
+        try:
+            max_rollover = int(float(max_rollover)) if max_rollover is not None else None
+        except Exception:
+            max_rollover = None
+        rules = (credits_per_period, rollout_percentage, max_rollover)
 
-            # 2) Leggi subscriptions attive con campi plan (per-plan rollout/discount/cap)
-            subs_r = await client.get(
-                f"{supabase_url}/rest/v1/subscriptions?status=eq.active&select=user_id,credits_per_month,plan_id,plan:subscription_plans(rollout_percentage,max_credits_rollover)",
-                headers=headers,
-            )
-            users: List[Dict[str, Any]] = []
-            if subs_r.status_code == 200 and subs_r.headers.get("content-type", "").startswith("application/json"):
-                users = subs_r.json()
-
-            # 3) Leggi balances attuali per applicare eventuale cap di rollover
-            user_ids = [u.get("user_id") for u in users if u.get("user_id")]
-            balances: Dict[str, float] = {}
-            if user_ids:
-                # Chunk semplice per query IN
-                # Nota: supabase REST non supporta facilmente IN massivo; faremo richieste singole limitate
-                for uid in user_ids:
-                    prof_r = await client.get(f"{supabase_url}/rest/v1/profiles?id=eq.{uid}&select=credits", headers=headers)
-                    if prof_r.status_code == 200 and prof_r.headers.get("content-type", "").startswith("application/json"):
-                        arr = prof_r.json()
-                        if arr:
-                            try:
-                                balances[uid] = float(arr[0].get("credits") or 0)
-                            except Exception:
-                                balances[uid] = 0.0
-
-            # 4) Calcoli
-            details: List[Dict[str, Any]] = []
-            users_processed = 0
-            users_successful = 0
-            users_failed = 0
-            total_accredited = 0.0
-            for row in users:
-                uid = row.get("user_id")
-                if not uid:
-                    continue
-                per_month = int(float(row.get("credits_per_month") or 0))
-                # Calcola override per-plan
-                plan_obj = row.get("plan") or {}
-                plan_rollout_pct = plan_obj.get("rollout_percentage")
-                plan_cap_rollover = plan_obj.get("max_credits_rollover")
-                # Base period credits: se configurato globale >0 usa override globale, altrimenti quelli del piano/subscription
-                base_amount = int(credits_per_period if credits_per_period > 0 else per_month)
-                # Percentuale rollout: priorità al piano, fallback globale
-                eff_rollout_pct = float(plan_rollout_pct if plan_rollout_pct is not None else rollout_percentage)
-                to_credit = int(round(base_amount * (eff_rollout_pct / 100.0)))
-                current_balance = float(balances.get(uid, 0.0))
-
-                # Applica cap di rollover: non superare max_rollover
-                cap = None
-                if plan_cap_rollover is not None:
-                    try:
-                        cap = int(float(plan_cap_rollover))
-                    except Exception:
-                        cap = None
-                if cap is None and max_rollover is not None and max_rollover >= 0:
-                    cap = max_rollover
-                if cap is not None and cap >= 0:
-                    if current_balance + to_credit > cap:
-                        to_credit = max(0, int(cap - current_balance))
-
-                item = {
-                    "user_id": uid,
-                    "credits_per_month": per_month,
-                    "calculated_credit": to_credit,
-                    "balance_before": current_balance,
-                }
-                users_processed += 1
+        # 2) Run reale: apre (o riprende) il run del periodo
+        stats: Dict[str, Any] = {"users_processed": 0, "users_successful": 0, "users_failed": 0, "total_credits_accredited": 0.0}
+        run_id: Optional[str] = None
+        after: Optional[str] = None
+        if not dry_run:
+            run_id, after, previous = await self._open_rollout_run(app_id, period, rollout_cfg)
+            for k in stats:
+                stats[k] += previous.get(k) or 0
+            if after:
+                logger.info("🔁 Rollout %s/%s ripreso dal checkpoint user_id=%s", app_id, period, after)
 
-                if to_credit <= 0:
-                    item["skipped"] = True
+        # 3) Pagine di subscriptions attive → blocchi paralleli
+        details: List[Dict[str, Any]] = []
+        error: Optional[str] = None
+        while True:
+            page = await self._fetch_active_subscriptions(after, page_size)
+            if page is None:
+                error = "Lettura subscriptions fallita"
+                break
+            if not page:
+                break
+            rows = _dedupe_by_user(page)
+            chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+            results = await asyncio.gather(*(
+                self._rollout_chunk(chunk, rules, app_id=app_id, period=period, run_id=run_id, dry_run=dry_run, semaphore=semaphore)
+                for chunk in chunks
+            ))
+            for chunk_details in results:
+                for item in chunk_details:
                     details.append(item)
-                    continue
+                    stats["users_processed"] += 1
+                    if item.get("error"):
+                        stats["users_failed"] += 1
+                    elif item.get("credited"):
+                        stats["users_successful"] += 1
+                        stats["total_credits_accredited"] += item["credited"]
+                    elif item.get("would_credit"):
+                        stats["total_credits_accredited"] += item["would_credit"]
 
-                if dry_run:
-                    item["would_credit"] = to_credit
-                    details.append(item)
-                    total_accredited += to_credit
-                    continue
+            after = page[-1].get("user_id")
+            if run_id:
+                await self._update_rollout_run(run_id, {**stats, "checkpoint_user_id": after})
+            logger.info(
+                "📦 Rollout %s/%s: processati=%s accreditati=%s falliti=%s",
+                app_id, period, stats["users_processed"], stats["users_successful"], stats["users_failed"],
+            )
+            if progress is not None:
+                try:
+                    res = progress({**stats, "period": period, "dry_run": dry_run, "checkpoint_user_id": after})
+                    if asyncio.iscoroutine(res):
+                        await res
+                except Exception as e:
+                    logger.warning("Callback progress rollout fallita: %s", e)
+            if len(page) < page_size:
+                break
 
-                # Accredito reale
-                res = await self.credit(uid, float(to_credit), reason="monthly_rollout")
-                if res.get("success"):
-                    users_successful += 1
-                    total_accredited += to_credit
-                    item["credited"] = to_credit
-                    details.append(item)
-                else:
-                    users_failed += 1
-                    item["error"] = res
-                    details.append(item)
+        success = stats["users_failed"] == 0 and error is None
+        summary = {
+            "success": success,
+            "dry_run": dry_run,
+            "period": period,
+            **stats,
+            "details": details,
+        }
+        if error:
+            summary["error"] = error
 
-            summary = {
-                "success": users_failed == 0,
-                "dry_run": dry_run,
-                "users_processed": users_processed,
-                "users_successful": users_successful,
-                "users_failed": users_failed,
-                "total_credits_accredited": total_accredited,
-                "details": details,
+        # 4) Audit (solo se run reale)
+        if not dry_run:
+            final = {
+                **stats,
+                "success": success,
+                "status": "completed" if error is None else "failed",
+                "error_message": error,
+                "execution_time_seconds": int(time.monotonic() - started),
             }
-
-            # 5) Audit (solo se run reale)
-            if not dry_run:
-                audit_headers = {
-                    "apikey": service_key,
-                    "Authorization": f"Bearer {service_key}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=representation",
-                }
+            if run_id:
+                await self._update_rollout_run(run_id, final)
+            else:
+                # Schema senza migration 002: audit legacy a fine run
                 audit_payload = {
                     "run_type": "manual",
-                    "users_processed": users_processed,
-                    "users_successful": users_successful,
-                    "users_failed": users_failed,
-                    "total_credits_accredited": total_accredited,
-                    "success": users_failed == 0,
+                    "users_processed": stats["users_processed"],
+                    "users_successful": stats["users_successful"],
+                    "users_failed": stats["users_failed"],
+                    "total_credits_accredited": stats["total_credits_accredited"],
+                    "success": success,
                     "config_snapshot": rollout_cfg,
                 }
                 try:
-                    await client.post(f"{supabase_url}/rest/v1/credits_rollout_runs", headers=audit_headers, json=audit_payload)
+                    await sb.post("/rest/v1/credits_rollout_runs", json=audit_payload, prefer="return=representation", timeout=20)
                 except Exception:
                     # Audit failure non blocca l'operazione
                     pass
 
-            return summary
+        return summary
+
+    async def _fetch_active_subscriptions(self, after: Optional[str], limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Pagina keyset di subscriptions attive ordinate per user_id."""
+        path = (
+            "/rest/v1/subscriptions?status=eq.active"
+            "&select=user_id,credits_per_month,plan_id,plan:subscription_plans(rollout_percentage,max_credits_rollover)"
+            f"&order=user_id.asc&limit={limit}"
+        )
+        if after:
+            path += f"&user_id=gt.{after}"
+        r = await get_supabase().get(path, timeout=20)
+        if r.status_code != 200 or not r.headers.get("content-type", "").startswith("application/json"):
+            logger.warning("⚠️ Lettura subscriptions fallita: %s %s", r.status_code, r.text)
+            return None
+        return r.json() or []
+
+    async def _fetch_balances(self, user_ids: List[str]) -> Dict[str, float]:
+        """Saldi di un blocco di utenti con una sola query `id=in.(...)`."""
+        if not user_ids:
+            return {}
+        r = await get_supabase().get(f"/rest/v1/profiles?id=in.({','.join(user_ids)})&select=id,credits", timeout=20)
+        balances: Dict[str, float] = {}
+        if r.status_code == 200 and r.headers.get("content-type", "").startswith("application/json"):
+            for row in r.json() or []:
+                uid = row.get("id")
+                if not uid:
+                    continue
+                try:
+                    balances[uid] = float(row.get("credits") or 0)
+                except Exception:
+                    balances[uid] = 0.0
+        return balances
+
+    async def _rollout_chunk(
+        self,
+        rows: List[Dict[str, Any]],
+        rules: Tuple[int, float, Optional[int]],
+        *,
+        app_id: str,
+        period: str,
+        run_id: Optional[str],
+        dry_run: bool,
+        semaphore: asyncio.Semaphore,
+    ) -> List[Dict[str, Any]]:
+        async with semaphore:
+            balances = await self._fetch_balances([r["user_id"] for r in rows])
+            details = [_rollout_item(row, balances.get(row["user_id"], 0.0), rules) for row in rows]
+            to_credit = [d for d in details if d["calculated_credit"] > 0]
+            for d in details:
+                if d["calculated_credit"] <= 0:
+                    d["skipped"] = True
+            if dry_run:
+                for d in to_credit:
+                    d["would_credit"] = d["calculated_credit"]
+                return details
+            if to_credit:
+                await self._credit_batch(to_credit, app_id=app_id, period=period, run_id=run_id)
+            return details
+
+    async def _credit_batch(self, items: List[Dict[str, Any]], *, app_id: str, period: str, run_id: Optional[str]) -> None:
+        """Accredita un blocco con la RPC set-based; fallback a chiamate singole se la RPC manca."""
+        payload = {
+            "p_app_id": app_id,
+            "p_period": period,
+            "p_run_id": run_id,
+            "p_items": [{"user_id": d["user_id"], "amount": d["calculated_credit"]} for d in items],
+            "p_reason": "monthly_rollout",
+        }
+        r = await get_supabase().rpc("rollout_credit_batch", payload, timeout=30)
+        if r.status_code == 200:
+            data = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
+            credited = {str(c.get("user_id")) for c in (data.get("credited") or []) if isinstance(c, dict)}
+            invalidate_user_context(*credited)
+            for d in items:
+                if d["user_id"] in credited:
+                    d["credited"] = d["calculated_credit"]
+                else:
+                    # Già accreditato nel periodo (resume) o profilo inesistente
+                    d["skipped"] = True
+                    d["already_credited"] = True
+            return
+        if r.status_code != 404:
+            for d in items:
+                d["error"] = {"success": False, "status": r.status_code, "error": r.text}
+            return
+
+        # Migration 002 non applicata: chiamate singole (non idempotenti per periodo)
+        for d in items:
+            res = await self.credit(d["user_id"], float(d["calculated_credit"]), reason="monthly_rollout")
+            if res.get("success"):
+                d["credited"] = d["calculated_credit"]
+            else:
+                d["error"] = res
+
+    async def _open_rollout_run(self, app_id: str, period: str, rollout_cfg: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], Dict[str, Any]]:
+        """Riprende il run 'running' del periodo o ne crea uno nuovo.
+
+        Returns: (run_id, checkpoint_user_id, contatori già accumulati)
+        """
+        sb = get_supabase()
+        r = await sb.get(
+            f"/rest/v1/credits_rollout_runs?app_id=eq.{app_id}&period=eq.{period}&status=eq.running"
+            "&select=id,checkpoint_user_id,users_processed,users_successful,users_failed,total_credits_accredited"
+            "&order=run_timestamp.desc&limit=1",
+            timeout=20,
+        )
+        if r.status_code != 200:
+            # Colonne della migration 002 assenti: niente checkpoint
+            return None, None, {}
+        rows = r.json() or []
+        if rows:
+            row = rows[0]
+            previous = {k: row.get(k) for k in ("users_processed", "users_successful", "users_failed", "total_credits_accredited")}
+            return row.get("id"), row.get("checkpoint_user_id"), previous
+        created = await sb.post(
+            "/rest/v1/credits_rollout_runs",
+            json={"run_type": "manual", "app_id": app_id, "period": period, "status": "running", "config_snapshot": rollout_cfg},
+            prefer="return=representation",
+            timeout=20,
+        )
+        if created.status_code not in (200, 201):
+            return None, None, {}
+        data = created.json()
+        row = data[0] if isinstance(data, list) and data else data
+        return (row or {}).get("id"), None, {}
+
+    async def _update_rollout_run(self, run_id: str, fields: Dict[str, Any]) -> None:
+        try:
+            await get_supabase().patch(
+                f"/rest/v1/credits_rollout_runs?id=eq.{run_id}",
+                json={**fields, "updated_at": datetime.now(timezone.utc).isoformat()},
+                timeout=20,
+            )
+        except Exception as e:
+            logger.warning("⚠️ Aggiornamento checkpoint rollout fallito: %s", e)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def _dedupe_by_user(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Una sola subscription per utente (la prima per ordine)."""
+    seen = set()
+    out: List[Dict[str, Any]] = []
+    for row in rows:
+        uid = row.get("user_id")
+        if not uid or uid in seen:
+            continue
+        seen.add(uid)
+        out.append(row)
+    return out
+
+
+def _rollout_item(row: Dict[str, Any], current_balance: float, rules: Tuple[int, float, Optional[int]]) -> Dict[str, Any]:
+    """Calcola l'accredito per un utente (override per-plan, percentuale, cap di rollover)."""
+    credits_per_period, rollout_percentage, max_rollover = rules
+    uid = row.get("user_id")
+    per_month = int(float(row.get("credits_per_month") or 0))
+    # Calcola override per-plan
+    plan_obj = row.get("plan") or {}
+    plan_rollout_pct = plan_obj.get("rollout_percentage")
+    plan_cap_rollover = plan_obj.get("max_credits_rollover")
+    # Base period credits: se configurato globale >0 usa override globale, altrimenti quelli del piano/subscription
+    base_amount = int(credits_per_period if credits_per_period > 0 else per_month)
+    # Percentuale rollout: priorità al piano, fallback globale
+    eff_rollout_pct = float(plan_rollout_pct if plan_rollout_pct is not None else rollout_percentage)
+    to_credit = int(round(base_amount * (eff_rollout_pct / 100.0)))
+    current_balance = float(current_balance or 0.0)
+
+    # Applica cap di rollover: non superare max_rollover
+    cap = None
+    if plan_cap_rollover is not None:
+        try:
+            cap = int(float(plan_cap_rollover))
+        except Exception:
+            cap = None
+    if cap is None and max_rollover is not None and max_rollover >= 0:
+        cap = max_rollover
+    if cap is not None and cap >= 0:
+        if current_balance + to_credit > cap:
+            to_credit = max(0, int(cap - current_balance))
+
+    return {
+        "user_id": uid,
+        "credits_per_month": per_month,
+        "calculated_credit": to_credit,
+        "balance_before": current_balance,
+    }
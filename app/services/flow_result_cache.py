@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+"""
+Cache dei risultati per flow Flowise stateless
+==============================================
+Flow non conversazionali come `title`, `excerpt`, `google_meta` vengono
+rieseguiti spesso con input identici: ogni run ripaga Flowise, gli LLM a valle
+e la misura del delta usage OpenRouter.
+
+- Opt-in per flow in `flow_configs.metadata`:
+  `{"result_cache": {"ttl_seconds": 3600}}` (oppure `"result_cache": true`
+  con TTL di default). I flow conversazionali non sono mai cacheati.
+- Chiave: SHA-256 del JSON canonico di `flow_id`, domanda normalizzata
+  (`question` | `input` | `text`, come la inoltra l'adapter) e resto di `data`,
+  esclusi campi interni (`_*`), sessione e qualsiasi chiave API iniettata.
+- LRU in memoria con TTL per voce e limite sul numero di voci.
+- Una hit salta Flowise e la misura dell'usage OpenRouter: nessuna
+  prenotazione, ma lo stesso gate sul saldo (402) e un addebito ridotto
+  (`flow_cache_hit_cost_ratio` del pricing) accodato sulla coda job, come per
+  la cache chat. La chiave non contiene utente né app: senza gate e addebito
+  chiunque otterrebbe gratis un risultato scaldato da un altro utente.
+
+Env:
+- FLOW_RESULT_CACHE_TTL (TTL di default per `result_cache: true`, secondi, default 3600)
+- FLOW_RESULT_CACHE_MAX_ENTRIES (default 1000; 0 = cache disattivata)
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import time
+
+
+_QUESTION_FIELDS = ("question", "input", "text")
+_SESSION_FIELDS = ("sessionId", "chatId", "session_id")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def flow_result_cache_ttl(metadata: Any, is_conversational: bool) -> float:
+    """TTL configurato per il flow (0 = cache non attiva)."""
+    if is_conversational or not isinstance(metadata, dict):
+        return 0.0
+    opt = metadata.get("result_cache")
+    if opt is True:
+        return _env_float("FLOW_RESULT_CACHE_TTL", 3600.0)
+    if isinstance(opt, dict) and opt.get("enabled", True):
+        try:
+            return max(0.0, float(opt.get("ttl_seconds", _env_float("FLOW_RESULT_CACHE_TTL", 3600.0))))
+        except (TypeError, ValueError):
+            return 0.0
+    return 0.0
+
+
+def _is_secret(key: str) -> bool:
+    k = key.lower().replace("_", "")
+    return "apikey" in k or k in ("authorization", "openrouterkey")
+
+
+def _strip(value: Any) -> Any:
+    """Normalizza ricorsivamente: niente chiavi interne/segrete, stringhe senza spazi ai bordi."""
+    if isinstance(value, dict):
+        return {k: _strip(v) for k, v in value.items() if not str(k).startswith("_") and not _is_secret(str(k))}
+    if isinstance(value, list):
+        return [_strip(v) for v in value]
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def normalize_flow_input(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Domanda normalizzata + resto dei dati rilevanti per il risultato del flow."""
+    question: Optional[str] = None
+    for field in _QUESTION_FIELDS:
+        if field in data:
+            raw = data[field]
+            question = raw if isinstance(raw, str) else json.dumps(raw, ensure_ascii=False, sort_keys=True)
+            break
+    rest = {k: v for k, v in data.items() if k not in _QUESTION_FIELDS and k not in _SESSION_FIELDS}
+    return {"question": question.strip() if question is not None else None, "data": _strip(rest)}
+
+
+def flow_result_cache_key(flow_id: str, data: Dict[str, Any]) -> str:
+    canonical = json.dumps(
+        {"flow_id": flow_id, **normalize_flow_input(data)},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class FlowResultCache:
+    """LRU di risultati Flowise con TTL per voce."""
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def max_entries() -> int:
+        return int(_env_float("FLOW_RESULT_CACHE_MAX_ENTRIES", 1000))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._items.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self._items.pop(key, None)
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, result: Dict[str, Any], ttl: float) -> None:
+        limit = self.max_entries()
+        if ttl <= 0 or limit <= 0:
+            return
+        self._items.pop(key, None)
+        self._items[key] = (time.monotonic() + ttl, result)
+        self.stores += 1
+        while len(self._items) > limit:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": len(self._items),
+        }
+
+
+_flow_result_cache = FlowResultCache()
+
+
+def get_flow_result_cache() -> FlowResultCache:
+    return _flow_result_cache
+
+
+def invalidate_flow_result_cache() -> None:
+    """Da chiamare quando cambia la configurazione di un flow (il TTL copre il resto)."""
+    _flow_result_cache.clear()
+
+
+def get_flow_result_cache_stats() -> Dict[str, Any]:
+    return _flow_result_cache.stats()
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+"""
+Single-flight per esecuzioni Flowise deterministiche identiche in corso
+=======================================================================
+Un doppio submit del client, o molti utenti che lanciano lo stesso flow con lo
+stesso input nello stesso momento, aprivano ognuno una `FlowiseAdapter.execute`
+(fino a 600s). Qui la prima richiesta (leader) esegue il flow; i duplicati che
+arrivano mentre è in corso (follower) attendono lo stesso risultato.
+
+- Solo flow non conversazionali marcati deterministici in `flow_configs.metadata`
+  (`"deterministic": true`, implicito con `result_cache`).
+- Chiave: la stessa della cache risultati (`flow_id` + input normalizzato).
+- Errore del leader: propagato a tutti i follower (nessuna ripetizione a cascata).
+- Coalescing per processo: i duplicati su worker diversi non si vedono.
+
+Addebito per chiamante (`metadata.coalesce_billing`, default FLOW_COALESCE_BILLING):
+- `each`: ogni chiamante paga il costo misurato, come un'esecuzione propria (default)
+- `split`: il costo misurato è diviso in parti uguali tra i chiamanti
+- `leader`: paga solo il leader; le prenotazioni dei follower vengono rilasciate
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+import asyncio
+import os
+
+
+BILLING_POLICIES = ("each", "split", "leader")
+
+
+def flow_is_deterministic(metadata: Any, is_conversational: bool) -> bool:
+    if is_conversational or not isinstance(metadata, dict):
+        return False
+    return bool(metadata.get("deterministic")) or bool(metadata.get("result_cache"))
+
+
+def coalesce_billing_policy(metadata: Any) -> str:
+    policy = metadata.get("coalesce_billing") if isinstance(metadata, dict) else None
+    policy = str(policy or os.environ.get("FLOW_COALESCE_BILLING", "each")).lower()
+    return policy if policy in BILLING_POLICIES else "each"
+
+
+def billing_shares(policy: str, callers: int) -> List[float]:
+    """Frazione del costo misurato per chiamante (indice 0 = leader)."""
+    callers = max(1, callers)
+    if policy == "split":
+        return [1.0 / callers] * callers
+    if policy == "leader":
+        return [1.0] + [0.0] * (callers - 1)
+    return [1.0] * callers
+
+
+@dataclass
+class Flight:
+    """Esecuzione in corso: i follower si registrano e attendono `future`."""
+
+    future: "asyncio.Future[Any]"
+    followers: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class FlowSingleFlight:
+    def __init__(self) -> None:
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.failures = 0
+
+    def join(self, key: str, follower: Dict[str, Any]) -> Optional[Flight]:
+        """Registra un follower se c'è un'esecuzione in corso per `key`."""
+        flight = self._flights.get(key)
+        if flight is None or flight.future.done():
+            return None
+        flight.followers.append(follower)
+        self.followers += 1
+        return flight
+
+    def lead(self, key: str) -> Flight:
+        flight = Flight(future=asyncio.get_running_loop().create_future())
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def finish(self, key: str, flight: Flight, result: Any = None, error: Optional[BaseException] = None) -> List[Dict[str, Any]]:
+        """Chiude il flight (nessun nuovo follower) e risveglia i follower. Ritorna i follower registrati."""
+        if self._flights.get(key) is flight:
+            self._flights.pop(key, None)
+        if not flight.future.done():
+            if error is not None:
+                self.failures += 1
+                flight.future.set_exception(error)
+                # Evita "exception was never retrieved" se nessun follower attende
+                flight.future.exception()
+            else:
+                flight.future.set_result(result)
+        return list(flight.followers)
+
+    @staticmethod
+    async def wait(flight: Flight) -> Any:
+        # shield: un follower annullato non annulla il risultato condiviso
+        return await asyncio.shield(flight.future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self._flights), "leaders": self.leaders, "followers": self.followers, "failures": self.failures}
+
+
+_single_flight = FlowSingleFlight()
+
+
+def get_flow_single_flight() -> FlowSingleFlight:
+    return _single_flight
+
+
+def get_flow_single_flight_stats() -> Dict[str, Any]:
+    return _single_flight.stats()
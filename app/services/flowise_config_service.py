@@ -21,12 +21,90 @@ ENV supportate (compat InsightDesk):
 
 Nodi per-chiave (opzionale):
 - FLOWISE_NODE_MAP_JSON = { "intro": ["chatOpenRouter_0"], "news_writer": ["chatOpenRouter_0","chatOpenRouter_1"] }
+
+Cache risoluzione DB (app_id, flow_key) → config, invalidata dalle scritture admin:
+- FLOW_CONFIG_CACHE_TTL (secondi, default 300; 0 = disabilitata)
+- FLOW_CONFIG_NEGATIVE_TTL (secondi per flow_key sconosciute, default 30)
 """
 
+import copy
+import logging
 import os
 import json
-from typing import Dict, List, Optional
-import httpx
+import time
+from typing import Dict, List, Optional, Tuple
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+class FlowConfigCache:
+    """Config DB risolte per (app_id, flow_key), incluse le assenze (negative caching).
+
+    Come per la cache pricing, `invalidate()` incrementa la versione: una lettura
+    partita prima di una scrittura admin non può ripopolare la cache.
+    """
+
+    def __init__(self) -> None:
+        self._items: Dict[Tuple[str, str], Tuple[float, Optional[Dict[str, object]]]] = {}
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, app_id: str, flow_key: str) -> Tuple[bool, Optional[Dict[str, object]]]:
+        """Ritorna (hit, config); config None con hit=True = flow_key nota come assente."""
+        entry = self._items.get((app_id, flow_key))
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, app_id: str, flow_key: str, config: Optional[Dict[str, object]], version: int) -> None:
+        ttl = _env_float("FLOW_CONFIG_CACHE_TTL", 300.0)
+        if config is None:
+            ttl = min(ttl, _env_float("FLOW_CONFIG_NEGATIVE_TTL", 30.0))
+        if ttl <= 0 or version != self._version:
+            return
+        self._items[(app_id, flow_key)] = (time.monotonic() + ttl, copy.deepcopy(config))
+
+    def invalidate(self, app_id: Optional[str] = None, flow_key: Optional[str] = None) -> None:
+        self._version += 1
+        if app_id is None:
+            self._items = {}
+            return
+        self._items = {
+            k: v for k, v in self._items.items()
+            if not (k[0] == app_id and (flow_key is None or k[1] == flow_key))
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+
+_flow_config_cache = FlowConfigCache()
+
+
+def invalidate_flow_config_cache(app_id: Optional[str] = None, flow_key: Optional[str] = None) -> None:
+    """Da chiamare dopo ogni scrittura su `flow_configs` (None = tutto)."""
+    _flow_config_cache.invalidate(app_id, flow_key)
+    logger.info("♻️ Cache flow config invalidata (app_id=%s flow_key=%s)", app_id, flow_key)
+
+
+def get_flow_config_cache_stats() -> Dict[str, int]:
+    return _flow_config_cache.stats()
 
 
 _FLOW_KEY_TO_ENV: Dict[str, str] = {
@@ -96,47 +174,52 @@ class FlowiseConfigService:
         return []
 
     async def _lookup_db_config(self, app_id: str, flow_key: str) -> Optional[Dict[str, object]]:
+        hit, cached = _flow_config_cache.get(app_id, flow_key)
+        if hit:
+            return cached
+        version = _flow_config_cache.version
+        ok, cfg = await self._query_db_config(app_id, flow_key)
+        # Solo risposte valide (trovata o assente) finiscono in cache, mai gli errori
+        if ok:
+            _flow_config_cache.put(app_id, flow_key, cfg, version)
+        return cfg
+
+    async def _query_db_config(self, app_id: str, flow_key: str) -> Tuple[bool, Optional[Dict[str, object]]]:
         supabase_url = os.environ.get("SUPABASE_URL")
         service_key = os.environ.get("SUPABASE_SERVICE_KEY")
         if not supabase_url or not service_key:
-            return None
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json",
+            return False, None
+        path = f"/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}&select=flow_id,node_names,is_conversational,metadata"
+        resp = await get_supabase().get(path, timeout=10)
+        if resp.status_code != 200:
+            return False, None
+        data = resp.json()
+        if not data:
+            return True, None
+        row = data[0]
+        nodes = row.get("node_names")
+        parsed_nodes: List[str] = []
+        if isinstance(nodes, list):
+            parsed_nodes = [str(n) for n in nodes]
+        elif isinstance(nodes, str):
+            try:
+                j = json.loads(nodes)
+                if isinstance(j, list):
+                    parsed_nodes = [str(n) for n in j]
+            except Exception:
+                parsed_nodes = []
+        # dedup preservando ordine
+        seen = set()
+        dedup_nodes = []
+        for n in parsed_nodes:
+            if n not in seen:
+                seen.add(n)
+                dedup_nodes.append(n)
+        return True, {
+            "flow_id": row.get("flow_id"),
+            "node_names": dedup_nodes,
+            "is_conversational": row.get("is_conversational", False),
+            "metadata": row.get("metadata", {}),
         }
-        url = f"{supabase_url}/rest/v1/flow_configs?app_id=eq.{app_id}&flow_key=eq.{flow_key}&select=flow_id,node_names,is_conversational,metadata"
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code != 200:
-                return None
-            data = resp.json()
-            if not data:
-                return None
-            row = data[0]
-            nodes = row.get("node_names")
-            parsed_nodes: List[str] = []
-            if isinstance(nodes, list):
-                parsed_nodes = [str(n) for n in nodes]
-            elif isinstance(nodes, str):
-                try:
-                    j = json.loads(nodes)
-                    if isinstance(j, list):
-                        parsed_nodes = [str(n) for n in j]
-                except Exception:
-                    parsed_nodes = []
-            # dedup preservando ordine
-            seen = set()
-            dedup_nodes = []
-            for n in parsed_nodes:
-                if n not in seen:
-                    seen.add(n)
-                    dedup_nodes.append(n)
-            return {
-                "flow_id": row.get("flow_id"),
-                "node_names": dedup_nodes,
-                "is_conversational": row.get("is_conversational", False),
-                "metadata": row.get("metadata", {}),
-            }
 
 
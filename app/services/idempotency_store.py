@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+"""
+Store idempotenza per `Idempotency-Key` (utente, chiave, route)
+===============================================================
+PostgREST ignora l'header `Idempotency-Key`: un retry del client rieseguiva il
+flow Flowise/la chat OpenRouter e addebitava due volte. Questo store rende le
+route idempotenti a livello applicativo:
+
+- la prima richiesta "reclama" la chiave con un insert atomico su
+  `idempotency_keys` (on conflict do nothing) ed esegue la chiamata provider;
+- la risposta (solo se riuscita) viene salvata e riproposta ai retry senza
+  rieseguire nulla: nessuna spesa upstream, nessuna latenza aggiuntiva;
+- una richiesta fallita libera la chiave, così il retry può rieseguire;
+- stessa chiave con payload diverso → 422; chiave ancora in corso in un altro
+  processo → 409 con Retry-After.
+- la riga `in_progress` ha un lease breve (`expires_at`), portato al TTL pieno
+  solo al completamento: se il worker muore durante la chiamata, scaduto il
+  lease un retry riprende la chiave invece di ricevere 409 per 24 ore.
+
+Davanti al DB c'è una cache in memoria a TTL breve (retry ravvicinati senza
+I/O) e una mappa delle richieste in volo nel processo: i duplicati concorrenti
+attendono l'esito della prima. Senza la migration 004 lo store lavora solo in
+memoria.
+
+Env:
+- IDEMPOTENCY_TTL_SECONDS (validità della chiave su DB, default 86400)
+- IDEMPOTENCY_LEASE_SECONDS (lease della chiave in corso, default 660: copre il timeout Flowise di 600s)
+- IDEMPOTENCY_CACHE_TTL (secondi in memoria, default 300)
+- IDEMPOTENCY_CACHE_SIZE (default 5000, 0 = disabilitata)
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+_TABLE = "/rest/v1/idempotency_keys"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+@dataclass
+class _Stored:
+    request_hash: str
+    response: Any
+    expires_at: float
+
+
+class IdempotencyStore:
+    """Risposte memorizzate per (route, utente, Idempotency-Key)."""
+
+    def __init__(self) -> None:
+        self._cache: "OrderedDict[str, _Stored]" = OrderedDict()
+        self._inflight: Dict[str, Tuple[str, "asyncio.Future[Any]"]] = {}
+        self._db_available: Optional[bool] = None
+        self.replays = 0
+        self.executions = 0
+
+    @staticmethod
+    def fingerprint(request: Any) -> str:
+        raw = json.dumps(jsonable_encoder(request), sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replays": self.replays,
+            "executions": self.executions,
+            "cached": len(self._cache),
+            "inflight": len(self._inflight),
+            "db_available": self._db_available,
+        }
+
+    async def run(
+        self,
+        *,
+        user_id: str,
+        key: Optional[str],
+        route: str,
+        request: Any,
+        call: Callable[[], Awaitable[Any]],
+        cacheable: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """Esegue `call` una sola volta per chiave; i retry ricevono la risposta salvata.
+
+        Args:
+            user_id: utente (o sorgente, es. provider webhook)
+            key: valore di Idempotency-Key; None = nessuna idempotenza
+            route: nome logico della route
+            request: payload usato per riconoscere il riuso della chiave su richieste diverse
+            call: esecuzione reale
+            cacheable: predicato sulla risposta; se False la chiave viene liberata
+        """
+        if not key:
+            return await call()
+
+        cache_key = f"{route}:{user_id}:{key}"
+        request_hash = self.fingerprint(request)
+
+        stored = self._cache_get(cache_key)
+        if stored is not None:
+            return self._replay(stored.request_hash, request_hash, stored.response)
+
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            # Duplicato concorrente nello stesso processo: attende la prima esecuzione
+            inflight_hash, inflight_future = inflight
+            response = await asyncio.shield(inflight_future)
+            return self._replay(inflight_hash, request_hash, response)
+
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = (request_hash, future)
+        claimed = False
+        try:
+            existing = await self._claim(user_id, route, key, request_hash)
+            if existing is not None:
+                response = self._replay(existing.get("request_hash") or request_hash, request_hash, existing.get("response"))
+                self._cache_put(cache_key, request_hash, response)
+                future.set_result(response)
+                return response
+            claimed = True
+
+            self.executions += 1
+            result = await call()
+            body = jsonable_encoder(result)
+            if cacheable is not None and not cacheable(body):
+                await self._release(user_id, route, key)
+                future.set_result(body)
+                return result
+            await self._complete(user_id, route, key, body)
+            self._cache_put(cache_key, request_hash, body)
+            future.set_result(body)
+            return result
+        except BaseException as e:
+            if claimed:
+                await self._release(user_id, route, key)
+            if not future.done():
+                future.set_exception(e)
+                # Evita "exception was never retrieved" se nessun duplicato è in attesa
+                future.exception()
+            raise
+        finally:
+            self._inflight.pop(cache_key, None)
+
+    def _replay(self, stored_hash: Optional[str], request_hash: str, response: Any) -> Any:
+        if stored_hash and stored_hash != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key già usata con un payload diverso")
+        self.replays += 1
+        return response
+
+    # -----------------------------
+    # Cache in memoria
+    # -----------------------------
+    def _cache_get(self, cache_key: str) -> Optional[_Stored]:
+        stored = self._cache.get(cache_key)
+        if stored is None:
+            return None
+        if stored.expires_at <= time.monotonic():
+            self._cache.pop(cache_key, None)
+            return None
+        self._cache.move_to_end(cache_key)
+        return stored
+
+    def _cache_put(self, cache_key: str, request_hash: str, response: Any) -> None:
+        max_size = int(_env_float("IDEMPOTENCY_CACHE_SIZE", 5000))
+        ttl = _env_float("IDEMPOTENCY_CACHE_TTL", 300.0)
+        if max_size <= 0 or ttl <= 0:
+            return
+        self._cache[cache_key] = _Stored(request_hash=request_hash, response=response, expires_at=time.monotonic() + ttl)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._db_available = None
+
+    # -----------------------------
+    # Persistenza (Supabase)
+    # -----------------------------
+    def _db_enabled(self) -> bool:
+        return self._db_available is not False and get_supabase().configured
+
+    def _mark_missing(self, status_code: int) -> bool:
+        # 404 = tabella assente (migration 004 non applicata): solo memoria
+        if status_code == 404:
+            if self._db_available is not False:
+                logger.warning("⚠️ Tabella idempotency_keys assente: idempotenza solo in memoria")
+            self._db_available = False
+            return True
+        return False
+
+    @staticmethod
+    def _row_filter(user_id: str, route: str, key: str) -> str:
+        return f"user_id=eq.{quote(user_id, safe='')}&route=eq.{quote(route, safe='')}&idempotency_key=eq.{quote(key, safe='')}"
+
+    async def _claim(self, user_id: str, route: str, key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+        """Reclama la chiave. Ritorna la riga completata da riproporre, None se tocca a noi eseguire."""
+        if not self._db_enabled():
+            return None
+        sb = get_supabase()
+        lease = _env_float("IDEMPOTENCY_LEASE_SECONDS", 660.0)
+        row = {
+            "user_id": user_id,
+            "route": route,
+            "idempotency_key": key,
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "expires_at": (datetime.now(timezone.utc) + timedelta(seconds=lease)).isoformat(),
+        }
+        try:
+            for _ in range(2):
+                resp = await sb.post(_TABLE, json=row, prefer="resolution=ignore-duplicates,return=representation", timeout=10)
+                if self._mark_missing(resp.status_code):
+                    return None
+                if resp.status_code in (200, 201) and resp.json():
+                    self._db_available = True
+                    return None
+
+                resp = await sb.get(f"{_TABLE}?{self._row_filter(user_id, route, key)}&select=request_hash,status,response,expires_at", timeout=10)
+                rows = resp.json() if resp.status_code == 200 else []
+                if not rows:
+                    continue
+                existing = rows[0]
+                expires_at = datetime.fromisoformat(str(existing.get("expires_at")).replace("Z", "+00:00"))
+                if expires_at <= datetime.now(timezone.utc):
+                    # Chiave scaduta o lease di un worker morto: la si libera e si riprova il claim
+                    await self._release(user_id, route, key, expired_only=True)
+                    continue
+                if existing.get("status") == "completed":
+                    return existing
+                raise HTTPException(
+                    status_code=409,
+                    detail="Richiesta con la stessa Idempotency-Key ancora in corso",
+                    headers={"Retry-After": "2"},
+                )
+        except HTTPException:
+            raise
+        except Exception as e:
+            # Lo store non deve bloccare il traffico: si degrada a sola memoria
+            logger.warning("Claim idempotenza fallito (%s): procedo senza persistenza", e)
+        return None
+
+    async def _complete(self, user_id: str, route: str, key: str, body: Any) -> None:
+        if not self._db_enabled():
+            return
+        now = datetime.now(timezone.utc)
+        ttl = _env_float("IDEMPOTENCY_TTL_SECONDS", 86400.0)
+        try:
+            await get_supabase().patch(
+                f"{_TABLE}?{self._row_filter(user_id, route, key)}",
+                json={
+                    "status": "completed",
+                    "response": body,
+                    "updated_at": now.isoformat(),
+                    "expires_at": (now + timedelta(seconds=ttl)).isoformat(),
+                },
+                timeout=10,
+            )
+        except Exception as e:
+            logger.warning("Salvataggio risposta idempotente fallito: %s", e)
+
+    async def _release(self, user_id: str, route: str, key: str, expired_only: bool = False) -> None:
+        """Libera la chiave; con `expired_only` solo se scaduta (non cancella il claim appena fatto da un altro worker)."""
+        if not self._db_enabled():
+            return
+        path = f"{_TABLE}?{self._row_filter(user_id, route, key)}"
+        if expired_only:
+            path += f"&expires_at=lt.{quote(datetime.now(timezone.utc).isoformat(), safe='')}"
+        try:
+            await get_supabase().delete(path, timeout=10)
+        except Exception as e:
+            logger.warning("Rilascio chiave idempotente fallito: %s", e)
+
+    async def purge_expired(self) -> None:
+        """Elimina le chiavi scadute (chiamato dal loop di manutenzione)."""
+        if not self._db_enabled():
+            return
+        now = quote(datetime.now(timezone.utc).isoformat(), safe="")
+        resp = await get_supabase().delete(f"{_TABLE}?expires_at=lt.{now}", timeout=30)
+        self._mark_missing(resp.status_code)
+
+
+_store: Optional[IdempotencyStore] = None
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Store condiviso del processo."""
+    global _store
+    if _store is None:
+        _store = IdempotencyStore()
+    return _store
@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+"""
+Coda job durevole su Postgres (lavoro post-risposta)
+====================================================
+L'addebito dei flow in FAST_RETURN e il provisioning post-signup partivano con
+`asyncio.create_task`: un restart o un redeploy li perdeva (output consegnato
+senza addebito, utenti senza chiave/crediti). Ora ogni lavoro è una riga di
+`core_jobs` (migration 007):
+
+- `enqueue()` scrive il job già "in esecuzione" per questo worker (una sola
+  insert) e lo esegue subito in-process, con il contesto in memoria (es. il
+  ticket del cost engine): nessuna latenza aggiuntiva rispetto a prima.
+- Se l'esecuzione fallisce il job torna in coda con backoff esponenziale; se il
+  worker muore, allo scadere del visibility timeout il job torna reclamabile.
+- Un pool di worker (in questo processo o dedicato:
+  `python -m app.services.job_queue`) reclama i job con `FOR UPDATE SKIP
+  LOCKED` e li riesegue senza contesto in memoria. Dopo `max_attempts` il job
+  diventa "dead".
+
+Gli handler ricevono `(payload, context)`; `context` è None quando il job viene
+ripreso da un altro worker. Un handler può aggiornare `payload` (es. salvando
+un risultato intermedio): la versione aggiornata viene persistita per il
+tentativo successivo. Senza migration 007 la coda lavora solo in memoria
+(retry nel processo, nessuna durabilità).
+
+Env:
+- JOB_QUEUE_WORKERS (worker del pool nel processo API, default 2, 0 = nessuno)
+- JOB_POLL_INTERVAL (secondi tra due claim a coda vuota, default 2)
+- JOB_VISIBILITY_TIMEOUT (secondi, default 300)
+- JOB_MAX_ATTEMPTS (default 8)
+- JOB_RETRY_BASE_SECONDS / JOB_RETRY_MAX_SECONDS (backoff, default 5 / 600)
+- JOB_RETENTION_DAYS (job conclusi conservati, default 7)
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import asyncio
+import logging
+import os
+import random
+import socket
+import uuid
+from urllib.parse import quote
+
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+_TABLE = "/rest/v1/core_jobs"
+
+JobHandler = Callable[[Dict[str, Any], Optional[Dict[str, Any]]], Awaitable[None]]
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _backoff(attempts: int) -> float:
+    base = _env_float("JOB_RETRY_BASE_SECONDS", 5.0)
+    delay = min(base * (2 ** max(0, attempts - 1)), _env_float("JOB_RETRY_MAX_SECONDS", 600.0))
+    # Jitter: retry di job falliti insieme non ripartono insieme
+    return delay * random.uniform(1.0, 1.25)
+
+
+class JobQueue:
+    """Coda `core_jobs` con esecuzione immediata in-process e pool di recupero."""
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, JobHandler] = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._workers: List["asyncio.Task[None]"] = []
+        self._local: Set["asyncio.Task[None]"] = set()
+        self._db_available: Optional[bool] = None
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "running_local": len(self._local),
+            "workers": len(self._workers),
+            "db_available": self._db_available,
+        }
+
+    # -----------------------------
+    # Produzione
+    # -----------------------------
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        *,
+        context: Optional[Dict[str, Any]] = None,
+        max_attempts: Optional[int] = None,
+    ) -> Optional[str]:
+        """Persiste il job e lo avvia subito in questo processo. Ritorna l'id del job (None se solo in memoria)."""
+        if kind not in self._handlers:
+            raise ValueError(f"Nessun handler registrato per i job '{kind}'")
+        self.enqueued += 1
+        attempts_max = int(max_attempts or _env_float("JOB_MAX_ATTEMPTS", 8))
+        job_id = await self._insert(kind, payload, attempts_max)
+        if job_id is None:
+            self._spawn(self._run_memory(kind, payload, context, attempts_max))
+        else:
+            job = {"id": job_id, "kind": kind, "payload": payload, "attempts": 1, "max_attempts": attempts_max}
+            self._spawn(self._execute(job, context))
+        return job_id
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = asyncio.ensure_future(coro)
+        # Riferimento forte: evita che il task venga raccolto dal GC a metà
+        self._local.add(task)
+        task.add_done_callback(self._local.discard)
+
+    async def _insert(self, kind: str, payload: Dict[str, Any], max_attempts: int) -> Optional[str]:
+        if not self._db_enabled():
+            return None
+        job_id = str(uuid.uuid4())
+        row = {
+            "id": job_id,
+            "kind": kind,
+            "payload": payload,
+            "status": "running",
+            "attempts": 1,
+            "max_attempts": max_attempts,
+            "locked_by": self.worker_id,
+            "locked_until": (_now() + timedelta(seconds=_env_float("JOB_VISIBILITY_TIMEOUT", 300.0))).isoformat(),
+        }
+        try:
+            resp = await get_supabase().post(_TABLE, json=row, prefer="return=minimal", timeout=10)
+            if self._mark_missing(resp.status_code):
+                return None
+            if resp.status_code in (200, 201, 204):
+                self._db_available = True
+                return job_id
+            logger.warning("Insert job %s fallito: HTTP %s", kind, resp.status_code)
+        except Exception as e:
+            logger.warning("Insert job %s fallito: %s", kind, e)
+        # Il lavoro non va perso: esecuzione in memoria
+        return None
+
+    # -----------------------------
+    # Esecuzione
+    # -----------------------------
+    async def _execute(self, job: Dict[str, Any], context: Optional[Dict[str, Any]]) -> None:
+        kind = job.get("kind")
+        payload = dict(job.get("payload") or {})
+        handler = self._handlers.get(kind)
+        try:
+            if handler is None:
+                raise RuntimeError(f"handler assente per '{kind}'")
+            await handler(payload, context)
+        except Exception as e:
+            await self._fail(job, payload, e)
+            return
+        await self._complete(job["id"])
+
+    async def _run_memory(self, kind: str, payload: Dict[str, Any], context: Optional[Dict[str, Any]], max_attempts: int) -> None:
+        handler = self._handlers[kind]
+        for attempt in range(1, max_attempts + 1):
+            try:
+                await handler(payload, context if attempt == 1 else None)
+                self.completed += 1
+                return
+            except Exception as e:
+                if attempt >= max_attempts:
+                    self.dead += 1
+                    logger.error("❌ Job %s fallito definitivamente: %s", kind, e)
+                    return
+                self.retried += 1
+                delay = _backoff(attempt)
+                logger.warning("Job %s fallito (tentativo %s), retry tra %.0fs: %s", kind, attempt, delay, e)
+                await asyncio.sleep(delay)
+
+    async def _complete(self, job_id: str) -> None:
+        self.completed += 1
+        try:
+            await get_supabase().patch(
+                f"{_TABLE}?id=eq.{job_id}",
+                json={"status": "done", "locked_by": None, "locked_until": None, "updated_at": _now().isoformat()},
+                timeout=10,
+            )
+        except Exception as e:
+            # Il job verrebbe rieseguito allo scadere del visibility timeout: gli handler sono idempotenti
+            logger.warning("Chiusura job %s fallita: %s", job_id, e)
+
+    async def _fail(self, job: Dict[str, Any], payload: Dict[str, Any], error: Exception) -> None:
+        attempts = int(job.get("attempts") or 1)
+        max_attempts = int(job.get("max_attempts") or _env_float("JOB_MAX_ATTEMPTS", 8))
+        update: Dict[str, Any] = {
+            "payload": payload,
+            "locked_by": None,
+            "locked_until": None,
+            "last_error": str(error)[:1000],
+            "updated_at": _now().isoformat(),
+        }
+        if attempts >= max_attempts:
+            self.dead += 1
+            update["status"] = "dead"
+            logger.error("❌ Job %s (%s) fallito definitivamente: %s", job.get("id"), job.get("kind"), error)
+        else:
+            self.retried += 1
+            delay = _backoff(attempts)
+            update["status"] = "queued"
+            update["run_at"] = (_now() + timedelta(seconds=delay)).isoformat()
+            logger.warning("Job %s (%s) fallito (tentativo %s), retry tra %.0fs: %s", job.get("id"), job.get("kind"), attempts, delay, error)
+        try:
+            await get_supabase().patch(f"{_TABLE}?id=eq.{job['id']}", json=update, timeout=10)
+        except Exception as e:
+            logger.warning("Aggiornamento job %s fallito: %s", job.get("id"), e)
+
+    # -----------------------------
+    # Pool di worker
+    # -----------------------------
+    async def claim(self, limit: int = 1) -> List[Dict[str, Any]]:
+        """Reclama job pronti o orfani (FOR UPDATE SKIP LOCKED)."""
+        if not self._db_enabled():
+            return []
+        resp = await get_supabase().rpc(
+            "claim_core_jobs",
+            {
+                "p_worker": self.worker_id,
+                "p_limit": limit,
+                "p_visibility_seconds": int(_env_float("JOB_VISIBILITY_TIMEOUT", 300.0)),
+                "p_kinds": sorted(self._handlers) or None,
+            },
+            timeout=10,
+        )
+        if self._mark_missing(resp.status_code):
+            return []
+        if resp.status_code != 200:
+            logger.warning("claim_core_jobs: HTTP %s", resp.status_code)
+            return []
+        self._db_available = True
+        return resp.json() or []
+
+    async def run_once(self) -> int:
+        """Reclama ed esegue al più un job; ritorna il numero di job eseguiti."""
+        jobs = await self.claim(1)
+        for job in jobs:
+            await self._execute(job, None)
+        return len(jobs)
+
+    async def _worker_loop(self) -> None:
+        interval = max(0.2, _env_float("JOB_POLL_INTERVAL", 2.0))
+        while True:
+            try:
+                if not await self.run_once():
+                    await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Worker job: %s", e)
+                await asyncio.sleep(interval)
+
+    async def start(self, workers: Optional[int] = None) -> None:
+        """Avvia il pool di worker (idempotente)."""
+        count = int(workers if workers is not None else _env_float("JOB_QUEUE_WORKERS", 2))
+        while len(self._workers) < count:
+            self._workers.append(asyncio.create_task(self._worker_loop()))
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def purge_finished(self) -> None:
+        """Elimina i job conclusi più vecchi di JOB_RETENTION_DAYS (loop di manutenzione)."""
+        if not self._db_enabled():
+            return
+        cutoff = quote((_now() - timedelta(days=_env_float("JOB_RETENTION_DAYS", 7.0))).isoformat(), safe="")
+        resp = await get_supabase().delete(f"{_TABLE}?status=in.(done,dead)&updated_at=lt.{cutoff}", timeout=30)
+        self._mark_missing(resp.status_code)
+
+    # -----------------------------
+    # Disponibilità DB
+    # -----------------------------
+    def _db_enabled(self) -> bool:
+        return self._db_available is not False and get_supabase().configured
+
+    def _mark_missing(self, status_code: int) -> bool:
+        # 404 = tabella/RPC assente (migration 007 non applicata): solo memoria
+        if status_code == 404:
+            if self._db_available is not False:
+                logger.warning("⚠️ Tabella core_jobs assente: job eseguiti solo in memoria (non durevoli)")
+            self._db_available = False
+            return True
+        return False
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    """Coda condivisa del processo."""
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+async def _run_dedicated_worker() -> None:
+    # Registra gli handler importando i moduli che li definiscono
+    import app.api.endpoints.auth_proxy  # noqa: F401
+    import app.api.endpoints.core  # noqa: F401
+
+    queue = get_job_queue()
+    await get_supabase().start()
+    await queue.start(max(1, int(_env_float("JOB_QUEUE_WORKERS", 2))))
+    logger.info("🚀 Worker job avviato (%s, %s worker)", queue.worker_id, len(queue._workers))
+    try:
+        await asyncio.gather(*queue._workers)
+    finally:
+        await get_supabase().aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run_dedicated_worker())
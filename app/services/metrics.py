@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+"""
+Metriche di processo in formato Prometheus (text exposition 0.0.4), senza dipendenze.
+
+- Counter / Gauge / Histogram con etichette: aggiornamenti senza lock (un solo
+  event loop per processo; un `+=` su float/int non cede mai il controllo).
+- Collector di stats: a ogni scrape le `stats()` dei componenti (cache, coda
+  job, admission, ...) diventano gauge `core_<componente>_<campo>`.
+- `MetricsMiddleware` (ASGI puro): latenza per route template, metodo e status.
+- `InstrumentedTransport`: wrapper del transport httpx che misura latenza
+  (fino agli header di risposta) e status per upstream e target
+  (tabella/RPC Supabase, endpoint OpenRouter, flow Flowise), più le richieste
+  in volo per pool di connessioni.
+
+Env:
+- CORE_METRICS_TOKEN (opzionale: se impostato /metrics richiede `Authorization: Bearer <token>`)
+"""
+
+import asyncio
+import bisect
+import math
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        return ()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        self._values[self._key(labels)] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per serie: conteggi per bucket (non cumulativi, +Inf in coda), somma, totale
+        self._series: Dict[LabelKey, List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self._series[key] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels: Any) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total, n) in list(self._series.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                cumulative += c
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {n}"
+
+
+class MetricsRegistry:
+    """Metriche registrate per nome, più collector di stats valutati allo scrape."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._stats: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def _get_or_create(self, cls: type, name: str, help_text: str, labelnames: Sequence[str], **kwargs: Any) -> Any:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, help_text, labelnames, **kwargs)
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def register_stats(self, component: str, fn: Callable[[], Dict[str, Any]]) -> None:
+        """Espone i campi numerici di `fn()` come gauge `core_<component>_<campo>`."""
+        self._stats[component] = fn
+
+    def _stats_lines(self) -> List[str]:
+        lines: List[str] = []
+        for component, fn in list(self._stats.items()):
+            try:
+                stats = fn() or {}
+            except Exception:
+                continue
+            for field, value in stats.items():
+                if isinstance(value, bool):
+                    value = 1 if value else 0
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"core_{component}_{field}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return lines
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        lines.extend(self._stats_lines())
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    return _registry
+
+
+HTTP_REQUEST_SECONDS = _registry.histogram(
+    "core_http_request_duration_seconds", "Durata richieste HTTP del Core per route", ("method", "route", "status"),
+)
+UPSTREAM_REQUEST_SECONDS = _registry.histogram(
+    "core_upstream_request_duration_seconds", "Latenza chiamate upstream fino agli header di risposta", ("upstream", "target", "status"),
+)
+UPSTREAM_INFLIGHT = _registry.gauge(
+    "core_upstream_inflight_requests", "Chiamate upstream in corso", ("upstream",),
+)
+POOL_INFLIGHT = _registry.gauge(
+    "core_http_pool_inflight_requests", "Richieste in corso per pool di connessioni", ("pool",),
+)
+POOL_MAX_CONNECTIONS = _registry.gauge(
+    "core_http_pool_max_connections", "Connessioni massime configurate per pool", ("pool",),
+)
+CREDITS_DEBITED = _registry.counter(
+    "core_credits_debited_total", "Crediti addebitati (rate() = crediti/secondo)", ("reason",),
+)
+EVENT_LOOP_TASKS = _registry.gauge(
+    "core_event_loop_tasks", "Task asyncio attivi nel processo (backlog lavoro in background)",
+)
+
+
+def record_credits_debited(amount: Any, reason: Optional[str]) -> None:
+    try:
+        value = float(amount or 0.0)
+    except (TypeError, ValueError):
+        return
+    if value > 0:
+        CREDITS_DEBITED.inc(value, reason=reason or "unknown")
+
+
+def render_metrics() -> str:
+    try:
+        EVENT_LOOP_TASKS.set(len(asyncio.all_tasks()))
+    except RuntimeError:
+        pass
+    return _registry.render()
+
+
+# -----------------------------
+# Classificazione upstream
+# -----------------------------
+_hosts_cache: Tuple[Tuple[Optional[str], ...], Dict[str, str]] = ((), {})
+
+
+def _upstream_hosts() -> Dict[str, str]:
+    """netloc → nome upstream, ricalcolato solo se cambiano gli URL in ENV."""
+    global _hosts_cache
+    env = (
+        os.environ.get("SUPABASE_URL"),
+        os.environ.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
+        os.environ.get("FLOWISE_BASE_URL"),
+        os.environ.get("LEMONSQUEEZY_BASE_URL", "https://api.lemonsqueezy.com/v1"),
+    )
+    if env != _hosts_cache[0]:
+        hosts: Dict[str, str] = {}
+        for name, url in zip(("supabase", "openrouter", "flowise", "lemonsqueezy"), env):
+            netloc = urlsplit(url).netloc if url else ""
+            if netloc:
+                hosts.setdefault(netloc, name)
+        _hosts_cache = (env, hosts)
+    return _hosts_cache[1]
+
+
+def classify_upstream(url: httpx.URL, upstream: Optional[str] = None) -> Tuple[str, str]:
+    """(upstream, target) a cardinalità limitata: niente id o query string nelle etichette."""
+    name = upstream or _upstream_hosts().get(url.netloc.decode("ascii", "replace"), "other")
+    parts = [p for p in url.path.split("/") if p]
+    if name == "other" and "prediction" in parts[:-1]:
+        # Base URL Flowise salvata nelle credenziali (non in ENV)
+        name = "flowise"
+    if name == "supabase":
+        if parts[:2] == ["rest", "v1"]:
+            rest = parts[2:]
+            if rest[:1] == ["rpc"]:
+                return name, f"rpc/{rest[1] if len(rest) > 1 else ''}"
+            return name, f"rest/{rest[0] if rest else ''}"
+        if parts[:2] == ["auth", "v1"]:
+            return name, f"auth/{parts[2] if len(parts) > 2 else ''}"
+        return name, "/".join(parts[:2])
+    if name == "openrouter":
+        # /api/v1/chat/completions, /api/v1/auth/key, /api/v1/keys/{hash}
+        tail = parts[2:] if parts[:2] == ["api", "v1"] else parts
+        if tail[:1] == ["keys"]:
+            return name, "keys"
+        return name, "/".join(tail[:2])
+    if name == "flowise":
+        # .../prediction/{flow_id}: il flow è il target
+        return name, parts[-1] if parts else ""
+    if name == "lemonsqueezy":
+        tail = parts[1:] if parts[:1] == ["v1"] else parts
+        return name, tail[0] if tail else ""
+    return name, url.host
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transport httpx che registra latenza/status per target e richieste in volo per pool.
+
+    `upstream` forza il nome dell'upstream (utile se l'URL arriva dalle credenziali
+    e non da ENV); altrimenti è dedotto dall'host.
+    """
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, *, pool: str, upstream: Optional[str] = None) -> None:
+        self._inner = inner
+        self._pool = pool
+        self._upstream = upstream
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        upstream, target = classify_upstream(request.url, self._upstream)
+        UPSTREAM_INFLIGHT.inc(upstream=upstream)
+        POOL_INFLIGHT.inc(pool=self._pool)
+        status = "error"
+        started = time.perf_counter()
+        try:
+            response = await self._inner.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            UPSTREAM_REQUEST_SECONDS.observe(time.perf_counter() - started, upstream=upstream, target=target, status=status)
+            UPSTREAM_INFLIGHT.dec(upstream=upstream)
+            POOL_INFLIGHT.dec(pool=self._pool)
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+def instrumented_transport(pool: str, upstream: Optional[str] = None, **kwargs: Any) -> InstrumentedTransport:
+    """`httpx.AsyncHTTPTransport(**kwargs)` strumentato (kwargs: http2, limits, retries...)."""
+    limits = kwargs.get("limits")
+    if isinstance(limits, httpx.Limits) and limits.max_connections is not None:
+        POOL_MAX_CONNECTIONS.set(limits.max_connections, pool=pool)
+    return InstrumentedTransport(httpx.AsyncHTTPTransport(**kwargs), pool=pool, upstream=upstream)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI: durata richiesta per route template (404 → 'unmatched')."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def _send(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope.get("method", ""),
+                route=getattr(route, "path", None) or "unmatched",
+                status=str(status[0]),
+            )
@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+"""
+Attribuzione costi OpenRouter per esecuzione (cursore usage per chiave)
+======================================================================
+Flowise chiama OpenRouter con la chiave dell'utente, quindi il Core non vede gli
+id di generazione: l'unica fonte di verità è l'usage cumulativo della chiave
+(`GET /auth/key`). Invece di misurare un delta prima/dopo con sleep fissi
+(fino a 31 chiamate per esecuzione, e delta sovrapposti tra esecuzioni
+concorrenti dello stesso utente), ogni chiave ha un cursore:
+
+- `begin()` registra l'esecuzione; legge l'usage solo se non ci sono altre
+  esecuzioni aperte sulla chiave (altrimenti riusa il cursore: 0 chiamate).
+- `settle()` accoda l'esecuzione conclusa al poller della chiave: un solo loop
+  per chiave attiva serve tutte le misurazioni in attesa, con backoff
+  esponenziale. Ogni incremento osservato oltre il cursore è attribuito per
+  intero a una sola esecuzione, la più vecchia in attesa, e il cursore avanza:
+  un'esecuzione economica non paga parte di una costosa conclusa insieme.
+  Ogni centesimo consumato viene addebitato al massimo una volta.
+- Un'esecuzione senza incremento entro OR_SETTLE_TIMEOUT si chiude con delta
+  None (costo non determinabile): il chiamante rilascia la prenotazione.
+  Il cursore resta valido finché c'è un'esecuzione aperta sulla chiave.
+- Un token bucket globale limita le letture `/auth/key` di tutti i poller, così
+  centinaia di flow conclusi insieme non martellano OpenRouter.
+
+Limite noto: l'usage della chiave è un totale cumulativo senza id di
+generazione. Se due esecuzioni sulla stessa chiave fanno crescere l'usage tra
+due letture consecutive, l'incremento (somma dei due costi) va per intero alla
+più vecchia; l'altra non vede altri incrementi e si chiude con delta None
+(prenotazione rilasciata, nessun addebito). Il totale addebitato per chiave
+resta corretto, ma `actual_cost_credits` e le righe di `credit_transactions`
+della singola richiesta no.
+
+Env:
+- OR_SETTLE_INITIAL_DELAY (secondi, default 1.0)
+- OR_SETTLE_MAX_INTERVAL (secondi, default 8.0)
+- OR_SETTLE_TIMEOUT (secondi, default 60.0)
+- OR_USAGE_POLL_RATE (letture/secondo globali, default 5)
+- OR_USAGE_POLL_BURST (default 10)
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+UsageReader = Callable[[Optional[str]], Awaitable[Optional[float]]]
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+@dataclass
+class CostTicket:
+    """Esecuzione aperta su una chiave OpenRouter."""
+
+    ticket_id: int
+    api_key: Optional[str]
+    usage_before: Optional[float]
+    started_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class CostAttribution:
+    """Esito dell'attribuzione: delta None se l'usage non è leggibile."""
+
+    delta_usd: Optional[float]
+    usage_before: Optional[float]
+    usage_after: Optional[float]
+    upstream_calls: int = 0
+
+
+class _RateLimiter:
+    """Token bucket condiviso tra tutti i poller."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = max(0.01, rate)
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+@dataclass
+class _Waiting:
+    ticket: CostTicket
+    future: "asyncio.Future[CostAttribution]"
+    deadline: float
+    calls: int = 0
+
+
+@dataclass
+class _KeyCursor:
+    usage: Optional[float] = None
+    open_tickets: Dict[int, CostTicket] = field(default_factory=dict)
+    waiting: Dict[int, _Waiting] = field(default_factory=dict)
+    poller: Optional["asyncio.Task[None]"] = None
+
+
+class CostAttributionEngine:
+    """Cursori usage per chiave con poller condiviso e settlement a lotti."""
+
+    def __init__(self, usage_reader: Optional[UsageReader] = None) -> None:
+        if usage_reader is None:
+            from app.services.openrouter_usage_service import OpenRouterUsageService
+            usage_reader = OpenRouterUsageService().get_usage_usd
+        self._read_usage = usage_reader
+        self._cursors: Dict[str, _KeyCursor] = {}
+        self._ids = itertools.count(1)
+        self._limiter = _RateLimiter(
+            rate=_env_float("OR_USAGE_POLL_RATE", 5.0),
+            burst=_env_float("OR_USAGE_POLL_BURST", 10.0),
+        )
+        self.polls = 0
+        self.settled = 0
+
+    def _cursor(self, api_key: str) -> _KeyCursor:
+        cursor = self._cursors.get(api_key)
+        if cursor is None:
+            cursor = _KeyCursor()
+            self._cursors[api_key] = cursor
+        return cursor
+
+    def stats(self) -> Dict[str, Any]:
+        """Contatori del poller (chiavi attive, letture, settlement)."""
+        return {
+            "active_keys": len(self._cursors),
+            "active_pollers": sum(1 for c in self._cursors.values() if c.poller is not None),
+            "pending_settlements": sum(len(c.waiting) for c in self._cursors.values()),
+            "usage_polls": self.polls,
+            "settled": self.settled,
+        }
+
+    async def begin(self, api_key: Optional[str]) -> CostTicket:
+        """Apre un'esecuzione. Ritorna il ticket da passare a `settle()`."""
+        ticket_id = next(self._ids)
+        if not api_key:
+            return CostTicket(ticket_id=ticket_id, api_key=None, usage_before=None)
+        cursor = self._cursor(api_key)
+        # Nessuna esecuzione aperta: riallinea il cursore (usage esterno escluso).
+        # Con esecuzioni aperte il cursore è già valido: nessuna chiamata upstream.
+        needs_read = not cursor.open_tickets or cursor.usage is None
+        ticket = CostTicket(ticket_id=ticket_id, api_key=api_key, usage_before=cursor.usage)
+        cursor.open_tickets[ticket_id] = ticket
+        if needs_read:
+            usage = await self._read_usage(api_key)
+            # Con un poller attivo è lui l'unico autorizzato ad avanzare il cursore
+            if usage is not None and cursor.poller is None:
+                cursor.usage = usage
+            ticket.usage_before = cursor.usage
+        return ticket
+
+    def resume(self, api_key: Optional[str], usage_before: Optional[float]) -> CostTicket:
+        """Ricostruisce un ticket da un job persistito (ripreso dopo un restart o da un altro worker).
+
+        Senza esecuzioni aperte sulla chiave il cursore riparte dall'usage
+        registrato all'avvio dell'esecuzione, così il delta maturato nel
+        frattempo viene comunque attribuito.
+        """
+        ticket_id = next(self._ids)
+        ticket = CostTicket(ticket_id=ticket_id, api_key=api_key, usage_before=usage_before)
+        if not api_key:
+            return ticket
+        cursor = self._cursor(api_key)
+        idle = not cursor.open_tickets and not cursor.waiting and cursor.poller is None
+        if usage_before is not None and (cursor.usage is None or (idle and usage_before < cursor.usage)):
+            cursor.usage = usage_before
+        cursor.open_tickets[ticket_id] = ticket
+        return ticket
+
+    def abandon(self, ticket: CostTicket) -> None:
+        """Chiude un'esecuzione fallita senza attribuire costi."""
+        if not ticket.api_key:
+            return
+        cursor = self._cursors.get(ticket.api_key)
+        if cursor is not None:
+            cursor.open_tickets.pop(ticket.ticket_id, None)
+            self._maybe_drop(ticket.api_key, cursor)
+
+    async def settle(self, ticket: CostTicket) -> CostAttribution:
+        """Accoda il ticket al poller della chiave e attende la sua quota di delta."""
+        if not ticket.api_key:
+            return CostAttribution(delta_usd=None, usage_before=None, usage_after=None)
+        cursor = self._cursor(ticket.api_key)
+        future: "asyncio.Future[CostAttribution]" = asyncio.get_running_loop().create_future()
+        cursor.waiting[ticket.ticket_id] = _Waiting(
+            ticket=ticket,
+            future=future,
+            deadline=time.monotonic() + _env_float("OR_SETTLE_TIMEOUT", 60.0),
+        )
+        if cursor.poller is None:
+            cursor.poller = asyncio.create_task(self._poll_key(ticket.api_key, cursor))
+        try:
+            return await future
+        finally:
+            cursor.waiting.pop(ticket.ticket_id, None)
+            cursor.open_tickets.pop(ticket.ticket_id, None)
+            self._maybe_drop(ticket.api_key, cursor)
+
+    async def _poll_key(self, api_key: str, cursor: _KeyCursor) -> None:
+        """Loop unico per chiave: termina quando non ci sono più settlement in attesa."""
+        initial_delay = max(0.0, _env_float("OR_SETTLE_INITIAL_DELAY", 1.0))
+        max_interval = _env_float("OR_SETTLE_MAX_INTERVAL", 8.0)
+        delay = initial_delay
+        try:
+            while cursor.waiting:
+                if delay > 0:
+                    next_deadline = min(w.deadline for w in cursor.waiting.values())
+                    await asyncio.sleep(max(0.0, min(delay, next_deadline - time.monotonic())))
+                await self._limiter.acquire()
+                usage = await self._read_usage(api_key)
+                self.polls += 1
+                batch = list(cursor.waiting.values())
+                for w in batch:
+                    w.calls += 1
+                base = cursor.usage
+
+                if usage is None or base is None:
+                    if usage is not None:
+                        cursor.usage = usage
+                    self._resolve(cursor, batch, None, base, usage)
+                    continue
+
+                if usage > base + 1e-9:
+                    # Un incremento = una esecuzione: la più vecchia in attesa prende l'intero delta
+                    delta = usage - base
+                    cursor.usage = usage
+                    oldest = min(batch, key=lambda w: w.ticket.ticket_id)
+                    self._resolve(cursor, [oldest], delta, base, usage)
+                    logger.info("💰 Costo attribuito a ticket %s delta_usd=%.6f", oldest.ticket.ticket_id, delta)
+                    delay = initial_delay
+                    continue
+
+                now = time.monotonic()
+                expired = [w for w in batch if w.deadline <= now]
+                if expired:
+                    self._resolve(cursor, expired, None, base, usage)
+                delay = min(max(delay * 2, 0.5), max_interval)
+        except Exception as e:
+            logger.warning("Poller usage OpenRouter interrotto: %s", e)
+            self._resolve(cursor, list(cursor.waiting.values()), None, cursor.usage, None)
+        finally:
+            cursor.poller = None
+
+    def _resolve(self, cursor: _KeyCursor, items: List[_Waiting], delta: Optional[float], base: Optional[float], usage: Optional[float]) -> None:
+        for w in items:
+            cursor.waiting.pop(w.ticket.ticket_id, None)
+            if not w.future.done():
+                w.future.set_result(CostAttribution(delta_usd=delta, usage_before=base, usage_after=usage, upstream_calls=w.calls))
+                self.settled += 1
+
+    def _maybe_drop(self, api_key: str, cursor: _KeyCursor) -> None:
+        # Chiavi inattive: il cursore verrà riletto al prossimo begin()
+        if not cursor.open_tickets and not cursor.waiting and cursor.poller is None:
+            self._cursors.pop(api_key, None)
+
+
+_engine: Optional[CostAttributionEngine] = None
+
+
+def get_cost_attribution() -> CostAttributionEngine:
+    """Engine condiviso del processo."""
+    global _engine
+    if _engine is None:
+        _engine = CostAttributionEngine()
+    return _engine
@@ -12,9 +12,11 @@ import logging
 from datetime import datetime
 from typing import Optional, Dict, Any
 
-import httpx
 
+from app.services.upstream_pools import upstream_client, upstream_timeout
 from app.services.pricing_service import AdvancedPricingSystem as PricingService
+from app.services.supabase_rest import get_supabase
+from app.services.user_context import invalidate_user_context
 
 logger = logging.getLogger(__name__)
 
@@ -55,8 +57,7 @@ class OpenRouterProvisioningService:
         logger.info(f"🔄 Step 1: Creo chiave su OpenRouter: {self.base_url}/keys")
         logger.debug(f"Payload: {payload}")
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(f"{self.base_url}/keys", headers=headers, json=payload)
+        resp = await upstream_client("openrouter").post(f"{self.base_url}/keys", headers=headers, json=payload, timeout=upstream_timeout("openrouter", 30.0))
         
         logger.info(f"📡 Risposta OpenRouter: status={resp.status_code}")
         
@@ -89,13 +90,8 @@ class OpenRouterProvisioningService:
 
         # 4) Salva la chiave nel profilo utente e i metadati (come InsightDesk)
         logger.info(f"🔄 Step 4: Salvo chiave nel profilo Supabase...")
-        upsert_headers = {
-            "apikey": self.service_key,
-            "Authorization": f"Bearer {self.service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "resolution=merge-duplicates,return=representation",
-        }
-        
+        upsert_prefer = "resolution=merge-duplicates,return=representation"
+
         # Aggiorna il profilo con chiave e metadati OpenRouter (solo colonne esistenti)
         profile_payload = {
             "id": user_id,
@@ -110,8 +106,7 @@ class OpenRouterProvisioningService:
         
         logger.debug(f"Profile payload: {profile_payload}")
         
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r3 = await client.post(f"{self.supabase_url}/rest/v1/profiles", headers=upsert_headers, json=profile_payload)
+        r3 = await get_supabase().post("/rest/v1/profiles", json=profile_payload, prefer=upsert_prefer, timeout=15.0)
         
         logger.info(f"📡 Risposta Supabase profiles: status={r3.status_code}")
         
@@ -119,13 +114,13 @@ class OpenRouterProvisioningService:
             logger.error(f"❌ Supabase update profile failed: {r3.status_code} - {r3.text}")
             raise RuntimeError(f"Supabase update profile failed: {r3.status_code} {r3.text}")
         
+        invalidate_user_context(user_id)
         logger.info(f"✅ Step 4: Chiave salvata nel profilo")
 
         # 5) Salva mapping su Supabase per tracking (come fa InsightDesk)
         logger.info(f"🔄 Step 5: Salvo mapping in openrouter_user_keys...")
         mapping_payload = {"user_id": user_id, "key_name": key_name}
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r2 = await client.post(f"{self.supabase_url}/rest/v1/openrouter_user_keys", headers=upsert_headers, json=mapping_payload)
+        r2 = await get_supabase().post("/rest/v1/openrouter_user_keys", json=mapping_payload, prefer=upsert_prefer, timeout=15.0)
         if r2.status_code not in (200, 201):
             # Non bloccare se il mapping fallisce, la chiave è già salvata nel profilo
             logger.warning(f"⚠️  Mapping openrouter_user_keys fallito (non critico): {r2.status_code} - {r2.text}")
@@ -147,28 +142,16 @@ class OpenRouterProvisioningService:
 
     async def _ensure_profile(self, user_id: str, email: str) -> None:
         """Crea/aggiorna il profilo utente se manca, mantenendo credits invariati se già presente."""
-        headers = {
-            "apikey": self.service_key,
-            "Authorization": f"Bearer {self.service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "resolution=merge-duplicates,return=representation",
-        }
+        upsert_prefer = "resolution=merge-duplicates,return=representation"
         payload = {"id": user_id, "email": email}
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r = await client.post(f"{self.supabase_url}/rest/v1/profiles", headers=headers, json=payload)
+        r = await get_supabase().post("/rest/v1/profiles", json=payload, prefer=upsert_prefer, timeout=15.0)
         if r.status_code not in (200, 201):
             raise RuntimeError(f"Supabase upsert profile failed: {r.status_code} {r.text}")
 
         # Se il profilo esiste ma ha 0 crediti, assegna i crediti iniziali da pricing config
         try:
             # Legge credits attuali
-            get_headers = {
-                "apikey": self.service_key,
-                "Authorization": f"Bearer {self.service_key}",
-                "Accept": "application/json",
-            }
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                r2 = await client.get(f"{self.supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=credits", headers=get_headers)
+            r2 = await get_supabase().get(f"/rest/v1/profiles?id=eq.{user_id}&select=credits", timeout=10.0)
             if r2.status_code == 200:
                 data = r2.json()
                 current = float(data[0].get("credits", 0.0)) if data else 0.0
@@ -188,28 +171,16 @@ class OpenRouterProvisioningService:
                         pricing = PricingService(config_file=config_path)
                         initial = float(getattr(pricing.config, "signup_initial_credits", 0.0) or 0.0)
                     if initial > 0.0:
-                        up_headers = {
-                            "apikey": self.service_key,
-                            "Authorization": f"Bearer {self.service_key}",
-                            "Content-Type": "application/json",
-                            "Prefer": "resolution=merge-duplicates,return=representation",
-                        }
                         up_payload = {"id": user_id, "credits": initial, "updated_at": datetime.utcnow().isoformat()}
-                        async with httpx.AsyncClient(timeout=10.0) as client:
-                            _ = await client.post(f"{self.supabase_url}/rest/v1/profiles", headers=up_headers, json=up_payload)
+                        _ = await get_supabase().post("/rest/v1/profiles", json=up_payload, prefer=upsert_prefer, timeout=10.0)
+                        invalidate_user_context(user_id)
         except Exception:
             # Non bloccare il provisioning se fallisce
             pass
 
     async def get_user_email(self, user_id: str) -> Optional[str]:
         """Legge l'email dal profilo utente, se presente."""
-        headers = {
-            "apikey": self.service_key,
-            "Authorization": f"Bearer {self.service_key}",
-            "Accept": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            r = await client.get(f"{self.supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=email", headers=headers)
+        r = await get_supabase().get(f"/rest/v1/profiles?id=eq.{user_id}&select=email", timeout=10.0)
         if r.status_code != 200:
             return None
         data = r.json()
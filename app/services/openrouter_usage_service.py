@@ -13,9 +13,10 @@ https://openrouter.ai/api/v1).
 
 from typing import Optional, Tuple
 import os
-import httpx
 import logging
 
+from app.services.upstream_pools import upstream_client, upstream_timeout
+
 
 logger = logging.getLogger(__name__)
 
@@ -37,8 +38,8 @@ class OpenRouterUsageService:
             return None
         headers = {"Authorization": f"Bearer {user_api_key}", "Content-Type": "application/json"}
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                resp = await client.get(f"{self.base_url}/auth/key", headers=headers)
+            # Con breaker aperto fallisce subito (UpstreamUnavailable) invece di attendere 30s
+            resp = await upstream_client("openrouter").get(f"{self.base_url}/auth/key", headers=headers, timeout=upstream_timeout("openrouter", 30.0))
             if resp.status_code != 200:
                 logger.warning("OpenRouter usage non disponibile: %s %s", resp.status_code, resp.text)
                 return None
@@ -7,13 +7,16 @@ Usa la tabella `openrouter_user_keys`:
 - user_id (uuid primary key)
 - key_name (text)
 
+Chiave e key_name arrivano dallo snapshot profilo condiviso (`user_context`).
+
 Nota: La vera provisioning della chiave su OpenRouter non è gestita qui.
 Questo modulo assume che il mapping esista, oppure fallisce con errore esplicito.
 """
 
 from typing import Optional
 import os
-import httpx
+from app.services.supabase_rest import get_supabase
+from app.services.user_context import get_user_context
 
 
 class OpenRouterUserKeysService:
@@ -26,37 +29,22 @@ class OpenRouterUserKeysService:
             raise RuntimeError("SUPABASE_URL o SUPABASE_SERVICE_KEY non configurati")
 
     async def get_user_key_name(self, user_id: str) -> Optional[str]:
-        """Ritorna il key_name OpenRouter associato all'utente, se presente."""
-        url = f"{self.supabase_url}/rest/v1/openrouter_user_keys?user_id=eq.{user_id}&select=key_name"
-        headers = {
-            "apikey": self.service_key,
-            "Authorization": f"Bearer {self.service_key}",
-            "Accept": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code != 200:
-                return None
-            data = resp.json()
-            if not data:
-                return None
-            return data[0].get("key_name") or None
+        """Ritorna il key_name OpenRouter associato all'utente, se presente.
+
+        Prima dallo snapshot profilo (`profiles.openrouter_key_name`), poi dal mapping storico.
+        """
+        ctx = await get_user_context(user_id)
+        if ctx is not None and ctx.openrouter_key_name:
+            return ctx.openrouter_key_name
+        resp = await get_supabase().get(f"/rest/v1/openrouter_user_keys?user_id=eq.{user_id}&select=key_name", timeout=10)
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        if not data:
+            return None
+        return data[0].get("key_name") or None
 
     async def get_user_api_key(self, user_id: str) -> Optional[str]:
         """Ritorna la API key OpenRouter salvata nel profilo (profiles.openrouter_api_key), se presente."""
-        url = f"{self.supabase_url}/rest/v1/profiles?id=eq.{user_id}&select=openrouter_api_key"
-        headers = {
-            "apikey": self.service_key,
-            "Authorization": f"Bearer {self.service_key}",
-            "Accept": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code != 200:
-                return None
-            data = resp.json()
-            if not data:
-                return None
-            return data[0].get("openrouter_api_key") or None
-
-
+        ctx = await get_user_context(user_id)
+        return ctx.openrouter_api_key if ctx is not None else None
@@ -6,39 +6,69 @@ PaymentsService
 Servizio di orchestrazione dei pagamenti provider-agnostico.
 
 - Seleziona l'adapter in base alla config in `billing_configs`
-- Espone API minime: get_plans, create_checkout, process_webhook
+- Espone API minime: get_plans, create_checkout, ingest_webhook, process_webhook
 - Bridge: salva i webhook e normalizza le transazioni nel layer agnostico
 
+Webhook asincroni (migration 008): `ingest_webhook` verifica la firma e salva
+l'evento grezzo con una sola RPC (dedup su provider + event_id), così il
+provider riceve 200 in pochi millisecondi. `consume_webhooks` (loop in
+app/main.py, risvegliato a ogni ingestione) elabora gli eventi in ordine di
+arrivo con retry e backoff; con la migration 012 l'accredito è al più uno per
+evento e un evento in errore non blocca gli altri. Senza migration 008 si
+ricade su `process_webhook` inline.
+
 Sicurezza: usa SUPABASE_SERVICE_KEY lato server per scrivere su Supabase.
 """
 
-from typing import Any, Dict, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import logging
 import os
 import json
-import httpx
+import time
+
+from fastapi import HTTPException
 
 from app.services.billing_config_service import BillingConfigService
-from app.services.credentials_manager import CredentialsManager
+from app.services.credentials_manager import get_credentials_manager
 from app.adapters.provider_lemonsqueezy import LemonSqueezyAdapter
 from app.core.interfaces import BillingProvider
 from app.services.credits_supabase import SupabaseCreditsLedger
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
 
 
 class PaymentsService:
     def __init__(self) -> None:
         self._billing_cfg_svc = BillingConfigService()
-        self._credentials = CredentialsManager()
+        self._credentials = get_credentials_manager()
         self._cached_adapter: Optional[BillingProvider] = None
         self._cached_provider: Optional[str] = None
+        self._cached_config: Optional[Dict[str, Any]] = None
+        self._plans_response: Optional[Tuple[Dict[str, Any], float, bytes, str]] = None
+        self._ingest_available: Optional[bool] = None
+        self._wakeup: Optional[asyncio.Event] = None
 
     async def _get_adapter(self) -> BillingProvider:
+        # Snapshot dalla cache di BillingConfigService: nessun round-trip a ogni chiamata
         cfg = await self._billing_cfg_svc.get_config()
         conf: Dict[str, Any] = cfg.get("config") or {}
-        provider = (conf.get("provider") or "lemonsqueezy").strip().lower()
 
-        # Riuso cache se il provider non cambia
-        if self._cached_adapter and self._cached_provider == provider:
+        # Stesso snapshot → stesso adapter; una config aggiornata ricostruisce l'adapter
+        if self._cached_adapter and self._cached_config is conf:
             return self._cached_adapter
+        provider = (conf.get("provider") or "lemonsqueezy").strip().lower()
 
         if provider == "lemonsqueezy":
             adapter = LemonSqueezyAdapter(config=conf, credentials_manager=self._credentials)
@@ -49,18 +79,208 @@ class PaymentsService:
 
         self._cached_adapter = adapter
         self._cached_provider = provider
+        self._cached_config = conf
         return adapter
 
     async def get_plans(self) -> Dict[str, Any]:
         adapter = await self._get_adapter()
         return await adapter.get_plans()
 
+    async def get_plans_response(self) -> Tuple[bytes, str]:
+        """Risposta `/billing/plans` precalcolata: (body JSON, ETag).
+
+        Ricalcolata solo quando cambia la config billing o dopo BILLING_PLANS_TTL
+        secondi (i piani possono arrivare dall'API del provider).
+        """
+        adapter = await self._get_adapter()
+        cached = self._plans_response
+        if cached is not None and cached[0] is self._cached_config and cached[1] > time.monotonic():
+            return cached[2], cached[3]
+        plans = await adapter.get_plans()
+        body = json.dumps(plans, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self._plans_response = (self._cached_config or {}, time.monotonic() + _env_float("BILLING_PLANS_TTL", 300.0), body, etag)
+        return body, etag
+
     async def create_checkout(self, *, user_id: str, credits: int, amount_usd: Optional[float] = None, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         adapter = await self._get_adapter()
         return await adapter.create_checkout(user_id=user_id, credits=credits, amount_usd=amount_usd, metadata=metadata)
 
+    @staticmethod
+    def _parse_body(body: bytes) -> Dict[str, Any]:
+        try:
+            payload = json.loads(body.decode("utf-8")) if body else {}
+        except Exception:
+            payload = {}
+        return payload if isinstance(payload, dict) else {}
+
+    async def ingest_webhook(self, *, body: bytes, signature: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Percorso veloce del webhook: firma, una scrittura (evento grezzo), risposta.
+
+        L'elaborazione avviene in `consume_webhooks`. Se la persistenza fallisce
+        risponde 503, così il provider ritenta la consegna. Ritorna None se la
+        migration 008 non è applicata: il chiamante usa `process_webhook`.
+        """
+        sb = get_supabase()
+        if not sb.configured:
+            return {"status": "error", "error": "Supabase non configurato"}
+        if self._ingest_available is False:
+            return None
+
+        adapter = await self._get_adapter()
+        provider = (self._cached_provider or "lemonsqueezy")
+        if hasattr(adapter, "refresh_signing_secret"):
+            await adapter.refresh_signing_secret()
+        if not adapter.validate_webhook(body=body, signature=signature):
+            return {"status": "ignored", "reason": "invalid_signature"}
+
+        payload = self._parse_body(body)
+        if hasattr(adapter, "webhook_event_id"):
+            event_id = adapter.webhook_event_id(payload, body)
+        else:
+            event_id = hashlib.sha256(body).hexdigest()
+
+        try:
+            resp = await sb.rpc(
+                "ingest_billing_webhook",
+                {"p_provider": provider, "p_event_id": event_id, "p_payload": payload},
+                timeout=10,
+            )
+        except Exception as e:
+            logger.error(f"❌ Persistenza webhook fallita: {e}")
+            raise HTTPException(status_code=503, detail="Persistenza webhook non riuscita", headers={"Retry-After": "5"})
+        if resp.status_code == 404:
+            # Migration 008 non applicata: elaborazione inline (comportamento storico)
+            logger.warning("⚠️ RPC ingest_billing_webhook assente: webhook elaborati inline")
+            self._ingest_available = False
+            return None
+        if resp.status_code != 200:
+            logger.error(f"❌ Persistenza webhook fallita: HTTP {resp.status_code} {resp.text}")
+            raise HTTPException(status_code=503, detail="Persistenza webhook non riuscita", headers={"Retry-After": "5"})
+
+        self._ingest_available = True
+        data = resp.json() or {}
+        self.wake_consumer()
+        return {
+            "status": "ok",
+            "provider": provider,
+            "event_id": event_id,
+            "queued": not data.get("duplicate"),
+            "duplicate": bool(data.get("duplicate")),
+        }
+
+    # -----------------------------
+    # Consumer eventi persistiti
+    # -----------------------------
+    def wake_consumer(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+
+    async def wait_for_webhooks(self, timeout: float) -> None:
+        """Attende una nuova ingestione (o il timeout di polling)."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def consume_webhooks(self) -> int:
+        """Elabora in ordine di arrivo il prossimo lotto di eventi persistiti.
+
+        Un evento che fallisce va in backoff (parcheggiato fino a `locked_until`)
+        e il lotto prosegue con gli altri: un solo evento non blocca la coda.
+        Il lease viene esteso prima di ogni evento, non una volta per lotto.
+        L'accredito è idempotente sulla riga di log (migration 012), quindi
+        rielaborare un evento dopo un lease scaduto non accredita due volte.
+        Ritorna il numero di eventi elaborati.
+        """
+        sb = get_supabase()
+        if not sb.configured or self._ingest_available is False:
+            return 0
+        resp = await sb.rpc(
+            "claim_billing_webhooks",
+            {
+                "p_limit": int(_env_float("WEBHOOK_BATCH_SIZE", 20)),
+                "p_visibility_seconds": int(_env_float("WEBHOOK_VISIBILITY_TIMEOUT", 120)),
+            },
+            timeout=15,
+        )
+        if resp.status_code == 404:
+            self._ingest_available = False
+            return 0
+        if resp.status_code != 200:
+            logger.warning(f"⚠️ claim_billing_webhooks: HTTP {resp.status_code}")
+            return 0
+        rows: List[Dict[str, Any]] = sorted(
+            resp.json() or [],
+            key=lambda r: (str(r.get("received_at") or ""), str(r.get("id") or "")),
+        )
+        if not rows:
+            return 0
+
+        adapter = await self._get_adapter()
+        visibility = _env_float("WEBHOOK_VISIBILITY_TIMEOUT", 120)
+        processed = 0
+        for i, row in enumerate(rows):
+            # Lease rinnovato sugli eventi ancora da elaborare: il lotto resta di questo worker
+            await self._extend_lease(rows[i:], visibility)
+            try:
+                result = await self._apply_event(
+                    adapter,
+                    row.get("provider") or self._cached_provider or "lemonsqueezy",
+                    row.get("payload") or {},
+                    log_id=row.get("id"),
+                )
+                if result.get("status") != "ok":
+                    raise RuntimeError(result.get("error") or "elaborazione fallita")
+            except Exception as e:
+                await self._fail_event(row, e)
+                continue
+            await self._update_event(row["id"], {
+                "status": "processed",
+                "processed_at": datetime.now(timezone.utc).isoformat(),
+                "locked_until": None,
+                "error_message": None,
+                "result": {k: v for k, v in result.items() if k != "transaction"},
+            })
+            processed += 1
+        return processed
+
+    async def _fail_event(self, row: Dict[str, Any], error: Exception) -> None:
+        attempts = int(row.get("attempts") or 1)
+        if attempts >= int(_env_float("WEBHOOK_MAX_ATTEMPTS", 10)):
+            logger.error(f"❌ Webhook {row.get('event_id')} scartato dopo {attempts} tentativi: {error}")
+            await self._update_event(row["id"], {"status": "failed", "locked_until": None, "error_message": str(error)[:1000]})
+        else:
+            delay = min(5.0 * (2 ** (attempts - 1)), _env_float("WEBHOOK_RETRY_MAX_SECONDS", 600))
+            logger.warning(f"⚠️ Webhook {row.get('event_id')} fallito (tentativo {attempts}), retry tra {delay:.0f}s: {error}")
+            # locked_until futuro: l'evento resta parcheggiato, claim_billing_webhooks lo salta
+            await self._update_event(row["id"], {
+                "status": "received",
+                "locked_until": (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat(),
+                "error_message": str(error)[:1000],
+            })
+
+    async def _extend_lease(self, rows: List[Dict[str, Any]], seconds: float) -> None:
+        ids = ",".join(str(r["id"]) for r in rows)
+        until = (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+        try:
+            await get_supabase().patch(f"/rest/v1/billing_webhook_logs?id=in.({ids})", json={"locked_until": until}, timeout=15)
+        except Exception as e:
+            logger.warning(f"⚠️ Rinnovo lease webhook fallito: {e}")
+
+    async def _update_event(self, log_id: str, fields: Dict[str, Any]) -> None:
+        try:
+            await get_supabase().patch(f"/rest/v1/billing_webhook_logs?id=eq.{log_id}", json=fields, timeout=15)
+        except Exception as e:
+            # Visibility timeout: l'evento verrà ripreso
+            logger.warning(f"⚠️ Aggiornamento webhook {log_id} fallito: {e}")
+
     async def process_webhook(self, *, body: bytes, signature: Optional[str]) -> Dict[str, Any]:
-        """Processa webhook provider:
+        """Processa webhook provider inline (fallback senza migration 008):
         - Valida firma
         - Salva webhook raw in `billing_webhook_logs`
         - Normalizza e salva in `lemonsqueezy_transactions` (se LS)
@@ -76,34 +296,38 @@ class PaymentsService:
         provider = (self._cached_provider or "lemonsqueezy")
 
         # 1) Parse JSON body se possibile
-        try:
-            payload = json.loads(body.decode("utf-8")) if body else {}
-        except Exception:
-            payload = {}
+        payload = self._parse_body(body)
 
         # 2) Salva log webhook (status received)
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Content-Type": "application/json",
-            "Prefer": "resolution=merge-duplicates,return=representation",
-        }
+        sb = get_supabase()
+        upsert_prefer = "resolution=merge-duplicates,return=representation"
         log_row = {
             "provider": provider,
             "payload": payload or {},
             "status": "received",
         }
-        async with httpx.AsyncClient(timeout=15) as client:
-            try:
-                await client.post(f"{supabase_url}/rest/v1/billing_webhook_logs", headers=headers, json=log_row)
-            except Exception:
-                pass
+        try:
+            await sb.post("/rest/v1/billing_webhook_logs", json=log_row, prefer=upsert_prefer, timeout=15)
+        except Exception:
+            pass
 
         # 3) Valida firma (se adapter la supporta)
         if hasattr(adapter, "validate_webhook") and callable(getattr(adapter, "validate_webhook")):
+            if hasattr(adapter, "refresh_signing_secret"):
+                await adapter.refresh_signing_secret()
             if not adapter.validate_webhook(body=body, signature=signature):
                 return {"status": "ignored", "reason": "invalid_signature"}
 
+        return await self._apply_event(adapter, provider, payload)
+
+    async def _apply_event(self, adapter: BillingProvider, provider: str, payload: Dict[str, Any], log_id: Optional[str] = None) -> Dict[str, Any]:
+        """Normalizza l'evento, salva le transazioni e accredita i crediti.
+
+        Con `log_id` (evento persistito) l'accredito è al più uno per evento.
+        """
+        sb = get_supabase()
+        upsert_prefer = "resolution=merge-duplicates,return=representation"
+
         # 4) Normalizza payload
         normalized: Dict[str, Any] = {}
         if hasattr(adapter, "parse_webhook"):
@@ -131,36 +355,37 @@ class PaymentsService:
                     "credits_amount": normalized.get("credits_to_add") or 0,
                     "raw_data": payload,
                 }
-                async with httpx.AsyncClient(timeout=20) as client:
-                    # Upsert LS transaction
-                    await client.post(
-                        f"{supabase_url}/rest/v1/lemonsqueezy_transactions?on_conflict=lemonsqueezy_transaction_id",
-                        headers=headers,
-                        json=tx,
-                    )
-
-                    # Inserisci anche layer agnostico billing_transactions
-                    bt = {
-                        "provider": provider,
-                        "provider_transaction_id": tx["lemonsqueezy_transaction_id"],
-                        "provider_order_id": tx.get("lemonsqueezy_order_id"),
-                        "provider_subscription_id": tx.get("lemonsqueezy_subscription_id"),
-                        "provider_customer_id": tx.get("lemonsqueezy_customer_id"),
-                        "user_id": tx.get("user_id"),
-                        "transaction_type": tx.get("transaction_type") or "one_time",
-                        "amount_cents": tx.get("amount_cents") or 0,
-                        "currency": "USD",
-                        "status": tx.get("status") or "paid",
-                        "product_name": tx.get("product_name"),
-                        "variant_name": tx.get("variant_name"),
-                        "credits_amount": tx.get("credits_amount") or 0,
-                        "raw_data": tx.get("raw_data"),
-                    }
-                    await client.post(
-                        f"{supabase_url}/rest/v1/billing_transactions?on_conflict=provider_transaction_id",
-                        headers=headers,
-                        json=bt,
-                    )
+                # Upsert LS transaction
+                await sb.post(
+                    "/rest/v1/lemonsqueezy_transactions?on_conflict=lemonsqueezy_transaction_id",
+                    json=tx,
+                    prefer=upsert_prefer,
+                    timeout=20,
+                )
+
+                # Inserisci anche layer agnostico billing_transactions
+                bt = {
+                    "provider": provider,
+                    "provider_transaction_id": tx["lemonsqueezy_transaction_id"],
+                    "provider_order_id": tx.get("lemonsqueezy_order_id"),
+                    "provider_subscription_id": tx.get("lemonsqueezy_subscription_id"),
+                    "provider_customer_id": tx.get("lemonsqueezy_customer_id"),
+                    "user_id": tx.get("user_id"),
+                    "transaction_type": tx.get("transaction_type") or "one_time",
+                    "amount_cents": tx.get("amount_cents") or 0,
+                    "currency": "USD",
+                    "status": tx.get("status") or "paid",
+                    "product_name": tx.get("product_name"),
+                    "variant_name": tx.get("variant_name"),
+                    "credits_amount": tx.get("credits_amount") or 0,
+                    "raw_data": tx.get("raw_data"),
+                }
+                await sb.post(
+                    "/rest/v1/billing_transactions?on_conflict=provider_transaction_id",
+                    json=bt,
+                    prefer=upsert_prefer,
+                    timeout=20,
+                )
 
                 result["transaction"] = tx
 
@@ -169,8 +394,22 @@ class PaymentsService:
                 user_id = normalized.get("user_id")
                 if user_id and credits_to_add > 0:
                     ledger = SupabaseCreditsLedger()
-                    _ = await ledger.credit(user_id=user_id, amount=float(credits_to_add), reason="ls_webhook")
-                    result["credits_accredited"] = credits_to_add
+                    credit_res = None
+                    if log_id:
+                        credit_res = await ledger.credit_webhook_event(log_id, user_id, float(credits_to_add), "ls_webhook")
+                        if credit_res.get("status") == 404:
+                            # Migration 012 non applicata: accredito storico
+                            credit_res = None
+                    if credit_res is None:
+                        credit_res = await ledger.credit(user_id=user_id, amount=float(credits_to_add), reason="ls_webhook")
+                    if isinstance(credit_res, dict) and credit_res.get("success") is False:
+                        status_code = credit_res.get("status")
+                        if isinstance(status_code, int) and (status_code >= 500 or status_code == 429):
+                            # Errore transitorio: il consumer ritenta l'evento (gli upsert sopra sono idempotenti)
+                            raise RuntimeError(f"Accredito crediti fallito: HTTP {status_code}")
+                        result["credit_error"] = credit_res.get("error")
+                    else:
+                        result["credits_accredited"] = credits_to_add
 
         except Exception as e:
             result = {"status": "error", "error": str(e)}
@@ -178,3 +417,12 @@ class PaymentsService:
         return result
 
 
+_service: Optional[PaymentsService] = None
+
+
+def get_payments_service() -> PaymentsService:
+    """Servizio condiviso del processo (endpoint billing e consumer webhook)."""
+    global _service
+    if _service is None:
+        _service = PaymentsService()
+    return _service
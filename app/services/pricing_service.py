@@ -6,12 +6,16 @@ Permette simulazioni di business cambiando revenue target e costi fissi.
 """
 import os
 import json
+import asyncio
 import logging
+import time
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Awaitable, Callable, Dict, Any, Optional, List, Tuple
 import httpx
 from dataclasses import dataclass, field, asdict, fields
 
+from app.services.supabase_rest import get_supabase, service_headers
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -91,6 +95,102 @@ class PricingConfig:
     # Revenue recognition
     unused_credits_recognized_as_revenue: bool = True
 
+    # Cache risposte chat OpenRouter (opt-in): TTL in secondi per modello, "*" = default.
+    # Mappa vuota = cache disattivata
+    chat_cache_ttl_seconds: Dict[str, float] = field(default_factory=dict)
+    # Frazione del costo pieno addebitata su una hit di cache (0 = gratuita)
+    chat_cache_hit_cost_ratio: float = 0.1
+    # Cache risultati Flowise: frazione del costo del flow (flowise_execute) addebitata su una hit
+    flow_cache_hit_cost_ratio: float = 0.1
+
+class PricingConfigCache:
+    """Snapshot in-process di `PricingConfig` per app_id, con TTL e invalidazione versionata.
+
+    Gli snapshot sono trattati come immutabili: ogni reload crea una nuova istanza
+    e la sostituisce con un singolo assegnamento, senza modificare quella in uso.
+    `invalidate()` incrementa la versione: un caricamento partito prima
+    dell'invalidazione non può ripopolare la cache con dati vecchi.
+    I miss concorrenti per lo stesso app_id condividono un solo caricamento.
+
+    Env:
+    - PRICING_CONFIG_CACHE_TTL (secondi, default 60; 0 = disabilitata)
+    """
+
+    def __init__(self) -> None:
+        self._snapshots: Dict[str, Tuple[float, PricingConfig]] = {}
+        self._last_good: Dict[str, PricingConfig] = {}
+        self._inflight: Dict[str, "asyncio.Future[Optional[PricingConfig]]"] = {}
+        self._version = 0
+
+    @staticmethod
+    def ttl() -> float:
+        try:
+            return float(os.environ.get("PRICING_CONFIG_CACHE_TTL", "60"))
+        except Exception:
+            return 60.0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, app_id: str) -> Optional[PricingConfig]:
+        entry = self._snapshots.get(app_id)
+        if entry is None:
+            return None
+        expires_at, config = entry
+        if expires_at <= time.monotonic():
+            return None
+        return config
+
+    def put(self, app_id: str, config: PricingConfig, version: int) -> None:
+        ttl = self.ttl()
+        if version != self._version:
+            return
+        self._last_good[app_id] = config
+        if ttl <= 0:
+            return
+        self._snapshots[app_id] = (time.monotonic() + ttl, config)
+
+    def last_good(self, app_id: str) -> Optional[PricingConfig]:
+        """Ultimo snapshot caricato (anche scaduto o invalidato): fallback se Supabase non risponde."""
+        return self._last_good.get(app_id)
+
+    async def load_once(self, app_id: str, loader: Callable[[], Awaitable[Optional[PricingConfig]]]) -> Optional[PricingConfig]:
+        """Esegue `loader` una sola volta per app_id anche con miss concorrenti."""
+        inflight = self._inflight.get(app_id)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        future: "asyncio.Future[Optional[PricingConfig]]" = asyncio.get_running_loop().create_future()
+        self._inflight[app_id] = future
+        version = self._version
+        try:
+            loaded = await loader()
+            if loaded is not None:
+                self.put(app_id, loaded, version)
+            future.set_result(loaded)
+            return loaded
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(app_id, None)
+
+    def invalidate(self) -> None:
+        """Invalida tutti gli snapshot (la riga 'default' vale per ogni app_id)."""
+        self._version += 1
+        self._snapshots = {}
+
+
+_pricing_cache = PricingConfigCache()
+
+
+def invalidate_pricing_cache() -> None:
+    """Da chiamare dopo ogni scrittura su `pricing_configs`."""
+    _pricing_cache.invalidate()
+    logger.info("♻️ Cache pricing config invalidata (version=%s)", _pricing_cache.version)
+
+
 class AdvancedPricingSystem:
     """
     Sistema di pricing avanzato con configurazione dinamica per simulazioni di business.
@@ -124,33 +224,29 @@ class AdvancedPricingSystem:
         Strategia:
         - Carica SEMPRE la riga 'default' (single source of truth a livello progetto)
         - Per retrocompatibilità, se specificato, prova anche la riga per app_id
-        - Se viene trovata una config valida, aggiorna self.config e la ritorna
+        - Se viene trovata una config valida la ritorna come nuovo snapshot
+          (non modifica `self.config`: chi tiene uno snapshot non lo vede cambiare)
         """
         supabase_url = os.environ.get("SUPABASE_URL")
         service_key = os.environ.get("SUPABASE_SERVICE_KEY")
         if not supabase_url or not service_key:
             return None
-        headers = {
-            "apikey": service_key,
-            "Authorization": f"Bearer {service_key}",
-            "Accept": "application/json",
-        }
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                # 1) Prova riga 'default'
-                r = await client.get(f"{supabase_url}/rest/v1/pricing_configs?app_id=eq.default&select=config", headers=headers)
-                cfg_obj: Optional[Dict[str, Any]] = None
-                if r.status_code == 200:
-                    data = r.json()
-                    if data:
-                        cfg_obj = data[0].get("config") or {}
-                # 2) Retrocompatibilità: se non trovata e app_id specificato, prova quella riga
-                if cfg_obj is None and app_id and app_id != "default":
-                    r2 = await client.get(f"{supabase_url}/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config", headers=headers)
-                    if r2.status_code == 200:
-                        data2 = r2.json()
-                        if data2:
-                            cfg_obj = data2[0].get("config") or {}
+            sb = get_supabase()
+            # 1) Prova riga 'default'
+            r = await sb.get("/rest/v1/pricing_configs?app_id=eq.default&select=config", timeout=10.0)
+            cfg_obj: Optional[Dict[str, Any]] = None
+            if r.status_code == 200:
+                data = r.json()
+                if data:
+                    cfg_obj = data[0].get("config") or {}
+            # 2) Retrocompatibilità: se non trovata e app_id specificato, prova quella riga
+            if cfg_obj is None and app_id and app_id != "default":
+                r2 = await sb.get(f"/rest/v1/pricing_configs?app_id=eq.{app_id}&select=config", timeout=10.0)
+                if r2.status_code == 200:
+                    data2 = r2.json()
+                    if data2:
+                        cfg_obj = data2[0].get("config") or {}
 
             if cfg_obj is None:
                 return None
@@ -171,16 +267,31 @@ class AdvancedPricingSystem:
                     filtered['fixed_monthly_costs_usd'] = []
             if 'flow_costs_usd' not in filtered or not isinstance(filtered.get('flow_costs_usd'), dict):
                 filtered['flow_costs_usd'] = {}
+            if not isinstance(filtered.get('chat_cache_ttl_seconds', {}), dict):
+                filtered['chat_cache_ttl_seconds'] = {}
 
             loaded = PricingConfig(**filtered)
-            # Aggiorna in memoria per uso successivo
-            self.config = loaded
             logger.info("📥 Pricing config caricata da Supabase (source=default%s)", f", fallback={app_id}" if app_id and app_id != "default" else "")
             return loaded
         except Exception as e:
             logger.warning(f"⚠️ Errore caricamento pricing da Supabase: {e}")
             return None
 
+    async def get_config_snapshot(self, app_id: Optional[str] = None) -> PricingConfig:
+        """Ritorna lo snapshot pricing per app_id senza I/O se ancora valido.
+
+        In caso di miss ricarica da Supabase (un solo caricamento per app_id);
+        se Supabase non risponde ritorna l'ultimo snapshot caricato o i default.
+        """
+        key = app_id or "default"
+        cached = _pricing_cache.get(key)
+        if cached is not None:
+            return cached
+        loaded = await _pricing_cache.load_once(key, lambda: self._load_from_supabase_async(key))
+        if loaded is None:
+            return _pricing_cache.last_good(key) or self.config
+        return loaded
+
     def save_to_supabase(self, app_id: str, config: Optional[PricingConfig] = None) -> bool:
         """Salva la configurazione su Supabase come fonte di verità.
         Ritorna True/False senza sollevare eccezioni."""
@@ -198,15 +309,14 @@ class AdvancedPricingSystem:
             ]:
                 if k in payload:
                     payload.pop(k, None)
-            headers = {
-                "apikey": service_key,
-                "Authorization": f"Bearer {service_key}",
-                "Content-Type": "application/json",
-                "Prefer": "resolution=merge-duplicates,return=representation",
-            }
+            headers = service_headers(json_body=True, prefer="resolution=merge-duplicates,return=representation")
+            # Metodo sincrono: non può usare il pool async condiviso
             with httpx.Client(timeout=12.0) as client:
                 r = client.post(f"{supabase_url}/rest/v1/pricing_configs", headers=headers, json={"app_id": app_id, "config": payload})
-            return r.status_code in (200, 201)
+            ok = r.status_code in (200, 201)
+            if ok:
+                invalidate_pricing_cache()
+            return ok
         except Exception as e:
             logger.warning(f"⚠️ Errore salvataggio pricing su Supabase: {e}")
             return False
@@ -239,12 +349,32 @@ class AdvancedPricingSystem:
         logging.info("🔧 Configurazione pricing aggiornata (in memoria).")
         return self.config
 
-    def calculate_operation_cost_credits(self, operation_type: str, context: Optional[Dict] = None) -> float:
+    def calculate_operation_cost_credits(self, operation_type: str, context: Optional[Dict] = None, config: Optional[PricingConfig] = None) -> float:
         """
         Calcola il costo finale in crediti per una data operazione.
         - Supporta override per flow specifico (context['flow_key'] o context['flow_id']).
+        - Se il provider riporta il costo reale (context['cost_usd']), usa quello come base.
+        - `openrouter_chat_cached`: hit della cache chat, `chat_cache_hit_cost_ratio`
+          del costo della chat originale (0 = nessun addebito).
+        - `flowise_execute_cached`: hit della cache risultati flow, `flow_cache_hit_cost_ratio`
+          del costo configurato del flow.
+        - `config`: snapshot da usare (default: self.config)
         """
         context = context or {}
+        cfg = config or self.config
+
+        if operation_type == "openrouter_chat_cached":
+            ratio = float(getattr(cfg, "chat_cache_hit_cost_ratio", 0.0) or 0.0)
+            if ratio <= 0:
+                return 0.0
+            full_cost = self.calculate_operation_cost_credits("openrouter_chat", context, config=cfg)
+            return round(max(full_cost * ratio, cfg.minimum_operation_cost_credits), 2)
+        if operation_type == "flowise_execute_cached":
+            ratio = float(getattr(cfg, "flow_cache_hit_cost_ratio", 0.0) or 0.0)
+            if ratio <= 0:
+                return 0.0
+            full_cost = self.calculate_operation_cost_credits("flowise_execute", context, config=cfg)
+            return round(max(full_cost * ratio, cfg.minimum_operation_cost_credits), 2)
 
         # Determina costo base USD
         base_cost_usd = self.operation_costs_usd.get(operation_type, 0.01)
@@ -253,39 +383,46 @@ class AdvancedPricingSystem:
             # Priorità: flow_key, poi flow_id
             flow_key = context.get("flow_key") if isinstance(context, dict) else None
             flow_id = context.get("flow_id") if isinstance(context, dict) else None
-            if flow_key and flow_key in self.config.flow_costs_usd:
-                base_cost_usd = float(self.config.flow_costs_usd[flow_key])
-            elif flow_id and flow_id in self.config.flow_costs_usd:
-                base_cost_usd = float(self.config.flow_costs_usd[flow_id])
+            if flow_key and flow_key in cfg.flow_costs_usd:
+                base_cost_usd = float(cfg.flow_costs_usd[flow_key])
+            elif flow_id and flow_id in cfg.flow_costs_usd:
+                base_cost_usd = float(cfg.flow_costs_usd[flow_id])
+        elif isinstance(context, dict) and context.get("cost_usd") is not None:
+            try:
+                base_cost_usd = float(context["cost_usd"])
+            except (TypeError, ValueError):
+                pass
         
-        final_cost_credits = base_cost_usd * self.config.final_credit_multiplier
+        final_cost_credits = base_cost_usd * cfg.final_credit_multiplier
         
         # Applica il costo minimo per garantire sostenibilità
-        cost = max(final_cost_credits, self.config.minimum_operation_cost_credits)
+        cost = max(final_cost_credits, cfg.minimum_operation_cost_credits)
         
         logging.debug(f"💰 Costo calcolato per '{operation_type}' (base ${base_cost_usd:.6f}): {cost:.2f} crediti")
         return round(cost, 2)
 
-    def calculate_flow_pricing(self, flow_key: Optional[str], flow_id: Optional[str]) -> Dict[str, float]:
+    def calculate_flow_pricing(self, flow_key: Optional[str], flow_id: Optional[str], config: Optional[PricingConfig] = None) -> Dict[str, float]:
         """Ritorna un breakdown dei moltiplicatori business per un flow.
         Keys: usd_to_credits, overhead_multiplier, margin_multiplier, final_credit_multiplier, final_cost_credits, final_cost_usd
         Nota: base_cost_usd è stato rimosso per evitare ambiguità.
+        `config`: snapshot da usare (default: self.config)
         """
+        cfg = config or self.config
         # Base USD (override per flow o default op)
         base_cost_usd = self.operation_costs_usd.get("flowise_execute", 0.01)
-        if flow_key and flow_key in self.config.flow_costs_usd:
-            base_cost_usd = float(self.config.flow_costs_usd[flow_key])
-        elif flow_id and flow_id in self.config.flow_costs_usd:
-            base_cost_usd = float(self.config.flow_costs_usd[flow_id])
-
-        overhead_multiplier = self.config.total_overhead_multiplier
-        margin_multiplier = self.config.target_margin_multiplier
-        usd_to_credits = self.config.usd_to_credits
+        if flow_key and flow_key in cfg.flow_costs_usd:
+            base_cost_usd = float(cfg.flow_costs_usd[flow_key])
+        elif flow_id and flow_id in cfg.flow_costs_usd:
+            base_cost_usd = float(cfg.flow_costs_usd[flow_id])
+
+        overhead_multiplier = cfg.total_overhead_multiplier
+        margin_multiplier = cfg.target_margin_multiplier
+        usd_to_credits = cfg.usd_to_credits
         final_credit_multiplier = overhead_multiplier * margin_multiplier * usd_to_credits
         usd_multiplier = overhead_multiplier * margin_multiplier
         total_multiplier_percent = usd_multiplier * 100.0
         markup_percent = (usd_multiplier - 1.0) * 100.0
-        final_cost_credits = max(base_cost_usd * final_credit_multiplier, self.config.minimum_operation_cost_credits)
+        final_cost_credits = max(base_cost_usd * final_credit_multiplier, cfg.minimum_operation_cost_credits)
         # Prezzo finale anche in USD (prima della conversione crediti): divide per usd_to_credits
         final_cost_usd = round(final_cost_credits / usd_to_credits, 6) if usd_to_credits else round(base_cost_usd * overhead_multiplier * margin_multiplier, 6)
 
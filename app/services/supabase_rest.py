@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+"""
+Client REST Supabase/PostgREST condiviso (pool di connessioni long-lived).
+
+- Un unico `httpx.AsyncClient` per processo, avviato/chiuso dagli eventi
+  startup/shutdown dell'app: niente handshake TCP+TLS per ogni query.
+- HTTP/2 con keep-alive se il pacchetto `h2` è installato, altrimenti HTTP/1.1.
+- Costruzione header service-role centralizzata.
+
+Env:
+- SUPABASE_HTTP2 (default '1')
+- SUPABASE_POOL_MAX_CONNECTIONS (default 100)
+- SUPABASE_POOL_MAX_KEEPALIVE (default 20)
+- SUPABASE_POOL_KEEPALIVE_EXPIRY (secondi, default 30)
+- SUPABASE_HTTP_TIMEOUT (secondi, default 15)
+
+Il transport passa dal bulkhead/circuit breaker `supabase` di `upstream_pools`.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+import importlib.util
+import logging
+import os
+
+import httpx
+
+from app.services.upstream_pools import get_upstream_pools
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def supabase_env() -> Tuple[Optional[str], Optional[str]]:
+    """Ritorna (SUPABASE_URL, SUPABASE_SERVICE_KEY) letti da ENV."""
+    return os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_KEY")
+
+
+def service_headers(*, json_body: bool = False, prefer: Optional[str] = None, extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Header standard per chiamate service-role verso Supabase.
+
+    Args:
+        json_body: se True aggiunge Content-Type JSON (richieste con body)
+        prefer: valore opzionale per l'header `Prefer` di PostgREST
+        extra: header aggiuntivi che sovrascrivono i default
+    """
+    service_key = os.environ.get("SUPABASE_SERVICE_KEY") or ""
+    headers = {
+        "apikey": service_key,
+        "Authorization": f"Bearer {service_key}",
+        "Accept": "application/json",
+    }
+    if json_body:
+        headers["Content-Type"] = "application/json"
+    if prefer:
+        headers["Prefer"] = prefer
+    if extra:
+        headers.update(extra)
+    return headers
+
+
+class SupabaseRestClient:
+    """Wrapper sottile attorno a un `httpx.AsyncClient` condiviso.
+
+    I path sono relativi a SUPABASE_URL (es. `/rest/v1/profiles?id=eq.X`).
+    Ogni metodo accetta `timeout` per-richiesta, così i timeout storici dei
+    singoli servizi restano invariati pur condividendo lo stesso pool.
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def configured(self) -> bool:
+        supabase_url, service_key = supabase_env()
+        return bool(supabase_url and service_key)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        http2 = os.environ.get("SUPABASE_HTTP2", "1").lower() in ("1", "true", "yes")
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.info("SUPABASE_HTTP2 attivo ma pacchetto 'h2' assente: uso HTTP/1.1")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=_env_int("SUPABASE_POOL_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=_env_int("SUPABASE_POOL_MAX_KEEPALIVE", 20),
+            keepalive_expiry=_env_float("SUPABASE_POOL_KEEPALIVE_EXPIRY", 30.0),
+        )
+        pools = get_upstream_pools()
+        timeout = httpx.Timeout(_env_float("SUPABASE_HTTP_TIMEOUT", 15.0), connect=5.0, pool=pools.acquire_timeout("supabase"))
+        # Pool dedicato (bulkhead) + circuit breaker; strumentato per /metrics
+        return httpx.AsyncClient(transport=pools.transport("supabase", http2=http2, limits=limits), timeout=timeout)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Client condiviso; creato on-demand se l'app non l'ha ancora avviato (script, test)."""
+        if self._client is None:
+            self._client = self._build_client()
+        return self._client
+
+    async def start(self) -> None:
+        """Inizializza il pool (chiamato allo startup dell'app)."""
+        _ = self.client
+
+    async def aclose(self) -> None:
+        """Chiude il pool (chiamato allo shutdown dell'app)."""
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning("Chiusura client Supabase fallita: %s", e)
+
+    def url(self, path: str) -> str:
+        supabase_url = (os.environ.get("SUPABASE_URL") or "").rstrip("/")
+        return f"{supabase_url}{path if path.startswith('/') else '/' + path}"
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        json: Any = None,
+        headers: Optional[Dict[str, str]] = None,
+        prefer: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> httpx.Response:
+        hdrs = headers if headers is not None else service_headers(json_body=json is not None, prefer=prefer)
+        kwargs: Dict[str, Any] = {"headers": hdrs}
+        if json is not None:
+            kwargs["json"] = json
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return await self.client.request(method, self.url(path), **kwargs)
+
+    async def get(self, path: str, *, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> httpx.Response:
+        return await self.request("GET", path, headers=headers, timeout=timeout)
+
+    async def post(self, path: str, json: Any = None, *, headers: Optional[Dict[str, str]] = None, prefer: Optional[str] = None, timeout: Optional[float] = None) -> httpx.Response:
+        return await self.request("POST", path, json=json, headers=headers, prefer=prefer, timeout=timeout)
+
+    async def patch(self, path: str, json: Any = None, *, headers: Optional[Dict[str, str]] = None, prefer: Optional[str] = None, timeout: Optional[float] = None) -> httpx.Response:
+        return await self.request("PATCH", path, json=json, headers=headers, prefer=prefer, timeout=timeout)
+
+    async def put(self, path: str, json: Any = None, *, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> httpx.Response:
+        return await self.request("PUT", path, json=json, headers=headers, timeout=timeout)
+
+    async def delete(self, path: str, *, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> httpx.Response:
+        return await self.request("DELETE", path, headers=headers, timeout=timeout)
+
+    async def rpc(self, function: str, payload: Dict[str, Any], *, timeout: Optional[float] = None) -> httpx.Response:
+        """Invoca una funzione Postgres esposta da PostgREST (`/rest/v1/rpc/<function>`)."""
+        return await self.post(f"/rest/v1/rpc/{function}", json=payload, prefer="return=representation", timeout=timeout)
+
+
+_shared = SupabaseRestClient()
+
+
+def get_supabase() -> SupabaseRestClient:
+    """Ritorna il client Supabase condiviso del processo."""
+    return _shared
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+"""
+Bulkhead e circuit breaker per upstream (Supabase, OpenRouter, Flowise, LemonSqueezy).
+
+- Un `httpx.AsyncClient` long-lived per upstream con il proprio limite di
+  connessioni: un Flowise lento (timeout 600s) esaurisce solo il pool `flowise`,
+  non i socket usati per Supabase.
+- Attesa di uno slot del pool limitata (`pool` timeout): a bulkhead saturo la
+  richiesta fallisce con `httpx.PoolTimeout` invece di accodarsi per minuti.
+- Circuit breaker per upstream sul transport: dopo N errori consecutivi
+  (eccezioni di rete/timeout o status 502/503/504) passa a `open` e rifiuta subito
+  con `UpstreamUnavailable`; trascorso il cooldown lascia passare un numero
+  limitato di richieste di prova (`half_open`) e richiude al primo successo.
+  Gli altri 5xx contano come upstream raggiungibile: un 500 di Flowise per un
+  singolo flow mal configurato non deve aprire il breaker per tutti i flow.
+- Stato su /metrics: `core_upstream_breaker_state{upstream}` (0 closed,
+  1 half_open, 2 open), transizioni e richieste rifiutate.
+
+Env (per upstream `<NAME>` = SUPABASE | OPENROUTER | FLOWISE | LEMONSQUEEZY, fallback globali):
+- <NAME>_POOL_MAX_CONNECTIONS (default: supabase 100, openrouter 50, flowise 20, lemonsqueezy 10)
+- <NAME>_POOL_MAX_KEEPALIVE (default 20)
+- <NAME>_POOL_ACQUIRE_TIMEOUT / UPSTREAM_POOL_ACQUIRE_TIMEOUT (secondi, default 10)
+- <NAME>_BREAKER_FAILURES / UPSTREAM_BREAKER_FAILURES (errori consecutivi, default 5, 0 = breaker disattivo)
+- <NAME>_BREAKER_OPEN_SECONDS / UPSTREAM_BREAKER_OPEN_SECONDS (cooldown, default 30)
+- <NAME>_BREAKER_HALF_OPEN_PROBES / UPSTREAM_BREAKER_HALF_OPEN_PROBES (richieste di prova, default 1)
+"""
+
+import importlib.util
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.services.metrics import get_metrics_registry, instrumented_transport
+
+
+logger = logging.getLogger(__name__)
+
+UPSTREAMS = ("supabase", "openrouter", "flowise", "lemonsqueezy")
+_DEFAULT_MAX_CONNECTIONS = {"supabase": 100, "openrouter": 50, "flowise": 20, "lemonsqueezy": 10}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+# Status che indicano upstream non disponibile (gateway/sovraccarico/timeout)
+_BREAKER_STATUSES = frozenset({502, 503, 504})
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_registry = get_metrics_registry()
+BREAKER_STATE = _registry.gauge(
+    "core_upstream_breaker_state", "Stato circuit breaker (0 closed, 1 half_open, 2 open)", ("upstream",),
+)
+BREAKER_TRANSITIONS = _registry.counter(
+    "core_upstream_breaker_transitions_total", "Transizioni di stato del circuit breaker", ("upstream", "state"),
+)
+BREAKER_REJECTED = _registry.counter(
+    "core_upstream_breaker_rejected_total", "Richieste rifiutate senza chiamare l'upstream (breaker aperto)", ("upstream",),
+)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def _setting(upstream: str, suffix: str, default: float) -> float:
+    """`<UPSTREAM>_<SUFFIX>` con fallback su `UPSTREAM_<SUFFIX>` e poi sul default."""
+    return _env_float(f"{upstream.upper()}_{suffix}", _env_float(f"UPSTREAM_{suffix}", default))
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """Breaker aperto: la richiesta non è stata inviata all'upstream."""
+
+    def __init__(self, upstream: str, retry_after: float, request: Optional[httpx.Request] = None) -> None:
+        super().__init__(f"{upstream} non disponibile (circuit breaker aperto, retry tra {retry_after:.0f}s)", request=request)
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Breaker a errori consecutivi con half-open a probe limitati.
+
+    Tutto lo stato è mutato senza await intermedi: sicuro su un singolo event loop.
+    """
+
+    def __init__(self, upstream: str) -> None:
+        self.upstream = upstream
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes_inflight = 0
+        self.rejected = 0
+        BREAKER_STATE.set(0, upstream=upstream)
+
+    @property
+    def threshold(self) -> int:
+        return int(_setting(self.upstream, "BREAKER_FAILURES", 5))
+
+    @property
+    def open_seconds(self) -> float:
+        return _setting(self.upstream, "BREAKER_OPEN_SECONDS", 30.0)
+
+    @property
+    def max_probes(self) -> int:
+        return max(1, int(_setting(self.upstream, "BREAKER_HALF_OPEN_PROBES", 1)))
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        BREAKER_STATE.set(_STATE_VALUE[state], upstream=self.upstream)
+        BREAKER_TRANSITIONS.inc(upstream=self.upstream, state=state)
+        if state == OPEN:
+            logger.warning("⚡ Circuit breaker %s aperto dopo %s errori consecutivi", self.upstream, self.failures)
+        elif state == CLOSED:
+            logger.info("✅ Circuit breaker %s richiuso", self.upstream)
+
+    def before_request(self) -> bool:
+        """True se la richiesta è un probe half-open; solleva se il breaker è aperto."""
+        if self.threshold <= 0 or self.state == CLOSED:
+            return False
+        now = time.monotonic()
+        if self.state == OPEN:
+            remaining = self.opened_at + self.open_seconds - now
+            if remaining > 0:
+                self.rejected += 1
+                BREAKER_REJECTED.inc(upstream=self.upstream)
+                raise UpstreamUnavailable(self.upstream, remaining)
+            self._transition(HALF_OPEN)
+        if self.probes_inflight >= self.max_probes:
+            self.rejected += 1
+            BREAKER_REJECTED.inc(upstream=self.upstream)
+            raise UpstreamUnavailable(self.upstream, self.open_seconds)
+        self.probes_inflight += 1
+        return True
+
+    def record_success(self, probe: bool) -> None:
+        if probe:
+            self.probes_inflight = max(0, self.probes_inflight - 1)
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self, probe: bool) -> None:
+        if probe:
+            self.probes_inflight = max(0, self.probes_inflight - 1)
+        self.failures += 1
+        threshold = self.threshold
+        if self.state == HALF_OPEN or (threshold > 0 and self.failures >= threshold):
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+    def release_probe(self, probe: bool) -> None:
+        """Probe concluso senza esito utile (es. bulkhead saturo, richiesta annullata)."""
+        if probe:
+            self.probes_inflight = max(0, self.probes_inflight - 1)
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.probes_inflight = 0
+        self._transition(CLOSED)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class BreakerTransport(httpx.AsyncBaseTransport):
+    """Transport che consulta il breaker prima di inviare e ne aggiorna lo stato all'arrivo degli header."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, breaker: CircuitBreaker) -> None:
+        self._inner = inner
+        self._breaker = breaker
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        breaker = self._breaker
+        try:
+            probe = breaker.before_request()
+        except UpstreamUnavailable as e:
+            e.request = request
+            raise
+        try:
+            response = await self._inner.handle_async_request(request)
+        except httpx.PoolTimeout:
+            # Saturazione locale del bulkhead, non un guasto dell'upstream
+            breaker.release_probe(probe)
+            raise
+        except (httpx.TransportError, OSError):
+            breaker.record_failure(probe)
+            raise
+        except BaseException:
+            breaker.release_probe(probe)
+            raise
+        if response.status_code in _BREAKER_STATUSES:
+            breaker.record_failure(probe)
+        else:
+            breaker.record_success(probe)
+        return response
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class UpstreamPools:
+    """Client HTTP per upstream, creati on-demand e chiusi allo shutdown."""
+
+    def __init__(self) -> None:
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {name: CircuitBreaker(name) for name in UPSTREAMS}
+
+    def breaker(self, upstream: str) -> CircuitBreaker:
+        breaker = self.breakers.get(upstream)
+        if breaker is None:
+            breaker = self.breakers[upstream] = CircuitBreaker(upstream)
+        return breaker
+
+    def transport(self, upstream: str, **kwargs: Any) -> BreakerTransport:
+        """Transport bulkhead+breaker (strumentato per /metrics) per `upstream`."""
+        limits = kwargs.pop("limits", None) or httpx.Limits(
+            max_connections=int(_setting(upstream, "POOL_MAX_CONNECTIONS", _DEFAULT_MAX_CONNECTIONS.get(upstream, 20))),
+            max_keepalive_connections=int(_setting(upstream, "POOL_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=_setting(upstream, "POOL_KEEPALIVE_EXPIRY", 30.0),
+        )
+        inner = instrumented_transport(upstream, upstream=upstream, limits=limits, **kwargs)
+        return BreakerTransport(inner, self.breaker(upstream))
+
+    def acquire_timeout(self, upstream: str) -> float:
+        return _setting(upstream, "POOL_ACQUIRE_TIMEOUT", 10.0)
+
+    def timeout(self, upstream: str, seconds: float, *, connect: float = 10.0) -> httpx.Timeout:
+        """Timeout per-richiesta che mantiene l'attesa slot del bulkhead breve."""
+        return httpx.Timeout(seconds, connect=connect, pool=self.acquire_timeout(upstream))
+
+    def client(self, upstream: str) -> httpx.AsyncClient:
+        """Client condiviso dell'upstream (non Supabase: quello è in `supabase_rest`)."""
+        client = self._clients.get(upstream)
+        if client is None or client.is_closed:
+            http2 = upstream == "openrouter" and importlib.util.find_spec("h2") is not None
+            client = httpx.AsyncClient(
+                transport=self.transport(upstream, http2=http2),
+                timeout=self.timeout(upstream, 30.0),
+            )
+            self._clients[upstream] = client
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for name, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning("Chiusura client %s fallita: %s", name, e)
+
+
+_pools = UpstreamPools()
+
+
+def get_upstream_pools() -> UpstreamPools:
+    return _pools
+
+
+def upstream_client(upstream: str) -> httpx.AsyncClient:
+    """Client bulkhead condiviso per `openrouter` | `flowise` | `lemonsqueezy`."""
+    return _pools.client(upstream)
+
+
+def upstream_timeout(upstream: str, seconds: float, *, connect: float = 10.0) -> httpx.Timeout:
+    return _pools.timeout(upstream, seconds, connect=connect)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+"""
+Snapshot del profilo utente per il percorso caldo di esecuzione
+===============================================================
+Una `flowise_execute` leggeva `profiles` tre volte (chiave API nel Core, di
+nuovo nell'adapter, saldo) più `openrouter_user_keys` per il key_name: quattro
+round-trip sequenziali per i dati di una sola riga. Qui una sola `select`
+(`credits, openrouter_api_key, openrouter_key_name`) alimenta tutte le fasi:
+auth, affordability, adapter e pricing.
+
+- TTL breve (USER_CONTEXT_TTL, default 30s; 0 = disabilitata): all'interno di
+  una richiesta tutte le fasi condividono lo stesso snapshot.
+- Letture concorrenti per lo stesso utente condividono un'unica query.
+- `invalidate_user_context()` è chiamata da debit/credit/settle, rollout e
+  provisioning; la versione per-utente impedisce a una lettura partita prima
+  dell'invalidazione di ripopolare la cache.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+
+from app.services.supabase_rest import get_supabase
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserContext:
+    """Campi di `profiles` usati dall'esecuzione."""
+
+    user_id: str
+    credits: float
+    openrouter_api_key: Optional[str]
+    openrouter_key_name: Optional[str]
+    loaded_at: float = field(default_factory=time.monotonic)
+
+
+def _ttl() -> float:
+    try:
+        return float(os.environ.get("USER_CONTEXT_TTL", "30"))
+    except Exception:
+        return 30.0
+
+
+class UserContextCache:
+    """Snapshot per utente con TTL, coalescing delle letture e invalidazione versionata."""
+
+    def __init__(self) -> None:
+        self._items: Dict[str, Tuple[float, Optional[UserContext]]] = {}
+        self._versions: Dict[str, int] = {}
+        self._inflight: Dict[str, "asyncio.Future[Optional[UserContext]]"] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id: str) -> Optional[UserContext]:
+        entry = self._items.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        inflight = self._inflight.get(user_id)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future: "asyncio.Future[Optional[UserContext]]" = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        version = self._versions.get(user_id, 0)
+        try:
+            ok, ctx = await _load(user_id)
+            ttl = _ttl()
+            # Né errori né utente assente vengono memorizzati: l'invalidazione è per processo,
+            # un profilo appena creato da un altro worker deve essere visibile subito
+            if ok and ctx is not None and ttl > 0 and version == self._versions.get(user_id, 0):
+                self._items[user_id] = (time.monotonic() + ttl, ctx)
+            future.set_result(ctx)
+            return ctx
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(user_id, None)
+
+    def invalidate(self, user_ids: Iterable[str]) -> None:
+        for user_id in user_ids:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._versions.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+
+async def _load(user_id: str) -> Tuple[bool, Optional[UserContext]]:
+    sb = get_supabase()
+    if not sb.configured:
+        return False, None
+    resp = await sb.get(
+        f"/rest/v1/profiles?id=eq.{user_id}&select=credits,openrouter_api_key,openrouter_key_name",
+        timeout=10,
+    )
+    if resp.status_code != 200:
+        logger.warning("Lettura profilo %s fallita: %s", user_id, resp.status_code)
+        return False, None
+    rows = resp.json() or []
+    if not rows:
+        return True, None
+    row = rows[0]
+    try:
+        credits = float(row.get("credits", 0) or 0)
+    except Exception:
+        credits = 0.0
+    return True, UserContext(
+        user_id=user_id,
+        credits=credits,
+        openrouter_api_key=row.get("openrouter_api_key") or None,
+        openrouter_key_name=row.get("openrouter_key_name") or None,
+    )
+
+
+_cache = UserContextCache()
+
+
+async def get_user_context(user_id: str, *, fresh: bool = False) -> Optional[UserContext]:
+    """Snapshot del profilo (None se l'utente non esiste o Supabase non risponde).
+
+    `fresh=True` scarta lo snapshot e rilegge il profilo (aggiornando la cache).
+    """
+    if fresh:
+        _cache.invalidate([user_id])
+    return await _cache.get(user_id)
+
+
+def invalidate_user_context(*user_ids: str) -> None:
+    """Da chiamare dopo ogni scrittura su saldo o chiave OpenRouter degli utenti indicati."""
+    _cache.invalidate(u for u in user_ids if u)
+
+
+def get_user_context_stats() -> Dict[str, int]:
+    return _cache.stats()
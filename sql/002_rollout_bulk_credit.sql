@@ -0,0 +1,84 @@
+-- Migration: rollout mensile a lotti, ripristinabile e idempotente
+-- Esegui questo file su database esistenti (idempotente).
+
+-- Stato e checkpoint del run (le righe esistenti restano 'completed')
+alter table public.credits_rollout_runs add column if not exists app_id text;
+alter table public.credits_rollout_runs add column if not exists period text;           -- es. '2025-01'
+alter table public.credits_rollout_runs add column if not exists status text not null default 'completed'; -- 'running' | 'completed' | 'failed'
+alter table public.credits_rollout_runs add column if not exists checkpoint_user_id uuid; -- ultimo user_id (ordinato) completato
+alter table public.credits_rollout_runs add column if not exists updated_at timestamptz default now();
+create index if not exists idx_credits_rollout_runs_period on public.credits_rollout_runs(app_id, period, status);
+
+-- Un accredito per utente per periodo: rende sicuro il resume dopo un crash
+create table if not exists public.credits_rollout_items (
+  app_id text not null,
+  period text not null,
+  user_id uuid not null,
+  amount numeric not null,
+  run_id uuid,
+  credited_at timestamptz not null default now(),
+  primary key (app_id, period, user_id)
+);
+
+alter table public.credits_rollout_items enable row level security;
+do $$ begin
+  begin
+    create policy credits_rollout_items_deny_all on public.credits_rollout_items for all
+      using (false) with check (false);
+  exception when duplicate_object then null; end;
+end $$;
+
+-- Accredito set-based di un lotto: p_items = [{"user_id": uuid, "amount": numeric}, ...]
+-- Gli utenti già accreditati nel periodo vengono saltati (on conflict do nothing).
+create or replace function public.rollout_credit_batch(
+  p_app_id text,
+  p_period text,
+  p_items jsonb,
+  p_run_id uuid default null,
+  p_reason text default 'monthly_rollout'
+) returns json as $$
+declare
+  v_credited json;
+  v_count integer;
+  v_total numeric;
+begin
+  with items as (
+    select (e->>'user_id')::uuid as user_id, (e->>'amount')::numeric as amount
+    from jsonb_array_elements(coalesce(p_items, '[]'::jsonb)) e
+    where (e->>'amount')::numeric > 0
+  ), claimed as (
+    insert into public.credits_rollout_items(app_id, period, user_id, amount, run_id)
+    select p_app_id, p_period, i.user_id, i.amount, p_run_id
+    from items i
+    join public.profiles p on p.id = i.user_id
+    on conflict (app_id, period, user_id) do nothing
+    returning user_id, amount
+  ), updated as (
+    update public.profiles p
+       set credits = coalesce(p.credits, 0) + c.amount, updated_at = now()
+      from claimed c
+     where p.id = c.user_id
+    returning p.id as user_id, c.amount, p.credits as credits_after
+  ), ledger as (
+    insert into public.credit_transactions(
+      user_id, amount, reason, operation_type, operation_name, context, reference_id, reference_type, created_at, updated_at
+    )
+    select u.user_id, u.amount, p_reason, 'system', p_reason,
+           jsonb_build_object('app_id', p_app_id, 'period', p_period), p_period, 'rollout_period', now(), now()
+      from updated u
+  )
+  -- I CTE data-modifying (incluso `ledger`) vengono sempre eseguiti
+  select coalesce(json_agg(json_build_object('user_id', u.user_id, 'amount', u.amount, 'credits_after', u.credits_after)), '[]'::json),
+         count(*), coalesce(sum(u.amount), 0)
+    into v_credited, v_count, v_total
+    from updated u;
+
+  return json_build_object(
+    'success', true,
+    'credited', v_credited,
+    'credited_count', v_count,
+    'total_credited', v_total,
+    'skipped_count', jsonb_array_length(coalesce(p_items, '[]'::jsonb)) - v_count
+  );
+end;
+$$ language plpgsql security definer;
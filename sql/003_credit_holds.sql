@@ -0,0 +1,169 @@
+-- Migration: prenotazione crediti (hold → settle/release) con scadenza
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- Il gate di affordability e la prenotazione diventano un'unica chiamata atomica:
+-- saldo disponibile = credits - credits_held.
+
+alter table public.profiles add column if not exists credits_held numeric not null default 0;
+
+create table if not exists public.credit_holds (
+  id uuid primary key default gen_random_uuid(),
+  user_id uuid not null references public.profiles(id) on delete cascade,
+  amount numeric not null check (amount >= 0),
+  reason text,
+  status text not null default 'held', -- 'held' | 'settled' | 'released' | 'expired'
+  settled_amount numeric,
+  created_at timestamptz not null default now(),
+  expires_at timestamptz not null,
+  closed_at timestamptz
+);
+
+create index if not exists idx_credit_holds_open on public.credit_holds(expires_at) where status = 'held';
+create index if not exists idx_credit_holds_user on public.credit_holds(user_id, created_at);
+
+alter table public.credit_holds enable row level security;
+do $$ begin
+  begin
+    create policy credit_holds_select_self on public.credit_holds
+      for select using (user_id = auth.uid());
+  exception when duplicate_object then null; end;
+end $$;
+
+-- Prenota p_amount se il disponibile copre max(p_amount, p_min_available)
+create or replace function public.reserve_user_credits(
+  p_user_id uuid,
+  p_amount numeric,
+  p_min_available numeric default 0,
+  p_ttl_seconds integer default 900,
+  p_reason text default 'hold'
+) returns json as $$
+declare
+  v_credits numeric;
+  v_held numeric;
+  v_available numeric;
+  v_required numeric;
+  v_hold_id uuid;
+begin
+  if p_amount is null or p_amount < 0 then
+    return json_build_object('success', false, 'error', 'invalid_amount');
+  end if;
+
+  select coalesce(credits, 0), coalesce(credits_held, 0) into v_credits, v_held
+    from public.profiles where id = p_user_id for update;
+  if not found then
+    return json_build_object('success', false, 'error', 'user_not_found');
+  end if;
+
+  v_available := v_credits - v_held;
+  v_required := greatest(p_amount, coalesce(p_min_available, 0));
+  if v_available < v_required then
+    return json_build_object('success', false, 'error', 'insufficient_credits', 'available', v_available, 'required', v_required);
+  end if;
+
+  update public.profiles set credits_held = v_held + p_amount, updated_at = now() where id = p_user_id;
+  insert into public.credit_holds(user_id, amount, reason, expires_at)
+    values (p_user_id, p_amount, p_reason, now() + make_interval(secs => greatest(coalesce(p_ttl_seconds, 900), 1)))
+    returning id into v_hold_id;
+
+  return json_build_object('success', true, 'hold_id', v_hold_id, 'held', p_amount, 'available', v_available - p_amount);
+end;
+$$ language plpgsql security definer;
+
+-- Chiude la prenotazione addebitando il costo reale (mai sotto zero).
+-- Idempotente: una seconda chiamata ritorna l'esito già registrato.
+create or replace function public.settle_credit_hold(
+  p_hold_id uuid,
+  p_actual numeric,
+  p_reason text default null
+) returns json as $$
+declare
+  v_hold public.credit_holds%rowtype;
+  v_credits numeric;
+  v_charge numeric;
+  v_after numeric;
+begin
+  select * into v_hold from public.credit_holds where id = p_hold_id for update;
+  if not found then
+    return json_build_object('success', false, 'error', 'hold_not_found');
+  end if;
+  if v_hold.status <> 'held' then
+    return json_build_object('success', v_hold.status = 'settled', 'status', v_hold.status, 'charged', v_hold.settled_amount, 'idempotent', true);
+  end if;
+
+  select coalesce(credits, 0) into v_credits from public.profiles where id = v_hold.user_id for update;
+  v_charge := least(greatest(coalesce(p_actual, 0), 0), greatest(v_credits, 0));
+  v_after := v_credits - v_charge;
+
+  update public.profiles
+     set credits = v_after,
+         credits_held = greatest(0, coalesce(credits_held, 0) - v_hold.amount),
+         updated_at = now()
+   where id = v_hold.user_id;
+  update public.credit_holds set status = 'settled', settled_amount = v_charge, closed_at = now() where id = p_hold_id;
+
+  if v_charge > 0 then
+    insert into public.credit_transactions(
+      user_id, amount, reason, operation_type, operation_name, context, reference_id, reference_type, created_at, updated_at
+    ) values (
+      v_hold.user_id, -v_charge, coalesce(p_reason, v_hold.reason), 'system', coalesce(p_reason, v_hold.reason, 'debit'),
+      jsonb_build_object('held', v_hold.amount), p_hold_id::text, 'credit_hold', now(), now()
+    );
+  end if;
+
+  return json_build_object(
+    'success', true,
+    'hold_id', p_hold_id,
+    'credits_before', v_credits,
+    'credits_after', v_after,
+    'charged', v_charge,
+    'shortfall', greatest(coalesce(p_actual, 0) - v_charge, 0)
+  );
+end;
+$$ language plpgsql security definer;
+
+-- Rilascia la prenotazione senza addebito (errore provider, costo non misurabile, scadenza)
+create or replace function public.release_credit_hold(
+  p_hold_id uuid,
+  p_status text default 'released'
+) returns json as $$
+declare
+  v_hold public.credit_holds%rowtype;
+begin
+  select * into v_hold from public.credit_holds where id = p_hold_id for update;
+  if not found then
+    return json_build_object('success', false, 'error', 'hold_not_found');
+  end if;
+  if v_hold.status <> 'held' then
+    return json_build_object('success', true, 'status', v_hold.status, 'idempotent', true);
+  end if;
+
+  update public.profiles
+     set credits_held = greatest(0, coalesce(credits_held, 0) - v_hold.amount), updated_at = now()
+   where id = v_hold.user_id;
+  update public.credit_holds set status = p_status, closed_at = now() where id = p_hold_id;
+
+  return json_build_object('success', true, 'hold_id', p_hold_id, 'status', p_status);
+end;
+$$ language plpgsql security definer;
+
+-- Sweeper: rilascia le prenotazioni scadute (chiamato periodicamente dal Core)
+create or replace function public.expire_credit_holds(
+  p_limit integer default 500
+) returns json as $$
+declare
+  v_id uuid;
+  v_count integer := 0;
+begin
+  for v_id in
+    select id from public.credit_holds
+     where status = 'held' and expires_at < now()
+     order by expires_at
+     limit greatest(coalesce(p_limit, 500), 1)
+     for update skip locked
+  loop
+    perform public.release_credit_hold(v_id, 'expired');
+    v_count := v_count + 1;
+  end loop;
+  return json_build_object('success', true, 'expired', v_count);
+end;
+$$ language plpgsql security definer;
@@ -0,0 +1,28 @@
+-- Migration: store idempotenza per Idempotency-Key (utente, route, chiave)
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- Il Core reclama la chiave con insert ... on conflict do nothing, salva la
+-- risposta riuscita e la ripropone ai retry senza rieseguire il provider.
+
+create table if not exists public.idempotency_keys (
+  user_id text not null,          -- utente o sorgente (es. 'webhook:lemonsqueezy')
+  route text not null,            -- es. 'openrouter_chat' | 'flowise_execute' | 'billing_webhook'
+  idempotency_key text not null,
+  request_hash text,              -- sha256 del payload: stessa chiave con payload diverso → 422
+  status text not null default 'in_progress', -- 'in_progress' | 'completed'
+  response jsonb,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now(),
+  expires_at timestamptz not null,
+  primary key (user_id, route, idempotency_key)
+);
+
+create index if not exists idx_idempotency_keys_expires on public.idempotency_keys(expires_at);
+
+alter table public.idempotency_keys enable row level security;
+do $$ begin
+  begin
+    create policy idempotency_keys_deny_all on public.idempotency_keys for all
+      using (false) with check (false);
+  exception when duplicate_object then null; end;
+end $$;
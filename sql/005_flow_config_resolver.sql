@@ -0,0 +1,46 @@
+-- Migration: risoluzione flow_configs in un'unica query indicizzata
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- flow_key_norm = lower(trim(flow_key)) copre match esatto e case-insensitive
+-- con un indice btree; l'indice trigram copre la ricerca "contiene".
+
+create extension if not exists pg_trgm;
+
+alter table public.flow_configs
+  add column if not exists flow_key_norm text generated always as (lower(btrim(flow_key))) stored;
+
+create index if not exists idx_flow_configs_app_key_norm on public.flow_configs(app_id, flow_key_norm);
+create index if not exists idx_flow_configs_key_norm_trgm on public.flow_configs using gin (flow_key_norm gin_trgm_ops);
+
+-- Ritorna le config candidate ordinate per qualità del match:
+-- 0 = esatto, 1 = case-insensitive, 2 = contiene (poi per similarità)
+create or replace function public.resolve_flow_config(
+  p_app_id text,
+  p_flow_key text,
+  p_limit integer default 5
+) returns table (
+  app_id text,
+  flow_key text,
+  flow_id text,
+  node_names jsonb,
+  is_conversational boolean,
+  metadata jsonb,
+  match_rank integer
+) as $$
+  with q as (
+    select btrim(p_flow_key) as raw,
+           lower(btrim(p_flow_key)) as norm,
+           '%' || replace(replace(replace(lower(btrim(p_flow_key)), '\', '\\'), '%', '\%'), '_', '\_') || '%' as pattern
+  )
+  select f.app_id, f.flow_key, f.flow_id, f.node_names, f.is_conversational, f.metadata,
+         case
+           when f.flow_key = q.raw then 0
+           when f.flow_key_norm = q.norm then 1
+           else 2
+         end as match_rank
+    from public.flow_configs f, q
+   where f.app_id = btrim(p_app_id)
+     and (f.flow_key_norm = q.norm or f.flow_key_norm like q.pattern)
+   order by match_rank, similarity(f.flow_key_norm, q.norm) desc, f.flow_key
+   limit greatest(coalesce(p_limit, 5), 1);
+$$ language sql stable security definer;
@@ -0,0 +1,104 @@
+-- Migration: contatori condivisi per l'admission control (ADMISSION_BACKEND=postgres)
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- Con più worker i limiti per utente/app devono essere globali: gli slot di
+-- concorrenza sono lease con scadenza (un worker che muore non li lascia
+-- occupati), i rate limit sono token bucket per scope.
+
+create table if not exists public.admission_leases (
+  id uuid primary key default gen_random_uuid(),
+  scope text not null,              -- es. 'user:<uuid>' | 'app:<app_id>'
+  created_at timestamptz not null default now(),
+  expires_at timestamptz not null
+);
+
+create index if not exists idx_admission_leases_scope on public.admission_leases(scope, expires_at);
+
+create table if not exists public.admission_buckets (
+  scope text primary key,
+  tokens double precision not null,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.admission_leases enable row level security;
+alter table public.admission_buckets enable row level security;
+do $$ begin
+  begin
+    create policy admission_leases_deny_all on public.admission_leases for all
+      using (false) with check (false);
+  exception when duplicate_object then null; end;
+  begin
+    create policy admission_buckets_deny_all on public.admission_buckets for all
+      using (false) with check (false);
+  exception when duplicate_object then null; end;
+end $$;
+
+-- Occupa uno slot di p_scope se i lease attivi sono meno di p_limit
+create or replace function public.admission_acquire(
+  p_scope text,
+  p_limit integer,
+  p_ttl_seconds integer default 900
+) returns json as $$
+declare
+  v_inflight integer;
+  v_lease_id uuid;
+begin
+  -- Serializza gli acquire sullo stesso scope (count + insert atomici)
+  perform pg_advisory_xact_lock(hashtext('admission:' || p_scope));
+
+  delete from public.admission_leases where scope = p_scope and expires_at <= now();
+  select count(*) into v_inflight from public.admission_leases where scope = p_scope;
+  if v_inflight >= p_limit then
+    return json_build_object('admitted', false, 'inflight', v_inflight);
+  end if;
+
+  insert into public.admission_leases(scope, expires_at)
+    values (p_scope, now() + make_interval(secs => greatest(coalesce(p_ttl_seconds, 900), 1)))
+    returning id into v_lease_id;
+  return json_build_object('admitted', true, 'lease_id', v_lease_id, 'inflight', v_inflight + 1);
+end;
+$$ language plpgsql security definer;
+
+create or replace function public.admission_release(p_lease_id uuid) returns void as $$
+  delete from public.admission_leases where id = p_lease_id;
+$$ language sql security definer;
+
+-- Token bucket: ricarica p_rate token/s fino a p_burst e ne consuma uno
+create or replace function public.admission_take_token(
+  p_scope text,
+  p_rate double precision,
+  p_burst double precision
+) returns json as $$
+declare
+  v_tokens double precision;
+  v_updated timestamptz;
+begin
+  insert into public.admission_buckets(scope, tokens, updated_at)
+    values (p_scope, p_burst, now())
+    on conflict (scope) do nothing;
+
+  select tokens, updated_at into v_tokens, v_updated
+    from public.admission_buckets where scope = p_scope for update;
+
+  v_tokens := least(p_burst, v_tokens + extract(epoch from (now() - v_updated)) * p_rate);
+  if v_tokens >= 1 then
+    update public.admission_buckets set tokens = v_tokens - 1, updated_at = now() where scope = p_scope;
+    return json_build_object('allowed', true, 'retry_after', 0);
+  end if;
+
+  update public.admission_buckets set tokens = v_tokens, updated_at = now() where scope = p_scope;
+  return json_build_object('allowed', false, 'retry_after', (1 - v_tokens) / greatest(p_rate, 0.001));
+end;
+$$ language plpgsql security definer;
+
+-- Pulizia periodica (lease scaduti, bucket inattivi da più di un giorno)
+create or replace function public.admission_purge() returns integer as $$
+declare
+  v_count integer;
+begin
+  delete from public.admission_leases where expires_at <= now();
+  get diagnostics v_count = row_count;
+  delete from public.admission_buckets where updated_at < now() - interval '1 day';
+  return v_count;
+end;
+$$ language plpgsql security definer;
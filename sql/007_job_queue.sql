@@ -0,0 +1,68 @@
+-- Migration: coda job durevole (addebiti post-risposta, provisioning post-signup)
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- I job sopravvivono a restart/redeploy del worker: un job "running" il cui
+-- visibility timeout è scaduto torna reclamabile da qualunque worker.
+-- Il claim usa FOR UPDATE SKIP LOCKED: più worker non si contendono le righe.
+
+create table if not exists public.core_jobs (
+  id uuid primary key default gen_random_uuid(),
+  kind text not null,                  -- es. 'flow_settle' | 'signup_provisioning'
+  payload jsonb not null default '{}'::jsonb,
+  status text not null default 'queued', -- 'queued' | 'running' | 'done' | 'dead'
+  attempts integer not null default 0,
+  max_attempts integer not null default 8,
+  run_at timestamptz not null default now(),
+  locked_by text,
+  locked_until timestamptz,
+  last_error text,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+create index if not exists idx_core_jobs_ready on public.core_jobs(run_at) where status = 'queued';
+create index if not exists idx_core_jobs_running on public.core_jobs(locked_until) where status = 'running';
+create index if not exists idx_core_jobs_finished on public.core_jobs(updated_at) where status in ('done', 'dead');
+
+alter table public.core_jobs enable row level security;
+do $$ begin
+  begin
+    create policy core_jobs_deny_all on public.core_jobs for all
+      using (false) with check (false);
+  exception when duplicate_object then null; end;
+end $$;
+
+-- Reclama fino a p_limit job pronti (o orfani) per il worker p_worker
+create or replace function public.claim_core_jobs(
+  p_worker text,
+  p_limit integer default 1,
+  p_visibility_seconds integer default 300,
+  p_kinds text[] default null
+) returns setof public.core_jobs as $$
+begin
+  -- Job orfani che hanno esaurito i tentativi: non vengono più ripresi
+  update public.core_jobs
+     set status = 'dead', last_error = coalesce(last_error, 'visibility timeout'), updated_at = now()
+   where status = 'running' and locked_until <= now() and attempts >= max_attempts;
+
+  return query
+  with picked as (
+    select j.id from public.core_jobs j
+     where ((j.status = 'queued' and j.run_at <= now())
+         or (j.status = 'running' and j.locked_until <= now()))
+       and (p_kinds is null or j.kind = any(p_kinds))
+     order by j.run_at
+     limit greatest(coalesce(p_limit, 1), 1)
+     for update skip locked
+  )
+  update public.core_jobs j
+     set status = 'running',
+         attempts = j.attempts + 1,
+         locked_by = p_worker,
+         locked_until = now() + make_interval(secs => greatest(coalesce(p_visibility_seconds, 300), 1)),
+         updated_at = now()
+    from picked
+   where j.id = picked.id
+  returning j.*;
+end;
+$$ language plpgsql security definer;
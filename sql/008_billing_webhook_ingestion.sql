@@ -0,0 +1,70 @@
+-- Migration: ingestione asincrona dei webhook billing
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- L'endpoint webhook verifica la firma e salva l'evento grezzo con una sola
+-- RPC (dedup su provider + event_id), poi risponde subito al provider. Un
+-- consumer elabora gli eventi in ordine di arrivo: normalizzazione,
+-- transazioni e accredito crediti.
+
+alter table public.billing_webhook_logs add column if not exists event_id text;
+alter table public.billing_webhook_logs add column if not exists attempts integer not null default 0;
+alter table public.billing_webhook_logs add column if not exists locked_until timestamptz;
+alter table public.billing_webhook_logs add column if not exists processed_at timestamptz;
+alter table public.billing_webhook_logs add column if not exists result jsonb;
+
+-- Dedup: i retry del provider con lo stesso evento non creano nuove righe
+-- (le righe storiche hanno event_id null e restano fuori dal consumer)
+create unique index if not exists uq_billing_webhook_event on public.billing_webhook_logs(provider, event_id);
+create index if not exists idx_billing_webhook_pending on public.billing_webhook_logs(received_at)
+  where event_id is not null and status in ('received', 'processing');
+
+-- Persistenza dell'evento grezzo (unica scrittura sul percorso della richiesta)
+create or replace function public.ingest_billing_webhook(
+  p_provider text,
+  p_event_id text,
+  p_payload jsonb
+) returns json as $$
+declare
+  v_id uuid;
+begin
+  insert into public.billing_webhook_logs(provider, event_id, payload, status)
+    values (p_provider, p_event_id, coalesce(p_payload, '{}'::jsonb), 'received')
+    on conflict (provider, event_id) do nothing
+    returning id into v_id;
+  if v_id is null then
+    return json_build_object('duplicate', true);
+  end if;
+  return json_build_object('duplicate', false, 'id', v_id);
+end;
+$$ language plpgsql security definer;
+
+-- Reclama il prossimo lotto di eventi in ordine di arrivo.
+-- Un solo lotto alla volta (tra tutti i worker): gli accrediti seguono l'ordine degli eventi.
+-- locked_until futuro = lotto in corso oppure evento in backoff dopo un errore: la coda attende.
+create or replace function public.claim_billing_webhooks(
+  p_limit integer default 20,
+  p_visibility_seconds integer default 120
+) returns setof public.billing_webhook_logs as $$
+begin
+  perform pg_advisory_xact_lock(hashtext('billing_webhook_consumer'));
+  if exists (
+    select 1 from public.billing_webhook_logs
+     where event_id is not null and status in ('received', 'processing') and locked_until > now()
+  ) then
+    return;
+  end if;
+
+  return query
+  update public.billing_webhook_logs l
+     set status = 'processing',
+         attempts = l.attempts + 1,
+         locked_until = now() + make_interval(secs => greatest(coalesce(p_visibility_seconds, 120), 1))
+   where l.id in (
+     select w.id from public.billing_webhook_logs w
+      where w.event_id is not null and w.status in ('received', 'processing')
+      order by w.received_at, w.id
+      limit greatest(coalesce(p_limit, 20), 1)
+   )
+  returning l.*;
+end;
+$$ language plpgsql security definer;
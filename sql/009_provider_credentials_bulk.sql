@@ -0,0 +1,16 @@
+-- Migration: lettura in blocco delle credenziali provider di un'app
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- Il Core carica tutte le credenziali dell'app con una sola RPC (allo startup
+-- e allo scadere del TTL) invece di una `get_provider_credential` per chiave.
+-- I valori restano cifrati con Fernet lato applicazione.
+
+create or replace function public.get_provider_credentials(
+  p_app_id text
+) returns table(provider text, credential_key text, value text) as $$
+  select c.provider,
+         c.credential_key,
+         convert_from(decode(c.encrypted_value, 'base64'), 'UTF8')
+    from public.provider_credentials c
+   where c.app_id = p_app_id;
+$$ language sql security definer;
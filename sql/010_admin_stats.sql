@@ -0,0 +1,122 @@
+-- Migration: statistiche aggregate per la dashboard admin
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- `/admin/stats` legge tutti i numeri della dashboard con una sola RPC
+-- (`get_admin_stats`) invece di scaricare gli utenti nel browser.
+-- - Utenti e crediti in circolo: contatori mantenuti da trigger su `profiles`,
+--   su 16 shard per non serializzare gli addebiti concorrenti su una sola riga.
+-- - Ricavi: contatori per valuta mantenuti da trigger su `billing_transactions`
+--   (transazioni `paid` di tipo subscription / one_time).
+-- - Crediti addebitati oggi: somma su `credit_transactions` tramite indice
+--   parziale sugli addebiti (costo proporzionale ai movimenti del giorno).
+
+create table if not exists public.admin_stat_counters (
+  metric text not null,
+  shard smallint not null default 0,
+  value numeric not null default 0,
+  primary key (metric, shard)
+);
+
+alter table public.admin_stat_counters enable row level security;
+
+create or replace function public._bump_admin_stat(p_metric text, p_shard smallint, p_delta numeric)
+returns void as $$
+begin
+  if p_delta is null or p_delta = 0 then
+    return;
+  end if;
+  insert into public.admin_stat_counters(metric, shard, value)
+  values (p_metric, p_shard, p_delta)
+  on conflict (metric, shard) do update set value = public.admin_stat_counters.value + excluded.value;
+end;
+$$ language plpgsql;
+
+-- UPDATE tocca solo `credits_outstanding` (di quanto è cambiato il saldo):
+-- gli addebiti non scrivono sulla riga `users` dello shard.
+create or replace function public._profiles_admin_stats() returns trigger as $$
+declare
+  v_shard smallint;
+begin
+  if tg_op = 'UPDATE' then
+    v_shard := abs(hashtext(new.id::text)) % 16;
+    perform public._bump_admin_stat('credits_outstanding', v_shard, coalesce(new.credits, 0) - coalesce(old.credits, 0));
+  elsif tg_op = 'INSERT' then
+    v_shard := abs(hashtext(new.id::text)) % 16;
+    perform public._bump_admin_stat('users', v_shard, 1);
+    perform public._bump_admin_stat('credits_outstanding', v_shard, coalesce(new.credits, 0));
+  else
+    v_shard := abs(hashtext(old.id::text)) % 16;
+    perform public._bump_admin_stat('users', v_shard, -1);
+    perform public._bump_admin_stat('credits_outstanding', v_shard, -coalesce(old.credits, 0));
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_profiles_admin_stats on public.profiles;
+create trigger trg_profiles_admin_stats
+  after insert or delete or update of credits on public.profiles
+  for each row execute function public._profiles_admin_stats();
+
+create or replace function public._billing_tx_revenue(p_status text, p_type text, p_amount integer)
+returns numeric as $$
+  select case when p_status = 'paid' and p_type in ('subscription', 'one_time') then coalesce(p_amount, 0) else 0 end;
+$$ language sql immutable;
+
+create or replace function public._billing_tx_admin_stats() returns trigger as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    perform public._bump_admin_stat('revenue_cents:' || upper(old.currency), 0::smallint,
+      -public._billing_tx_revenue(old.status, old.transaction_type, old.amount_cents));
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform public._bump_admin_stat('revenue_cents:' || upper(new.currency), 0::smallint,
+      public._billing_tx_revenue(new.status, new.transaction_type, new.amount_cents));
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_billing_tx_admin_stats on public.billing_transactions;
+create trigger trg_billing_tx_admin_stats
+  after insert or delete or update of status, transaction_type, amount_cents, currency on public.billing_transactions
+  for each row execute function public._billing_tx_admin_stats();
+
+-- Ricostruzione dei contatori dai dati esistenti (blocca le scritture solo per la durata del backfill)
+do $$
+begin
+  lock table public.profiles, public.billing_transactions in share mode;
+  delete from public.admin_stat_counters;
+  insert into public.admin_stat_counters(metric, shard, value)
+  select m.metric, s.shard, m.value
+    from (
+      select abs(hashtext(id::text)) % 16 as shard, count(*)::numeric as users, coalesce(sum(credits), 0) as credits
+        from public.profiles
+       group by 1
+    ) s
+    cross join lateral (values ('users', s.users), ('credits_outstanding', s.credits)) as m(metric, value);
+  insert into public.admin_stat_counters(metric, shard, value)
+  select 'revenue_cents:' || upper(currency), 0, sum(public._billing_tx_revenue(status, transaction_type, amount_cents))
+    from public.billing_transactions
+   group by upper(currency);
+end $$;
+
+create index if not exists idx_credit_tx_debits_created
+  on public.credit_transactions(created_at) include (amount)
+  where amount < 0;
+
+create or replace function public.get_admin_stats()
+returns json as $$
+  select json_build_object(
+    'users', coalesce((select sum(value) from public.admin_stat_counters where metric = 'users'), 0),
+    'credits_outstanding', coalesce((select sum(value) from public.admin_stat_counters where metric = 'credits_outstanding'), 0),
+    'credits_debited_today', coalesce((
+      select -sum(amount) from public.credit_transactions
+       where amount < 0 and created_at >= date_trunc('day', now())
+    ), 0),
+    'revenue_cents', coalesce((
+      select json_object_agg(substr(metric, length('revenue_cents:') + 1), value)
+        from public.admin_stat_counters where metric like 'revenue_cents:%'
+    ), '{}'::json)
+  );
+$$ language sql stable security definer;
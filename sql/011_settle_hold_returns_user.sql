@@ -0,0 +1,58 @@
+-- Migration: settle_credit_hold ritorna anche user_id
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- Il chiamante invalida lo snapshot profilo (`user_context`) dell'utente
+-- addebitato senza dover rileggere la prenotazione.
+
+-- Chiude la prenotazione addebitando il costo reale (mai sotto zero).
+-- Idempotente: una seconda chiamata ritorna l'esito già registrato.
+create or replace function public.settle_credit_hold(
+  p_hold_id uuid,
+  p_actual numeric,
+  p_reason text default null
+) returns json as $$
+declare
+  v_hold public.credit_holds%rowtype;
+  v_credits numeric;
+  v_charge numeric;
+  v_after numeric;
+begin
+  select * into v_hold from public.credit_holds where id = p_hold_id for update;
+  if not found then
+    return json_build_object('success', false, 'error', 'hold_not_found');
+  end if;
+  if v_hold.status <> 'held' then
+    return json_build_object('success', v_hold.status = 'settled', 'status', v_hold.status, 'charged', v_hold.settled_amount, 'idempotent', true);
+  end if;
+
+  select coalesce(credits, 0) into v_credits from public.profiles where id = v_hold.user_id for update;
+  v_charge := least(greatest(coalesce(p_actual, 0), 0), greatest(v_credits, 0));
+  v_after := v_credits - v_charge;
+
+  update public.profiles
+     set credits = v_after,
+         credits_held = greatest(0, coalesce(credits_held, 0) - v_hold.amount),
+         updated_at = now()
+   where id = v_hold.user_id;
+  update public.credit_holds set status = 'settled', settled_amount = v_charge, closed_at = now() where id = p_hold_id;
+
+  if v_charge > 0 then
+    insert into public.credit_transactions(
+      user_id, amount, reason, operation_type, operation_name, context, reference_id, reference_type, created_at, updated_at
+    ) values (
+      v_hold.user_id, -v_charge, coalesce(p_reason, v_hold.reason), 'system', coalesce(p_reason, v_hold.reason, 'debit'),
+      jsonb_build_object('held', v_hold.amount), p_hold_id::text, 'credit_hold', now(), now()
+    );
+  end if;
+
+  return json_build_object(
+    'success', true,
+    'hold_id', p_hold_id,
+    'user_id', v_hold.user_id,
+    'credits_before', v_credits,
+    'credits_after', v_after,
+    'charged', v_charge,
+    'shortfall', greatest(coalesce(p_actual, 0) - v_charge, 0)
+  );
+end;
+$$ language plpgsql security definer;
@@ -0,0 +1,89 @@
+-- Migration: accredito webhook idempotente e coda senza blocco globale
+-- Esegui questo file su database esistenti (idempotente).
+--
+-- - `credit_billing_webhook` accredita i crediti di un evento persistito
+--   (riga di `billing_webhook_logs`) al più una volta: la transazione di
+--   ledger porta `reference_id` = id del log e un indice univoco scarta i
+--   doppioni (retry dopo un timeout, lease scaduto, due worker sullo stesso evento).
+-- - `claim_billing_webhooks` non blocca più la coda su un evento in backoff:
+--   l'evento fallito resta parcheggiato fino a `locked_until`, gli altri proseguono.
+
+create unique index if not exists uq_credit_tx_billing_webhook
+  on public.credit_transactions(reference_id)
+  where reference_type = 'billing_webhook';
+
+create or replace function public.credit_billing_webhook(
+  p_log_id uuid,
+  p_user_id uuid,
+  p_amount numeric,
+  p_reason text default 'ls_webhook'
+) returns json as $$
+declare
+  v_before numeric;
+  v_after numeric;
+begin
+  if p_amount is null or p_amount <= 0 then
+    return json_build_object('success', false, 'error', 'invalid_amount');
+  end if;
+
+  -- Serializza i tentativi sullo stesso evento
+  perform 1 from public.billing_webhook_logs where id = p_log_id for update;
+  if not found then
+    return json_build_object('success', false, 'error', 'event_not_found');
+  end if;
+  if exists (
+    select 1 from public.credit_transactions
+     where reference_type = 'billing_webhook' and reference_id = p_log_id::text
+  ) then
+    return json_build_object('success', true, 'idempotent', true);
+  end if;
+
+  select credits into v_before from public.profiles where id = p_user_id for update;
+  if v_before is null then
+    return json_build_object('success', false, 'error', 'user_not_found');
+  end if;
+
+  v_after := coalesce(v_before, 0) + p_amount;
+  update public.profiles set credits = v_after, updated_at = now() where id = p_user_id;
+
+  insert into public.credit_transactions(
+    user_id, amount, reason, operation_type, operation_name, context, reference_id, reference_type, created_at, updated_at
+  ) values (
+    p_user_id, p_amount, p_reason, 'system', coalesce(p_reason, 'credit'), '{}'::jsonb, p_log_id::text, 'billing_webhook', now(), now()
+  );
+
+  return json_build_object('success', true, 'credits_before', v_before, 'credits_after', v_after);
+end;
+$$ language plpgsql security definer;
+
+-- Reclama il prossimo lotto di eventi in ordine di arrivo.
+-- Un solo lotto alla volta (tra tutti i worker): riga `processing` con lease valido = lotto in corso.
+-- Gli eventi in backoff (`received` con locked_until futuro) vengono saltati senza fermare gli altri.
+create or replace function public.claim_billing_webhooks(
+  p_limit integer default 20,
+  p_visibility_seconds integer default 120
+) returns setof public.billing_webhook_logs as $$
+begin
+  perform pg_advisory_xact_lock(hashtext('billing_webhook_consumer'));
+  if exists (
+    select 1 from public.billing_webhook_logs
+     where event_id is not null and status = 'processing' and locked_until > now()
+  ) then
+    return;
+  end if;
+
+  return query
+  update public.billing_webhook_logs l
+     set status = 'processing',
+         attempts = l.attempts + 1,
+         locked_until = now() + make_interval(secs => greatest(coalesce(p_visibility_seconds, 120), 1))
+   where l.id in (
+     select w.id from public.billing_webhook_logs w
+      where w.event_id is not null and w.status in ('received', 'processing')
+        and (w.locked_until is null or w.locked_until <= now())
+      order by w.received_at, w.id
+      limit greatest(coalesce(p_limit, 20), 1)
+   )
+  returning l.*;
+end;
+$$ language plpgsql security definer;
@@ -0,0 +1,11 @@
+"""
+Harness di carico offline per il Core.
+
+Avvia in locale stand-in HTTP di Supabase (PostgREST + GoTrue), OpenRouter e
+Flowise con latenza ed errori configurabili, poi guida l'app FastAPI reale
+(uvicorn) a concorrenza configurabile. Nessuna rete esterna: gira in CI.
+
+Uso:
+    python -m tests.load.bench --requests 500 --concurrency 32
+    python -m tests.load.bench --scenarios flow_execute --latency flowise=300 --errors openrouter=0.05
+"""
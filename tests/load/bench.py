@@ -0,0 +1,438 @@
+from __future__ import annotations
+
+"""
+Load test del Core contro stand-in locali (nessuna rete esterna).
+
+Per ogni scenario riporta latenze p50/p95/p99, RPS, esiti per status HTTP e
+chiamate upstream per richiesta, incluse quelle eseguite dopo la risposta
+(es. settlement dei flow): a fine scenario si attende che gli upstream
+tornino inattivi prima di leggere i contatori.
+
+Gli scenari girano in sequenza sullo stesso processo: le cache del Core
+restano calde da uno scenario al successivo (usa --warmup per escludere
+anche il primo riempimento).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from tests.load.upstreams import UpstreamBehavior, Upstreams
+
+
+BENCH_APP_ID = "bench"
+BENCH_FLOW_KEY = "bench_flow"
+UPSTREAM_NAMES = ("postgrest", "gotrue", "openrouter", "flowise")
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    path: str
+    body: Optional[Dict[str, Any]] = None
+    description: str = ""
+
+
+SCENARIOS: Dict[str, Scenario] = {s.name: s for s in [
+    Scenario("users_me", "GET", "/core/v1/users/me", description="verifica JWT (JWKS + cache token)"),
+    Scenario("credits_balance", "GET", "/core/v1/credits/balance", description="JWT + snapshot profilo"),
+    Scenario(
+        "openrouter_chat", "POST", "/core/v1/providers/openrouter/chat",
+        {"model": "openai/gpt-4o-mini", "messages": [{"role": "user", "content": "ciao"}]},
+        description="admission, prenotazione crediti, chat, settle",
+    ),
+    Scenario(
+        "flow_execute", "POST", f"/core/v1/flows/execute?app_id={BENCH_APP_ID}",
+        {"flow_key": BENCH_FLOW_KEY, "input": "ciao"},
+        description="flow_config, prenotazione, Flowise, settlement asincrono",
+    ),
+]}
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Percentile nearest-rank (0 se non ci sono campioni)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.4999)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int
+    concurrency: int
+    duration_s: float
+    latencies_ms: List[float]
+    statuses: Counter
+    reconnects: int = 0
+    upstream_calls: Dict[str, int] = field(default_factory=dict)
+    upstream_routes: Dict[str, Dict[str, int]] = field(default_factory=dict)
+
+    def summary(self) -> Dict[str, Any]:
+        ok = sum(n for status, n in self.statuses.items() if 200 <= status < 300)
+        done = max(1, len(self.latencies_ms))
+        return {
+            "scenario": self.name,
+            "requests": self.requests,
+            "concurrency": self.concurrency,
+            "ok": ok,
+            "errors": self.requests - ok,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "reconnects": self.reconnects,
+            "duration_s": round(self.duration_s, 3),
+            "rps": round(self.requests / self.duration_s, 1) if self.duration_s > 0 else 0.0,
+            "p50_ms": round(percentile(self.latencies_ms, 50), 2),
+            "p95_ms": round(percentile(self.latencies_ms, 95), 2),
+            "p99_ms": round(percentile(self.latencies_ms, 99), 2),
+            "max_ms": round(max(self.latencies_ms, default=0.0), 2),
+            "upstream_calls": dict(self.upstream_calls),
+            "upstream_calls_per_request": {name: round(n / done, 3) for name, n in self.upstream_calls.items()},
+            "upstream_routes": {name: dict(routes) for name, routes in self.upstream_routes.items()},
+        }
+
+
+def _bound_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def _url(sock: socket.socket) -> str:
+    host, port = sock.getsockname()[:2]
+    return f"http://{host}:{port}"
+
+
+class _ServerThread(threading.Thread):
+    """Event loop dedicato con uvicorn per stand-in e Core."""
+
+    def __init__(self, apps: List[Tuple[Any, socket.socket]], log_level: str) -> None:
+        super().__init__(name="load-servers", daemon=True)
+        self._apps = apps
+        self._log_level = log_level
+        self.ready = threading.Event()
+        self.error: Optional[BaseException] = None
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self._main())
+        except BaseException as e:
+            self.error = e
+            self.ready.set()
+
+    async def _main(self) -> None:
+        import uvicorn
+
+        servers = []
+        tasks = []
+        for app, sock in self._apps:
+            if app == "core":
+                # Import dopo aver impostato l'ambiente: il Core legge gli URL upstream da ENV.
+                # Le print di avvio vanno su stderr: stdout resta pulito per --json -
+                with contextlib.redirect_stdout(sys.stderr):
+                    from app.main import app as core_app
+                app = core_app
+            server = uvicorn.Server(uvicorn.Config(app, log_level=self._log_level, access_log=False))
+            servers.append(server)
+            tasks.append(asyncio.create_task(server.serve(sockets=[sock])))
+        while not all(s.started for s in servers):
+            if any(t.done() for t in tasks):
+                await asyncio.gather(*tasks)
+                raise RuntimeError("avvio server fallito")
+            await asyncio.sleep(0.01)
+        self.ready.set()
+        while not self._stopping.is_set():
+            await asyncio.sleep(0.05)
+        for server in servers:
+            server.should_exit = True
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self.join(timeout=15)
+
+
+class Harness:
+    """Avvia stand-in e Core su porte locali effimere; da usare come context manager."""
+
+    def __init__(
+        self,
+        upstreams: Optional[Upstreams] = None,
+        users: int = 50,
+        env: Optional[Dict[str, str]] = None,
+        log_level: str = "critical",
+    ) -> None:
+        self.upstreams = upstreams or Upstreams()
+        self.users = self.upstreams.seed_users(users)
+        self.upstreams.postgrest.add_flow_config(BENCH_APP_ID, BENCH_FLOW_KEY, "flow-bench")
+        self._env = env or {}
+        self._log_level = log_level
+        self._thread: Optional[_ServerThread] = None
+        self.core_url = ""
+
+    def _configure_env(self, supabase: str, openrouter: str, flowise: str) -> None:
+        # Limiti di admission alti: si misura il throughput, non il rate limiting (sovrascrivibili)
+        defaults = {
+            "ADMISSION_USER_RATE": "100000",
+            "ADMISSION_USER_BURST": "100000",
+            "ADMISSION_APP_RATE": "100000",
+            "ADMISSION_APP_BURST": "100000",
+            "ADMISSION_MAX_INFLIGHT": "100000",
+            "ADMISSION_MAX_INFLIGHT_PER_USER": "1000",
+            "ADMISSION_MAX_INFLIGHT_PER_APP": "100000",
+            # Loop di background rari: non sporcano i contatori per richiesta
+            "JOB_POLL_INTERVAL": "3600",
+            "WEBHOOK_CONSUMER_INTERVAL": "3600",
+            "CREDIT_HOLD_SWEEP_INTERVAL": "0",
+            "SUPABASE_HTTP2": "0",
+        }
+        for key, value in defaults.items():
+            os.environ.setdefault(key, value)
+        if not os.environ.get("CORE_ENCRYPTION_KEY"):
+            from cryptography.fernet import Fernet
+            os.environ["CORE_ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+        os.environ.update({
+            "SUPABASE_URL": supabase,
+            "SUPABASE_SERVICE_KEY": "bench-service-key",
+            "SUPABASE_ANON_KEY": "bench-anon-key",
+            "SUPABASE_JWKS_URL": f"{supabase}/auth/v1/.well-known/jwks.json",
+            "SUPABASE_VERIFY_DISABLED": "0",
+            "OPENROUTER_BASE_URL": f"{openrouter}/api/v1",
+            "OPENROUTER_PROVISIONING_KEY": "sk-or-v1-bench-provisioning",
+            "FLOWISE_BASE_URL": f"{flowise}/api/v1/prediction",
+            "FLOWISE_API_KEY": "bench-flowise-key",
+            "CORE_APP_ID": BENCH_APP_ID,
+        })
+        os.environ.update(self._env)
+
+    def __enter__(self) -> "Harness":
+        socks = [_bound_socket() for _ in range(4)]
+        supabase, openrouter, flowise, core = socks
+        self._configure_env(_url(supabase), _url(openrouter), _url(flowise))
+        self.core_url = _url(core)
+        apps: List[Tuple[Any, socket.socket]] = [
+            (self.upstreams.supabase_app(), supabase),
+            (Starlette(routes=[Mount("/api/v1", app=self.upstreams.openrouter.app())]), openrouter),
+            (Starlette(routes=[Mount("/api/v1", app=self.upstreams.flowise.app())]), flowise),
+            ("core", core),
+        ]
+        self._thread = _ServerThread(apps, self._log_level)
+        self._thread.start()
+        if not self._thread.ready.wait(timeout=60) or self._thread.error is not None:
+            raise RuntimeError(f"Harness non avviato: {self._thread.error}")
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._thread is not None:
+            self._thread.stop()
+
+    def wait_idle(self, quiet_seconds: float = 0.3, timeout: float = 10.0) -> None:
+        """Attende che nessun upstream riceva chiamate per `quiet_seconds` (lavoro post-risposta)."""
+        deadline = time.monotonic() + timeout
+        last = self.upstreams.total_calls()
+        while time.monotonic() < deadline:
+            time.sleep(quiet_seconds)
+            current = self.upstreams.total_calls()
+            if current == last:
+                return
+            last = current
+
+    async def _drive(self, scenario: Scenario, requests: int, concurrency: int, timeout: float) -> Tuple[List[float], Counter, int, float]:
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        reconnects = [0]
+        pending = iter(range(requests))
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async with httpx.AsyncClient(base_url=self.core_url, limits=limits, timeout=timeout) as client:
+            async def _worker() -> None:
+                for i in pending:
+                    user = self.users[i % len(self.users)]
+                    headers = {"Authorization": f"Bearer {user['token']}", "X-App-Id": BENCH_APP_ID}
+                    started = time.perf_counter()
+                    status = 0  # errore di trasporto/timeout
+                    for attempt in range(2):
+                        try:
+                            resp = await client.request(scenario.method, scenario.path, json=scenario.body, headers=headers)
+                            status = resp.status_code
+                        except (httpx.ReadError, httpx.RemoteProtocolError):
+                            # uvicorn chiude la connessione keep-alive dopo un'eccezione non gestita:
+                            # la richiesta successiva su quel socket non arriva all'app, si ritenta una volta
+                            reconnects[0] += 1
+                            if attempt == 0:
+                                continue
+                        except httpx.HTTPError:
+                            pass
+                        break
+                    latencies.append((time.perf_counter() - started) * 1000.0)
+                    statuses[status] += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(_worker() for _ in range(max(1, concurrency))))
+            return latencies, statuses, reconnects[0], time.perf_counter() - started
+
+    def run_scenario(self, scenario: Scenario, requests: int, concurrency: int, warmup: int = 0, timeout: float = 30.0) -> ScenarioResult:
+        if warmup > 0:
+            asyncio.run(self._drive(scenario, warmup, concurrency, timeout))
+        self.wait_idle()
+        self.upstreams.reset()
+        latencies, statuses, reconnects, duration = asyncio.run(self._drive(scenario, requests, concurrency, timeout))
+        self.wait_idle()
+        return ScenarioResult(
+            name=scenario.name,
+            requests=requests,
+            concurrency=concurrency,
+            duration_s=duration,
+            latencies_ms=latencies,
+            statuses=statuses,
+            reconnects=reconnects,
+            upstream_calls={u.name: u.calls for u in self.upstreams.all()},
+            upstream_routes={u.name: dict(u.routes) for u in self.upstreams.all() if u.routes},
+        )
+
+
+def run_benchmark(
+    scenarios: Sequence[str],
+    requests: int,
+    concurrency: int,
+    *,
+    users: int = 50,
+    warmup: int = 0,
+    behaviors: Optional[Dict[str, UpstreamBehavior]] = None,
+    env: Optional[Dict[str, str]] = None,
+    timeout: float = 30.0,
+    log_level: str = "critical",
+) -> List[Dict[str, Any]]:
+    """Esegue gli scenari in sequenza e ritorna i riepiloghi (vedi `ScenarioResult.summary`)."""
+    upstreams = Upstreams()
+    for name, behavior in (behaviors or {}).items():
+        upstreams.get(name).behavior = behavior
+    results: List[Dict[str, Any]] = []
+    with Harness(upstreams, users=users, env=env, log_level=log_level) as harness:
+        for name in scenarios:
+            result = harness.run_scenario(SCENARIOS[name], requests, concurrency, warmup=warmup, timeout=timeout)
+            results.append(result.summary())
+    return results
+
+
+def format_report(results: Sequence[Dict[str, Any]]) -> str:
+    header = f"{'scenario':<16} {'reqs':>6} {'conc':>5} {'ok':>6} {'err':>5} {'rps':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}  upstream/req"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        per_req = " ".join(f"{name}={n:g}" for name, n in r["upstream_calls_per_request"].items())
+        lines.append(
+            f"{r['scenario']:<16} {r['requests']:>6} {r['concurrency']:>5} {r['ok']:>6} {r['errors']:>5} "
+            f"{r['rps']:>8.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}  {per_req}"
+        )
+        if r["errors"]:
+            lines.append(f"{'':<16} statuses={r['statuses']} reconnects={r['reconnects']}")
+    return "\n".join(lines)
+
+
+def _parse_pairs(values: Optional[List[str]], names: Sequence[str]) -> Dict[str, str]:
+    """`name=value` (ripetibile o separato da virgole); `all=value` vale per ogni upstream."""
+    pairs: Dict[str, str] = {}
+    for raw in values or []:
+        for item in raw.split(","):
+            if not item.strip():
+                continue
+            key, sep, value = item.partition("=")
+            key = key.strip()
+            if not sep:
+                raise argparse.ArgumentTypeError(f"Formato atteso name=value: {item}")
+            targets = list(names) if key == "all" else [key]
+            for target in targets:
+                if target not in names:
+                    raise argparse.ArgumentTypeError(f"Upstream sconosciuto: {target} (validi: {', '.join(names)})")
+                pairs[target] = value.strip()
+    return pairs
+
+
+def _behaviors(args: argparse.Namespace) -> Dict[str, UpstreamBehavior]:
+    names = UPSTREAM_NAMES
+    latency = _parse_pairs(args.latency, names)
+    jitter = _parse_pairs(args.jitter, names)
+    errors = _parse_pairs(args.errors, names)
+    return {
+        name: UpstreamBehavior(
+            latency_ms=float(latency.get(name, 0.0)),
+            jitter_ms=float(jitter.get(name, 0.0)),
+            error_rate=float(errors.get(name, 0.0)),
+            error_status=args.error_status,
+        )
+        for name in names
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test offline del Core con upstream simulati")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Scenari separati da virgola ({', '.join(SCENARIOS)})")
+    parser.add_argument("--requests", type=int, default=200, help="Richieste per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Richieste in volo contemporaneamente")
+    parser.add_argument("--users", type=int, default=50, help="Utenti distinti (token/profili) a rotazione")
+    parser.add_argument("--warmup", type=int, default=0, help="Richieste di riscaldamento per scenario, escluse dalle metriche")
+    parser.add_argument("--latency", action="append", help="Latenza upstream in ms, es. openrouter=200,flowise=500 o all=5")
+    parser.add_argument("--jitter", action="append", help="Jitter uniforme aggiuntivo in ms, stesso formato di --latency")
+    parser.add_argument("--errors", action="append", help="Frazione di risposte in errore, es. openrouter=0.05")
+    parser.add_argument("--error-status", type=int, default=503, help="Status HTTP degli errori iniettati")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Timeout client per richiesta (s)")
+    parser.add_argument("--env", action="append", default=[], help="Variabile d'ambiente per il Core, KEY=VALUE (ripetibile)")
+    parser.add_argument("--json", dest="json_path", help="Scrive i risultati in JSON su file ('-' = stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Mostra i log del Core")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"Scenari sconosciuti: {', '.join(unknown)}")
+    try:
+        behaviors = _behaviors(args)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    env = dict(item.split("=", 1) for item in args.env if "=" in item)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    results = run_benchmark(
+        scenarios,
+        args.requests,
+        args.concurrency,
+        users=args.users,
+        warmup=args.warmup,
+        behaviors=behaviors,
+        env=env,
+        timeout=args.timeout,
+        log_level="info" if args.verbose else "critical",
+    )
+    if args.json_path == "-":
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_report(results))
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
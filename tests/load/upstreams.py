@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+"""
+Stand-in HTTP locali per gli upstream del Core (solo per il load test).
+
+- FakePostgrest: tabelle e RPC usate dai percorsi caldi (profili, prenotazioni
+  crediti, flow_configs, pricing). Le RPC non modellate rispondono 404, come
+  una migration non applicata: il Core usa il proprio fallback.
+- FakeGotrue: JWKS RS256 con `kid`, login password, /user.
+- FakeOpenRouter: /chat/completions, /auth/key (usage crescente), /keys.
+- FakeFlowise: /prediction/{flow_id}.
+
+Ogni upstream conta le chiamate ricevute e applica latenza/errori configurabili
+(`UpstreamBehavior`) prima di rispondere.
+"""
+
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+
+
+_METHODS = ["GET", "POST", "PATCH", "PUT", "DELETE", "HEAD"]
+
+
+@dataclass
+class UpstreamBehavior:
+    """Latenza (ms, con jitter uniforme) ed errori iniettati per un upstream."""
+
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+
+
+class FakeUpstream:
+    """Base: conteggio chiamate, latenza/errori e app Starlette catch-all."""
+
+    name = "upstream"
+
+    def __init__(self, behavior: Optional[UpstreamBehavior] = None) -> None:
+        self.behavior = behavior or UpstreamBehavior()
+        self.calls = 0
+        self.errors = 0
+        self.routes: Counter = Counter()
+
+    def reset(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.routes = Counter()
+
+    async def _endpoint(self, request: Request) -> Response:
+        path = "/" + request.path_params.get("path", "")
+        self.calls += 1
+        self.routes[f"{request.method} {self.route_label(path)}"] += 1
+        b = self.behavior
+        delay = b.latency_ms + (random.uniform(0.0, b.jitter_ms) if b.jitter_ms > 0 else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+        if b.error_rate > 0 and random.random() < b.error_rate:
+            self.errors += 1
+            return JSONResponse({"message": f"{self.name}: errore iniettato"}, status_code=b.error_status)
+        return await self.handle(request, path)
+
+    def route_label(self, path: str) -> str:
+        return path
+
+    async def handle(self, request: Request, path: str) -> Response:
+        return JSONResponse({"message": "not found"}, status_code=404)
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[Route("/{path:path}", self._endpoint, methods=_METHODS)])
+
+
+async def _json_body(request: Request) -> Any:
+    raw = await request.body()
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except Exception:
+        return None
+
+
+def _eq(request: Request, column: str) -> Optional[str]:
+    """Valore di un filtro PostgREST `col=eq.X` (None se assente)."""
+    raw = request.query_params.get(column)
+    if raw and raw.startswith("eq."):
+        return raw[3:]
+    return None
+
+
+class FakePostgrest(FakeUpstream):
+    """PostgREST in memoria con le tabelle/RPC toccate dai percorsi caldi."""
+
+    name = "postgrest"
+
+    def __init__(self, behavior: Optional[UpstreamBehavior] = None) -> None:
+        super().__init__(behavior)
+        self.profiles: Dict[str, Dict[str, Any]] = {}
+        self.flow_configs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.pricing_config: Dict[str, Any] = {}
+        self.holds: Dict[str, Dict[str, Any]] = {}
+
+    def add_profile(self, user_id: str, email: str, credits: float, openrouter_api_key: Optional[str]) -> None:
+        self.profiles[user_id] = {
+            "id": user_id,
+            "email": email,
+            "credits": credits,
+            "openrouter_api_key": openrouter_api_key,
+            "openrouter_key_name": f"bench-{user_id[:8]}",
+        }
+
+    def add_flow_config(self, app_id: str, flow_key: str, flow_id: str) -> None:
+        self.flow_configs[(app_id, flow_key)] = {
+            "app_id": app_id,
+            "flow_key": flow_key,
+            "flow_id": flow_id,
+            "node_names": [],
+            "is_conversational": False,
+            "metadata": {},
+        }
+
+    def route_label(self, path: str) -> str:
+        return path.split("?", 1)[0]
+
+    def _held(self, user_id: str) -> float:
+        return sum(h["amount"] for h in self.holds.values() if h["user_id"] == user_id and h["status"] == "held")
+
+    async def handle(self, request: Request, path: str) -> Response:
+        body = await _json_body(request)
+        if path.startswith("/rpc/"):
+            return self._rpc(path[5:], body or {})
+        table = path.strip("/")
+        if request.method == "GET":
+            return JSONResponse(self._select(table, request))
+        if request.method == "POST":
+            prefer = request.headers.get("prefer", "")
+            if "return=representation" in prefer:
+                rows = body if isinstance(body, list) else [body]
+                return JSONResponse(rows, status_code=201)
+            return Response(status_code=201)
+        return Response(status_code=204)
+
+    def _select(self, table: str, request: Request) -> List[Dict[str, Any]]:
+        if table == "profiles":
+            user_id = _eq(request, "id")
+            profile = self.profiles.get(user_id or "")
+            return [dict(profile)] if profile else []
+        if table == "flow_configs":
+            row = self.flow_configs.get((_eq(request, "app_id") or "", _eq(request, "flow_key") or ""))
+            return [dict(row)] if row else []
+        if table == "pricing_configs":
+            return [{"config": self.pricing_config}] if _eq(request, "app_id") == "default" else []
+        return []
+
+    def _rpc(self, fn: str, args: Dict[str, Any]) -> Response:
+        if fn == "reserve_user_credits":
+            user_id = str(args.get("p_user_id"))
+            profile = self.profiles.get(user_id)
+            if profile is None:
+                return JSONResponse({"success": False, "error": "user_not_found"})
+            amount = float(args.get("p_amount") or 0.0)
+            available = float(profile["credits"]) - self._held(user_id)
+            required = max(amount, float(args.get("p_min_available") or 0.0))
+            if available < required:
+                return JSONResponse({"success": False, "error": "insufficient_credits", "available": available, "required": required})
+            hold_id = str(uuid.uuid4())
+            self.holds[hold_id] = {"user_id": user_id, "amount": amount, "status": "held"}
+            return JSONResponse({"success": True, "hold_id": hold_id, "held": amount, "available": available - amount})
+        if fn in ("settle_credit_hold", "release_credit_hold"):
+            hold = self.holds.get(str(args.get("p_hold_id")))
+            if hold is None:
+                return JSONResponse({"success": False, "error": "hold_not_found"})
+            if hold["status"] != "held":
+                return JSONResponse({"success": True, "status": hold["status"], "idempotent": True})
+            if fn == "release_credit_hold":
+                hold["status"] = "released"
+                return JSONResponse({"success": True, "status": "released"})
+            actual = float(args.get("p_actual") or 0.0)
+            hold["status"] = "settled"
+            profile = self.profiles[hold["user_id"]]
+            profile["credits"] = float(profile["credits"]) - actual
+            return JSONResponse({"success": True, "status": "settled", "charged": actual, "user_id": hold["user_id"], "credits_after": profile["credits"]})
+        if fn in ("debit_user_credits", "credit_user_credits"):
+            profile = self.profiles.get(str(args.get("p_user_id")))
+            if profile is None:
+                return JSONResponse({"success": False, "error": "user_not_found"})
+            sign = -1.0 if fn == "debit_user_credits" else 1.0
+            profile["credits"] = float(profile["credits"]) + sign * float(args.get("p_amount") or 0.0)
+            return JSONResponse({"success": True, "transaction_id": str(uuid.uuid4()), "credits_after": profile["credits"]})
+        if fn == "expire_credit_holds":
+            return JSONResponse({"success": True, "expired": 0})
+        if fn in ("get_provider_credentials", "claim_core_jobs", "claim_billing_webhooks"):
+            return JSONResponse([])
+        # RPC non modellata: come una migration non applicata
+        return JSONResponse({"message": f"function {fn} not found"}, status_code=404)
+
+
+class FakeGotrue(FakeUpstream):
+    """GoTrue minimale: JWKS (RS256, kid) e token firmati per gli utenti registrati."""
+
+    name = "gotrue"
+    kid = "bench-key"
+
+    def __init__(self, behavior: Optional[UpstreamBehavior] = None) -> None:
+        super().__init__(behavior)
+        self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self._private_key.public_key()))
+        jwk.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+        self._jwks = {"keys": [jwk]}
+        self.users: Dict[str, str] = {}
+
+    def add_user(self, user_id: str, email: str) -> None:
+        self.users[email] = user_id
+
+    def issue_token(self, user_id: str, email: str, ttl_seconds: int = 3600) -> str:
+        now = int(time.time())
+        claims = {"sub": user_id, "email": email, "role": "authenticated", "iat": now, "exp": now + ttl_seconds}
+        return jwt.encode(claims, self._private_key, algorithm="RS256", headers={"kid": self.kid})
+
+    def route_label(self, path: str) -> str:
+        return path.split("?", 1)[0]
+
+    async def handle(self, request: Request, path: str) -> Response:
+        if path == "/.well-known/jwks.json":
+            return JSONResponse(self._jwks)
+        if path == "/token" and request.method == "POST":
+            body = await _json_body(request) or {}
+            user_id = self.users.get(str(body.get("email")))
+            if user_id is None:
+                return JSONResponse({"error": "invalid_grant"}, status_code=400)
+            token = self.issue_token(user_id, body["email"])
+            return JSONResponse({
+                "access_token": token,
+                "token_type": "bearer",
+                "expires_in": 3600,
+                "refresh_token": uuid.uuid4().hex,
+                "user": {"id": user_id, "email": body["email"]},
+            })
+        if path == "/user":
+            token = request.headers.get("authorization", "").replace("Bearer ", "")
+            try:
+                claims = jwt.decode(token, self._private_key.public_key(), algorithms=["RS256"])
+            except Exception:
+                return JSONResponse({"error": "invalid_token"}, status_code=401)
+            return JSONResponse({"id": claims["sub"], "email": claims.get("email")})
+        return await super().handle(request, path)
+
+
+class FakeOpenRouter(FakeUpstream):
+    """OpenRouter: chat completions, usage per chiave (cresce a ogni lettura), creazione chiavi."""
+
+    name = "openrouter"
+
+    def __init__(self, behavior: Optional[UpstreamBehavior] = None, usage_step_usd: float = 0.001) -> None:
+        super().__init__(behavior)
+        self.usage_step_usd = usage_step_usd
+        self.usage: Dict[str, float] = {}
+
+    async def handle(self, request: Request, path: str) -> Response:
+        if path == "/chat/completions" and request.method == "POST":
+            body = await _json_body(request) or {}
+            content = f"[bench] {body.get('model')} risponde a {len(body.get('messages') or [])} messaggi"
+            return JSONResponse({
+                "id": f"gen-{uuid.uuid4().hex[:12]}",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 12, "completion_tokens": 24, "total_tokens": 36, "cost": 0.0004},
+            })
+        if path == "/auth/key" and request.method == "GET":
+            key = request.headers.get("authorization", "").replace("Bearer ", "")
+            usage = self.usage.get(key, 0.0) + self.usage_step_usd
+            self.usage[key] = usage
+            return JSONResponse({"data": {"label": "bench", "usage": round(usage, 6), "limit": None}})
+        if path == "/keys" and request.method == "POST":
+            key = f"sk-or-v1-bench-{uuid.uuid4().hex}"
+            return JSONResponse({"key": key, "data": {"hash": uuid.uuid4().hex, "name": "bench"}}, status_code=201)
+        return await super().handle(request, path)
+
+
+class FakeFlowise(FakeUpstream):
+    """Flowise: prediction bufferizzata su qualsiasi flow_id."""
+
+    name = "flowise"
+
+    def route_label(self, path: str) -> str:
+        return "/prediction/{flow_id}" if path.startswith("/prediction/") else path
+
+    async def handle(self, request: Request, path: str) -> Response:
+        if path.startswith("/prediction/") and request.method == "POST":
+            body = await _json_body(request) or {}
+            session_id = body.get("sessionId") or str(uuid.uuid4())
+            return JSONResponse({
+                "text": f"[bench] flow {path.rsplit('/', 1)[-1]}: {str(body.get('question') or '')[:40]}",
+                "sessionId": session_id,
+                "chatId": session_id,
+            })
+        return await super().handle(request, path)
+
+
+@dataclass
+class Upstreams:
+    """Insieme degli stand-in; `supabase_app` monta PostgREST e GoTrue sullo stesso host."""
+
+    postgrest: FakePostgrest = field(default_factory=FakePostgrest)
+    gotrue: FakeGotrue = field(default_factory=FakeGotrue)
+    openrouter: FakeOpenRouter = field(default_factory=FakeOpenRouter)
+    flowise: FakeFlowise = field(default_factory=FakeFlowise)
+
+    def all(self) -> List[FakeUpstream]:
+        return [self.postgrest, self.gotrue, self.openrouter, self.flowise]
+
+    def get(self, name: str) -> FakeUpstream:
+        for upstream in self.all():
+            if upstream.name == name:
+                return upstream
+        raise KeyError(name)
+
+    def reset(self) -> None:
+        for upstream in self.all():
+            upstream.reset()
+
+    def total_calls(self) -> int:
+        return sum(u.calls for u in self.all())
+
+    def supabase_app(self) -> Starlette:
+        return Starlette(routes=[
+            Mount("/rest/v1", app=self.postgrest.app()),
+            Mount("/auth/v1", app=self.gotrue.app()),
+        ])
+
+    def seed_users(self, count: int, credits: float = 1_000_000.0) -> List[Dict[str, str]]:
+        """Crea `count` utenti (profilo + account GoTrue) e ritorna id, email e bearer token."""
+        users = []
+        for i in range(count):
+            user_id = str(uuid.UUID(int=i + 1))
+            email = f"bench{i}@example.com"
+            self.postgrest.add_profile(user_id, email, credits, openrouter_api_key=f"sk-or-v1-user-{i}")
+            self.gotrue.add_user(user_id, email)
+            users.append({"id": user_id, "email": email, "token": self.gotrue.issue_token(user_id, email)})
+        return users
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+"""
+Test /admin/stats: numeri della dashboard da una sola RPC aggregata, fallback senza migration 010.
+"""
+
+from typing import Any, Dict, List, Optional
+
+from tests.test_rollout_and_observability import FakeAsyncClient, _Resp
+
+
+class _StatsClient(FakeAsyncClient):
+    def __init__(self, rpc_available: bool = True) -> None:
+        super().__init__()
+        self.rpc_available = rpc_available
+        self.urls: List[str] = []
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        self.urls.append(url)
+        if "/profiles" in url:
+            assert (headers or {}).get("Prefer") == "count=exact"
+            return _Resp(200, [{"id": "u1"}], headers={"content-range": "0-0/1234"})
+        return await super().get(url, headers=headers, **kwargs)
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        self.urls.append(url)
+        if url.endswith("/rpc/get_admin_stats"):
+            if not self.rpc_available:
+                return _Resp(404, {"message": "function not found"})
+            return _Resp(200, {"users": 1234, "credits_outstanding": 56789.5, "credits_debited_today": 321.25, "revenue_cents": {"USD": 199900}})
+        return await super().post(url, headers=headers, json=json, **kwargs)
+
+
+def _get_stats(monkeypatch, client: _StatsClient) -> Dict[str, Any]:
+    from app.services.supabase_rest import get_supabase
+
+    monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    monkeypatch.setenv("CORE_ADMIN_KEY", "admin-key")
+    monkeypatch.setattr(get_supabase(), "_client", client)
+
+    from app.main import app
+    from fastapi.testclient import TestClient
+
+    with TestClient(app) as http:
+        resp = http.get("/core/v1/admin/stats", headers={"X-Admin-Key": "admin-key"})
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_stats_single_rpc_without_listing_users(monkeypatch):
+    client = _StatsClient()
+    body = _get_stats(monkeypatch, client)
+    assert body == {
+        "users": 1234,
+        "credits_outstanding": 56789.5,
+        "credits_debited_today": 321.25,
+        "revenue_cents": {"USD": 199900},
+        "source": "counters",
+    }
+    assert [u for u in client.urls if "/profiles" in u] == []
+
+
+def test_stats_fallback_counts_users_only(monkeypatch):
+    body = _get_stats(monkeypatch, _StatsClient(rpc_available=False))
+    assert body["users"] == 1234
+    assert body["source"] == "fallback"
+    assert body["credits_outstanding"] is None
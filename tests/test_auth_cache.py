@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+"""
+Test cache JWKS e token verificati di SupabaseAuthBackend (senza rete).
+"""
+
+import asyncio
+import json
+import time
+from typing import Any
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+
+
+class _Resp:
+    def __init__(self, data: Any):
+        self.status_code = 200
+        self._data = data
+
+    def raise_for_status(self):
+        return None
+
+    def json(self):
+        return self._data
+
+
+class FakeJwksClient:
+    def __init__(self, jwks: Any):
+        self.jwks = jwks
+        self.calls = 0
+
+    async def get(self, url: str, **kwargs: Any):
+        self.calls += 1
+        return _Resp(self.jwks)
+
+
+def _make_key(kid: str):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "alg": "RS256", "use": "sig"})
+    return private_key, jwk
+
+
+def _token(private_key, kid: str, sub: str = "user-1") -> str:
+    now = int(time.time())
+    payload = {"sub": sub, "email": "u@example.com", "iat": now, "exp": now + 3600}
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture
+def auth_env(monkeypatch):
+    import app.adapters.auth_supabase as auth_mod
+    from app.services.supabase_rest import get_supabase
+
+    monkeypatch.setenv("SUPABASE_JWKS_URL", "http://supabase.local/auth/v1/.well-known/jwks.json")
+    monkeypatch.setenv("SUPABASE_VERIFY_DISABLED", "0")
+    monkeypatch.setenv("SUPABASE_JWKS_MIN_REFRESH", "0")
+    auth_mod._jwks_cache.clear()
+    auth_mod._token_cache.clear()
+    fake = FakeJwksClient({"keys": []})
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+    yield auth_mod, fake
+    auth_mod._jwks_cache.clear()
+    auth_mod._token_cache.clear()
+
+
+def test_verified_token_cache_skips_jwks_and_verify(auth_env):
+    auth_mod, fake = auth_env
+    private_key, jwk = _make_key("k1")
+    fake.jwks = {"keys": [jwk]}
+    token = _token(private_key, "k1")
+    backend = auth_mod.SupabaseAuthBackend()
+
+    async def _run():
+        first = await backend.get_current_user(token)
+        second = await backend.get_current_user(token)
+        assert first == second == {"id": "user-1", "email": "u@example.com"}
+
+    before = auth_mod.get_auth_cache_stats()
+    asyncio.run(_run())
+    after = auth_mod.get_auth_cache_stats()
+    assert fake.calls == 1
+    assert after["token_cache_hits"] - before["token_cache_hits"] == 1
+
+
+def test_unknown_kid_triggers_refresh(auth_env):
+    auth_mod, fake = auth_env
+    key1, jwk1 = _make_key("k1")
+    key2, jwk2 = _make_key("k2")
+    fake.jwks = {"keys": [jwk1]}
+    backend = auth_mod.SupabaseAuthBackend()
+
+    async def _run():
+        await backend.get_current_user(_token(key1, "k1", sub="a"))
+        # Rotazione chiavi: il nuovo kid forza un refresh del JWKS
+        fake.jwks = {"keys": [jwk1, jwk2]}
+        user = await backend.get_current_user(_token(key2, "k2", sub="b"))
+        assert user["id"] == "b"
+
+    asyncio.run(_run())
+    assert fake.calls == 2
+
+
+def test_invalid_token_is_rejected(auth_env):
+    auth_mod, fake = auth_env
+    _, jwk = _make_key("k1")
+    other_key, _ = _make_key("k1")
+    fake.jwks = {"keys": [jwk]}
+    backend = auth_mod.SupabaseAuthBackend()
+
+    # Firma con una chiave diversa: niente fallback a decode non verificato
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(backend.get_current_user(_token(other_key, "k1")))
+    assert exc.value.status_code == 401
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+"""
+Test cache billing_configs (write-through da put_config) e /billing/plans con ETag.
+"""
+
+import asyncio
+from typing import Any, Dict
+
+import pytest
+
+from tests.test_rollout_and_observability import _Resp
+from app.services import billing_config_service as bcs
+
+
+@pytest.fixture
+def supabase_rows(monkeypatch):
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    monkeypatch.setenv("BILLING_CONFIG_CACHE_TTL", "60")
+    bcs.invalidate_billing_config_cache()
+    state: Dict[str, Any] = {"config": {"provider": "lemonsqueezy", "lemonsqueezy": {"store_id": "1"}}, "gets": 0}
+
+    class _Fake:
+        async def request(self, method: str, url: str, **kwargs: Any):
+            if method == "GET" and "/billing_configs" in url:
+                state["gets"] += 1
+                return _Resp(200, [{"config": state["config"]}])
+            if method == "POST" and "/billing_configs" in url:
+                state["config"] = kwargs["json"]["config"]
+                return _Resp(201, [kwargs["json"]])
+            return _Resp(404, {})
+
+    monkeypatch.setattr(get_supabase(), "_client", _Fake())
+    yield state
+    bcs.invalidate_billing_config_cache()
+
+
+def test_config_cached_and_written_through(supabase_rows):
+    svc = bcs.BillingConfigService()
+
+    async def _run():
+        first = await svc.get_config("app")
+        second = await svc.get_config("app")
+        assert first is second
+        assert supabase_rows["gets"] == 1
+
+        await svc.put_config({"lemonsqueezy": {"store_id": "2"}}, app_id="app")
+        gets_after_put = supabase_rows["gets"]
+        third = await svc.get_config("app")
+        # Nuovo snapshot servito subito dalla cache, senza rilettura
+        assert third["config"]["lemonsqueezy"]["store_id"] == "2"
+        assert supabase_rows["gets"] == gets_after_put
+
+    asyncio.run(_run())
+
+
+def test_plans_response_precomputed_with_etag(supabase_rows):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+    first = client.get("/core/v1/billing/plans")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert first.json()["plans"]
+    gets = supabase_rows["gets"]
+
+    second = client.get("/core/v1/billing/plans", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert supabase_rows["gets"] == gets
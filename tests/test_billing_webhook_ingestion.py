@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+"""
+Test ingestione asincrona webhook billing (persistenza con dedup, consumer ordinato con retry).
+"""
+
+import asyncio
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+from tests.test_rollout_and_observability import _Resp
+
+
+class _Adapter:
+    def validate_webhook(self, body: bytes, signature):
+        return signature == "ok"
+
+    def webhook_event_id(self, payload: Dict[str, Any], body: bytes) -> str:
+        return f"order_created:orders:{payload['data']['id']}:"
+
+
+@pytest.fixture
+def service(monkeypatch):
+    from app.services.payments_service import PaymentsService
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    svc = PaymentsService()
+
+    async def _adapter():
+        svc._cached_provider = "lemonsqueezy"
+        return _Adapter()
+
+    monkeypatch.setattr(svc, "_get_adapter", _adapter)
+    return svc
+
+
+def _install(monkeypatch, handler):
+    from app.services.supabase_rest import get_supabase
+    calls: List[Tuple[str, str, Any]] = []
+
+    class _Fake:
+        async def request(self, method: str, url: str, **kwargs: Any):
+            path = url.split("/rest/v1/", 1)[-1]
+            calls.append((method, path, kwargs.get("json")))
+            return handler(method, path, kwargs.get("json"))
+
+    monkeypatch.setattr(get_supabase(), "_client", _Fake())
+    return calls
+
+
+def test_ingest_persists_once_and_dedupes(service, monkeypatch):
+    seen = set()
+
+    def _handler(method, path, body):
+        if path == "rpc/ingest_billing_webhook":
+            duplicate = body["p_event_id"] in seen
+            seen.add(body["p_event_id"])
+            return _Resp(200, {"duplicate": True} if duplicate else {"duplicate": False, "id": "log-1"})
+        return _Resp(500, {})
+
+    calls = _install(monkeypatch, _handler)
+    body = b'{"data": {"id": "42"}}'
+
+    async def _run():
+        first = await service.ingest_webhook(body=body, signature="ok")
+        second = await service.ingest_webhook(body=body, signature="ok")
+        bad = await service.ingest_webhook(body=body, signature="forged")
+        return first, second, bad
+
+    first, second, bad = asyncio.run(_run())
+    assert first["queued"] is True and first["event_id"] == "order_created:orders:42:"
+    assert second["duplicate"] is True and second["queued"] is False
+    assert bad == {"status": "ignored", "reason": "invalid_signature"}
+    # Una sola scrittura per consegna, nessuna per firme non valide
+    assert [c[1] for c in calls] == ["rpc/ingest_billing_webhook", "rpc/ingest_billing_webhook"]
+
+
+def test_ingest_returns_none_without_migration(service, monkeypatch):
+    _install(monkeypatch, lambda method, path, body: _Resp(404, {}))
+    assert asyncio.run(service.ingest_webhook(body=b'{"data": {"id": "1"}}', signature="ok")) is None
+    assert service._ingest_available is False
+
+
+def test_consumer_parks_failed_event_and_continues(service, monkeypatch):
+    rows = {
+        "b": {"id": "b", "event_id": "e2", "provider": "lemonsqueezy", "payload": {"n": 2}, "received_at": "2026-01-01T00:00:02", "attempts": 1},
+        "a": {"id": "a", "event_id": "e1", "provider": "lemonsqueezy", "payload": {"n": 1}, "received_at": "2026-01-01T00:00:01", "attempts": 1},
+    }
+    patches: List[Tuple[str, Dict[str, Any]]] = []
+    claims = {"n": 0}
+
+    def _handler(method, path, body):
+        if path == "rpc/claim_billing_webhooks":
+            claims["n"] += 1
+            # Secondo giro: resta solo l'evento parcheggiato (backoff scaduto)
+            return _Resp(200, [dict(r) for r in rows.values()] if claims["n"] == 1 else [dict(rows["a"], attempts=2)])
+        if method == "PATCH":
+            patches.append((path.split("id=", 1)[-1], body))
+            return _Resp(204, None)
+        return _Resp(500, {})
+
+    _install(monkeypatch, _handler)
+    applied: List[Tuple[int, Any]] = []
+    failures = {"left": 1}
+
+    async def _apply(adapter, provider, payload, log_id=None):
+        if failures["left"]:
+            failures["left"] -= 1
+            return {"status": "error", "error": "ledger timeout"}
+        applied.append((payload["n"], log_id))
+        return {"status": "ok", "provider": provider}
+
+    monkeypatch.setattr(service, "_apply_event", _apply)
+
+    async def _run():
+        assert await service.consume_webhooks() == 1
+        assert await service.consume_webhooks() == 1
+
+    asyncio.run(_run())
+    assert applied == [(2, "b"), (1, "a")]
+    # Lease rinnovato prima di ogni evento sugli eventi ancora da elaborare
+    leases = [p for p in patches if p[0].startswith("in.")]
+    assert [p[0] for p in leases] == ["in.(a,b)", "in.(b)", "in.(a)"]
+    assert all(set(p[1]) == {"locked_until"} for p in leases)
+    # L'evento fallito va in backoff senza fermare il successivo
+    updates = [p for p in patches if p[0].startswith("eq.")]
+    assert updates[0][0] == "eq.a" and updates[0][1]["status"] == "received" and updates[0][1]["locked_until"]
+    assert [(p[0], p[1]["status"]) for p in updates[1:]] == [("eq.b", "processed"), ("eq.a", "processed")]
+
+
+def test_webhook_credit_keyed_on_event_log(service, monkeypatch):
+    from tests.test_rollout_and_observability import FakeAsyncClient
+    from app.services.supabase_rest import get_supabase
+
+    credited: List[Tuple[str, Dict[str, Any]]] = []
+
+    class _Client(FakeAsyncClient):
+        async def post(self, url: str, headers=None, json: Any = None, **kwargs: Any):
+            if "/rpc/" in url:
+                credited.append((url.rsplit("/", 1)[-1], json))
+                return _Resp(200, {"success": True})
+            return _Resp(201, [{}])
+
+    monkeypatch.setattr(get_supabase(), "_client", _Client())
+
+    class _Parser(_Adapter):
+        def parse_webhook(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+            return {"user_id": "u1", "credits_to_add": 100, "provider_ids": {"transaction_id": "t1"}}
+
+    async def _run():
+        await service._apply_event(_Parser(), "lemonsqueezy", {"id": "t1"}, log_id="log-1")
+        await service._apply_event(_Parser(), "lemonsqueezy", {"id": "t1"})
+
+    asyncio.run(_run())
+    assert credited[0] == ("credit_billing_webhook", {"p_log_id": "log-1", "p_user_id": "u1", "p_amount": 100.0, "p_reason": "ls_webhook"})
+    # Webhook inline (senza log persistito): accredito storico
+    assert credited[1][0] == "credit_user_credits"
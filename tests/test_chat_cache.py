@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+"""
+Test cache risposte chat OpenRouter: chiave canonica, LRU a byte, tier su disco, hit con addebito ridotto.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+from app.services.chat_cache import ChatResponseCache, chat_cache_key, chat_cache_ttl, invalidate_chat_cache
+from app.services.pricing_service import AdvancedPricingSystem, PricingConfig
+
+
+MESSAGES = [{"role": "user", "content": "Riassumi il documento"}]
+
+
+def test_key_is_canonical_and_ttl_requires_opt_in():
+    assert chat_cache_key("a", "m", MESSAGES, {"temperature": 0, "max_tokens": 10}) == \
+        chat_cache_key("a", "m", MESSAGES, {"max_tokens": 10.0, "temperature": 0.0, "cache": True})
+    assert chat_cache_key("a", "m", MESSAGES, {"temperature": 0}) != chat_cache_key("b", "m", MESSAGES, {"temperature": 0})
+
+    cfg = PricingConfig(chat_cache_ttl_seconds={"m": 60, "*": 5})
+    assert chat_cache_ttl("m", {"temperature": 0}, cfg) == 60
+    assert chat_cache_ttl("other", {"temperature": 0}, cfg) == 5
+    assert chat_cache_ttl("m", {"temperature": 0.7}, cfg) == 0
+    assert chat_cache_ttl("m", {"temperature": 0.7, "cache": True}, cfg) == 60
+    assert chat_cache_ttl("m", {"temperature": 0, "cache": False}, cfg) == 0
+    assert chat_cache_ttl("m", {"temperature": 0}, PricingConfig()) == 0
+
+
+def test_cached_cost_is_reduced_fraction():
+    pricing = AdvancedPricingSystem(config_file="unused")
+    cfg = PricingConfig(chat_cache_hit_cost_ratio=0.25)
+    full = pricing.calculate_operation_cost_credits("openrouter_chat", {"cost_usd": 0.02}, config=cfg)
+    cached = pricing.calculate_operation_cost_credits("openrouter_chat_cached", {"cost_usd": 0.02}, config=cfg)
+    assert cached == round(full * 0.25, 2)
+    assert pricing.calculate_operation_cost_credits("openrouter_chat_cached", {}, config=PricingConfig(chat_cache_hit_cost_ratio=0)) == 0.0
+
+
+def test_lru_byte_budget_and_disk_tier(monkeypatch, tmp_path):
+    monkeypatch.setenv("CHAT_CACHE_MAX_BYTES", "450")
+    monkeypatch.setenv("CHAT_CACHE_DIR", str(tmp_path))
+    cache = ChatResponseCache()
+    body = {"choices": [{"message": {"content": "x" * 100}}]}
+
+    async def _run() -> None:
+        for key in ("k1", "k2", "k3"):
+            await cache.put(key, body, {"cost_usd": 0.01}, ttl=60)
+        # Budget superato: k1 esce dalla memoria ma resta su disco
+        assert cache.stats()["evictions"] >= 1
+        assert (await cache.get("k1")).response == body
+        assert cache.disk_hits == 1
+        assert (await cache.get("k3")) is not None and cache.memory_hits == 1
+
+        await cache.put("old", body, {}, ttl=-1)
+        assert await cache.purge_disk() == 1
+        assert await cache.get("missing") is None
+
+    asyncio.run(_run())
+    assert 0 < cache.stats()["hit_ratio"] < 1
+
+
+def test_repeat_prompt_served_from_cache_with_reduced_debit(monkeypatch):
+    import app.api.endpoints.core as core
+
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+    monkeypatch.delenv("SUPABASE_JWKS_URL", raising=False)
+    monkeypatch.delenv("CHAT_CACHE_DIR", raising=False)
+    invalidate_chat_cache()
+    cfg = PricingConfig(chat_cache_ttl_seconds={"*": 300}, chat_cache_hit_cost_ratio=0.1)
+    calls: List[Any] = []
+
+    async def _snapshot(app_id=None):
+        return cfg
+
+    class _OpenRouter:
+        async def chat(self, user_id: str, model: str, messages, options=None):
+            calls.append(("chat", model))
+            return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}, {"cost_usd": 0.02}
+
+    class _Ledger:
+        async def reserve(self, user_id: str, amount: float, **kwargs: Any) -> Dict[str, Any]:
+            return {"success": True, "hold_id": "h1"}
+
+        async def settle(self, hold_id: str, actual: float, reason=None) -> Dict[str, Any]:
+            calls.append(("settle", actual))
+            return {"success": True}
+
+        async def debit(self, user_id: str, amount: float, reason: str, idempotency_key=None) -> Dict[str, Any]:
+            calls.append(("debit", amount, reason))
+            return {"success": True}
+
+    monkeypatch.setattr(core.pricing, "get_config_snapshot", _snapshot)
+    monkeypatch.setattr(core, "openrouter", _OpenRouter())
+    monkeypatch.setattr(core, "credits_ledger", _Ledger())
+
+    from app.main import app
+    from fastapi.testclient import TestClient
+
+    token = jwt.encode({"sub": "user-1", "email": "u@example.com"}, "secret", algorithm="HS256")
+    body = {"model": "openai/gpt-4o-mini", "messages": MESSAGES, "options": {"temperature": 0}}
+    headers = {"Authorization": f"Bearer {token}"}
+    with TestClient(app) as client:
+        first = client.post("/core/v1/providers/openrouter/chat", json=body, headers=headers)
+        second = client.post("/core/v1/providers/openrouter/chat", json=body, headers=headers)
+        for _ in range(50):
+            if any(c[0] == "debit" for c in calls):
+                break
+            time.sleep(0.01)
+
+    assert first.status_code == 200 and second.status_code == 200
+    assert second.json()["response"] == first.json()["response"]
+    assert second.json()["usage"]["cached"] is True
+    assert [c for c in calls if c[0] == "chat"] == [("chat", "openai/gpt-4o-mini")]
+    debit = next(c for c in calls if c[0] == "debit")
+    assert debit[2] == "openrouter_chat_cached"
+    assert debit[1] == second.json()["usage"]["cost_credits"]
+
+
+def test_cache_hit_gated_on_balance_and_debit_capped(monkeypatch):
+    import app.api.endpoints.core as core
+    from app.services.chat_cache import CachedChat
+
+    cfg = PricingConfig(chat_cache_hit_cost_ratio=0.5)
+    hit = CachedChat(response={"choices": [{"message": {"content": "ok"}}]}, usage={"cost_usd": 0.02}, expires_at=time.time() + 60, size=10)
+    payload = core.ChatRequest(model="openai/gpt-4o-mini", messages=MESSAGES, options={"temperature": 0})
+    debits: List[Any] = []
+
+    async def _context(user_id: str):
+        return SimpleNamespace(credits=0.0)
+
+    class _Ledger:
+        async def debit(self, user_id: str, amount: float, reason: str, idempotency_key=None) -> Dict[str, Any]:
+            debits.append((amount, idempotency_key))
+            if len(debits) == 1:
+                return {"success": False, "error": "insufficient_credits", "available": 0.5, "required": amount}
+            return {"success": True}
+
+    monkeypatch.setattr(core, "get_user_context", _context)
+    monkeypatch.setattr(core, "credits_ledger", _Ledger())
+
+    # Saldo dello snapshot sotto il costo ridotto: 402 come senza cache
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(core._cached_chat_response(hit, payload, "user-1", cfg, None))
+    assert exc.value.status_code == 402
+    assert exc.value.detail["error_type"] == "insufficient_credits"
+
+    # Saldo sceso tra gate e addebito: il job addebita il disponibile invece di scartare
+    asyncio.run(core._cache_hit_debit_job({"user_id": "user-1", "amount": 2.0, "idempotency_key": "k"}, None))
+    assert debits == [(2.0, "k"), (0.5, "k:available")]
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+"""
+Test cache condivisa delle credenziali provider (caricamento in blocco, rotazione, fallback legacy).
+"""
+
+import asyncio
+import base64
+import os
+from typing import Any, Dict, List
+
+import pytest
+from cryptography.fernet import Fernet
+
+from tests.test_rollout_and_observability import _Resp
+from app.services import credentials_manager as cm
+
+
+def _stored(value: str) -> str:
+    """Valore come restituito dalle RPC (un livello base64 già tolto dal DB)."""
+    encrypted = Fernet(os.environ["CORE_ENCRYPTION_KEY"].encode()).encrypt(value.encode())
+    return base64.b64encode(encrypted).decode()
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    monkeypatch.setenv("CREDENTIALS_CACHE_TTL", "60")
+    monkeypatch.delenv("FLOWISE_API_KEY", raising=False)
+    monkeypatch.setattr(cm._credentials_cache, "bulk_available", None)
+    cm.invalidate_credentials_cache()
+    state: Dict[str, Any] = {"values": {("flowise", "api_key"): "k1"}, "bulk": True, "calls": []}
+
+    class _Fake:
+        async def request(self, method: str, url: str, **kwargs: Any):
+            path = url.split("/rest/v1/", 1)[-1]
+            state["calls"].append(path)
+            body = kwargs.get("json") or {}
+            if path == "rpc/get_provider_credentials":
+                if not state["bulk"]:
+                    return _Resp(404, {})
+                rows = [{"provider": p, "credential_key": k, "value": _stored(v)} for (p, k), v in state["values"].items()]
+                return _Resp(200, rows)
+            if path == "rpc/get_provider_credential":
+                value = state["values"].get((body["p_provider"], body["p_key"]))
+                return _Resp(200, _stored(value) if value else None)
+            if path == "rpc/set_provider_credential":
+                state["values"][(body["p_provider"], body["p_key"])] = "rotated"
+                return _Resp(200, None)
+            return _Resp(404, {})
+
+    monkeypatch.setattr(get_supabase(), "_client", _Fake())
+    yield state
+    cm.invalidate_credentials_cache()
+
+
+def test_bulk_load_once_and_rotation_invalidates(supabase):
+    mgr = cm.get_credentials_manager("app-creds")
+    assert mgr is cm.get_credentials_manager("app-creds")
+
+    async def _run():
+        values = await asyncio.gather(*[mgr.get_credential("flowise", "api_key") for _ in range(5)])
+        assert values == ["k1"] * 5
+        # Chiave assente nello snapshot: nessuna lettura extra dal DB
+        assert await mgr.get_credential("flowise", "base_url") is None
+        assert supabase["calls"] == ["rpc/get_provider_credentials"]
+
+        assert await mgr.set_credential("flowise", "api_key", "k2") is True
+        assert await mgr.get_credential("flowise", "api_key") == "rotated"
+        assert supabase["calls"].count("rpc/get_provider_credentials") == 2
+
+    asyncio.run(_run())
+    assert len(cm._ciphers) == 1
+
+
+def test_legacy_per_key_reads_are_cached_without_bulk_rpc(supabase):
+    supabase["bulk"] = False
+    mgr = cm.get_credentials_manager("app-legacy")
+
+    async def _run():
+        assert await mgr.get_credential("flowise", "api_key") == "k1"
+        assert await mgr.get_credential("flowise", "api_key") == "k1"
+        mgr.clear_cache()
+        assert await mgr.get_credential("flowise", "api_key") == "k1"
+
+    asyncio.run(_run())
+    calls: List[str] = supabase["calls"]
+    assert calls == ["rpc/get_provider_credentials", "rpc/get_provider_credential", "rpc/get_provider_credential"]
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+"""
+Test cache risoluzione flow_configs (hit, negative caching, invalidazione).
+"""
+
+import asyncio
+from typing import Any, Dict, Optional
+
+from tests.test_rollout_and_observability import FakeAsyncClient, _Resp
+
+
+class FlowConfigClient(FakeAsyncClient):
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        if "/flow_configs" in url:
+            self.gets += 1
+            if "flow_key=eq.intro" in url:
+                return _Resp(200, [{"flow_id": "f-1", "node_names": '["n1","n1","n2"]', "is_conversational": True}])
+            return _Resp(200, [])
+        return await super().get(url, headers=headers, **kwargs)
+
+
+def test_flow_config_cache_hits_negative_and_invalidation(monkeypatch):
+    import app.services.flowise_config_service as fcs
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service_key_test")
+    fake = FlowConfigClient()
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+    fcs.invalidate_flow_config_cache()
+    svc = fcs.FlowiseConfigService()
+
+    async def _run():
+        first = await svc.get_config_for_user("u1", "intro", app_id="app")
+        first["node_names"].append("mutato")
+        second = await svc.get_config_for_user("u1", "intro", app_id="app")
+        assert second["flow_id"] == "f-1" and second["node_names"] == ["n1", "n2"]
+        assert fake.gets == 1
+        # flow_key sconosciuta: assenza memorizzata
+        assert await svc.get_config_for_user("u1", "missing", app_id="app") is None
+        assert await svc.get_config_for_user("u1", "missing", app_id="app") is None
+        assert fake.gets == 2
+        # Scrittura admin: la config viene riletta
+        fcs.invalidate_flow_config_cache("app", "intro")
+        await svc.get_config_for_user("u1", "intro", app_id="app")
+        assert fake.gets == 3
+
+    asyncio.run(_run())
+    fcs.invalidate_flow_config_cache()
+
+
+class ResolverClient(FakeAsyncClient):
+    def __init__(self, rpc_available: bool):
+        super().__init__()
+        self.rpc_available = rpc_available
+        self.calls = 0
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        self.calls += 1
+        return _Resp(200, [])
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        self.calls += 1
+        if url.endswith("/rpc/resolve_flow_config") and self.rpc_available:
+            return _Resp(200, [{"flow_key": "Intro", "flow_id": "f-1", "match_rank": 1}])
+        return _Resp(404, {"message": "not found"})
+
+
+def test_admin_resolver_single_round_trip(monkeypatch):
+    from app.api.endpoints.admin import _resolve_flow_config_rows
+    from app.services.supabase_rest import get_supabase
+
+    fake = ResolverClient(rpc_available=True)
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+    rows = asyncio.run(_resolve_flow_config_rows("app", "intro"))
+    assert rows[0]["flow_id"] == "f-1" and fake.calls == 1
+
+    # Migration 005 assente: i tre tentativi storici
+    legacy = ResolverClient(rpc_available=False)
+    monkeypatch.setattr(get_supabase(), "_client", legacy)
+    assert asyncio.run(_resolve_flow_config_rows("app", "nope")) == []
+    assert legacy.calls == 4
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+"""
+Test cache risultati flow stateless: chiave normalizzata, opt-in da metadata, hit senza Flowise con gate e addebito ridotto.
+"""
+
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import jwt
+
+from app.services.flow_result_cache import (
+    FlowResultCache,
+    flow_result_cache_key,
+    flow_result_cache_ttl,
+    invalidate_flow_result_cache,
+)
+from app.services.pricing_service import PricingConfig
+from tests.test_openrouter_stream import FakeLedger
+
+
+def test_key_ignores_internal_fields_session_and_api_keys():
+    base = flow_result_cache_key("f1", {"question": "  Titolo per: Roma  ", "lang": "it"})
+    assert base == flow_result_cache_key("f1", {"input": "Titolo per: Roma", "lang": "it", "_node_names": ["n1"], "sessionId": "s1"})
+    assert flow_result_cache_key("f1", {"question": "x", "overrideConfig": {"openRouterApiKey": "sk-1"}}) == \
+        flow_result_cache_key("f1", {"question": "x", "overrideConfig": {"openRouterApiKey": "sk-2"}})
+    assert base != flow_result_cache_key("f2", {"question": "Titolo per: Roma", "lang": "it"})
+    assert base != flow_result_cache_key("f1", {"question": "Titolo per: Milano", "lang": "it"})
+
+
+def test_ttl_from_metadata_and_bounded_lru(monkeypatch):
+    assert flow_result_cache_ttl({"result_cache": {"ttl_seconds": 120}}, False) == 120
+    assert flow_result_cache_ttl({"result_cache": {"ttl_seconds": 120}}, True) == 0
+    assert flow_result_cache_ttl({"result_cache": {"enabled": False}}, False) == 0
+    assert flow_result_cache_ttl({}, False) == 0
+
+    monkeypatch.setenv("FLOW_RESULT_CACHE_MAX_ENTRIES", "2")
+    cache = FlowResultCache()
+    cache.put("a", {"text": "A"}, 60)
+    cache.put("b", {"text": "B"}, 60)
+    assert cache.get("a") == {"text": "A"}
+    cache.put("c", {"text": "C"}, 60)
+    assert cache.get("b") is None and cache.get("a") is not None
+    cache.put("old", {"text": "X"}, 0.001)
+    time.sleep(0.01)
+    assert cache.get("old") is None
+    assert cache.stats()["evictions"] >= 1
+
+
+class _DebitLedger(FakeLedger):
+    async def debit(self, user_id: str, amount: float, reason: str, idempotency_key=None) -> Dict[str, Any]:
+        self.calls.append(("debit", amount, reason))
+        return {"success": True}
+
+
+def test_repeat_flow_input_skips_flowise_and_bills_reduced_hit(monkeypatch):
+    import app.api.endpoints.core as core
+    from app.services.flowise_config_service import FlowiseConfigService
+    from app.services.supabase_rest import get_supabase
+    from tests.test_rollout_and_observability import FakeAsyncClient
+
+    monkeypatch.delenv("SUPABASE_JWKS_URL", raising=False)
+    monkeypatch.setattr(get_supabase(), "_client", FakeAsyncClient())
+    invalidate_flow_result_cache()
+    executions: List[Dict[str, Any]] = []
+
+    async def _config(self, user_id, flow_key, app_id=None):
+        return {"flow_id": "flow-title", "node_names": [], "is_conversational": False, "metadata": {"result_cache": {"ttl_seconds": 300}}}
+
+    async def _execute(user_id, flow_id, data, session_id=None):
+        executions.append(data)
+        return {"text": "Roma, città eterna"}, {"cost_credits": None}
+
+    async def _snapshot(app_id=None):
+        return PricingConfig()
+
+    class _Keys:
+        async def get_user_api_key(self, user_id: str):
+            return None
+
+    balance = {"credits": 100.0}
+
+    async def _context(user_id: str):
+        return SimpleNamespace(credits=balance["credits"])
+
+    ledger = _DebitLedger()
+    monkeypatch.setattr(core, "get_user_context", _context)
+    monkeypatch.setattr(FlowiseConfigService, "get_config_for_user", _config)
+    monkeypatch.setattr(core.flowise, "execute", _execute)
+    monkeypatch.setattr(core.pricing, "get_config_snapshot", _snapshot)
+    monkeypatch.setattr(core, "get_user_keys_service", lambda: _Keys())
+    monkeypatch.setattr(core, "credits_ledger", ledger)
+
+    from app.main import app
+    from fastapi.testclient import TestClient
+
+    token = jwt.encode({"sub": "user-1", "email": "u@example.com"}, "secret", algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}", "X-App-Id": "news"}
+    with TestClient(app) as client:
+        first = client.post("/core/v1/providers/flowise/execute", json={"flow_key": "title", "data": {"question": "Roma"}}, headers=headers)
+        reserves = len([c for c in ledger.calls if c[0] == "reserve"])
+        second = client.post("/core/v1/providers/flowise/execute", json={"flow_key": "title", "data": {"question": " Roma "}}, headers=headers)
+        for _ in range(50):
+            if any(c[0] == "debit" for c in ledger.calls):
+                break
+            time.sleep(0.01)
+        # Saldo esaurito: la hit non regala il risultato
+        balance["credits"] = 0.0
+        broke = client.post("/core/v1/providers/flowise/execute", json={"flow_key": "title", "data": {"question": "Roma"}}, headers=headers)
+
+    assert first.status_code == 200 and second.status_code == 200
+    assert len(executions) == 1
+    assert second.json()["cached"] is True
+    assert second.json()["result"] == first.json()["result"]
+    hit_credits = second.json()["pricing"]["actual_cost_credits"]
+    assert hit_credits > 0
+    # La hit non prenota: addebito ridotto accodato sulla coda job
+    assert len([c for c in ledger.calls if c[0] == "reserve"]) == reserves
+    assert [c for c in ledger.calls if c[0] == "debit"] == [("debit", hit_credits, "flowise_execute_cached")]
+    assert broke.status_code == 402
+    assert broke.json()["detail"]["error_type"] == "insufficient_credits"
+    assert len(executions) == 1
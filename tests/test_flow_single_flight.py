@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+"""
+Test single-flight Flowise: fan-out del risultato, propagazione errori, una sola esecuzione con addebito ripartito.
+"""
+
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from app.services.flow_single_flight import FlowSingleFlight, billing_shares, coalesce_billing_policy, flow_is_deterministic
+from app.services.flow_result_cache import invalidate_flow_result_cache
+from app.services.openrouter_cost_attribution import CostAttribution
+from app.services.pricing_service import PricingConfig
+
+
+def test_policies_and_shares(monkeypatch):
+    assert billing_shares("each", 3) == [1.0, 1.0, 1.0]
+    assert billing_shares("split", 4) == [0.25] * 4
+    assert billing_shares("leader", 3) == [1.0, 0.0, 0.0]
+    assert flow_is_deterministic({"result_cache": True}, False)
+    assert not flow_is_deterministic({"deterministic": True}, True)
+    assert not flow_is_deterministic({}, False)
+
+    monkeypatch.setenv("FLOW_COALESCE_BILLING", "split")
+    assert coalesce_billing_policy({}) == "split"
+    assert coalesce_billing_policy({"coalesce_billing": "leader"}) == "leader"
+    assert coalesce_billing_policy({"coalesce_billing": "boh"}) == "each"
+
+
+def test_followers_share_result_and_error():
+    sf = FlowSingleFlight()
+
+    async def _run() -> None:
+        assert sf.join("k", {"user_id": "a"}) is None
+        flight = sf.lead("k")
+        joined = sf.join("k", {"user_id": "b"})
+        assert joined is flight
+        waiter = asyncio.create_task(sf.wait(joined))
+        await asyncio.sleep(0)
+        assert sf.finish("k", flight, result={"text": "ok"}) == [{"user_id": "b"}]
+        assert await waiter == {"text": "ok"}
+        # Flight chiuso: un nuovo arrivo diventa leader
+        assert sf.join("k", {"user_id": "c"}) is None
+
+        failing = sf.lead("k")
+        follower = sf.join("k", {"user_id": "d"})
+        sf.finish("k", failing, error=RuntimeError("flowise giù"))
+        with pytest.raises(RuntimeError):
+            await sf.wait(follower)
+
+    asyncio.run(_run())
+    assert sf.stats() == {"inflight": 0, "leaders": 2, "followers": 2, "failures": 1}
+
+
+def test_concurrent_duplicates_execute_once_and_split_cost(monkeypatch):
+    import app.api.endpoints.core as core
+    from app.services.flowise_config_service import FlowiseConfigService
+    from app.services.supabase_rest import get_supabase
+    from tests.test_rollout_and_observability import FakeAsyncClient
+
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+    monkeypatch.setenv("FAST_RETURN_CREDITS", "true")
+    monkeypatch.setattr(get_supabase(), "_client", FakeAsyncClient())
+    invalidate_flow_result_cache()
+    executions: List[Dict[str, Any]] = []
+    settled: Dict[str, float] = {}
+
+    async def _config(self, user_id, flow_key, app_id=None):
+        return {"flow_id": "flow-meta", "node_names": [], "is_conversational": False,
+                "metadata": {"deterministic": True, "coalesce_billing": "split"}}
+
+    async def _execute(user_id, flow_id, data, session_id=None):
+        executions.append(data)
+        await asyncio.sleep(0.05)
+        return {"text": "meta"}, {"cost_credits": None}
+
+    async def _snapshot(app_id=None):
+        return PricingConfig()
+
+    class _Keys:
+        async def get_user_api_key(self, user_id: str):
+            return None
+
+    class _Engine:
+        async def begin(self, api_key):
+            return SimpleNamespace(usage_before=1.0)
+
+        def abandon(self, ticket) -> None:
+            pass
+
+        async def settle(self, ticket) -> CostAttribution:
+            return CostAttribution(delta_usd=1.0, usage_before=1.0, usage_after=2.0)
+
+    class _Ledger:
+        def __init__(self) -> None:
+            self.holds = 0
+
+        async def reserve(self, user_id: str, amount: float, **kwargs: Any) -> Dict[str, Any]:
+            self.holds += 1
+            return {"success": True, "hold_id": f"hold-{self.holds}"}
+
+        async def settle(self, hold_id: str, actual: float, reason: Optional[str] = None) -> Dict[str, Any]:
+            settled[hold_id] = actual
+            return {"success": True, "charged": actual}
+
+        async def release(self, hold_id: str) -> Dict[str, Any]:
+            return {"success": True}
+
+    monkeypatch.setattr(FlowiseConfigService, "get_config_for_user", _config)
+    monkeypatch.setattr(core.flowise, "execute", _execute)
+    monkeypatch.setattr(core.pricing, "get_config_snapshot", _snapshot)
+    monkeypatch.setattr(core, "get_user_keys_service", lambda: _Keys())
+    monkeypatch.setattr(core, "get_cost_attribution", lambda: _Engine())
+    monkeypatch.setattr(core, "credits_ledger", _Ledger())
+
+    async def _run() -> List[Dict[str, Any]]:
+        requests = [core.FlowiseRequest(flow_key="meta", data={"question": "Roma"}) for _ in range(3)]
+        out = await asyncio.gather(*(core._flowise_execute_for_user(r, f"user-{i}", "news", None) for i, r in enumerate(requests)))
+        for _ in range(50):
+            if len(settled) == 3:
+                break
+            await asyncio.sleep(0.01)
+        return list(out)
+
+    results = asyncio.run(_run())
+    assert len(executions) == 1
+    assert all(r["result"] == {"text": "meta"} for r in results)
+    assert sum(1 for r in results if r.get("coalesced")) == 2
+    # Costo misurato ripartito in parti uguali tra i tre chiamanti
+    multiplier = PricingConfig().final_credit_multiplier
+    assert sorted(settled) == ["hold-1", "hold-2", "hold-3"]
+    assert all(v == round(multiplier / 3, 2) for v in settled.values())
+
+
+def test_followers_charged_with_own_app_multiplier(monkeypatch):
+    import app.api.endpoints.core as core
+
+    charged: Dict[str, float] = {}
+
+    async def _charge(user_id, hold_id, amount, idempotency_key):
+        charged[user_id] = amount
+
+    payload = {
+        "user_id": "leader",
+        "actual_usd": 1.0,
+        "credit_multiplier": 2.0,
+        "participants": core._flight_participants(
+            {"user_id": "leader", "hold_id": "h1", "credit_multiplier": 2.0},
+            [{"user_id": "follower", "hold_id": "h2", "credit_multiplier": 5.0}],
+            "each",
+        ),
+    }
+    monkeypatch.setattr(core, "_charge_flow_participant", _charge)
+    asyncio.run(core._settle_flow_job(payload, None))
+    assert charged == {"leader": 2.0, "follower": 5.0}
+
+
+def test_settle_retry_skips_participants_already_charged(monkeypatch):
+    import app.api.endpoints.core as core
+
+    charged: List[str] = []
+    failures = {"left": 1}
+
+    async def _charge(user_id, hold_id, amount, idempotency_key):
+        if user_id == "follower" and failures["left"]:
+            failures["left"] -= 1
+            raise RuntimeError("Addebito flow fallito: HTTP 503")
+        charged.append(user_id)
+
+    payload = {
+        "user_id": "leader",
+        "actual_usd": 1.0,
+        "participants": core._flight_participants(
+            {"user_id": "leader", "hold_id": "legacy:gone"},
+            [{"user_id": "follower", "hold_id": "h2"}],
+            "each",
+        ),
+    }
+    monkeypatch.setattr(core, "_charge_flow_participant", _charge)
+    with pytest.raises(RuntimeError):
+        asyncio.run(core._settle_flow_job(payload, None))
+    # Il payload (salvato dalla coda) ricorda chi è già stato addebitato
+    assert payload["settled"] == [0]
+    asyncio.run(core._settle_flow_job(payload, None))
+    assert charged == ["leader", "follower"]
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+"""
+Test streaming Flowise: eventi SSE inoltrati e prenotazione chiusa a fine stream.
+"""
+
+import time
+
+import jwt
+
+from tests.test_openrouter_stream import FakeLedger
+
+
+def test_flow_stream_relays_events_and_closes_hold(monkeypatch):
+    import json
+    import app.api.endpoints.core as core
+    from app.services.supabase_rest import get_supabase
+    from tests.test_rollout_and_observability import FakeAsyncClient
+
+    class _Keys:
+        async def get_user_api_key(self, user_id: str):
+            return None
+
+    async def _no_flowise():
+        return None
+
+    monkeypatch.delenv("SUPABASE_JWKS_URL", raising=False)
+    monkeypatch.setattr(get_supabase(), "_client", FakeAsyncClient())
+    monkeypatch.setattr(core.flowise, "_get_base_url", _no_flowise)
+    monkeypatch.setattr(core, "get_user_keys_service", lambda: _Keys())
+    ledger = FakeLedger()
+    monkeypatch.setattr(core, "credits_ledger", ledger)
+
+    from app.main import app
+    from fastapi.testclient import TestClient
+
+    token = jwt.encode({"sub": "user-1", "email": "u@example.com"}, "secret", algorithm="HS256")
+    body = {"flow_id": "flow-1", "input": "ciao"}
+    with TestClient(app) as client:
+        with client.stream("POST", "/core/v1/flows/execute/stream?app_id=default", json=body, headers={"Authorization": f"Bearer {token}"}) as r:
+            assert r.status_code == 200
+            events = [json.loads(line[5:]) for line in r.iter_lines() if line.startswith("data:")]
+        for _ in range(50):
+            if any(c[0] in ("settle", "release") for c in ledger.calls):
+                break
+            time.sleep(0.01)
+
+    kinds = [e["event"] for e in events]
+    assert kinds[0] == "start" and "token" in kinds and kinds[-1] == "core"
+    assert events[-1]["data"]["flow"]["flow_id"] == "flow-1"
+    # Senza chiave OpenRouter il costo non è misurabile: la prenotazione viene rilasciata
+    assert ("release", "hold-1") in ledger.calls
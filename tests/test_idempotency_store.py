@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+"""
+Test store idempotenza (memoria e claim su Supabase simulato).
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import pytest
+from fastapi import HTTPException
+
+from tests.test_rollout_and_observability import FakeAsyncClient, _Resp
+
+
+@pytest.fixture
+def memory_store(monkeypatch):
+    from app.services.idempotency_store import IdempotencyStore
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+    return IdempotencyStore()
+
+
+def test_retry_replays_without_second_call(memory_store):
+    calls: List[int] = []
+
+    async def _call():
+        calls.append(1)
+        return {"ok": True, "n": len(calls)}
+
+    async def _run():
+        first = await memory_store.run(user_id="u1", key="k1", route="r", request={"a": 1}, call=_call)
+        second = await memory_store.run(user_id="u1", key="k1", route="r", request={"a": 1}, call=_call)
+        assert first == second == {"ok": True, "n": 1}
+        # Stessa chiave, payload diverso → 422
+        with pytest.raises(HTTPException) as exc:
+            await memory_store.run(user_id="u1", key="k1", route="r", request={"a": 2}, call=_call)
+        assert exc.value.status_code == 422
+        # Chiave di un altro utente: esecuzione indipendente
+        await memory_store.run(user_id="u2", key="k1", route="r", request={"a": 1}, call=_call)
+
+    asyncio.run(_run())
+    assert len(calls) == 2
+
+
+def test_concurrent_duplicates_share_execution_and_failures_release(memory_store):
+    calls: List[int] = []
+
+    async def _slow():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"ok": True}
+
+    async def _boom():
+        raise HTTPException(status_code=502, detail="upstream")
+
+    async def _run():
+        results = await asyncio.gather(*[
+            memory_store.run(user_id="u1", key="k", route="r", request={}, call=_slow) for _ in range(5)
+        ])
+        assert all(r == {"ok": True} for r in results)
+        with pytest.raises(HTTPException):
+            await memory_store.run(user_id="u1", key="f", route="r", request={}, call=_boom)
+        # Il fallimento non viene memorizzato: il retry riesegue
+        assert await memory_store.run(user_id="u1", key="f", route="r", request={}, call=_slow) == {"ok": True}
+
+    asyncio.run(_run())
+    assert len(calls) == 2
+
+
+class IdempotencyClient(FakeAsyncClient):
+    """Simula idempotency_keys con una riga già completata da un altro processo."""
+
+    def __init__(self, row: Optional[Dict[str, Any]] = None):
+        super().__init__()
+        self.row = row
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        if "/idempotency_keys" in url:
+            return _Resp(200, [self.row] if self.row else [])
+        return await super().get(url, headers=headers, **kwargs)
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        if "/idempotency_keys" in url:
+            return _Resp(201, [] if self.row else [json])
+        return await super().post(url, headers=headers, json=json, **kwargs)
+
+
+def test_completed_row_in_db_is_replayed(monkeypatch):
+    from app.services.idempotency_store import IdempotencyStore
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service_key_test")
+    store = IdempotencyStore()
+    row = {
+        "request_hash": store.fingerprint({"a": 1}),
+        "status": "completed",
+        "response": {"stored": True},
+        "expires_at": "2999-01-01T00:00:00+00:00",
+    }
+    monkeypatch.setattr(get_supabase(), "_client", IdempotencyClient(row))
+
+    async def _never():
+        raise AssertionError("il provider non deve essere richiamato")
+
+    result = asyncio.run(store.run(user_id="u1", key="k1", route="r", request={"a": 1}, call=_never))
+    assert result == {"stored": True}
+
+
+class LeaseClient(FakeAsyncClient):
+    """Riga `in_progress` lasciata da un worker morto con lease già scaduto."""
+
+    def __init__(self, row: Dict[str, Any]):
+        super().__init__()
+        self.row: Optional[Dict[str, Any]] = row
+        self.claims: List[Dict[str, Any]] = []
+
+    async def request(self, method: str, url: str, **kwargs: Any):
+        if method == "DELETE" and "/idempotency_keys" in url:
+            assert "expires_at=lt." in url
+            self.row = None
+            return _Resp(204)
+        if method == "PATCH" and "/idempotency_keys" in url:
+            return _Resp(204)
+        return await super().request(method, url, **kwargs)
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        if "/idempotency_keys" in url:
+            return _Resp(200, [self.row] if self.row else [])
+        return await super().get(url, headers=headers, **kwargs)
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        if "/idempotency_keys" in url:
+            if self.row:
+                return _Resp(201, [])
+            self.claims.append(json)
+            self.row = json
+            return _Resp(201, [json])
+        return await super().post(url, headers=headers, json=json, **kwargs)
+
+
+def test_expired_in_progress_lease_is_taken_over(monkeypatch):
+    from datetime import datetime, timezone
+
+    from app.services.idempotency_store import IdempotencyStore
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service_key_test")
+    monkeypatch.setenv("IDEMPOTENCY_LEASE_SECONDS", "60")
+    store = IdempotencyStore()
+    client = LeaseClient({
+        "request_hash": store.fingerprint({"a": 1}),
+        "status": "in_progress",
+        "response": None,
+        "expires_at": "2000-01-01T00:00:00+00:00",
+    })
+    monkeypatch.setattr(get_supabase(), "_client", client)
+
+    async def _call():
+        return {"ok": True}
+
+    assert asyncio.run(store.run(user_id="u1", key="k1", route="r", request={"a": 1}, call=_call)) == {"ok": True}
+    # Il nuovo claim usa il lease breve, non il TTL di 24 ore
+    lease_until = datetime.fromisoformat(client.claims[0]["expires_at"])
+    assert (lease_until - datetime.now(timezone.utc)).total_seconds() <= 60
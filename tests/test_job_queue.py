@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+"""
+Test coda job durevole (retry in memoria, fallimento/ripresa su Supabase simulato).
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+from tests.test_rollout_and_observability import _Resp
+
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setenv("JOB_RETRY_BASE_SECONDS", "0")
+    monkeypatch.setenv("JOB_MAX_ATTEMPTS", "3")
+
+
+def test_memory_mode_retries_and_keeps_payload_updates(monkeypatch, fast_retry):
+    from app.services.job_queue import JobQueue
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+    queue = JobQueue()
+    seen: List[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]] = []
+
+    async def _handler(payload, context):
+        seen.append((dict(payload), context))
+        payload["step"] = "measured"
+        if len(seen) == 1:
+            raise RuntimeError("ledger down")
+
+    queue.register("k", _handler)
+
+    async def _run():
+        assert await queue.enqueue("k", {"n": 1}, context={"live": True}) is None
+        await asyncio.gather(*list(queue._local))
+
+    asyncio.run(_run())
+    # Il contesto in memoria vale solo per il primo tentativo; il payload aggiornato sopravvive
+    assert seen == [({"n": 1}, {"live": True}), ({"n": 1, "step": "measured"}, None)]
+    assert queue.stats()["completed"] == 1 and queue.stats()["retried"] == 1
+
+
+def test_db_mode_failed_job_is_requeued_and_claimed(monkeypatch, fast_retry):
+    from app.services.job_queue import JobQueue
+    from app.services.supabase_rest import get_supabase
+
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    requests: List[Tuple[str, str, Any]] = []
+    rows: Dict[str, Dict[str, Any]] = {}
+
+    class _Fake:
+        async def request(self, method: str, url: str, **kwargs: Any):
+            body = kwargs.get("json")
+            requests.append((method, url.split("/rest/v1/", 1)[-1], body))
+            if method == "POST" and url.endswith("/core_jobs"):
+                rows[body["id"]] = dict(body)
+                return _Resp(201, None)
+            if method == "PATCH":
+                job_id = url.split("id=eq.", 1)[-1]
+                rows[job_id].update(body)
+                return _Resp(204, None)
+            if url.endswith("/rpc/claim_core_jobs"):
+                ready = [r for r in rows.values() if r["status"] == "queued"]
+                for r in ready:
+                    r["status"] = "running"
+                    r["attempts"] += 1
+                return _Resp(200, ready[:1])
+            return _Resp(404, {})
+
+    monkeypatch.setattr(get_supabase(), "_client", _Fake())
+    queue = JobQueue()
+    calls: List[Optional[Dict[str, Any]]] = []
+
+    async def _handler(payload, context):
+        calls.append(context)
+        if context is not None:
+            payload["actual_credits"] = 1.5
+            raise RuntimeError("settle timeout")
+        assert payload["actual_credits"] == 1.5
+
+    queue.register("flow_settle", _handler)
+
+    async def _run():
+        job_id = await queue.enqueue("flow_settle", {"user_id": "u1"}, context={"ticket": object()})
+        await asyncio.gather(*list(queue._local))
+        assert rows[job_id]["status"] == "queued"
+        assert rows[job_id]["payload"]["actual_credits"] == 1.5
+        # Un worker del pool riprende il job senza contesto in memoria
+        assert await queue.run_once() == 1
+        assert rows[job_id]["status"] == "done"
+        assert await queue.run_once() == 0
+
+    asyncio.run(_run())
+    assert calls[0] is not None and calls[1] is None
+    assert requests[0][0] == "POST" and requests[0][2]["status"] == "running"
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+"""
+Smoke test dell'harness di carico offline (processo separato: app e stand-in su porte locali).
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from tests.load.bench import percentile
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 95) == 0.0
+
+
+def test_bench_drives_app_against_local_upstreams():
+    proc = subprocess.run(
+        [sys.executable, "-m", "tests.load.bench", "--scenarios", "credits_balance,openrouter_chat",
+         "--requests", "12", "--concurrency", "3", "--users", "4", "--json", "-"],
+        cwd=ROOT, capture_output=True, text=True, timeout=120,
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    results = {r["scenario"]: r for r in json.loads(proc.stdout)}
+
+    balance = results["credits_balance"]
+    assert balance["ok"] == 12 and balance["p99_ms"] >= balance["p50_ms"] > 0
+    # JWKS scaricato una volta sola, nessuna chiamata a OpenRouter/Flowise
+    assert balance["upstream_routes"]["gotrue"] == {"GET /.well-known/jwks.json": 1}
+    assert balance["upstream_calls"]["openrouter"] == 0
+
+    chat = results["openrouter_chat"]
+    assert chat["ok"] == 12
+    assert chat["upstream_calls_per_request"]["openrouter"] == 1.0
+    assert chat["upstream_routes"]["postgrest"]["POST /rpc/reserve_user_credits"] == 12
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+"""
+Test endpoint /metrics: formato Prometheus, etichette upstream a bassa cardinalità, route template.
+"""
+
+import asyncio
+
+import httpx
+from fastapi.testclient import TestClient
+
+from app.services.metrics import (
+    MetricsRegistry,
+    classify_upstream,
+    instrumented_transport,
+    render_metrics,
+)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    hist = registry.histogram("t_seconds", "test", ("route",), buckets=(0.1, 1.0))
+    hist.observe(0.05, route="/a")
+    hist.observe(0.5, route="/a")
+    hist.observe(3.0, route="/a")
+    registry.register_stats("cache", lambda: {"hits": 4, "enabled": True, "name": "x"})
+    text = registry.render()
+    assert 't_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 't_seconds_bucket{route="/a",le="1"} 2' in text
+    assert 't_seconds_bucket{route="/a",le="+Inf"} 3' in text
+    assert 't_seconds_count{route="/a"} 3' in text
+    assert "core_cache_hits 4" in text and "core_cache_enabled 1" in text
+    assert "core_cache_name" not in text
+
+
+def test_classify_upstream_targets(monkeypatch):
+    monkeypatch.setenv("SUPABASE_URL", "https://proj.supabase.co")
+    monkeypatch.setenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+    url = httpx.URL
+    assert classify_upstream(url("https://proj.supabase.co/rest/v1/rpc/debit_user_credits")) == ("supabase", "rpc/debit_user_credits")
+    assert classify_upstream(url("https://proj.supabase.co/rest/v1/profiles?id=eq.u1")) == ("supabase", "rest/profiles")
+    assert classify_upstream(url("https://openrouter.ai/api/v1/keys/abc123")) == ("openrouter", "keys")
+    assert classify_upstream(url("https://openrouter.ai/api/v1/chat/completions")) == ("openrouter", "chat/completions")
+    assert classify_upstream(url("https://flowise.internal/api/v1/prediction/flow-42")) == ("flowise", "flow-42")
+
+
+def test_instrumented_transport_records_upstream_latency():
+    async def _run() -> None:
+        transport = instrumented_transport("test_pool", upstream="flowise")
+        transport._inner = httpx.MockTransport(lambda request: httpx.Response(200, json={"ok": True}))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await client.post("http://flowise.test/api/v1/prediction/flow-metrics", json={})
+
+    asyncio.run(_run())
+    text = render_metrics()
+    assert 'core_upstream_request_duration_seconds_count{upstream="flowise",target="flow-metrics",status="200"} 1' in text
+    assert 'core_http_pool_inflight_requests{pool="test_pool"} 0' in text
+
+
+def test_metrics_endpoint_exposes_routes_and_stats(monkeypatch):
+    from app.main import app
+
+    monkeypatch.delenv("CORE_METRICS_TOKEN", raising=False)
+    client = TestClient(app)
+    assert client.get("/health").status_code == 200
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert 'core_http_request_duration_seconds_count{method="GET",route="/health",status="200"}' in resp.text
+    assert "core_flow_config_cache_" in resp.text
+
+    monkeypatch.setenv("CORE_METRICS_TOKEN", "scrape")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape"}).status_code == 200
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+"""
+Test cache snapshot pricing config (senza Supabase reale).
+"""
+
+import asyncio
+
+from app.services import pricing_service as ps
+
+
+def test_snapshot_cached_until_invalidated(monkeypatch):
+    monkeypatch.setenv("PRICING_CONFIG_CACHE_TTL", "60")
+    ps.invalidate_pricing_cache()
+    calls = {"n": 0}
+
+    async def fake_load(self, app_id=None):
+        calls["n"] += 1
+        return ps.PricingConfig(flow_costs_usd={"app": float(calls["n"])})
+
+    monkeypatch.setattr(ps.AdvancedPricingSystem, "_load_from_supabase_async", fake_load)
+    pricing = ps.AdvancedPricingSystem(config_file="unused.json")
+
+    async def _run():
+        first = await pricing.get_config_snapshot("app")
+        second = await pricing.get_config_snapshot("app")
+        assert first is second
+        assert calls["n"] == 1
+
+        ps.invalidate_pricing_cache()
+        third = await pricing.get_config_snapshot("app")
+        assert third.flow_costs_usd["app"] == 2.0
+
+    asyncio.run(_run())
+    ps.invalidate_pricing_cache()
+
+
+def test_stale_load_does_not_repopulate_after_invalidation():
+    ps.invalidate_pricing_cache()
+    cache = ps._pricing_cache
+    version = cache.version
+    ps.invalidate_pricing_cache()
+    # Caricamento iniziato prima dell'invalidazione: scartato
+    cache.put("app", ps.PricingConfig(), version)
+    assert cache.get("app") is None
+
+
+def test_concurrent_misses_share_one_load_without_mutating_config(monkeypatch):
+    monkeypatch.setenv("PRICING_CONFIG_CACHE_TTL", "60")
+    ps.invalidate_pricing_cache()
+    calls = {"n": 0}
+
+    async def fake_load(self, app_id=None):
+        calls["n"] += 1
+        await asyncio.sleep(0.01)
+        return ps.PricingConfig(flow_costs_usd={"app": 1.0})
+
+    monkeypatch.setattr(ps.AdvancedPricingSystem, "_load_from_supabase_async", fake_load)
+    pricing = ps.AdvancedPricingSystem(config_file="unused.json")
+    default_config = pricing.config
+
+    async def _run():
+        return await asyncio.gather(*(pricing.get_config_snapshot("app") for _ in range(5)))
+
+    snapshots = asyncio.run(_run())
+    assert calls["n"] == 1
+    assert all(s is snapshots[0] for s in snapshots)
+    assert pricing.config is default_config
+    ps.invalidate_pricing_cache()
@@ -3,13 +3,14 @@ from __future__ import annotations
 """
 Test minimal per rollout e osservabilità senza chiamate esterne reali.
 
-Si usano monkeypatch su httpx.AsyncClient per simulare Supabase REST.
+Si usano monkeypatch sul client httpx condiviso (app.services.supabase_rest)
+per simulare Supabase REST.
 """
 
 import types
 import json
 import asyncio
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import os
 os.environ.setdefault("CORE_APP_ID", "default")
@@ -36,7 +37,15 @@ class FakeAsyncClient:
     async def __aexit__(self, exc_type, exc, tb):
         return False
 
-    async def get(self, url: str, headers: Dict[str, str]):
+    async def request(self, method: str, url: str, **kwargs: Any):
+        if method == "GET":
+            return await self.get(url, **kwargs)
+        return await self.post(url, **kwargs)
+
+    async def aclose(self):
+        return None
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
         # pricing_configs
         if "/pricing_configs" in url and "select=config" in url:
             return _Resp(200, [{"config": {"rollout": {"credits_per_period": 1000, "rollout_percentage": 100, "max_credits_rollover": 2000}}}])
@@ -61,7 +70,7 @@ class FakeAsyncClient:
         # default
         return _Resp(200, [])
 
-    async def post(self, url: str, headers: Dict[str, str], json: Any):
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
         # credit rpc
         if url.endswith("/rpc/credit_user_credits"):
             return _Resp(200, {"success": True, "credits_after": 9999})
@@ -72,9 +81,10 @@ class FakeAsyncClient:
 
 
 def test_rollout_preview(monkeypatch):
-    # monkeypatch AsyncClient nel modulo credits_supabase
+    # monkeypatch del client condiviso usato da credits_supabase
     import app.services.credits_supabase as cs
-    monkeypatch.setattr(cs.httpx, "AsyncClient", FakeAsyncClient)
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setattr(get_supabase(), "_client", FakeAsyncClient())
 
     # Env richieste dal servizio
     os.environ.setdefault("SUPABASE_URL", "http://supabase.local")
@@ -93,9 +103,9 @@ def test_rollout_preview(monkeypatch):
 
 
 def test_observability_endpoints_exist(monkeypatch):
-    # monkeypatch AsyncClient nel modulo admin endpoints
-    import app.api.endpoints.admin as admin_ep
-    monkeypatch.setattr(admin_ep.httpx, "AsyncClient", FakeAsyncClient)
+    # monkeypatch del client condiviso usato dagli endpoint admin
+    from app.services.supabase_rest import get_supabase
+    monkeypatch.setattr(get_supabase(), "_client", FakeAsyncClient())
 
     # Configura admin key per bypass auth
     os.environ["CORE_ADMIN_KEY"] = "admkey"
@@ -111,3 +121,61 @@ def test_observability_endpoints_exist(monkeypatch):
     assert r2.status_code == 200
 
 
+
+
+class BulkRolloutClient(FakeAsyncClient):
+    """Simula run reale: RPC set-based e checkpoint su credits_rollout_runs."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.posts = []
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        self.posts.append(url)
+        if url.endswith("/rpc/rollout_credit_batch"):
+            credited = [{"user_id": i["user_id"], "amount": i["amount"]} for i in json["p_items"]]
+            return _Resp(200, {"success": True, "credited": credited})
+        if url.endswith("/credits_rollout_runs"):
+            return _Resp(201, [{"id": "run-1"}])
+        return await super().post(url, headers=headers, json=json, **kwargs)
+
+
+def test_rollout_run_uses_bulk_rpc(monkeypatch):
+    import app.services.credits_supabase as cs
+    from app.services.supabase_rest import get_supabase
+    fake = BulkRolloutClient()
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+
+    os.environ.setdefault("SUPABASE_URL", "http://supabase.local")
+    os.environ.setdefault("SUPABASE_SERVICE_KEY", "service_key_test")
+
+    progress = []
+    ledger = cs.SupabaseCreditsLedger()
+    result = asyncio.run(ledger.rollout_monthly_credits(app_id="default", dry_run=False, progress=progress.append))
+
+    assert result["users_successful"] == 2
+    assert result["total_credits_accredited"] == 2000
+    # Un'unica RPC per il blocco, nessun accredito per-utente
+    assert sum(1 for u in fake.posts if u.endswith("/rpc/rollout_credit_batch")) == 1
+    assert not any(u.endswith("/rpc/credit_user_credits") for u in fake.posts)
+    assert progress and progress[-1]["checkpoint_user_id"] == "00000000-0000-0000-0000-000000000002"
+
+
+def test_scheduler_detects_interrupted_run(monkeypatch):
+    from app.main import _has_interrupted_run
+    from app.services.supabase_rest import get_supabase
+
+    urls: List[str] = []
+
+    class _RunsClient(FakeAsyncClient):
+        async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+            urls.append(url)
+            if "/credits_rollout_runs" in url and "status=eq.running" in url:
+                return _Resp(200, [{"id": "run-1"}])
+            return await super().get(url, headers=headers, **kwargs)
+
+    monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service")
+    monkeypatch.setattr(get_supabase(), "_client", _RunsClient())
+    assert asyncio.run(_has_interrupted_run("default")) is True
+    assert "app_id=eq.default" in urls[0]
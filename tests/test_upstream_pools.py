@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+"""
+Test circuit breaker e bulkhead per upstream (transport finto, niente rete).
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.services import upstream_pools as up
+from app.services.metrics import render_metrics
+
+
+@pytest.fixture
+def breaker_env(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_BREAKER_FAILURES", "3")
+    monkeypatch.setenv("UPSTREAM_BREAKER_OPEN_SECONDS", "30")
+    monkeypatch.delenv("FLOWISE_BREAKER_FAILURES", raising=False)
+
+
+def _client(breaker: up.CircuitBreaker, handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=up.BreakerTransport(httpx.MockTransport(handler), breaker))
+
+
+def test_breaker_opens_fails_fast_and_recloses_after_probe(breaker_env, monkeypatch):
+    breaker = up.CircuitBreaker("flowise")
+    calls = {"n": 0, "status": 503}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls["n"] += 1
+        return httpx.Response(calls["status"])
+
+    async def _run() -> None:
+        async with _client(breaker, handler) as client:
+            for _ in range(3):
+                assert (await client.get("http://flowise.test/api/v1/prediction/f1")).status_code == 503
+            assert breaker.state == up.OPEN
+            with pytest.raises(up.UpstreamUnavailable):
+                await client.get("http://flowise.test/api/v1/prediction/f1")
+            assert calls["n"] == 3
+
+            # Cooldown scaduto: un probe half-open, successo → closed
+            breaker.opened_at -= 31
+            calls["status"] = 200
+            assert (await client.get("http://flowise.test/api/v1/prediction/f1")).status_code == 200
+            assert breaker.state == up.CLOSED and breaker.failures == 0
+
+    asyncio.run(_run())
+    assert 'core_upstream_breaker_state{upstream="flowise"} 0' in render_metrics()
+    assert 'core_upstream_breaker_rejected_total{upstream="flowise"}' in render_metrics()
+
+
+def test_failed_probe_reopens_and_limits_concurrent_probes(breaker_env):
+    breaker = up.CircuitBreaker("openrouter")
+    for _ in range(3):
+        breaker.record_failure(False)
+    assert breaker.state == up.OPEN
+    breaker.opened_at -= 31
+
+    assert breaker.before_request() is True
+    assert breaker.state == up.HALF_OPEN
+    # Un solo probe alla volta (UPSTREAM_BREAKER_HALF_OPEN_PROBES=1)
+    with pytest.raises(up.UpstreamUnavailable):
+        breaker.before_request()
+    breaker.record_failure(True)
+    assert breaker.state == up.OPEN
+    with pytest.raises(up.UpstreamUnavailable):
+        breaker.before_request()
+
+
+def test_transport_errors_count_but_pool_timeouts_do_not(breaker_env):
+    breaker = up.CircuitBreaker("lemonsqueezy")
+    errors = [httpx.PoolTimeout("pool"), httpx.ConnectError("down")]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise errors.pop(0)
+
+    async def _run() -> None:
+        async with _client(breaker, handler) as client:
+            with pytest.raises(httpx.PoolTimeout):
+                await client.get("http://ls.test/v1/checkouts")
+            assert breaker.failures == 0
+            with pytest.raises(httpx.ConnectError):
+                await client.get("http://ls.test/v1/checkouts")
+            assert breaker.failures == 1
+
+    asyncio.run(_run())
+
+
+def test_application_errors_do_not_open_breaker(breaker_env):
+    breaker = up.CircuitBreaker("flowise")
+    statuses = [500, 500, 500, 504, 504]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(statuses.pop(0))
+
+    async def _run() -> None:
+        async with _client(breaker, handler) as client:
+            # 500 di un flow rotto: upstream raggiungibile, il breaker resta chiuso
+            for _ in range(3):
+                await client.post("http://flowise.test/api/v1/prediction/broken")
+            assert breaker.state == up.CLOSED and breaker.failures == 0
+            for _ in range(2):
+                await client.post("http://flowise.test/api/v1/prediction/f1")
+            assert breaker.failures == 2
+
+    asyncio.run(_run())
+
+
+def test_upstreams_get_separate_pools(monkeypatch):
+    monkeypatch.setenv("FLOWISE_POOL_MAX_CONNECTIONS", "4")
+    pools = up.UpstreamPools()
+
+    async def _run() -> None:
+        flowise = pools.client("flowise")
+        openrouter = pools.client("openrouter")
+        assert flowise is not openrouter
+        assert pools.client("flowise") is flowise
+        await pools.aclose()
+        assert flowise.is_closed
+
+    asyncio.run(_run())
+    assert 'core_http_pool_max_connections{pool="flowise"} 4' in render_metrics()
+    assert pools.timeout("flowise", 600.0).pool == 10.0
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+"""
+Test snapshot profilo condiviso (una select per richiesta, invalidazione su addebito).
+"""
+
+import asyncio
+from typing import Any, Dict, Optional
+
+from tests.test_rollout_and_observability import FakeAsyncClient, _Resp
+
+
+class ProfileClient(FakeAsyncClient):
+    def __init__(self):
+        super().__init__()
+        self.profile_reads = 0
+        self.credits = 50.0
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+        if "/profiles" in url:
+            self.profile_reads += 1
+            await asyncio.sleep(0)
+            return _Resp(200, [{"credits": self.credits, "openrouter_api_key": "sk-or-user", "openrouter_key_name": "key-u1"}])
+        return await super().get(url, headers=headers, **kwargs)
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Any = None, **kwargs: Any):
+        if url.endswith("/rpc/debit_user_credits"):
+            self.credits -= json["p_amount"]
+            return _Resp(200, {"success": True})
+        return await super().post(url, headers=headers, json=json, **kwargs)
+
+
+def test_execute_stages_share_one_profile_read(monkeypatch):
+    import app.services.user_context as uc
+    from app.services.credits_supabase import SupabaseCreditsLedger
+    from app.services.openrouter_user_keys import OpenRouterUserKeysService
+    from app.services.supabase_rest import get_supabase
+
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service_key_test")
+    fake = ProfileClient()
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+    uc._cache.clear()
+    keys = OpenRouterUserKeysService()
+    ledger = SupabaseCreditsLedger()
+
+    async def _run():
+        api_key, key_name, balance = await asyncio.gather(
+            keys.get_user_api_key("ctx-user"),
+            keys.get_user_key_name("ctx-user"),
+            ledger.get_balance("ctx-user"),
+        )
+        assert (api_key, key_name, balance) == ("sk-or-user", "key-u1", 50.0)
+        assert await keys.get_user_api_key("ctx-user") == "sk-or-user"
+        assert fake.profile_reads == 1
+        # L'addebito invalida lo snapshot: il saldo successivo è aggiornato
+        await ledger.debit("ctx-user", 5.0, reason="test")
+        assert await ledger.get_balance("ctx-user") == 45.0
+        assert fake.profile_reads == 2
+        # Modifica da un altro worker: lo snapshot resta, la lettura fresh no
+        fake.credits = 10.0
+        assert await ledger.get_balance("ctx-user") == 45.0
+        assert await ledger.get_balance("ctx-user", fresh=True) == 10.0
+        assert fake.profile_reads == 3
+
+    asyncio.run(_run())
+    uc._cache.clear()
+
+
+def test_missing_profile_is_not_cached(monkeypatch):
+    import app.services.user_context as uc
+    from app.services.supabase_rest import get_supabase
+
+    class _LateProfile(ProfileClient):
+        def __init__(self):
+            super().__init__()
+            self.exists = False
+
+        async def get(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any):
+            if "/profiles" in url and not self.exists:
+                self.profile_reads += 1
+                return _Resp(200, [])
+            return await super().get(url, headers=headers, **kwargs)
+
+    monkeypatch.setenv("SUPABASE_URL", "http://supabase.local")
+    monkeypatch.setenv("SUPABASE_SERVICE_KEY", "service_key_test")
+    fake = _LateProfile()
+    monkeypatch.setattr(get_supabase(), "_client", fake)
+    uc._cache.clear()
+
+    async def _run():
+        assert await uc.get_user_context("new-user") is None
+        # Profilo creato da un altro worker: visibile alla lettura successiva
+        fake.exists = True
+        ctx = await uc.get_user_context("new-user")
+        assert ctx is not None and ctx.credits == 50.0
+
+    asyncio.run(_run())
+    uc._cache.clear()